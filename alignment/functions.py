@@ -1,11 +1,25 @@
 """
 A set of utility functions for alignment processing.
 """
+import pickle
 import re
+import zlib
 from collections import OrderedDict
+from django.db.models import Count
+from alignment.models import AlignedResidues, FamilyAlignmentStore, SiteSearchIndex
 from common import definitions
-from protein.models import Protein
+from protein.models import Protein, ProteinConformation, ProteinSegment
+from residue.models import Residue, ResidueGenericNumber
 
+import numpy as np
+
+
+# Site search index encoding: residues are stored as their index in AMINO_ACIDS (unknown residues get the code after
+# the last one) and site positions are matched with a bitmask of the allowed codes
+SITE_SEARCH_UNKNOWN = len(definitions.AMINO_ACIDS)
+SITE_SEARCH_CODES = np.full(256, SITE_SEARCH_UNKNOWN, dtype=np.uint8)
+SITE_SEARCH_CODES[[ord(aa) for aa in definitions.AMINO_ACIDS]] = np.arange(SITE_SEARCH_UNKNOWN)
+SITE_SEARCH_BITS = np.left_shift(np.uint32(1), np.arange(SITE_SEARCH_UNKNOWN + 1, dtype=np.uint32))
 
 def strip_html_tags(text):
     """
@@ -390,3 +404,345 @@ def prepare_aa_group_preference():
             for pref_feat in l_heap:
                 pref_dict[feat_row].extend(lengths[pref_feat])
     return pref_dict
+
+
+class StoredRelation(list):
+    """List stand-in for the related managers of a stored residue."""
+    def all(self):
+        return self
+
+
+class StoredResidue:
+    """Lightweight residue record rebuilt from the aligned residue store.
+
+    Exposes the attributes of residue.models.Residue that are used to build alignments.
+    """
+    __slots__ = ('protein_conformation', 'protein_segment', 'generic_number', 'display_generic_number',
+                 'alternative_generic_numbers', 'sequence_number', 'amino_acid')
+
+    def __init__(self, protein_conformation, protein_segment, sequence_number, amino_acid, generic_number=None,
+                 display_generic_number=None, alternative_generic_numbers=()):
+        self.protein_conformation = protein_conformation
+        self.protein_segment = protein_segment
+        self.sequence_number = sequence_number
+        self.amino_acid = amino_acid
+        self.generic_number = generic_number
+        self.display_generic_number = display_generic_number
+        self.alternative_generic_numbers = StoredRelation(alternative_generic_numbers)
+
+    def __str__(self):
+        return self.amino_acid + str(self.sequence_number)
+
+def build_aligned_residue_store(protein_conformation):
+    """
+    Store the residues of a protein conformation in the aligned residue store, one row per segment.
+
+    @param: protein_conformation - ProteinConformation to (re)build
+    """
+    residues = Residue.objects.filter(protein_conformation=protein_conformation).exclude(
+        protein_segment=None).order_by('sequence_number').values_list('id', 'protein_segment_id', 'sequence_number',
+        'amino_acid', 'generic_number_id', 'display_generic_number_id')
+
+    alternatives = {}
+    alternative_numbers = Residue.alternative_generic_numbers.through.objects.filter(
+        residue__protein_conformation=protein_conformation).values_list('residue_id', 'residuegenericnumber_id')
+    for residue_id, gn_id in alternative_numbers:
+        if residue_id not in alternatives:
+            alternatives[residue_id] = []
+        alternatives[residue_id].append(gn_id)
+
+    segments = OrderedDict()
+    for residue_id, segment_id, sequence_number, amino_acid, gn_id, display_gn_id in residues:
+        if segment_id not in segments:
+            segments[segment_id] = []
+        segments[segment_id].append((sequence_number, amino_acid, gn_id, display_gn_id,
+            tuple(alternatives.get(residue_id, ()))))
+
+    AlignedResidues.objects.filter(protein_conformation=protein_conformation).delete()
+    AlignedResidues.objects.bulk_create([AlignedResidues(protein_conformation=protein_conformation,
+        protein_segment_id=segment_id, residues=pickle.dumps(rows, pickle.HIGHEST_PROTOCOL))
+        for segment_id, rows in segments.items()])
+    return len(segments)
+
+def load_aligned_residues(protein_conformations, segment_slugs, alternative_numbers=False):
+    """
+    Rebuild the residues of the selected conformations and segments from the aligned residue store.
+
+    Returns a list of StoredResidue objects, or None when the store does not cover every selected conformation.
+
+    @param: protein_conformations - list of ProteinConformation objects
+    @param: segment_slugs - slugs of the segments to load
+    @param: alternative_numbers - also resolve alternative generic numbers
+    """
+    pconfs = {pc.id: pc for pc in protein_conformations}
+    if not pconfs:
+        return None
+
+    rows = AlignedResidues.objects.filter(protein_conformation_id__in=list(pconfs),
+        protein_segment__slug__in=segment_slugs).values_list('protein_conformation_id', 'protein_segment_id', 'residues')
+
+    stored = []
+    segment_ids = set()
+    gn_ids = set()
+    for pc_id, segment_id, residues in rows:
+        residues = pickle.loads(residues)
+        stored.append((pc_id, segment_id, residues))
+        segment_ids.add(segment_id)
+        for r in residues:
+            gn_ids.add(r[2])
+            gn_ids.add(r[3])
+            if alternative_numbers:
+                gn_ids.update(r[4])
+
+    # a conformation without any stored rows has not been added to the store (yet)
+    missing = set(pconfs) - set([s[0] for s in stored])
+    if missing and AlignedResidues.objects.filter(protein_conformation_id__in=list(missing)).values(
+            'protein_conformation_id').distinct().count() < len(missing):
+        return None
+
+    gn_ids.discard(None)
+    segments = ProteinSegment.objects.in_bulk(list(segment_ids))
+    gns = ResidueGenericNumber.objects.select_related('scheme').in_bulk(list(gn_ids))
+
+    rs = []
+    for pc_id, segment_id, residues in stored:
+        pc = pconfs[pc_id]
+        segment = segments[segment_id]
+        for sequence_number, amino_acid, gn_id, display_gn_id, alternative_ids in residues:
+            alternatives = [gns[i] for i in alternative_ids] if alternative_numbers else ()
+            rs.append(StoredResidue(pc, segment, sequence_number, amino_acid, gns.get(gn_id), gns.get(display_gn_id),
+                alternatives))
+    return rs
+
+def build_site_search_position(generic_number):
+    """
+    Store the residues of all wild-type protein conformations at a generic number in the site search index.
+
+    @param: generic_number - ResidueGenericNumber (default numbering scheme) to (re)build
+    """
+    residues = Residue.objects.filter(generic_number=generic_number,
+        protein_conformation__protein__sequence_type__slug='wt').order_by('protein_conformation_id').values_list(
+        'protein_conformation_id', 'amino_acid')
+
+    pconf_ids = np.array([r[0] for r in residues], dtype=np.int32)
+    amino_acids = SITE_SEARCH_CODES[np.frombuffer(''.join([r[1] for r in residues]).encode('ascii', 'replace'),
+        dtype=np.uint8)]
+    SiteSearchIndex.objects.update_or_create(generic_number=generic_number, defaults={
+        'protein_conformations': pconf_ids.tobytes(), 'amino_acids': amino_acids.tobytes()})
+    return len(pconf_ids)
+
+def site_search_mask(amino_acids):
+    """Bitmask of the site search codes of a list of amino acids."""
+    codes = SITE_SEARCH_CODES[np.frombuffer(''.join(amino_acids).encode('ascii', 'replace'), dtype=np.uint8)]
+    return np.bitwise_or.reduce(SITE_SEARCH_BITS[codes]) & ~SITE_SEARCH_BITS[SITE_SEARCH_UNKNOWN]
+
+def match_site_definitions(site_defs, protein_conformations):
+    """
+    Find the protein conformations matching all site definitions using the site search index.
+
+    Each site definition (residue group) is a dict with the minimum number of matching positions (min_match) and the
+    allowed amino acids of each position as a dict by generic number id (amino_acids). Returns the ids of the matching
+    conformations, or None when the index does not cover the conformations (not wild-type, or residues of a
+    conformation at the selected positions missing from the index).
+
+    @param: site_defs - site definitions by group id
+    @param: protein_conformations - list of ProteinConformation objects
+    """
+    pconf_ids = np.array(sorted(set([pc.id for pc in protein_conformations])), dtype=np.int32)
+    if ProteinConformation.objects.filter(id__in=pconf_ids.tolist()).exclude(
+            protein__sequence_type__slug='wt').exists():
+        return None
+
+    gn_ids = set([gn_id for site_def in site_defs.values() for gn_id in site_def['amino_acids']])
+    positions = {}
+    indexed = np.zeros(len(pconf_ids), dtype=np.int32)
+    for gn_id, pcs, amino_acids in SiteSearchIndex.objects.filter(generic_number_id__in=gn_ids).values_list(
+            'generic_number_id', 'protein_conformations', 'amino_acids'):
+        pcs = np.frombuffer(pcs, dtype=np.int32)
+        # only keep the selected conformations, as positions in pconf_ids
+        selected = np.isin(pcs, pconf_ids)
+        rows = np.searchsorted(pconf_ids, pcs[selected])
+        positions[gn_id] = (rows, SITE_SEARCH_BITS[np.frombuffer(amino_acids, dtype=np.uint8)[selected]])
+        indexed[rows] += 1
+
+    # every residue of the selected conformations at the selected positions has to be in the index, otherwise the
+    # index is missing (or outdated for) some of the conformations
+    residues = np.zeros(len(pconf_ids), dtype=np.int32)
+    for pconf_id, count in Residue.objects.filter(protein_conformation_id__in=pconf_ids.tolist(),
+            generic_number_id__in=gn_ids).values('protein_conformation_id').annotate(
+            count=Count('id')).values_list('protein_conformation_id', 'count'):
+        residues[np.searchsorted(pconf_ids, pconf_id)] = count
+    if not np.array_equal(indexed, residues):
+        return None
+
+    # count the matching positions of every conformation per group, conformations without a residue at a position
+    # (gaps in the alignment) only match it when the position allows gaps
+    matching = np.ones(len(pconf_ids), dtype=bool)
+    for site_def in site_defs.values():
+        num_matched = np.zeros(len(pconf_ids), dtype=np.int32)
+        for gn_id, amino_acids in site_def['amino_acids'].items():
+            rows, bits = positions.get(gn_id, (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.uint32)))
+            num_matched[rows[(bits & site_search_mask(amino_acids)) != 0]] += 1
+            if '-' in amino_acids:
+                gaps = np.ones(len(pconf_ids), dtype=bool)
+                gaps[rows] = False
+                num_matched[gaps] += 1
+        matching &= num_matched >= site_def['min_match']
+    return set(pconf_ids[matching].tolist())
+
+def calculate_family_alignment(slug, latin_name=None, include_trembl=False):
+    """
+    Calculate the full alignment of a protein family, including its consensus sequence and amino acid and feature
+    statistics, in the format of the family alignment store.
+
+    Returns the alignment (see family_alignment_to_dict), or None when the family has no matching proteins.
+
+    @param: slug - protein family slug (prefix)
+    @param: latin_name - only align proteins of this species (Swiss-Prot and TrEMBL)
+    @param: include_trembl - also align TrEMBL proteins
+    """
+    # common.alignment imports this module
+    from common.alignment import Alignment
+
+    include_trembl = include_trembl and latin_name is None
+    ps = Protein.objects.filter(sequence_type__slug='wt', family__slug__startswith=slug)
+    if latin_name is not None:
+        ps = ps.filter(species__latin_name=latin_name)
+    elif not include_trembl:
+        ps = ps.filter(source__id=1)
+    first_protein = ps.select_related('family').first()
+    if first_protein is None:
+        return None
+
+    protein_family = first_protein.family.slug[:3]
+    ss = ProteinSegment.objects.filter(partial=False)
+    if int(protein_family) < 100:
+        ss = [ s for s in ss if s.proteinfamily == 'GPCR']
+    elif protein_family == "100":
+        ss = [ s for s in ss if s.proteinfamily == 'Gprotein']
+    elif protein_family == "200":
+        ss = [ s for s in ss if s.proteinfamily == 'Arrestin']
+
+    a = Alignment()
+    a.show_padding = False
+    a.load_proteins(ps)
+    a.load_segments(ss)
+    a.build_alignment()
+    a.calculate_statistics()
+
+    # one column per alignment position, rows and statistics are stored as uint8 matrices over these columns
+    columns = [(segment, pos) for segment, positions in a.segments.items() for pos in positions]
+    column_index = {c: i for i, c in enumerate(columns)}
+
+    sequences = np.full((len(a.proteins), len(columns)), ord('-'), dtype=np.uint8)
+    for i, pc in enumerate(a.proteins):
+        for segment, s in pc.alignment.items():
+            for r in s:
+                sequences[i, column_index[(segment, r[0])]] = ord(r[2].replace('_', '-'))
+
+    consensus = np.zeros(len(columns), dtype=np.uint8)
+    for r in a.full_consensus:
+        consensus[column_index[(r.segment_slug, r.family_generic_number)]] = ord(r.amino_acid)
+
+    feature_stats = np.zeros((len(definitions.AMINO_ACID_GROUPS), len(columns)), dtype=np.uint8)
+    amino_acid_stats = np.zeros((len(definitions.AMINO_ACIDS), len(columns)), dtype=np.uint8)
+    for j, segment in enumerate(a.aa_count):
+        for k, gn in enumerate(a.generic_numbers[a.numbering_schemes[0][0]][segment]):
+            c = column_index[(segment, gn)]
+            for i in range(len(feature_stats)):
+                feature_stats[i, c] = int(a.feature_stats[i][j][k][0])
+            for i in range(len(amino_acid_stats)):
+                if a.amino_acid_stats[i][j][k]:
+                    amino_acid_stats[i, c] = int(a.amino_acid_stats[i][j][k][0])
+
+    stored = {
+        'numbering_scheme': first_protein.residue_numbering_scheme_id,
+        'entry_names': [pc.protein.entry_name for pc in a.proteins],
+        'columns': columns,
+        'sequences': sequences,
+        'consensus': consensus,
+        'feature_stats': feature_stats,
+        'amino_acid_stats': amino_acid_stats,
+    }
+    return stored
+
+def build_family_alignment_store(slug, latin_name=None, include_trembl=False):
+    """
+    Calculate the full alignment of a protein family and store it in the family alignment store.
+
+    Returns the stored alignment (see family_alignment_to_dict), or None when the family has no matching proteins.
+
+    @param: slug - protein family slug (prefix)
+    @param: latin_name - only align proteins of this species (Swiss-Prot and TrEMBL)
+    @param: include_trembl - also align TrEMBL proteins
+    """
+    include_trembl = include_trembl and latin_name is None
+    stored = calculate_family_alignment(slug, latin_name, include_trembl)
+    if stored is not None:
+        FamilyAlignmentStore.objects.update_or_create(slug=slug, species=latin_name or '', include_trembl=include_trembl,
+            defaults={'alignment': zlib.compress(pickle.dumps(stored, pickle.HIGHEST_PROTOCOL))})
+    return stored
+
+def load_family_alignment(slug, latin_name=None, include_trembl=False):
+    """
+    Fetch a family alignment from the family alignment store. Alignments that have not been stored (yet) are
+    calculated, but not stored, build_family_alignments builds the store.
+
+    @param: slug - protein family slug (prefix)
+    @param: latin_name - only align proteins of this species (Swiss-Prot and TrEMBL)
+    @param: include_trembl - also align TrEMBL proteins
+    """
+    include_trembl = include_trembl and latin_name is None
+    try:
+        stored = FamilyAlignmentStore.objects.get(slug=slug, species=latin_name or '', include_trembl=include_trembl)
+        return pickle.loads(zlib.decompress(stored.alignment))
+    except FamilyAlignmentStore.DoesNotExist:
+        return calculate_family_alignment(slug, latin_name, include_trembl)
+
+def family_alignment_to_dict(stored, segment_slugs=None, generic_numbers=None, statistics=False):
+    """
+    Cut the selected segments and positions out of a stored family alignment.
+
+    Returns an OrderedDict of aligned sequences by entry name, followed by the consensus sequence and optionally the
+    amino acid and feature frequencies, laid out as an alignment of only these segments and positions.
+
+    @param: stored - stored family alignment (see load_family_alignment)
+    @param: segment_slugs - segments to include, all segments when None
+    @param: generic_numbers - labels (default numbering scheme) of individual positions, put first in a custom segment
+    @param: statistics - include amino acid and feature frequencies
+    """
+    columns = stored['columns']
+
+    segments = OrderedDict()
+    if generic_numbers:
+        label_columns = {}
+        for c, (segment, pos) in enumerate(columns):
+            label_columns.setdefault(pos, c)
+        segments['Custom'] = sorted(set([label_columns[gn] for gn in generic_numbers if gn in label_columns]),
+            key=lambda c: columns[c][1].split('x'))
+    for c, (segment, pos) in enumerate(columns):
+        if segment_slugs is None or segment in segment_slugs:
+            segments.setdefault(segment, []).append(c)
+
+    selected = np.array([c for s in segments.values() for c in s], dtype=np.intp)
+    # the consensus sequence is ordered by position label within each segment
+    consensus_order = np.array([c for s in segments.values() for c in sorted(s, key=lambda c: columns[c][1])],
+        dtype=np.intp)
+
+    ali_dict = OrderedDict()
+    if len(selected):
+        for entry_name, row in zip(stored['entry_names'], stored['sequences'][:, selected]):
+            ali_dict[entry_name] = row.tobytes().decode('ascii')
+
+    consensus = stored['consensus'][consensus_order]
+    ali_dict['CONSENSUS'] = consensus[consensus > 0].tobytes().decode('ascii')
+
+    if statistics:
+        feat = {}
+        for i, feature in enumerate(definitions.AMINO_ACID_GROUPS):
+            feat[feature] = [str(v) for v in stored['feature_stats'][i, selected].tolist()]
+        for i, amino_acid in enumerate(definitions.AMINO_ACIDS):
+            feat[amino_acid] = [str(v) for v in stored['amino_acid_stats'][i, selected].tolist()]
+        ali_dict['statistics'] = feat
+
+    return ali_dict
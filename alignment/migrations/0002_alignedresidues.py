@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('protein', '0015_proteincouplings_physiological_ligand'),
+        ('alignment', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlignedResidues',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('residues', models.BinaryField()),
+                ('protein_conformation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.ProteinConformation')),
+                ('protein_segment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.ProteinSegment')),
+            ],
+            options={
+                'db_table': 'aligned_residues',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='alignedresidues',
+            unique_together={('protein_conformation', 'protein_segment')},
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alignment', '0002_alignedresidues'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FamilyAlignmentStore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.CharField(max_length=100)),
+                ('species', models.CharField(blank=True, max_length=100)),
+                ('include_trembl', models.BooleanField(default=False)),
+                ('alignment', models.BinaryField()),
+            ],
+            options={
+                'db_table': 'family_alignment_store',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='familyalignmentstore',
+            unique_together={('slug', 'species', 'include_trembl')},
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('residue', '0002_auto_20180504_1417'),
+        ('alignment', '0003_familyalignmentstore'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteSearchIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('protein_conformations', models.BinaryField()),
+                ('amino_acids', models.BinaryField()),
+                ('generic_number', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='residue.ResidueGenericNumber')),
+            ],
+            options={
+                'db_table': 'site_search_index',
+            },
+        ),
+    ]
@@ -5,4 +5,39 @@ from django.db import models
 class AlignmentConsensus(models.Model):
     slug = models.SlugField(max_length=100, unique=True)
     alignment = models.BinaryField()
-    gn_consensus = models.BinaryField(blank=True) # Store conservation calculation for each GN
\ No newline at end of file
+    gn_consensus = models.BinaryField(blank=True) # Store conservation calculation for each GN
+
+
+class AlignedResidues(models.Model):
+    protein_conformation = models.ForeignKey('protein.ProteinConformation', on_delete=models.CASCADE)
+    protein_segment = models.ForeignKey('protein.ProteinSegment', on_delete=models.CASCADE)
+    # pickled list of (sequence_number, amino_acid, generic_number_id, display_generic_number_id,
+    # alternative_generic_number_ids) tuples, ordered by sequence number
+    residues = models.BinaryField()
+
+    class Meta():
+        db_table = 'aligned_residues'
+        unique_together = ('protein_conformation', 'protein_segment')
+
+
+class FamilyAlignmentStore(models.Model):
+    slug = models.CharField(max_length=100)
+    species = models.CharField(max_length=100, blank=True) # latin name, empty for all species
+    include_trembl = models.BooleanField(default=False)
+    # pickled dict of the full family alignment, consensus and statistics, see build_family_alignment_store
+    alignment = models.BinaryField()
+
+    class Meta():
+        db_table = 'family_alignment_store'
+        unique_together = ('slug', 'species', 'include_trembl')
+
+
+class SiteSearchIndex(models.Model):
+    generic_number = models.OneToOneField('residue.ResidueGenericNumber', on_delete=models.CASCADE)
+    # packed int32 ids of the wild-type protein conformations with a residue at this generic number and the packed
+    # uint8 amino acid codes of these residues, see build_site_search_position
+    protein_conformations = models.BinaryField()
+    amino_acids = models.BinaryField()
+
+    class Meta():
+        db_table = 'site_search_index'
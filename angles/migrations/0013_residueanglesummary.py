@@ -0,0 +1,32 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('protein', '0015_proteincouplings_physiological_ligand'),
+        ('angles', '0012_residueangle_rotation_angle'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResidueAngleSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('structures', models.BinaryField()),
+                ('source_hash', models.CharField(max_length=40)),
+                ('generic_numbers', models.TextField()),
+                ('statistics', models.BinaryField()),
+                ('receptor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.Protein')),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.ProteinState')),
+            ],
+            options={
+                'db_table': 'residue_angle_summary',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='residueanglesummary',
+            unique_together={('receptor', 'state')},
+        ),
+    ]
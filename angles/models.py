@@ -2,8 +2,7 @@ from django.db import models
 from django.db.models import Avg
 import math, cmath
 from django.contrib.postgres.aggregates import ArrayAgg
-from structure.models import Structure
-import time
+from structure.models import Structure, get_group_summaries
 from scipy.stats import circmean, circstd
 import numpy as np
 import re
@@ -40,8 +39,90 @@ class ResidueAngle(models.Model):
         db_table = 'residue_angles'
         unique_together = ("residue", "structure")
 
+# Mergeable statistics of every summary column per generic number, the circular sums are used for the angles
+SUMMARY_COLUMNS = ['a_angle', 'b_angle', 'outer_angle', 'hse', 'sasa', 'rsa', 'phi', 'psi', 'theta', 'tau', 'core_distance']
+SUMMARY_CIRCULAR_COLUMNS = ['a_angle', 'b_angle', 'outer_angle', 'phi', 'psi', 'theta', 'tau']
+SUMMARY_STATISTICS = ['count', 'sum', 'sum_squares', 'sin_sum', 'cos_sum', 'min', 'max']
+
+class ResidueAngleSummary(models.Model):
+    # summary of the angles of the structures of a receptor in a state (see structure.models.get_structure_groups)
+    receptor            = models.ForeignKey('protein.Protein', on_delete=models.CASCADE)
+    state               = models.ForeignKey('protein.ProteinState', on_delete=models.CASCADE)
+    # packed int32 structure ids and a hash of the angle data they were computed from
+    structures          = models.BinaryField()
+    source_hash         = models.CharField(max_length=40)
+    # comma-separated GN labels and the packed float64 (GNs x SUMMARY_COLUMNS x SUMMARY_STATISTICS) statistics
+    generic_numbers     = models.TextField()
+    statistics          = models.BinaryField()
+
+    def get_structures(self):
+        return np.frombuffer(self.structures, dtype=np.int32).tolist()
+
+    def get_statistics(self):
+        return np.frombuffer(self.statistics, dtype=np.float64).reshape(-1, len(SUMMARY_COLUMNS), len(SUMMARY_STATISTICS))
+
+    class Meta():
+        db_table = 'residue_angle_summary'
+        unique_together = ("receptor", "state")
+
+ANGLE_COLUMNS = ['core_distance', 'a_angle', 'outer_angle', 'tau', 'phi', 'psi', 'sasa', 'rsa', 'theta', 'hse', 'tau_angle', 'rotation_angle']
+CIRCULAR_COLUMNS = ['a_angle', 'outer_angle', 'phi', 'psi', 'theta', 'tau', 'tau_angle', 'rotation_angle']
+
+def strip_generic_labels(labels):
+    # Reduce the display generic numbers (1.50x50) to the GPCRdb numbers (1x50), once per distinct label
+    stripped = {label: re.sub(r'\.[\d]+', '', label) for label in set(labels)}
+    return [stripped[label] for label in labels]
+
+def load_angle_values(pdbs, fields, columns):
+    # Lists of the field values of the angles of the structures and an array of the column values, NaN if missing
+    ds = list(ResidueAngle.objects.filter(structure__pdb_code__index__in=pdbs) \
+                        .exclude(residue__generic_number=None) \
+                        .values_list(*fields, *columns))
+    if not ds:
+        return [[] for f in fields], np.zeros((0, len(columns)))
+    field_values = [list(c) for c in list(zip(*ds))[:len(fields)]]
+    values = np.array([d[len(fields):] for d in ds], dtype=float)
+    return field_values, values
+
+def factorize(keys):
+    # Unique keys and the index of every key in them
+    unique_keys, index = np.unique(np.array(keys, dtype=object).astype(str), return_inverse=True)
+    return unique_keys.tolist(), index.reshape(-1)
+
+def round_values(values):
+    # Python rounding of the values, np.round can differ in the last digit
+    return np.array([round(v, 2) for v in values.flatten().tolist()]).reshape(values.shape)
+
+def group_sums(group_index, num_groups, values):
+    return np.column_stack([np.bincount(group_index, weights=values[:, i], minlength=num_groups) for i in range(values.shape[1])]).reshape(num_groups, values.shape[1])
+
+def group_angle_statistics(group_index, num_groups, values, circular, standard_deviation = False):
+    """Number of values and mean (or SD) of every column per group, NaN values are skipped.
+
+    Circular columns of groups with more than one value get the circular mean or SD in degrees (as radial_average and
+    radial_stddev), the other columns the arithmetic mean or sample SD.
+    """
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0)
+    counts = group_sums(group_index, num_groups, valid)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats = group_sums(group_index, num_groups, filled) / counts
+        if standard_deviation:
+            deviations = np.where(valid, values - stats[group_index], 0)
+            stats = np.sqrt(group_sums(group_index, num_groups, deviations ** 2) / (counts - 1))
+
+        radians = np.radians(filled[:, circular])
+        sin_sums = group_sums(group_index, num_groups, np.where(valid[:, circular], np.sin(radians), 0))
+        cos_sums = group_sums(group_index, num_groups, np.where(valid[:, circular], np.cos(radians), 0))
+        if standard_deviation:
+            lengths = np.minimum(1, np.hypot(sin_sums, cos_sums) / counts[:, circular])
+            circular_stats = np.degrees(np.sqrt(-2 * np.log(lengths)))
+        else:
+            circular_stats = np.degrees(np.arctan2(sin_sums, cos_sums))
+    stats[:, circular] = np.where(counts[:, circular] > 1, circular_stats, stats[:, circular])
+    return counts, stats
+
 def get_angle_averages(pdbs,s_lookup,normalized = False, standard_deviation = False, split_by_amino_acid = False, forced_class_a = False):
-    start_time = time.time()
     pdbs_upper = [pdb.upper() for pdb in pdbs]
     if forced_class_a:
         generic_label = 'residue__generic_number__label'
@@ -53,122 +134,48 @@ def get_angle_averages(pdbs,s_lookup,normalized = False, standard_deviation = Fa
                 ).values_list('protein_conformation__protein__parent__family__parent__parent__parent__slug', flat=True).distinct()
     if len(gpcr_class)>1:
         print('ERROR mix of classes!', gpcr_class)
-    else:
-        gpcr_class = gpcr_class[0]
 
     if len(pdbs)==1:
         # Never get SD when only looking at a single pdb...
         standard_deviation = False
 
-    if not s_lookup:
-        # Get the list of unique protein_families among pdbs
-        structures = Structure.objects.filter(pdb_code__index__in=pdbs_upper
-             ).select_related('protein_conformation__protein'
-             ).values('pk','pdb_code__index',
-                    'protein_conformation__protein__parent__entry_name',
-                    'protein_conformation__protein__parent__name',
-                    'protein_conformation__protein__entry_name')
-        pfs = set()
+    if normalized and not s_lookup:
+        # Get the "receptor" level of the structures to group these regardless of species
         s_lookup = {}
-        for s in structures:
-            protein, pdb_name,pf  = [s['protein_conformation__protein__parent__entry_name'],s['protein_conformation__protein__entry_name'],s['protein_conformation__protein__parent__name']]
-            s_lookup[s['pk']] = [protein, pdb_name,pf]
-            pfs |= {pf}
-    group_angles = {}
-
-    ds = ResidueAngle.objects.filter(structure__pdb_code__index__in=pdbs_upper) \
-                        .exclude(residue__generic_number=None) \
-                        .values_list(generic_label,'structure__pk','residue__amino_acid','core_distance','a_angle','outer_angle','tau','phi','psi', 'sasa', 'rsa','theta','hse', 'tau_angle', 'rotation_angle') \
-                        .order_by(generic_label,'residue__amino_acid')
-                        #'core_distance','a_angle','outer_angle','tau','phi','psi', 'sasa', 'rsa','theta','hse'
-    custom_angles = ['a_angle', 'outer_angle', 'phi', 'psi', 'theta', 'tau','tau_angle','rotation_angle']
-    index_names = {0:'core_distance',1:'a_angle',2:'outer_angle',3:'tau',4:'phi',5:'psi',6: 'sasa',7: 'rsa',8:'theta',9:'hse', 10:'tau_angle',11:'rotation_angle'}
-    # First bin all those belonging to same receptor
-    matrix = {}
-    matrix_normalized = {}
-    prev_key = ''
-    for d in ds:
-        d = list(d)
-        if not forced_class_a:
-            d[0] = re.sub(r'\.[\d]+', '', d[0])
-        gn = d[0]
-        aa = d[2]
+        for s in Structure.objects.filter(pdb_code__index__in=pdbs_upper).values_list('pk', 'protein_conformation__protein__parent__entry_name',
+                    'protein_conformation__protein__entry_name', 'protein_conformation__protein__parent__name'):
+            s_lookup[s[0]] = list(s[1:])
 
-        if split_by_amino_acid:
-            key = "{},{}".format(gn,aa)
-        else:
-            key = gn
-
-        vals = d[3:]
-
-        if normalized:
-            pf = s_lookup[d[1]][2] # get the "receptor" level of the structure to group these regardless of species
-            if key != prev_key:
-                matrix_normalized[key] = {}
-                matrix[key] = []
-                prev_key = key
-            if pf not in matrix_normalized[key]:
-                matrix_normalized[key][pf] = []
-            matrix_normalized[key][pf].append(vals)
-        else:
-            if key != prev_key:
-                matrix[key] = []
-                prev_key = key
-            matrix[key].append(vals)
+    (labels, structure_ids, amino_acids), values = load_angle_values(pdbs_upper, [generic_label, 'structure__pk', 'residue__amino_acid'], ANGLE_COLUMNS)
+    if not forced_class_a:
+        labels = strip_generic_labels(labels)
+    if split_by_amino_acid:
+        keys = ["{},{}".format(gn,aa) for gn, aa in zip(labels, amino_acids)]
+    else:
+        keys = labels
+    circular = np.array([c in CIRCULAR_COLUMNS for c in ANGLE_COLUMNS])
 
-    # Calculate the average of averages
+    # First average the structures of the same receptor
     if normalized:
-        for key,pfs in matrix_normalized.items():
-            means = []
-            for pf,dists in pfs.items():
-                if len(dists)==1:
-                    means.append(dists[0])
-                else:
-                    grouped = list(zip(*dists))
-                    mean_dists = []
-                    for i,L in enumerate(grouped):
-                        l = list(filter(None.__ne__, list(L)))
-                        if len(l)>1:
-                            if index_names[i] in custom_angles:
-                                mean_dists.append(radial_average(l))
-                            else:
-                                mean_dists.append(round(sum(l)/len(l),2))
-                        elif len(l)==1:
-                            mean_dists.append(round(l[0],2))
-                        else:
-                            mean_dists.append(None)
-                    means.append(mean_dists)
-            matrix[key] = means
-
-    for key,vals in matrix.items():
-        grouped = list(zip(*vals))
-        group_angles[key] = []
-        for i,L in enumerate(grouped):
-            #remove none
-            l = list(filter(None, list(L)))
-            if standard_deviation:
-                if len(l)>1:
-                    if index_names[i] in custom_angles:
-                        group_angles[key].append(radial_stddev(l))
-                        # print(key,index_names[i],l,radial_stddev(l),radial_average(l))
-                    else:
-                        group_angles[key].append(round(np.std(l, ddof=1),2))
-                elif len(l)==1:
-                    group_angles[key].append(0)
-                else:
-                    group_angles[key].append('')
-            else:
-                if len(l)>1:
-                    if index_names[i] in custom_angles:
-                        group_angles[key].append(radial_average(l))
-                    else:
-                        group_angles[key].append(round(sum(l)/len(l),2))
-                elif len(l)==1:
-                    group_angles[key].append(round(l[0],2))
-                else:
-                    group_angles[key].append('')
+        receptor_keys, receptor_index = factorize(["{}|{}".format(key, s_lookup[s][2]) for key, s in zip(keys, structure_ids)])
+        rows = np.bincount(receptor_index, minlength=len(receptor_keys))
+        counts, means = group_angle_statistics(receptor_index, len(receptor_keys), values, circular)
+        # the means of receptors with several structures are rounded, except for circular means
+        rounded = (rows > 1)[:, None] & ~(circular[None, :] & (counts > 1))
+        values = np.where(rounded, round_values(means), means)
+        keys = [key.rsplit('|', 1)[0] for key in receptor_keys]
+
+    # Zero values are skipped as missing
+    values = np.where(values == 0, np.nan, values)
+    group_keys, group_index = factorize(keys)
+    counts, stats = group_angle_statistics(group_index, len(group_keys), values, circular, standard_deviation)
+    stats = np.where(circular[None, :] & (counts > 1), stats, round_values(stats))
+    if standard_deviation:
+        stats[counts == 1] = 0
+    stats = stats.astype(object)
+    stats[counts == 0] = ''
 
-    return group_angles
+    return dict(zip(group_keys, stats.tolist()))
 
 def radial_average(L):
     # r = round(math.degrees(cmath.phase(sum(cmath.rect(1, math.radians(float(d))) for d in L)/len(L))),2)
@@ -179,91 +186,122 @@ def radial_stddev(L):
     scipy = circstd(L, 360,0)
     return scipy
 
+def most_common_dssp(L):
+    most_freq_dssp = Counter(L).most_common()
+    # Make a list with the most occuring possibilties
+    possible = [dssp for dssp, count in most_freq_dssp if count == most_freq_dssp[0][1]]
+    # If only one, use that..
+    if len(possible)==1:
+        return possible[0]
+    elif 'H' in possible: #If H is in the possibile, use H
+        return 'H'
+    # Remove - if it's not the only option, then pick the first element.
+    if '-' in possible:
+        possible.remove('-')
+    return possible[0]
+
 def get_all_angles(pdbs,pfs,normalized,forced_class_a = False):
     pdbs_upper = [pdb.upper() for pdb in pdbs]
-    custom_angles = ['a_angle', 'outer_angle', 'phi', 'psi', 'theta', 'tau','tau_angle', 'rotation_angle']
-    index_names = {0:'core_distance',1:'a_angle',2:'outer_angle',3:'tau',4:'phi',5:'psi',6: 'sasa',7: 'rsa',8:'theta',9:'hse', 10:'ss_dssp', 11:'tau_angle', 12:'rotation_angle'}
     all_angles = {}
     if forced_class_a:
         generic_label = 'residue__generic_number__label'
     else:
         generic_label = 'residue__display_generic_number__label'
-    print("new test",forced_class_a,generic_label)
+    columns = ANGLE_COLUMNS[:10] + ['ss_dssp'] + ANGLE_COLUMNS[10:]
+    numeric = [c for c in columns if c != 'ss_dssp']
+    dssp_position = columns.index('ss_dssp')
     if normalized:
-        ds = list(ResidueAngle.objects.filter(structure__pdb_code__index__in=pdbs_upper) \
-            .exclude(residue__generic_number=None) \
-            .values_list(generic_label,'structure__protein_conformation__protein__parent__family__slug','core_distance','a_angle','outer_angle','tau','phi','psi', 'sasa', 'rsa','theta','hse','ss_dssp','tau_angle', 'rotation_angle'))
-        for d in ds:
-            d = list(d)
-            if not forced_class_a:
-                d[0] = re.sub(r'\.[\d]+', '', d[0])
-            if d[0] not in all_angles:
-                all_angles[d[0]] = {}
-                for pf in pfs:
-                    all_angles[d[0]][pf] = []
-            all_angles[d[0]][d[1]].append(d)
-
-        for gn, pfs in all_angles.items():
-            for pf,Ls in pfs.items():
-                if Ls and len(Ls)>0:
-                    if len(Ls)==1:
-                        new_pf = Ls[0]
-                    else:
-                        grouped = list(zip(*Ls))
-                        new_pf = [Ls[0][0],Ls[0][1]]
-                        for i,L in enumerate(grouped[2:]):
-                            l = [x for x in L if x is not None]
-                            # If after filtering there is just one, then use that number.
-                            if len(l)==1:
-                                new_pf.append(l[0])
-                                continue
-                            # if nothing is left, then put in nothing..
-                            elif len(l)==0:
-                                new_pf.append(0)
-                                continue
-
-                            # if there is something and it's an angle type, take the mean of the values in circular space
-                            if index_names[i] in custom_angles:
-                                new_pf.append(radial_average(l))
-                            # if it's the categorical then use the following code
-                            elif i==10:
-                                most_freq_dssp = Counter(l).most_common()
-                                # if there are several possibitlies
-                                if len(most_freq_dssp)>1:
-                                    test = 0
-                                    # Make a list with the most occuring possibilties
-                                    possible = []
-                                    for dssp in most_freq_dssp:
-                                        if dssp[1]>=test:
-                                            possible.append(dssp[0])
-                                            test = dssp[1]
-                                    # If only one, use that..
-                                    if len(possible)==1:
-                                        new_pf.append(possible[0])
-                                    elif 'H' in possible: #If H is in the possibile, use H
-                                        new_pf.append('H')
-                                    else:
-                                        # Remove - if it's not the only option, then pick the first element.
-                                        if '-' in possible:
-                                            possible.remove('-')
-                                        new_pf.append(possible[0])
-                                else:
-                                    new_pf.append(most_freq_dssp[0][0])
-                            else:
-                                new_pf.append(round(sum(l)/len(l),2))
-                    all_angles[gn][pf]=new_pf
+        (labels, families, dssps), values = load_angle_values(pdbs_upper, [generic_label, 'structure__protein_conformation__protein__parent__family__slug', 'ss_dssp'], numeric)
+        if not forced_class_a:
+            labels = strip_generic_labels(labels)
+        for gn in set(labels):
+            all_angles[gn] = {pf: [] for pf in pfs}
+        if labels:
+            group_keys, group_index = factorize(["{}|{}".format(gn, pf) for gn, pf in zip(labels, families)])
+            rows = np.bincount(group_index, minlength=len(group_keys))
+            circular = np.array([c in CIRCULAR_COLUMNS for c in numeric])
+            counts, means = group_angle_statistics(group_index, len(group_keys), values, circular)
+            # linear means of several values are rounded, families without any value get 0
+            means = np.where(~circular[None, :] & (counts > 1), round_values(means), means)
+            means = np.where(counts == 0, 0, means).tolist()
+            group_rows = {}
+            for i, g in enumerate(group_index.tolist()):
+                group_rows.setdefault(g, []).append(i)
+            for g, key in enumerate(group_keys):
+                gn, pf = key.rsplit('|', 1)
+                first = group_rows[g][0]
+                if rows[g]==1:
+                    new_pf = [labels[first], families[first]] + [None if np.isnan(v) else v for v in values[first].tolist()]
+                    new_pf.insert(2 + dssp_position, dssps[first])
+                else:
+                    new_pf = [labels[first], families[first]] + means[g]
+                    l = [dssps[i] for i in group_rows[g] if dssps[i] is not None]
+                    new_pf.insert(2 + dssp_position, most_common_dssp(l) if len(l)>1 else (l[0] if l else 0))
+                all_angles[gn][pf] = new_pf
     else:
         ds = list(ResidueAngle.objects.filter(structure__pdb_code__index__in=pdbs) \
             .exclude(residue__generic_number=None) \
-            .values_list(generic_label,'structure__pdb_code__index','core_distance','a_angle','outer_angle','tau','phi','psi', 'sasa', 'rsa','theta','hse','ss_dssp','tau_angle','rotation_angle'))
-        for d in ds:
-            d = list(d)
-            if not forced_class_a:
-                d[0] = re.sub(r'\.[\d]+', '', d[0])
-            if d[0] not in all_angles:
-                all_angles[d[0]] = {}
+            .values_list(generic_label,'structure__pdb_code__index', *columns))
+        labels = [d[0] for d in ds]
+        if not forced_class_a:
+            labels = strip_generic_labels(labels)
+        for gn, d in zip(labels, ds):
+            if gn not in all_angles:
+                all_angles[gn] = {}
                 for pdb in pdbs:
-                    all_angles[d[0]][pdb] = []
-            all_angles[d[0]][d[1]] = d
+                    all_angles[gn][pdb] = []
+            all_angles[gn][d[1]] = [gn] + list(d[1:])
 
     return all_angles
+
+
+def summarize_angles(structure_ids):
+    """GN labels and statistics (as in ResidueAngleSummary) of the angles of the structures"""
+    ds = list(ResidueAngle.objects.filter(structure_id__in=list(structure_ids)) \
+                        .exclude(residue__generic_number=None) \
+                        .values_list('residue__generic_number__label', *SUMMARY_COLUMNS))
+    if not ds:
+        return [], np.zeros((0, len(SUMMARY_COLUMNS), len(SUMMARY_STATISTICS)))
+    gns, group_index = factorize([d[0] for d in ds])
+    values = np.array([d[1:] for d in ds], dtype=float)
+
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0)
+    radians = np.radians(filled)
+    minima = np.full((len(gns), len(SUMMARY_COLUMNS)), np.inf)
+    maxima = np.full((len(gns), len(SUMMARY_COLUMNS)), -np.inf)
+    np.fmin.at(minima, group_index, values)
+    np.fmax.at(maxima, group_index, values)
+    statistics = np.stack([group_sums(group_index, len(gns), valid),
+        group_sums(group_index, len(gns), filled),
+        group_sums(group_index, len(gns), filled ** 2),
+        group_sums(group_index, len(gns), np.where(valid, np.sin(radians), 0)),
+        group_sums(group_index, len(gns), np.where(valid, np.cos(radians), 0)),
+        minima, maxima], axis=2)
+    return gns, combine_angle_statistics([(gns, statistics)])[1]
+
+def combine_angle_statistics(summaries):
+    """GN labels and the merged statistics of (GN labels, statistics) summaries, min and max are NaN without values"""
+    gns = sorted(set(gn for summary_gns, statistics in summaries for gn in summary_gns))
+    axis = {gn: i for i, gn in enumerate(gns)}
+    combined = np.zeros((len(gns), len(SUMMARY_COLUMNS), len(SUMMARY_STATISTICS)))
+    combined[:, :, 5] = np.inf
+    combined[:, :, 6] = -np.inf
+    for summary_gns, statistics in summaries:
+        target = [axis[gn] for gn in summary_gns]
+        combined[target, :, :5] += statistics[:, :, :5]
+        combined[target, :, 5] = np.fmin(combined[target, :, 5], statistics[:, :, 5])
+        combined[target, :, 6] = np.fmax(combined[target, :, 6], statistics[:, :, 6])
+    combined[:, :, 5:][combined[:, :, 0] == 0] = np.nan
+    return gns, combined
+
+def get_group_angle_summary(structure_ids):
+    """GN labels and statistics of the angles of the structures from the precomputed group summaries
+
+    Returns None when the structures are not a union of summarized receptor and state groups.
+    """
+    summaries = get_group_summaries(ResidueAngleSummary.objects.all(), structure_ids)
+    if summaries is None:
+        return None
+    return combine_angle_statistics([(summary.generic_numbers.split(',') if summary.generic_numbers else [],
+        summary.get_statistics()) for summary in summaries])
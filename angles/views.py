@@ -9,7 +9,7 @@ from django.views.generic import TemplateView, View
 import contactnetwork.pdb as pdb
 from structure.models import Structure
 from residue.models import Residue
-from angles.models import ResidueAngle as Angle
+from angles.models import ResidueAngle as Angle, SUMMARY_COLUMNS, SUMMARY_CIRCULAR_COLUMNS, get_group_angle_summary
 
 import Bio.PDB
 import copy
@@ -42,6 +42,35 @@ def structureCheck(request):
     """
     return render(request, 'angles/structurecheck.html')
 
+# key of the aggregated values of each summary column in get_angles
+summary_keys = {'a_angle': 'aangle', 'b_angle': 'bangle', 'outer_angle': 'outer', 'hse': 'hse', 'sasa': 'sasa', 'rsa': 'rsa',
+    'phi': 'phi', 'psi': 'psi', 'theta': 'theta', 'tau': 'tau', 'core_distance': 'distance'}
+
+def get_angle_summary_rows(pdbs):
+    """
+    Aggregated angle values per generic number of the PDBs from the precomputed group summaries, None when the
+    structures are not a union of summarized receptor and state groups
+    """
+    structure_ids = Structure.objects.filter(pdb_code__index__in=pdbs).values_list('pk', flat=True)
+    summary = get_group_angle_summary(structure_ids)
+    if summary is None:
+        return None
+
+    rows = []
+    for gn, statistics in zip(summary[0], summary[1].tolist()):
+        row = {"residue__generic_number__label": gn}
+        for column, (count, total, sum_squares, sin_sum, cos_sum, minimum, maximum) in zip(SUMMARY_COLUMNS, statistics):
+            key = summary_keys[column]
+            row["min_" + key] = minimum if count else None
+            row["max_" + key] = maximum if count else None
+            if column in SUMMARY_CIRCULAR_COLUMNS:
+                # circular mean of multiple angles, as for the aggregated angles below
+                row["avg_" + key] = math.degrees(math.atan2(sin_sum, cos_sum)) if count > 1 else (total if count else [])
+            else:
+                row["avg_" + key] = total / count if count else None
+        rows.append(row)
+    return rows
+
 def get_angles(request):
     data = {'error': 0}
 
@@ -74,30 +103,32 @@ def get_angles(request):
                     data['data'].append(["-",q.residue.sequence_number, q.a_angle, q.b_angle, q.outer_angle, q.hse, q.sasa, q.rsa, q.phi, q.psi, q.theta, q.tau, q.core_distance, q.ss_dssp, q.ss_stride ])
             data['headers'] = [{"title" : "Value"}]
         else: # always a grouping or a comparison
-            query = Angle.objects.filter(structure__pdb_code__index__in=pdbs).prefetch_related("residue__generic_number") \
-                    .values("residue__generic_number__label") \
-                    .order_by('residue__generic_number__label') \
-                    .annotate(min_aangle = Min('a_angle'), avg_aangle=ArrayAgg('a_angle'), max_aangle = Max('a_angle'), \
-                        min_bangle = Min('b_angle'), avg_bangle=ArrayAgg('b_angle'), max_bangle = Max('b_angle'), \
-                        min_outer = Min('outer_angle'), avg_outer=ArrayAgg('outer_angle'), max_outer = Max('outer_angle'), \
-                        min_hse = Min('hse'), avg_hse=Avg('hse'), max_hse = Max('hse'), \
-                        min_sasa = Min('sasa'), avg_sasa=Avg('sasa'), max_sasa = Max('sasa'), \
-                        min_rsa = Min('rsa'), avg_rsa=Avg('rsa'), max_rsa = Max('rsa'), \
-                        min_phi = Min('phi'), avg_phi=ArrayAgg('phi'), max_phi = Max('phi'), \
-                        min_psi = Min('psi'), avg_psi=ArrayAgg('psi'), max_psi = Max('psi'), \
-                        min_theta = Min('theta'), avg_theta=ArrayAgg('theta'), max_theta = Max('theta'), \
-                        min_tau = Min('tau'), avg_tau=ArrayAgg('tau'), max_tau = Max('tau'), \
-                        min_distance = Min('core_distance'), avg_distance=Avg('core_distance'), max_distance = Max('core_distance'))
-
-            # Process angle aggregates to angle averages
-            for q in query:
-                for angle in angles:
-                    q[angle] = [ qa for qa in q[angle] if qa != None]
-                    if angle in q and len(q[angle]) > 1:
-                        # Sensible average for multiple angles (circular statistics: https://rosettacode.org/wiki/Averages/Mean_angle)
-                        q[angle] = math.degrees(cmath.phase(sum(cmath.rect(1, math.radians(float(d))) for d in q[angle])/len(q[angle])))
-                    elif len(q[angle]) == 1:
-                        q[angle] = q[angle][0]
+            query = get_angle_summary_rows(pdbs)
+            if query is None:
+                query = Angle.objects.filter(structure__pdb_code__index__in=pdbs).prefetch_related("residue__generic_number") \
+                        .values("residue__generic_number__label") \
+                        .order_by('residue__generic_number__label') \
+                        .annotate(min_aangle = Min('a_angle'), avg_aangle=ArrayAgg('a_angle'), max_aangle = Max('a_angle'), \
+                            min_bangle = Min('b_angle'), avg_bangle=ArrayAgg('b_angle'), max_bangle = Max('b_angle'), \
+                            min_outer = Min('outer_angle'), avg_outer=ArrayAgg('outer_angle'), max_outer = Max('outer_angle'), \
+                            min_hse = Min('hse'), avg_hse=Avg('hse'), max_hse = Max('hse'), \
+                            min_sasa = Min('sasa'), avg_sasa=Avg('sasa'), max_sasa = Max('sasa'), \
+                            min_rsa = Min('rsa'), avg_rsa=Avg('rsa'), max_rsa = Max('rsa'), \
+                            min_phi = Min('phi'), avg_phi=ArrayAgg('phi'), max_phi = Max('phi'), \
+                            min_psi = Min('psi'), avg_psi=ArrayAgg('psi'), max_psi = Max('psi'), \
+                            min_theta = Min('theta'), avg_theta=ArrayAgg('theta'), max_theta = Max('theta'), \
+                            min_tau = Min('tau'), avg_tau=ArrayAgg('tau'), max_tau = Max('tau'), \
+                            min_distance = Min('core_distance'), avg_distance=Avg('core_distance'), max_distance = Max('core_distance'))
+
+                # Process angle aggregates to angle averages
+                for q in query:
+                    for angle in angles:
+                        q[angle] = [ qa for qa in q[angle] if qa != None]
+                        if angle in q and len(q[angle]) > 1:
+                            # Sensible average for multiple angles (circular statistics: https://rosettacode.org/wiki/Averages/Mean_angle)
+                            q[angle] = math.degrees(cmath.phase(sum(cmath.rect(1, math.radians(float(d))) for d in q[angle])/len(q[angle])))
+                        elif len(q[angle]) == 1:
+                            q[angle] = q[angle][0]
 
             # Prep data
             data['data'] = [ [q["residue__generic_number__label"], " ", \
@@ -140,29 +171,31 @@ def get_angles(request):
 
             data['headers2'] = [{"title" : "Class<br/>Min"},{"title" : "Class<br/>Avg"},{"title" : "Class<br/>Max"}]
 
-        query = Angle.objects.filter(structure__pdb_code__index__in=pdbs2).prefetch_related("residue__generic_number") \
-                .values("residue__generic_number__label") \
-                .annotate(min_aangle = Min('a_angle'), avg_aangle=ArrayAgg('a_angle'), max_aangle = Max('a_angle'), \
-                    min_bangle = Min('b_angle'), avg_bangle=ArrayAgg('b_angle'), max_bangle = Max('b_angle'), \
-                    min_outer = Min('outer_angle'), avg_outer=ArrayAgg('outer_angle'), max_outer = Max('outer_angle'), \
-                    min_hse = Min('hse'), avg_hse=Avg('hse'), max_hse = Max('hse'), \
-                    min_sasa = Min('sasa'), avg_sasa=Avg('sasa'), max_sasa = Max('sasa'), \
-                    min_rsa = Min('rsa'), avg_rsa=Avg('rsa'), max_rsa = Max('rsa'), \
-                    min_phi = Min('phi'), avg_phi=ArrayAgg('phi'), max_phi = Max('phi'), \
-                    min_psi = Min('psi'), avg_psi=ArrayAgg('psi'), max_psi = Max('psi'), \
-                    min_theta = Min('theta'), avg_theta=ArrayAgg('theta'), max_theta = Max('theta'), \
-                    min_tau = Min('tau'), avg_tau=ArrayAgg('tau'), max_tau = Max('tau'), \
-                    min_distance = Min('core_distance'), avg_distance=Avg('core_distance'), max_distance = Max('core_distance'))
-
-        # Process angle aggregates to angle averages
-        for q in query:
-            for angle in angles:
-                q[angle] = [ q for q in q[angle] if q != None]
-                if angle in q and len(q[angle]) > 1:
-                    # Sensible average for multiple angles (circular statistics: https://rosettacode.org/wiki/Averages/Mean_angle)
-                    q[angle] = math.degrees(cmath.phase(sum(cmath.rect(1, math.radians(float(d))) for d in q[angle])/len(q[angle])))
-                elif len(q[angle]) == 1:
-                    q[angle] = q[angle][0]
+        query = get_angle_summary_rows(pdbs2)
+        if query is None:
+            query = Angle.objects.filter(structure__pdb_code__index__in=pdbs2).prefetch_related("residue__generic_number") \
+                    .values("residue__generic_number__label") \
+                    .annotate(min_aangle = Min('a_angle'), avg_aangle=ArrayAgg('a_angle'), max_aangle = Max('a_angle'), \
+                        min_bangle = Min('b_angle'), avg_bangle=ArrayAgg('b_angle'), max_bangle = Max('b_angle'), \
+                        min_outer = Min('outer_angle'), avg_outer=ArrayAgg('outer_angle'), max_outer = Max('outer_angle'), \
+                        min_hse = Min('hse'), avg_hse=Avg('hse'), max_hse = Max('hse'), \
+                        min_sasa = Min('sasa'), avg_sasa=Avg('sasa'), max_sasa = Max('sasa'), \
+                        min_rsa = Min('rsa'), avg_rsa=Avg('rsa'), max_rsa = Max('rsa'), \
+                        min_phi = Min('phi'), avg_phi=ArrayAgg('phi'), max_phi = Max('phi'), \
+                        min_psi = Min('psi'), avg_psi=ArrayAgg('psi'), max_psi = Max('psi'), \
+                        min_theta = Min('theta'), avg_theta=ArrayAgg('theta'), max_theta = Max('theta'), \
+                        min_tau = Min('tau'), avg_tau=ArrayAgg('tau'), max_tau = Max('tau'), \
+                        min_distance = Min('core_distance'), avg_distance=Avg('core_distance'), max_distance = Max('core_distance'))
+
+            # Process angle aggregates to angle averages
+            for q in query:
+                for angle in angles:
+                    q[angle] = [ q for q in q[angle] if q != None]
+                    if angle in q and len(q[angle]) > 1:
+                        # Sensible average for multiple angles (circular statistics: https://rosettacode.org/wiki/Averages/Mean_angle)
+                        q[angle] = math.degrees(cmath.phase(sum(cmath.rect(1, math.radians(float(d))) for d in q[angle])/len(q[angle])))
+                    elif len(q[angle]) == 1:
+                        q[angle] = q[angle][0]
 
         # Prep data
         data['data2'] = { q["residue__generic_number__label"]: [q["residue__generic_number__label"], " ", \
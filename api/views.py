@@ -2,6 +2,8 @@ from rest_framework import views, generics
 from rest_framework.response import Response
 from rest_framework.parsers import FileUploadParser
 from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.urls import replace_query_param
+from django.http import StreamingHttpResponse
 from django.template.loader import render_to_string
 
 from django.db.models import Q
@@ -10,7 +12,7 @@ from interaction.models import ResidueFragmentInteraction
 from mutation.models import MutationRaw
 from protein.models import Protein, ProteinFamily, Species, ProteinSegment
 from residue.models import Residue, ResidueGenericNumberEquivalent
-from structure.models import Structure
+from structure.models import Structure, StructureSummary
 from structure.assign_generic_numbers_gpcr import GenericNumbering
 from structure.sequence_parser import SequenceParser
 from api.serializers import (ProteinSerializer, ProteinFamilySerializer, SpeciesSerializer, ResidueSerializer,
@@ -18,10 +20,12 @@ from api.serializers import (ProteinSerializer, ProteinFamilySerializer, Species
                              MutationSerializer, ReceptorListSerializer)
 from api.renderers import PDBRenderer
 from common.alignment import Alignment
+from alignment.functions import load_family_alignment, family_alignment_to_dict
 from common.definitions import AMINO_ACIDS, AMINO_ACID_GROUPS
 from drugs.models import Drugs
 
 from io import StringIO
+import json
 from Bio.PDB import PDBIO, parse_pdb_header
 from collections import OrderedDict
 
@@ -228,90 +232,69 @@ class StructureList(views.APIView):
     """
     Get a list of structures
     \n/structure/
+    \nOptional query parameters: limit (page size, max 1000) and cursor (last pdb_code of the previous page)
+    return a page wrapped as {"next": url, "results": [...]}; mode=ndjson streams one structure per line.
     """
 
+    max_page_size = 1000
+
     def get(self, request, pdb_code=None, entry_name=None, representative=None):
+        structures = self.get_structures(pdb_code, entry_name, representative)
+
+        # paginate on the pdb code (cursor) to keep pages stable while the table grows
+        limit = request.query_params.get('limit')
+        cursor = request.query_params.get('cursor')
+        if limit is not None:
+            try:
+                limit = min(max(int(limit), 1), self.max_page_size)
+            except ValueError:
+                return Response({'error': 'limit must be an integer'}, status=400)
+
+        structures = structures.order_by('pdb_code__index')
+        if cursor:
+            structures = structures.filter(pdb_code__index__gt=cursor)
+        if limit is not None:
+            structures = structures[:limit+1]
+        page = list(structures.values_list('id', 'pdb_code__index'))
+
+        next_url = None
+        if limit is not None and len(page) > limit:
+            page = page[:limit]
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', page[-1][1])
+
+        # the summaries are refreshed by the structure builds, structures without one are rendered in the request
+        structure_ids = [structure_id for structure_id, _ in page]
+        summaries = dict(StructureSummary.objects.filter(structure_id__in=structure_ids).values_list('structure_id', 'data'))
+        missing = [structure_id for structure_id in structure_ids if structure_id not in summaries]
+        if missing:
+            summaries.update((structure_id, data) for structure_id, _, data
+                in StructureSummary.render(Structure.objects.filter(id__in=missing)))
+        rows = [summaries[structure_id] for structure_id in structure_ids if structure_id in summaries]
+
+        if request.query_params.get('mode') == 'ndjson':
+            response = StreamingHttpResponse((data + '\n' for data in rows), content_type='application/x-ndjson')
+            if next_url:
+                response['Link'] = '<{}>; rel="next"'.format(next_url)
+            return response
+
+        data = json.loads('[' + ','.join(rows) + ']')
+        if limit is not None:
+            return Response(OrderedDict([('next', next_url), ('results', data)]))
+        elif len(data) == 1:
+            # if a structure is selected, return a single dict rather then a list of dicts
+            return Response(data[0])
+        return Response(data)
+
+    def get_structures(self, pdb_code=None, entry_name=None, representative=None):
         if pdb_code:
-            structures = Structure.objects.filter(pdb_code__index=pdb_code)
+            return Structure.objects.filter(pdb_code__index=pdb_code)
         elif entry_name and representative:
-            structures = Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name,
+            return Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name,
                 representative=True)
         elif entry_name:
-            structures = Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name)
+            return Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name)
         elif representative:
-            structures = Structure.objects.filter(representative=True)
-        else:
-            structures = Structure.objects.all()
-
-        structures = structures.prefetch_related('protein_conformation__protein__parent__species', 'pdb_code',
-            'protein_conformation__protein__parent__family', 'protein_conformation__protein__parent__species',
-            'publication__web_link', 'structureligandinteraction_set__ligand__properities', 'structure_type',
-            'structureligandinteraction_set__ligand__properities__ligand_type',
-            'structureligandinteraction_set__ligand_role')
-
-        # structures = self.get_structures(pdb_code, entry_name, representative)
-
-        # convert objects to a list of dictionaries
-        # normal serializers can not be used because of abstraction of tables (e.g. protein_conformation)
-        s = []
-        for structure in structures:
-            # essential fields
-            structure_data = {
-                'pdb_code': structure.pdb_code.index,
-                'protein': structure.protein_conformation.protein.parent.entry_name,
-                'family': structure.protein_conformation.protein.parent.family.slug,
-                'species': structure.protein_conformation.protein.parent.species.latin_name,
-                'preferred_chain': structure.preferred_chain,
-                'resolution': structure.resolution,
-                'publication_date': structure.publication_date,
-                'type': structure.structure_type.name,
-                'state': structure.state.name,
-                'distance': structure.distance,
-            }
-
-            # publication
-            if structure.publication:
-                structure_data['publication'] = structure.publication.web_link.__str__()
-            else:
-                structure_data['publication'] = None
-
-            # ligand
-            ligands = []
-            for interaction in structure.structureligandinteraction_set.filter(annotated=True):
-                ligand = {}
-                if interaction.ligand.name:
-                    ligand['name'] = interaction.ligand.name
-                if interaction.ligand.properities.ligand_type and interaction.ligand.properities.ligand_type.name:
-                    ligand['type'] = interaction.ligand.properities.ligand_type.name
-                if interaction.ligand_role and interaction.ligand_role.name:
-                    ligand['function'] = interaction.ligand_role.name
-                if ligand:
-                    ligands.append(ligand)
-            structure_data['ligands'] = ligands
-
-            # signalling protein
-            if structure.signprot_complex:
-                sign_prot = {'type': 'G protein', 'data': {}}
-                sign_prot['data']['entity1'] = {'entry_name':structure.signprot_complex.protein.entry_name, 'chain':structure.signprot_complex.alpha}
-                if structure.signprot_complex.beta_protein:
-                    sign_prot['data']['entity2'] = {'entry_name':structure.signprot_complex.beta_protein.entry_name, 'chain':structure.signprot_complex.beta_chain}
-                if structure.signprot_complex.gamma_protein:
-                    sign_prot['data']['entity3'] = {'entry_name':structure.signprot_complex.gamma_protein.entry_name, 'chain':structure.signprot_complex.gamma_chain}
-                structure_data['signalling_protein'] = sign_prot
-            if len(structure.extra_proteins.all())>0:
-                for ep in structure.extra_proteins.all():
-                    if ep.wt_protein and ep.wt_protein.family.slug.startswith('200'):
-                        structure_data['signalling_protein'] = {'type': 'Arrestin', 'data': {'entity1':{'entry_name':ep.wt_protein.entry_name, 'chain':ep.chain}}}
-
-            s.append(structure_data)
-
-        # if a structure is selected, return a single dict rather then a list of dicts
-        if len(s) == 1:
-            s = s[0]
-
-        return Response(s)
-
-    def get_structures(self, pdb_code=None, representative=None):
+            return Structure.objects.filter(representative=True)
         return Structure.objects.all()
 
 
@@ -346,8 +329,6 @@ class StructureDetail(StructureList):
     \n/structure/{pdb_code}/
     \n{pdb_code} is a structure identifier from the Protein Data Bank, e.g. 2RH1
     """
-    def get_structures(self, pdb_code=None, representative=None):
-        return Structure.objects.filter(pdb_code__index=pdb_code)
 
 
 class FamilyAlignment(views.APIView):
@@ -361,28 +342,17 @@ class FamilyAlignment(views.APIView):
 
     def get(self, request, slug=None, segments=None, latin_name=None, statistics=False, include_trembl=False):
         if slug is not None:
-            # Check for specific species
-            if latin_name is not None:
-                ps = Protein.objects.filter(sequence_type__slug='wt', family__slug__startswith=slug,
-                    species__latin_name=latin_name)
-            else:
-                if not include_trembl:
-                    ps = Protein.objects.filter(sequence_type__slug='wt', family__slug__startswith=slug, source__id=1)
-                else:
-                    ps = Protein.objects.filter(sequence_type__slug='wt', family__slug__startswith=slug)
-
-            # take the numbering scheme from the first protein
-            #s_slug = Protein.objects.get(entry_name=ps[0]).residue_numbering_scheme_id
-            s_slug = ps[0].residue_numbering_scheme_id
-
-            protein_family = ps[0].family.slug[:3]
+            # the full family alignment is precomputed, partial alignments are cut out of it
+            stored = load_family_alignment(slug, latin_name, include_trembl)
+            if stored is None:
+                return Response(OrderedDict())
 
             gen_list = []
-            segment_list = []
+            segment_list = None
             if segments is not None:
+                segment_list = []
                 input_list = segments.split(",")
                 # fetch a list of all segments
-
                 protein_segments = ProteinSegment.objects.filter(partial=False).values_list('slug', flat=True)
                 for s in input_list:
                     # add to segment list
@@ -390,84 +360,13 @@ class FamilyAlignment(views.APIView):
                         segment_list.append(s)
                     # get generic numbering object for generic positions
                     else:
-                        # make sure the query works for all positions
-                        gen_object = ResidueGenericNumberEquivalent.objects.get(label=s, scheme__id=s_slug)
-                        gen_object.properties = {}
-                        gen_list.append(gen_object)
-
-                # fetch all complete protein_segments
-                ss = ProteinSegment.objects.filter(slug__in=segment_list, partial=False)
-            else:
-                ss = ProteinSegment.objects.filter(partial=False)
-
-            if int(protein_family) < 100:
-                ss = [ s for s in ss if s.proteinfamily == 'GPCR']
-            elif protein_family == "100":
-                ss = [ s for s in ss if s.proteinfamily == 'Gprotein']
-            elif protein_family == "200":
-                ss = [ s for s in ss if s.proteinfamily == 'Arrestin']
-
-            # create an alignment object
-            a = Alignment()
-            a.show_padding = False
-
-            # load data from selection into the alignment
-            a.load_proteins(ps)
-
-            # load generic numbers and TMs seperately
-            if gen_list:
-                a.load_segments(gen_list)
-            a.load_segments(ss)
-
-            # build the alignment data matrix
-            a.build_alignment()
-
-            a.calculate_statistics()
-
-            residue_list = []
-            for aa in a.full_consensus:
-                residue_list.append(aa.amino_acid)
-
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
-
-            # convert the list to a dict
-            ali_dict = OrderedDict({})
-            protein = "reference"
-            for row in response:
-                if row.strip() != "":
-                    if row.startswith(">"):
-                        protein = row[1:]
-                    else:
-                        ali_dict[protein] = row
-                        protein = False
+                        # make sure the query works for all positions (numbering scheme of the first protein)
+                        gen_object = ResidueGenericNumberEquivalent.objects.select_related('default_generic_number').get(
+                            label=s, scheme__id=stored['numbering_scheme'])
+                        gen_list.append(gen_object.default_generic_number.label)
 
-            ali_dict["CONSENSUS"] = "".join(residue_list)
+            return Response(family_alignment_to_dict(stored, segment_list, gen_list, statistics))
 
-            # render statistics for output
-            if statistics == True:
-                feat = {}
-                for i, feature in enumerate(AMINO_ACID_GROUPS):
-                    feature_stats = a.feature_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
-
-                for i, AA in enumerate(AMINO_ACIDS):
-                    feature_stats = a.amino_acid_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
-
-                ali_dict["statistics"] = feat
-
-            return Response(ali_dict)
 
 class FamilyAlignmentAll(FamilyAlignment):
 
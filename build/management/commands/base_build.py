@@ -5,6 +5,8 @@ from django.db import connection
 
 import datetime
 import logging
+import os
+import time
 from multiprocessing import Queue, Process, Value, Lock
 
 
@@ -25,6 +27,11 @@ class Command(BaseCommand):
             dest='test',
             default=False,
             help='Include only a subset of data for testing')
+        parser.add_argument('--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Skip items that were completed by the previous run (commands using run_jobs)')
 
     def prepare_input(self, proc, items, iteration=1):
         q = Queue()
@@ -54,4 +61,105 @@ class Command(BaseCommand):
             p.start()
 
         for p in procs:
-            p.join()
\ No newline at end of file
+            p.join()
+
+    def run_jobs(self, proc, items, job_func, resume=False):
+        """Runs job_func for every item in proc processes.
+
+        Items are handed out one at a time, so a slow item does not hold up the items after it. Every finished item is
+        recorded with its run time in the journal of the command, with resume the items completed by the previous run
+        are skipped. Failed items are logged and recorded, but do not stop the build. Returns the journal entries
+        (label, status, seconds) of the items run, an empty list when there was nothing to do.
+        """
+        journal_path = self.get_journal_path()
+        completed = set()
+        if resume:
+            entries = self.read_journal(journal_path)
+            for label, status, seconds in entries:
+                if status == 'done':
+                    completed.add(label)
+            # rewrite the journal without malformed lines, so new entries are not appended to a truncated line
+            self.write_journal(journal_path, entries)
+        elif os.path.isfile(journal_path):
+            os.remove(journal_path)
+        jobs = [item for item in items if self.job_label(item) not in completed]
+        if resume:
+            self.logger.info('Resuming, skipping {} of {} items completed by the previous run'.format(
+                len(items) - len(jobs), len(items)))
+        if not jobs:
+            return []
+
+        num = Value('i', 0)
+        lock = Lock()
+        start = time.time()
+        journal_start = len(self.read_journal(journal_path))
+        connection.close()
+        procs = list()
+        for i in range(0, min(proc, len(jobs))):
+            p = Process(target=self.job_worker, args=([jobs, job_func, journal_path, num, lock]))
+            procs.append(p)
+            p.start()
+
+        for p in procs:
+            p.join()
+
+        entries = self.read_journal(journal_path)[journal_start:]
+        self.report_jobs(entries, time.time() - start)
+        return entries
+
+    def job_worker(self, jobs, job_func, journal_path, count, lock):
+        while True:
+            with lock:
+                if count.value >= len(jobs):
+                    break
+                item = jobs[count.value]
+                count.value += 1
+            label = self.job_label(item)
+            start = time.time()
+            try:
+                job_func(item)
+                status = 'done'
+            except Exception:
+                self.logger.exception('Failed {}'.format(label))
+                status = 'failed'
+            seconds = time.time() - start
+            self.logger.info('Finished {} ({}) in {:.1f}s'.format(label, status, seconds))
+            with lock:
+                with open(journal_path, 'a') as f:
+                    f.write('{}\t{}\t{:.3f}\n'.format(label, status, seconds))
+
+    def job_label(self, item):
+        """Label of an item in the journal, must be unique and the same between runs."""
+        return str(item)
+
+    def get_journal_path(self):
+        journal_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'build_journals'])
+        os.makedirs(journal_dir, exist_ok=True)
+        return os.sep.join([journal_dir, self.__module__.split('.')[-1] + '.tsv'])
+
+    def read_journal(self, journal_path):
+        entries = []
+        if os.path.isfile(journal_path):
+            with open(journal_path) as f:
+                for line in f:
+                    # skip malformed lines, e.g. the last line of a journal of an interrupted run
+                    try:
+                        label, status, seconds = line.rstrip('\n').rsplit('\t', 2)
+                        entries.append((label, status, float(seconds)))
+                    except ValueError:
+                        self.logger.warning('Skipping malformed journal line: {!r}'.format(line))
+        return entries
+
+    def write_journal(self, journal_path, entries):
+        with open(journal_path, 'w') as f:
+            for label, status, seconds in entries:
+                f.write('{}\t{}\t{:.3f}\n'.format(label, status, seconds))
+
+    def report_jobs(self, entries, elapsed):
+        failed = [label for label, status, seconds in entries if status != 'done']
+        self.logger.info('Finished {} items in {:.1f}s ({:.2f} items/min), {} failed'.format(len(entries), elapsed,
+            len(entries) / elapsed * 60 if elapsed else 0, len(failed)))
+        for label, status, seconds in sorted(entries, key=lambda x: -x[2])[:5]:
+            self.logger.info('Slowest: {} {:.1f}s'.format(label, seconds))
+        if failed:
+            self.logger.warning('Failed items: {}'.format(', '.join(failed)))
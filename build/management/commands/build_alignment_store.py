@@ -0,0 +1,33 @@
+from build.management.commands.base_build import Command as BaseBuild
+
+from alignment.functions import build_aligned_residue_store
+from alignment.models import AlignedResidues
+from protein.models import ProteinConformation
+
+import logging
+
+
+class Command(BaseBuild):
+    help = 'Builds the aligned residue store that Alignment.build_alignment assembles alignments from'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser=parser)
+        parser.add_argument('-u', '--purge',
+            action='store_true',
+            dest='purge',
+            default=False,
+            help='Purge existing records')
+
+    def handle(self, *args, **options):
+        if options['purge']:
+            AlignedResidues.objects.all().delete()
+
+        self.logger.info('BUILDING ALIGNED RESIDUE STORE')
+        self.pconfs = list(ProteinConformation.objects.all().order_by('id'))
+        self.run_jobs(options['proc'], self.pconfs, build_aligned_residue_store, options['resume'])
+        self.logger.info('COMPLETED BUILDING ALIGNED RESIDUE STORE')
+
+    def job_label(self, pconf):
+        return str(pconf.id)
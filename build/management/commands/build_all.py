@@ -62,10 +62,14 @@ class Command(BaseCommand):
             ['build_g_protein_structures'],
             ['build_structure_extra_proteins'],
             ['build_structure_model_rmsd'],
+            ['build_alignment_store', {'proc': options['proc']}],
+            ['build_site_search_index', {'proc': options['proc']}],
+            ['build_family_alignments', {'proc': options['proc']}],
             ['build_blast_database']
         ]
         phase2 = [
             ['build_structure_angles', {'proc': options['proc']}],
+            ['build_structure_group_summaries', {'proc': options['proc']}],
             # ['build_distance_representative'],
             ['build_contact_representative'],
             ['build_construct_data'],
@@ -83,6 +87,7 @@ class Command(BaseCommand):
             ['build_complex_interactions'],
             ['assign_structure_states'],
             ['build_mammalian_representative'],
+            ['build_structure_summaries'],
             # ['build_homology_models', ['--update', '-z'], {'proc': options['proc'], 'test_run': options['test']}],
             ['build_text'],
             ['build_release_notes'],
@@ -81,6 +81,8 @@ class Command(BaseBuild):
         try:
             self.logger.info('CREATING RESIDUES')
 
+            # load the generic numbers once, the workers inherit the registry
+            get_generic_number_registry()
             self.prepare_input(options['proc'], self.pconfs)
 
             # if (self.check_if_residues()):
@@ -440,8 +442,7 @@ class Command(BaseBuild):
             pconf = p
             # print(pconf)
             al = []
-            bulk = []
-            bulk_alt = []
+            residues = []
 
             current = time.time()
 
@@ -465,38 +466,24 @@ class Command(BaseBuild):
 
                 # print("\t",res)
 
-                bulk_info = create_or_update_residue(pconf, segment, self.schemes,res,b_and_c)
-                bulk.append(bulk_info[0])
-                bulk_alt.append(bulk_info[1])
+                residues.append(get_residue_entry(pconf, segment, self.schemes,res,b_and_c))
 
                 al.append(res)
 
             try:
-                bulked = Residue.objects.bulk_create(bulk)
+                save_residues(pconf, residues)
             except Exception as msg:
                 print('Error saving residues for ',pconf)
                 print(msg)
-                try:
-                    bulked = Residue.objects.bulk_create(bulk)
-                except:
-                    print('failed 2nd try')
                 self.logger.error('Error saving residues for {}'.format(pconf))
 
-            rs = Residue.objects.filter(protein_conformation=pconf).order_by('sequence_number')
-
-            ThroughModel = Residue.alternative_generic_numbers.through
-            bulk = []
-            for i,res in enumerate(rs):
-                for alt in bulk_alt[i]:
-                    bulk.append(ThroughModel(residue_id=res.pk, residuegenericnumber_id=alt.pk))
-            ThroughModel.objects.bulk_create(bulk)
             end = time.time()
             diff = round(end - current,1)
-            self.logger.info('{} {} residues ({}) {}s alignment {}'.format(p.protein.entry_name,len(rs),human_ortholog,diff,aligned_gn_mismatch_gap))
+            self.logger.info('{} {} residues ({}) {}s alignment {}'.format(p.protein.entry_name,len(residues),human_ortholog,diff,aligned_gn_mismatch_gap))
             # print('{} {} residues ({}) {}s alignment {}'.format(p.protein.entry_name,len(rs),human_ortholog,diff,aligned_gn_mismatch_gap))
             if aligned_gn_mismatch_gap>20:
                 #print(p.protein.entry_name,len(rs),"residues","(",human_ortholog,")",diff,"s", " Unaligned generic numbers: ",aligned_gn_mismatch_gap)
-                self.logger.warning('{} {} residues ({}) {}s MANY ERRORS IN ALIGNMENT {}'.format(p.protein.entry_name,len(rs),human_ortholog,diff,aligned_gn_mismatch_gap))
+                self.logger.warning('{} {} residues ({}) {}s MANY ERRORS IN ALIGNMENT {}'.format(p.protein.entry_name,len(residues),human_ortholog,diff,aligned_gn_mismatch_gap))
 
         self.logger.info('COMPLETED ANNOTATIONS PROCESS {}'.format(positions))
         # print('COMPLETED ANNOTATIONS PROCESS {} {} {}'.format(iteration,positions,datetime.datetime.strftime(
@@ -8,7 +8,7 @@ from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
-import logging, sys, os, tempfile
+import logging, sys, os, tempfile, shutil
 from subprocess import Popen, PIPE
 
 class Command(BaseCommand):
@@ -85,8 +85,8 @@ class Command(BaseCommand):
         except Exception as e:
             self.logger.error("Makeblastdb failed")
 
-        # remove tmp sequence file
+        # keep the sequences next to the database, BlastSearch finds the database sequences of exact matches in them
         if os.path.exists(self.tmp_file_path):
-            os.unlink(self.tmp_file_path)
+            shutil.move(self.tmp_file_path, db_output_path + '.fasta')
 
         self.logger.info("COMPLETED BUILDING BLAST DATABASE" + blast_db_dir)
@@ -9,7 +9,7 @@ from structure.models import Structure
 from construct.models import (Construct,Crystallization,CrystallizationLigandConc,ChemicalType,Chemical,ChemicalConc,ChemicalList,
 CrystallizationMethods,CrystallizationTypes,ChemicalListName,ContributorInfo,ConstructMutation,ConstructInsertion,ConstructInsertionType,
 ConstructDeletion,ConstructModification,CrystalInfo,ExpressionSystem,Solubilization,PurificationStep,Purification)
-from construct.functions import add_construct, fetch_pdb_info
+from construct.functions import add_construct, fetch_pdb_info, prefetch_pdb_info
 
 from ligand.models import Ligand, LigandType, LigandRole
 from ligand.functions import get_or_make_ligand
@@ -151,7 +151,10 @@ class Command(BaseCommand):
                     add_construct(d)
 
         if do_all:
-            structures = Structure.objects.all()
+            structures = Structure.objects.all().select_related('pdb_code')
+            # download the web API entries of the new constructs concurrently before adding them one by one
+            constructed = set(Construct.objects.values_list('structure__pdb_code__index', flat=True))
+            prefetch_pdb_info([str(s) for s in structures if str(s) not in constructed])
             for s in structures:
                 pdbname = str(s)
                 try:
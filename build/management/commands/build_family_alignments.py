@@ -0,0 +1,61 @@
+from build.management.commands.base_build import Command as BaseBuild
+
+from alignment.functions import build_family_alignment_store
+from alignment.models import FamilyAlignmentStore
+from protein.models import Protein, ProteinFamily
+
+import logging
+
+
+class Command(BaseBuild):
+    help = 'Builds the family alignment store served by the family alignment API'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser=parser)
+        parser.add_argument('-u', '--purge',
+            action='store_true',
+            dest='purge',
+            default=False,
+            help='Purge existing records')
+        parser.add_argument('--species',
+            type=str,
+            nargs='*',
+            dest='species',
+            default=None,
+            help='Only build the species alignments of these species (latin names), default all species')
+
+    def handle(self, *args, **options):
+        if options['purge']:
+            FamilyAlignmentStore.objects.all().delete()
+
+        self.logger.info('BUILDING FAMILY ALIGNMENT STORE')
+        families = list(ProteinFamily.objects.exclude(slug='000').order_by('slug').values_list('slug', flat=True))
+        # every variant served by the family alignment API: Swiss-Prot, Swiss-Prot and TrEMBL, and per species
+        self.alignments = [(slug, None, False) for slug in families]
+        self.alignments += [(slug, None, True) for slug in families]
+
+        # species alignments of the families (and their parent families) with wild-type proteins of the species
+        species_families = set()
+        proteins = Protein.objects.filter(sequence_type__slug='wt')
+        if options['species'] is not None:
+            proteins = proteins.filter(species__latin_name__in=options['species'])
+        family_slugs = set(families)
+        for family_slug, species in proteins.values_list('family__slug', 'species__latin_name').distinct():
+            levels = family_slug.split('_')
+            for i in range(1, len(levels)+1):
+                slug = '_'.join(levels[:i])
+                if slug in family_slugs:
+                    species_families.add((slug, species))
+        self.alignments += [(slug, species, False) for slug, species in sorted(species_families)]
+
+        self.run_jobs(options['proc'], self.alignments, self.build_alignment, options['resume'])
+        self.logger.info('COMPLETED BUILDING FAMILY ALIGNMENT STORE')
+
+    def build_alignment(self, alignment):
+        slug, species, include_trembl = alignment
+        build_family_alignment_store(slug, species, include_trembl)
+
+    def job_label(self, alignment):
+        return '{} {} {}'.format(*alignment)
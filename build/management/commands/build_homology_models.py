@@ -200,7 +200,9 @@ class Command(BaseBuild):
         # Model building
         print("receptors to do",len(self.receptor_list))
         self.processors = options['proc']
-        self.prepare_input(options['proc'], self.receptor_list)
+        # template structures, their protein conformations and parsed coordinates are shared by all models of this build
+        AlignedReferenceTemplate.enable_template_cache(datetime.now().strftime('%Y%m%d%H%M%S%f'))
+        self.run_jobs(options['proc'], self.receptor_list, self.build_model, options['resume'])
 
         # Cleanup
         missing_models = []
@@ -232,38 +234,33 @@ class Command(BaseBuild):
             shutil.rmtree('homology_models')
             shutil.rmtree('PIR')
 
-    def main_func(self, positions, iteration, count, lock):
-        processor_id = round(self.processors*positions[0]/len(self.receptor_list))+1
-        i = 0
-        while count.value<len(self.receptor_list):
-            i += 1
-            with lock:
-                receptor = self.receptor_list[count.value]
-                count.value +=1
-
-            # RERUN: if a model zip file already exists, skip it and move to the next
-            if self.rerun:
-                # Init temporary model object for checks regarding signaling protein complexes etc.
-                temp_model_check = HomologyModeling(receptor[0].entry_name, receptor[1], [receptor[1]], iterations=self.modeller_iterations, complex_model=self.complex, signprot=self.signprot, debug=self.debug,
-                                                  force_main_temp=self.force_main_temp, fast_refinement=self.fast_refinement, keep_hetatoms=self.keep_hetatoms, mutations=self.added_mutations)
-
-                path = './structure/complex_models_zip/' if temp_model_check.complex else './structure/homology_models_zip/'
-                # Differentiate between structure refinement and homology modeling
-                if temp_model_check.revise_xtal:
-                    filepath = "{}*{}_refined_*.zip".format(path, receptor[0].entry_name.upper())
-                else:
-                    filepath = "{}*{}_{}_*.zip".format(path, receptor[0].entry_name, receptor[1])
+    def build_model(self, receptor):
+        # RERUN: if a model zip file already exists, skip it and move to the next
+        if self.rerun:
+            # Init temporary model object for checks regarding signaling protein complexes etc.
+            temp_model_check = HomologyModeling(receptor[0].entry_name, receptor[1], [receptor[1]], iterations=self.modeller_iterations, complex_model=self.complex, signprot=self.signprot, debug=self.debug,
+                                              force_main_temp=self.force_main_temp, fast_refinement=self.fast_refinement, keep_hetatoms=self.keep_hetatoms, mutations=self.added_mutations)
+
+            path = './structure/complex_models_zip/' if temp_model_check.complex else './structure/homology_models_zip/'
+            # Differentiate between structure refinement and homology modeling
+            if temp_model_check.revise_xtal:
+                filepath = "{}*{}_refined_*.zip".format(path, receptor[0].entry_name.upper())
+            else:
+                filepath = "{}*{}_{}_*.zip".format(path, receptor[0].entry_name, receptor[1])
 
-                # Check if model zip file exists
-                if len(glob.glob(filepath)) > 0:
-                    continue
+            # Check if model zip file exists
+            if len(glob.glob(filepath)) > 0:
+                return
+
+        mod_startTime = datetime.now()
+        logger.info('Generating model for  \'{}\' ({})...'.format(receptor[0].entry_name, receptor[1]))
+        chm = CallHomologyModeling(receptor[0].entry_name, receptor[1], iterations=self.modeller_iterations, debug=self.debug,
+                                   update=self.update, complex_model=self.complex, signprot=self.signprot, force_main_temp=self.force_main_temp, keep_hetatoms=self.keep_hetatoms, mutations=self.added_mutations)
+        chm.run(fast_refinement=self.fast_refinement)
+        logger.info('Model finished for  \'{}\' ({})... (Time: {})'.format(receptor[0].entry_name, receptor[1],datetime.now() - mod_startTime))
 
-            mod_startTime = datetime.now()
-            logger.info('Generating model for  \'{}\' ({})... ({} out of {}) (processor:{} count:{})'.format(receptor[0].entry_name, receptor[1],count.value, len(self.receptor_list),processor_id,i))
-            chm = CallHomologyModeling(receptor[0].entry_name, receptor[1], iterations=self.modeller_iterations, debug=self.debug,
-                                       update=self.update, complex_model=self.complex, signprot=self.signprot, force_main_temp=self.force_main_temp, keep_hetatoms=self.keep_hetatoms, mutations=self.added_mutations)
-            chm.run(fast_refinement=self.fast_refinement)
-            logger.info('Model finished for  \'{}\' ({})... (processor:{} count:{}) (Time: {})'.format(receptor[0].entry_name, receptor[1],processor_id,i,datetime.now() - mod_startTime))
+    def job_label(self, receptor):
+        return '{}_{}'.format(receptor[0].entry_name, receptor[1])
 
     def get_states_to_model(self, receptor):
         if self.force_main_temp and self.custom_selection:
@@ -4,6 +4,7 @@ from django.db import connection
 from django.db import IntegrityError
 
 from build.management.commands.base_build import Command as BaseBuild
+from alignment.models import FamilyAlignmentStore
 from protein.models import (Protein, ProteinConformation, ProteinState, ProteinFamily, ProteinAlias,
         ProteinSequenceType, Species, Gene, ProteinSource, ProteinSegment)
 from common.models import WebResource, WebLink
@@ -35,6 +36,9 @@ class Command(BaseBuild):
             self.protein_source_file = os.sep.join([settings.DATA_DIR, 'protein_data',
                 'proteins_and_families_test.txt'])
 
+        # stored family alignments are outdated by the rebuilt proteins
+        FamilyAlignmentStore.objects.all().delete()
+
         # create parent protein family, 000
         try:
             self.create_parent_protein_family()
@@ -4,6 +4,7 @@ from django.db import connection
 from django.db import IntegrityError
 
 from build.management.commands.base_build import Command as BaseBuild
+from alignment.models import FamilyAlignmentStore
 from protein.models import Protein, ProteinConformation, ProteinSegment, ProteinFamily
 from residue.functions import *
 
@@ -36,6 +37,12 @@ class Command(BaseBuild):
         try:
             self.logger.info('CREATING RESIDUES')
 
+            # stored family alignments are outdated by the rebuilt residues
+            FamilyAlignmentStore.objects.all().delete()
+
+            # load the generic numbers once, the workers inherit the registry
+            get_generic_number_registry()
+
             # run the function twice (second run for proteins without reference positions)
             iterations = 2
             for i in range(1,iterations+1):
@@ -134,6 +141,7 @@ class Command(BaseBuild):
             # determine segment ranges, and create residues
             nseg = self.segments.count()
             sequence_number_counter = 0
+            residues = []
             for i, segment in enumerate(self.segments):
                 # should this segment be aligned? This value is updated below
                 unaligned_segment = True
@@ -226,8 +234,13 @@ class Command(BaseBuild):
                     self.logger.warning('Start of segment {} is larger than its end'.format(segment))
                     continue
 
-                # create residues for this segment
-                create_or_update_residues_in_segment(pconf, segment, segment_start, aligned_segment_start,
+                # residues of this segment
+                residues += get_residues_in_segment(pconf, segment, segment_start, aligned_segment_start,
                     segment_end, aligned_segment_end, self.schemes, ref_positions, [], True)
 
                 sequence_number_counter = segment_end
+
+            # create the residues of all segments at once
+            created_residues = save_residues(pconf, residues)
+            if created_residues:
+                self.logger.info('Created {} residues for {}'.format(created_residues, pconf))
@@ -4,6 +4,7 @@ from django.db import connection
 from django.db.models import Q
 
 from build.management.commands.build_human_proteins import Command as BuildHumanProteins
+from alignment.models import FamilyAlignmentStore
 from residue.functions import *
 from structure.functions import BlastSearch
 from protein.models import Protein, ProteinFamily, Gene
@@ -57,6 +58,9 @@ class Command(BuildHumanProteins):
             except:
                 self.logger.error('Could not purge orthologs')
 
+        # stored family alignments are outdated by the rebuilt proteins
+        FamilyAlignmentStore.objects.all().delete()
+
         if options['constructs_only']:
             self.constructs_only = True
         else:
@@ -0,0 +1,35 @@
+from build.management.commands.base_build import Command as BaseBuild
+
+from alignment.functions import build_site_search_position
+from alignment.models import SiteSearchIndex
+from residue.models import Residue, ResidueGenericNumber
+
+import logging
+
+
+class Command(BaseBuild):
+    help = 'Builds the site search index of the residues of all wild-type proteins by generic number'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser=parser)
+        parser.add_argument('-u', '--purge',
+            action='store_true',
+            dest='purge',
+            default=False,
+            help='Purge existing records')
+
+    def handle(self, *args, **options):
+        if options['purge']:
+            SiteSearchIndex.objects.all().delete()
+
+        self.logger.info('BUILDING SITE SEARCH INDEX')
+        # generic numbers used to align residues (Residue.generic_number)
+        self.generic_numbers = list(ResidueGenericNumber.objects.filter(id__in=Residue.objects.filter(
+            generic_number__isnull=False).values('generic_number_id').distinct()).order_by('id'))
+        self.run_jobs(options['proc'], self.generic_numbers, build_site_search_position, options['resume'])
+        self.logger.info('COMPLETED BUILDING SITE SEARCH INDEX')
+
+    def job_label(self, generic_number):
+        return str(generic_number.id)
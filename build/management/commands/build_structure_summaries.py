@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from structure.models import Structure, StructureSummary
+
+import logging
+import time
+
+
+class Command(BaseCommand):
+    help = 'Builds the denormalized structure summaries served by the structure API'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing',
+            action='store_true',
+            dest='missing',
+            default=False,
+            help='Only build summaries of structures without one')
+
+    def handle(self, *args, **options):
+        structures = Structure.objects.all()
+        if options['missing']:
+            structures = structures.filter(summary__isnull=True)
+        else:
+            StructureSummary.objects.all().delete()
+
+        start = time.time()
+        StructureSummary.refresh(structures)
+        self.logger.info('Built {} structure summaries in {:.1f}s'.format(StructureSummary.objects.count(), time.time()-start))
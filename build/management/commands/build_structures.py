@@ -11,7 +11,7 @@ from residue.models import ResidueGenericNumber, ResidueNumberingScheme, Residue
 from common.models import WebLink, WebResource, Publication
 from structure.models import (Structure, StructureType, StructureSegment, StructureStabilizingAgent,PdbData,
     Rotamer, StructureSegmentModeling, StructureCoordinates, StructureCoordinatesDescription, StructureEngineering,
-    StructureEngineeringDescription, Fragment)
+    StructureEngineeringDescription, Fragment, StructureSummary)
 from construct.functions import *
 
 from contactnetwork.models import *
@@ -146,11 +146,16 @@ class Command(BaseBuild):
 
         try:
             self.logger.info('CREATING STRUCTURES')
+            # fetch the construct web API entries of all structures concurrently, the workers then read them from the cache
+            prefetch_pdb_info([os.path.splitext(f)[0].upper() for f in self.filenames if f.endswith('.yaml')])
             # run the function twice (once for representative structures, once for non-representative)
             iterations = 2
             for i in range(1,iterations+1):
                 self.prepare_input(options['proc'], self.filenames, i)
 
+            # summaries of the (re)built structures for the structure API
+            StructureSummary.refresh(Structure.objects.filter(summary__isnull=True))
+
             self.logger.info('COMPLETED CREATING STRUCTURES')
         except Exception as msg:
             print(msg)
@@ -1647,6 +1652,10 @@ class Command(BaseBuild):
                     Fragment.objects.filter(structure=s).delete()
                     Rotamer.objects.filter(structure=s).delete()
                     Residue.objects.filter(protein_conformation=s.protein_conformation).delete()
+                    # the interactions are removed with the residues, the contact index is rebuilt with them
+                    StructureContactIndex.objects.filter(structure=s).delete()
+                    # the API renders structures without a summary in the request until it is rebuilt
+                    StructureSummary.objects.filter(structure=s).delete()
 
                     d = {}
 
@@ -0,0 +1,5 @@
+from build.management.commands.build_alignment_store import Command as BuildAlignmentStore
+
+
+class Command(BuildAlignmentStore):
+    pass
@@ -0,0 +1,5 @@
+from build.management.commands.build_family_alignments import Command as BuildFamilyAlignments
+
+
+class Command(BuildFamilyAlignments):
+    pass
@@ -0,0 +1,5 @@
+from build.management.commands.build_site_search_index import Command as BuildSiteSearchIndex
+
+
+class Command(BuildSiteSearchIndex):
+    pass
@@ -0,0 +1,5 @@
+from build.management.commands.build_structure_summaries import Command as BuildStructureSummaries
+
+
+class Command(BuildStructureSummaries):
+    pass
@@ -7,7 +7,7 @@ from operator import itemgetter
 
 import numpy as np
 
-from alignment.functions import prepare_aa_group_preference
+from alignment.functions import load_aligned_residues, match_site_definitions, prepare_aa_group_preference
 from Bio.Align import substitution_matrices
 from common.definitions import *
 from django.conf import settings
@@ -26,6 +26,77 @@ try:
 except:
     cache_alignments = cache
 
+# Substitution matrix used for the similarity calculations, loaded once instead of for every residue pair
+BLOSUM62 = substitution_matrices.load("BLOSUM62")
+
+# Integer encoding of aligned residues used by the vectorized similarity calculations. Residues are encoded by their
+# index in the BLOSUM62 alphabet (unknown residues as X), gaps get the code after the last residue.
+GAP_CODE = len(BLOSUM62.alphabet)
+RESIDUE_CODES = np.full(256, BLOSUM62.alphabet.index('X'), dtype=np.uint8)
+RESIDUE_CODES[[ord(aa) for aa in BLOSUM62.alphabet]] = np.arange(GAP_CODE)
+SIMILARITY_SCORES = np.zeros((GAP_CODE + 1, GAP_CODE + 1))
+SIMILARITY_SCORES[:GAP_CODE, :GAP_CODE] = np.asarray(BLOSUM62)
+
+# Integer encoding of aligned residues used by the alignment statistics. Residues are encoded by their index in
+# AMINO_ACIDS, residues that are not counted (e.g. X) get the code after the last amino acid.
+SKIP_CODE = len(AMINO_ACIDS)
+AMINO_ACID_CODES = np.full(256, SKIP_CODE, dtype=np.uint8)
+AMINO_ACID_CODES[[ord(aa) for aa in AMINO_ACIDS]] = np.arange(SKIP_CODE)
+
+# amino acid (rows) membership of the property groups (columns)
+AMINO_ACID_GROUP_MEMBERS = np.array([[feature in AMINO_ACID_GROUPS_AA[aa] for feature in AMINO_ACID_GROUPS]
+    for aa in AMINO_ACIDS], dtype=int)
+
+# frequency and frequency interval (0 is 0-9, 1 is 10-19 etc, used for colors) of every possible percentage
+FREQUENCY_LABELS = [(str(value), '0' if value < 10 else str(value)[:-1]) for value in range(101)]
+
+
+def similarity_counts(codes, block_size=2**22):
+    """Calculate all-vs-all identity and similarity counts for an encoded alignment.
+
+    Returns four (proteins x proteins) arrays: the number of identical positions, the number of positions with a
+    positive BLOSUM62 score, the sum of those positive scores and the number of positions that are not gapped in both
+    sequences. The counts are calculated as matrix products of one-hot encoded rows, summed over blocks of positions
+    so the one-hot arrays hold at most about block_size values.
+    """
+    num_proteins, num_positions = codes.shape
+    positive_scores = np.where(SIMILARITY_SCORES > 0, SIMILARITY_SCORES, 0)[:GAP_CODE, :GAP_CODE].astype(np.float32)
+    similar = (positive_scores > 0).astype(np.float32)
+
+    identities = np.zeros((num_proteins, num_proteins))
+    similarities = np.zeros((num_proteins, num_proteins))
+    scores = np.zeros((num_proteins, num_proteins))
+    block_positions = max(1, block_size // (max(num_proteins, 1) * GAP_CODE))
+    for start in range(0, num_positions, block_positions):
+        block = codes[:, start:start + block_positions]
+        one_hot = np.zeros(block.shape + (GAP_CODE + 1,), dtype=np.float32)
+        one_hot[np.arange(num_proteins)[:, None], np.arange(block.shape[1])[None, :], block] = 1
+        one_hot = one_hot[:, :, :GAP_CODE]
+        rows = one_hot.reshape(num_proteins, -1)
+
+        identities += rows @ rows.T
+        similarities += (one_hot @ similar).reshape(num_proteins, -1) @ rows.T
+        scores += (one_hot @ positive_scores).reshape(num_proteins, -1) @ rows.T
+
+    gaps = (codes == GAP_CODE).astype(np.float32)
+    totals = num_positions - gaps @ gaps.T
+
+    return (np.rint(identities).astype(int), np.rint(similarities).astype(int), np.rint(scores),
+            np.rint(totals).astype(int))
+
+def format_percentage(count, total):
+    """Format a count as the percentage string used for identities and similarities."""
+    if not total:
+        return "{:10.0f}".format(-1)
+    return "{:10.0f}".format(count / total * 100)
+
+def percentages(counts, totals):
+    """Vectorized version of format_percentage, returns rounded integer percentages (-1 where total is 0)."""
+    result = np.full(counts.shape, -1, dtype=int)
+    compared = totals > 0
+    result[compared] = np.rint(counts[compared] / totals[compared] * 100)
+    return result
+
 
 class Alignment:
     """A class representing a protein sequence alignment, with or without a reference sequence."""
@@ -57,7 +128,6 @@ class Alignment:
         self.use_residue_groups = False
         self.ignore_alternative_residue_numbering_schemes = False # set to true if no numbering is to be displayed
         self.residues_to_delete = []
-        self.normalized_scores = OrderedDict()
         self.stats_done = False
         self.zscales = OrderedDict()
 
@@ -324,55 +394,91 @@ class Alignment:
 
         return hashlib.md5(hash_key.encode('utf-8')).hexdigest()
 
-    # AJK: point for optimization - primary bottleneck (#1 cleaning, #2 last for-loop in this function)
-    def build_alignment(self):
-        """Fetch selected residues from DB and build an alignment."""
-        # AJK: prevent prefetching all data for large alignments before checking #residues (DB + memory killer)
-        rs = Residue.objects.filter(protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins)
+    def load_stored_residues(self, alternative_numbers=False):
+        """Fetch selected residues from the aligned residue store (see build_aligned_residue_store).
 
+        Returns the segment residues and the individually selected residues (Custom segment), or None when the store
+        does not cover the selection.
+        """
+        segment_slugs = [s for s in self.segments if not (s == self.custom_segment_label or self.use_residue_groups)]
+        rs = load_aligned_residues(self.proteins, segment_slugs, alternative_numbers)
+        if rs is None:
+            return None
+
+        # If segment flagged to only include the alignable residues, exclude the ones with no GN
+        if self.segments_only_alignable:
+            rs = [r for r in rs if r.generic_number or r.protein_segment.slug not in self.segments_only_alignable]
 
-        self.number_of_residues_total = len(rs)
-        if self.number_of_residues_total>120000: #300 receptors, 400 residues limit
-            return "Too large"
+        # individually selected residues (Custom segment) can belong to any segment
+        crs = {}
+        for segment in self.segments:
+            if segment == self.custom_segment_label or self.use_residue_groups:
+                labels = set(self.segments[segment])
+                segment_slugs = list(ResidueGenericNumber.objects.filter(label__in=labels).values_list(
+                    'protein_segment__slug', flat=True).distinct())
+                segment_rs = load_aligned_residues(self.proteins, segment_slugs, alternative_numbers)
+                if segment_rs is None:
+                    return None
+                crs[segment] = [r for r in segment_rs if r.generic_number and r.generic_number.label in labels]
+
+        return rs, crs
+
+    def build_alignment(self):
+        """Fetch selected residues from DB and build an alignment."""
+        alternative_numbers = not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1
+
+        # Residues are read from the precomputed aligned residue store, which is sliced per segment and does not
+        # require any per-residue ORM objects. The Residue table is only queried when the store is not built.
+        stored_residues = self.load_stored_residues(alternative_numbers)
+        if stored_residues:
+            rs, crs = stored_residues
+            self.number_of_residues_total = len(rs)
+        else:
+            # AJK: prevent prefetching all data for large alignments before checking #residues (DB + memory killer)
+            rs = Residue.objects.filter(protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins)
+            self.number_of_residues_total = rs.count()
+            if self.number_of_residues_total>120000: #300 receptors, 400 residues limit
+                return "Too large"
 
         # AJK: performance boost -> Internal caching (not for very small alignments)
-        # AJK: note -> ideally we would have fully cached alignments and only select the relevant segments afterwards.
-        cache_key = "ALIGNMENTS_"+self.get_hash()
+        # (the prefix marks the cache format, entries cached before the encoded alignment was stored are not read)
+        cache_key = "ALIGNMENTS_ENCODED_"+self.get_hash()
 
         #cache_alignments.set(cache_key, 0, 0)
         if self.number_of_residues_total < 2500 or not cache_alignments.has_key(cache_key):
-            # fetch segment residues
-            if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
-                rs = Residue.objects.filter(
-                    protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
-                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                    'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
-            else:
-                rs = Residue.objects.filter(
-                    protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
-                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                    'generic_number__scheme', 'display_generic_number__scheme')
-
-            # If segment flagged to only include the alignable residues, exclude the ones with no GN
-            for s in self.segments_only_alignable:
-                rs = rs.exclude(protein_segment__slug=s, generic_number=None)
-
-            # fetch individually selected residues (Custom segment)
-            crs = {}
-            for segment in self.segments:
-                if segment == self.custom_segment_label or self.use_residue_groups:
-                    if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
-                        crs[segment] = Residue.objects.filter(
-                            generic_number__label__in=self.segments[segment],
-                            protein_conformation__in=self.proteins).prefetch_related(
-                            'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                            'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
-                    else:
-                        crs[segment] = Residue.objects.filter(
-                            generic_number__label__in=self.segments[segment],
-                            protein_conformation__in=self.proteins).prefetch_related(
-                            'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                            'generic_number__scheme', 'display_generic_number__scheme')
+            if not stored_residues:
+                # fetch segment residues
+                if alternative_numbers:
+                    rs = Residue.objects.filter(
+                        protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
+                        'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
+                        'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
+                else:
+                    rs = Residue.objects.filter(
+                        protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
+                        'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
+                        'generic_number__scheme', 'display_generic_number__scheme')
+
+                # If segment flagged to only include the alignable residues, exclude the ones with no GN
+                for s in self.segments_only_alignable:
+                    rs = rs.exclude(protein_segment__slug=s, generic_number=None)
+
+                # fetch individually selected residues (Custom segment)
+                crs = {}
+                for segment in self.segments:
+                    if segment == self.custom_segment_label or self.use_residue_groups:
+                        if alternative_numbers:
+                            crs[segment] = Residue.objects.filter(
+                                generic_number__label__in=self.segments[segment],
+                                protein_conformation__in=self.proteins).prefetch_related(
+                                'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
+                                'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
+                        else:
+                            crs[segment] = Residue.objects.filter(
+                                generic_number__label__in=self.segments[segment],
+                                protein_conformation__in=self.proteins).prefetch_related(
+                                'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
+                                'generic_number__scheme', 'display_generic_number__scheme')
 
             # create a dict of proteins, segments and residues
             proteins = {}
@@ -651,7 +757,9 @@ class Alignment:
                               'amino_acids': self.amino_acids,
                               'amino_acid_stats': self.amino_acid_stats,
                               'aa_count': self.aa_count,
-                              'aa_count_with_protein': self.aa_count_with_protein,
+                              # the encoded alignment, aa_count_with_protein is collected from it when used
+                              'statistics_columns': self._statistics_alignment[1],
+                              'statistics_codes': self._statistics_alignment[3],
                               'gaps': self.gaps,
                               'feat_consensus': self.feat_consensus,
                               'features': self.features,
@@ -673,7 +781,6 @@ class Alignment:
             self.amino_acids = cache_data['amino_acids']
             self.amino_acid_stats = cache_data['amino_acid_stats']
             self.aa_count = cache_data['aa_count']
-            self.aa_count_with_protein = cache_data['aa_count_with_protein']
             self.gaps = cache_data['gaps']
             self.feat_consensus = cache_data['feat_consensus']
             self.features = cache_data['features']
@@ -688,6 +795,9 @@ class Alignment:
             self.positions = cache_data['positions']
             self.segments = cache_data['segments']
             self.zscales = cache_data['zscales']
+            self._statistics_alignment = (self.unique_proteins, cache_data['statistics_columns'],
+                cache_data['statistics_codes'] != SKIP_CODE, cache_data['statistics_codes'])
+            self._aa_count_with_protein = None
             self.stats_done = True
 
         # Adapt alignment to order in current self.proteins
@@ -795,133 +905,169 @@ class Alignment:
         """A placeholder for an instance specific function."""
         return generic_number
 
-    def calculate_statistics(self, ignore={}):
-        """Calculate consensus sequence and amino acid and feature frequency."""
-        if not self.stats_done:
-            feature_count = OrderedDict()
-            most_freq_aa = OrderedDict()
-            amino_acids = OrderedDict([(a, 0) for a in AMINO_ACIDS]) # from common.definitions
-            self.amino_acids = list(AMINO_ACIDS.keys())
-
-            # AJK: optimized for speed - split into multiple steps
-            for i, p in enumerate(self.unique_proteins):
-                entry_name = p.protein.entry_name
-                # print(entry_name)
-                for j, s in p.alignment.items():
-                    if i == 0:
-                        self.aa_count[j] = OrderedDict()
+    @property
+    def aa_count_with_protein(self):
+        """Proteins behind each amino acid of each position, collected from the statistics alignment on first use."""
+        if self._aa_count_with_protein is None:
+            proteins, columns, counted, codes = self._statistics_alignment
+            amino_acid_labels = list(AMINO_ACIDS.keys())
+
+            # group the counted residues by position label and amino acid, ordered by first appearance
+            aa_count_with_protein = OrderedDict()
+            protein_names = np.array([p.protein.entry_name for p in proteins], dtype=object)
+            position_labels = OrderedDict()
+            position_ids = np.array([position_labels.setdefault(c[1], len(position_labels)) for c in columns],
+                dtype=np.intp)
+            labels = list(position_labels)
+            cell_rows, cell_columns = np.nonzero(counted)
+            cell_keys = position_ids[cell_columns] * SKIP_CODE + codes[cell_rows, cell_columns]
+            order = np.argsort(cell_keys, kind='stable')
+            starts = np.flatnonzero(np.diff(cell_keys[order], prepend=-1))
+            ends = np.append(starts[1:], len(order)).tolist()
+            group_keys = cell_keys[order[starts]].tolist()
+            group_names = protein_names[cell_rows[order]].tolist()
+            first_cells = order[starts]
+            starts = starts.tolist()
+            for k in np.argsort(first_cells, kind='stable').tolist():
+                generic_number = labels[group_keys[k] // SKIP_CODE]
+                if generic_number not in aa_count_with_protein:
+                    aa_count_with_protein[generic_number] = {}
+                aa_count_with_protein[generic_number][amino_acid_labels[group_keys[k] % SKIP_CODE]] = set(
+                    group_names[starts[k]:ends[k]])
+            self._aa_count_with_protein = aa_count_with_protein
+        return self._aa_count_with_protein
+
+    @aa_count_with_protein.setter
+    def aa_count_with_protein(self, value):
+        self._aa_count_with_protein = value
+
+    def encode_statistics_alignment(self, ignore={}):
+        """Encode the residues of the unique proteins as an integer matrix (proteins x positions) for the statistics.
+
+        Returns the segment slugs, the (segment, position) of every column and the matrix of AMINO_ACIDS indices.
+        Residues that are not counted (unknown residues and ignored positions) are encoded as SKIP_CODE.
+        """
+        residue_codes = AMINO_ACID_CODES.copy()
+        for gap in self.gaps:
+            # gaps are not counted when positions are ignored
+            residue_codes[ord(gap)] = SKIP_CODE if ignore else list(AMINO_ACIDS).index('-')
+
+        if not self.unique_proteins:
+            return [], [], np.zeros((0, 0), dtype=np.uint8)
+
+        # all proteins normally share the layout of the first protein, other rows are placed by position
+        first = self.unique_proteins[0].alignment
+        segments = list(first)
+        columns = [(segment, p[0]) for segment, s in first.items() for p in s]
+        lengths = [len(s) for s in first.values()]
+        column_index = None
+        rows = []
+        for protein in self.unique_proteins:
+            if [len(s) for s in protein.alignment.values()] == lengths:
+                sequence = ''.join([p[2] for s in protein.alignment.values() for p in s])
+                rows.append(residue_codes[np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8)])
+            else:
+                if column_index is None:
+                    column_index = {c: i for i, c in enumerate(columns)}
+                indices = []
+                sequence = ''
+                for segment, s in protein.alignment.items():
+                    if segment not in segments:
+                        segments.append(segment)
                     for p in s:
-                        generic_number = p[0]
-                        display_generic_number = p[1]
-                        amino_acid = p[2]
-
-                        ignore_list = ignore.get(generic_number, [])
-
-                        # Indicate gap and collect statistics
-                        if amino_acid in self.gaps:
-                            amino_acid = '-'
-
-                        # Skip when unknown amino acid type
-                        elif amino_acid == 'X':
-                            continue
-
-                        # skip when position is on the ignore list
-                        if entry_name in ignore_list:
-                            continue
-
-                        if ignore and amino_acid in self.gaps:
-                            continue
-
-                        # Init counters
-                        if generic_number not in self.aa_count[j]:
-                            self.aa_count[j][generic_number] = amino_acids.copy()
-                            #                        if generic_number in self.generic_number_objs:
-                            self.aa_count_with_protein[generic_number] = {}
-
-                        # update amino acid counter for this generic number
-                        self.aa_count[j][generic_number][amino_acid] += 1
+                        if (segment, p[0]) not in column_index:
+                            column_index[(segment, p[0])] = len(columns)
+                            columns.append((segment, p[0]))
+                        indices.append(column_index[(segment, p[0])])
+                        sequence += p[2]
+                rows.append((indices, residue_codes[np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8)]))
+
+        codes = np.full((len(rows), len(columns)), SKIP_CODE, dtype=np.uint8)
+        for i, row in enumerate(rows):
+            if isinstance(row, tuple):
+                codes[i, row[0]] = row[1]
+            else:
+                codes[i, :len(row)] = row
 
-                        #if generic_number in self.generic_number_objs:
-                        if amino_acid not in self.aa_count_with_protein[generic_number]:
-                            self.aa_count_with_protein[generic_number][amino_acid] = {entry_name}
-                        elif entry_name not in self.aa_count_with_protein[generic_number][amino_acid]:
-                            self.aa_count_with_protein[generic_number][amino_acid].add(entry_name)
+        # skip the proteins on the ignore list of a position
+        if ignore:
+            protein_rows = {}
+            for i, p in enumerate(self.unique_proteins):
+                protein_rows.setdefault(p.protein.entry_name, []).append(i)
+            for c, (segment, generic_number) in enumerate(columns):
+                for entry_name in ignore.get(generic_number, []):
+                    codes[protein_rows.get(entry_name, []), c] = SKIP_CODE
 
+        return segments, columns, codes
 
-            # AJK: Only need for update at the end of loop
-            # 1. Update most frequent amino_acids for this generic number
-            # 2. Update feature counter for this generic number
-            features = OrderedDict([(a, 0) for a in AMINO_ACID_GROUPS])
+    def calculate_statistics(self, ignore={}):
+        """Calculate consensus sequence and amino acid and feature frequency."""
+        if not self.stats_done:
+            amino_acid_labels = list(AMINO_ACIDS.keys())
+            self.amino_acids = amino_acid_labels
+            self.aa_count = OrderedDict()
+            self.consensus = OrderedDict()
+            self.forced_consensus = OrderedDict()
+            self.full_consensus = []
+            self.amino_acid_stats = []
+            self.feature_stats = []
+
+            # count all amino acids of all positions at once
+            segments, columns, codes = self.encode_statistics_alignment(ignore)
+            num_proteins, num_columns = codes.shape
+            counts = np.bincount((np.arange(num_columns, dtype=np.intp) * (SKIP_CODE + 1) + codes).ravel(),
+                minlength=num_columns * (SKIP_CODE + 1)).reshape(num_columns, SKIP_CODE + 1)[:, :SKIP_CODE]
+            counted = codes != SKIP_CODE
+            present = counted.any(axis=0)
+
+            # positions are added to the counters in the order they are first encountered (by protein, then position)
+            first_counted = np.where(present, counted.argmax(axis=0), num_proteins)
+            for segment in segments:
+                self.aa_count[segment] = OrderedDict()
+            count_rows = counts.tolist()
+            for c in np.lexsort((np.arange(num_columns), first_counted)).tolist():
+                if present[c]:
+                    segment, generic_number = columns[c]
+                    self.aa_count[segment][generic_number] = OrderedDict(zip(amino_acid_labels, count_rows[c]))
+
+            # proteins behind each amino acid of each position are only collected when used
+            self._statistics_alignment = (self.unique_proteins, columns, counted, codes)
+            self._aa_count_with_protein = None
+
+            features = list(AMINO_ACID_GROUPS)
             self.features_combo = [(x, y['display_name_short'], y['length']) for x,y in zip(list(AMINO_ACID_GROUP_NAMES.values()), list(AMINO_ACID_GROUP_PROPERTIES.values()))]
             self.features = list(AMINO_ACID_GROUP_NAMES.values())
 
-            for j in self.aa_count:
-                most_freq_aa[j] = OrderedDict()
-                feature_count[j] = OrderedDict()
-                for generic_number in self.aa_count[j]:
-                    feature_count[j][generic_number] = features.copy()
-                    most_freq_aa[j][generic_number] = [[], 0]
-                    for amino_acid in self.aa_count[j][generic_number]:
-                        # Most frequent AA
-                        if self.aa_count[j][generic_number][amino_acid] > most_freq_aa[j][generic_number][1]:
-                            most_freq_aa[j][generic_number] = [[amino_acid], self.aa_count[j][generic_number][amino_acid]]
-                        elif self.aa_count[j][generic_number][amino_acid] == most_freq_aa[j][generic_number][1]:
-                            if amino_acid not in most_freq_aa[j][generic_number][0]:
-                                most_freq_aa[j][generic_number][0].append(amino_acid)
-
-                        # create property frequency
-                        if self.aa_count[j][generic_number][amino_acid] > 0:
-                            for feature in AMINO_ACID_GROUPS_AA[amino_acid]:
-                                feature_count[j][generic_number][feature] += self.aa_count[j][generic_number][amino_acid]
-
-            # merge the amino acid counts into a consensus sequence
-            num_proteins = len(self.unique_proteins)
+            # frequencies (%) of amino acids and features, an extra row of zeros for positions without counts
+            with np.errstate(divide='ignore', invalid='ignore'):
+                amino_acid_freqs = np.rint(counts / num_proteins * 100).astype(int)
+                feature_freqs = np.rint(counts.dot(AMINO_ACID_GROUP_MEMBERS) / num_proteins * 100).astype(int)
+            amino_acid_freqs = np.vstack([amino_acid_freqs, np.zeros(SKIP_CODE, dtype=int)])
+            feature_freqs = np.vstack([feature_freqs, np.zeros(len(features), dtype=int)])
+
+            # merge the amino acid counts into a consensus sequence, most frequent amino acids first
+            max_counts = counts.max(axis=1, initial=0).tolist()
+            column_index = {c: i for i, c in enumerate(columns)}
             sequence_counter = 1
-            for i, s in most_freq_aa.items():
+            for i, s in self.aa_count.items():
                 self.consensus[i] = OrderedDict()
                 self.forced_consensus[i] = OrderedDict()
-                if i == 'Custom' and s == 'x':
-                    sorted_res = sorted(s, key=lambda x: (x.split("x")[0], x.split("x")[1]))
-                elif i == 'Custom' and s == '.':
-                    sorted_res = sorted(s, key=lambda x: (x.split(".")[0], x.split(".")[1]))
-                else:
-                    sorted_res = sorted(s)
-                for p in sorted_res:
-                    r = s[p]
-                    conservation = str(round(r[1]/num_proteins*100))
-                    if len(conservation) == 1:
-                        cons_interval = '0'
-                    else:
-                        # the intervals are defined as 0-10, where 0 is 0-9, 1 is 10-19 etc. Used for colors.
-                        cons_interval = conservation[:-1]
+                for p in sorted(s):
+                    c = column_index[(i, p)]
+                    most_frequent = [amino_acid_labels[a] for a in np.flatnonzero(counts[c] == max_counts[c])]
+                    frequency = round(max_counts[c]/num_proteins*100)
+                    cons_interval = FREQUENCY_LABELS[frequency][1]
 
                     # forced consensus sequence uses the first residue to break ties
-                    self.forced_consensus[i][p] = r[0][0]
+                    self.forced_consensus[i][p] = most_frequent[0]
 
                     # consensus sequence displays + in tie situations
-                    num_freq_aa = len(r[0])
-                    if num_freq_aa == 1:
-                        # Use raw data
-                        self.consensus[i][p] = [
-                            r[0][0],
-                            cons_interval,
-                            round(r[1]/num_proteins*100),
-                            ""
-                        ]
-                    elif num_freq_aa > 1 and ignore:
-                        self.consensus[i][p] = [
-                            r[0][0],
-                            cons_interval,
-                            round(r[1]/num_proteins*100),
-                            ", ".join(r[0])
-                        ]
-                    elif num_freq_aa > 1:
-                        self.consensus[i][p] = [
-                            '+',
-                            cons_interval,
-                            round(r[1]/num_proteins*100),
-                            ", ".join(r[0])
-                        ]
+                    if len(most_frequent) == 1:
+                        self.consensus[i][p] = [most_frequent[0], cons_interval, frequency, ""]
+                    elif ignore:
+                        self.consensus[i][p] = [most_frequent[0], cons_interval, frequency, ", ".join(most_frequent)]
+                    else:
+                        self.consensus[i][p] = ['+', cons_interval, frequency, ", ".join(most_frequent)]
 
                     # create a residue object full consensus
                     res = Residue()
@@ -930,90 +1076,28 @@ class Alignment:
                         res.display_generic_number = self.generic_number_objs[p]
                     res.family_generic_number = p
                     res.segment_slug = i
-                    res.amino_acid = r[0][0]
-                    res.frequency = self.consensus[i][p][2]
+                    res.amino_acid = most_frequent[0]
+                    res.frequency = frequency
                     self.full_consensus.append(res)
 
                     # update sequence counter
                     sequence_counter += 1
 
-            # process amino acid frequency
-            for i, amino_acid in enumerate(AMINO_ACIDS):
-                self.amino_acid_stats.append([])
-                j = 0
-                for segment, segment_num in self.aa_count.items():
-                    self.amino_acid_stats[i].append([])
-                    k = 0
-                    # if segment == 'Custom' and segment_num == 'x':
-                    #     sorted_res = sorted(segment_num, key=lambda x: (x.split("x")[0], x.split("x")[1]))
-                    # elif segment == 'Custom' and segment_num == '.':
-                    #     sorted_res = sorted(segment_num, key=lambda x: (x.split(".")[0], x.split(".")[1]))
-                    # else:
-                    #sorted_res = segment_num
-                    for gn in self.generic_numbers[self.numbering_schemes[0][0]][segment]:
-                        aas = segment_num[gn]
-                        self.amino_acid_stats[i][j].append([])
-                        for aa, freq in aas.items():
-                            if aa == amino_acid:
-                                frequency = str(round(freq/num_proteins*100))
-                                if len(frequency) == 1:
-                                    freq_interval = '0'
-                                else:
-                                    # intervals defined in the same way as for the consensus sequence
-                                    freq_interval = frequency[:-1]
-                                self.amino_acid_stats[i][j][k] = [frequency, freq_interval]
-                        k += 1
-                    j += 1
-
-            # create index and prepare stats array
-            index_AAG = {}
-            for i, feature in enumerate(AMINO_ACID_GROUPS):
-                index_AAG[feature] = i
-                self.feature_stats.append([])
-                for segment in feature_count:
-                    self.feature_stats[i].append([])
-
-            j = 0
-            for segment, segment_num in feature_count.items():
-                k = 0
-
-                # first_gn = list(segment_num.items())[0]
-                # if segment == 'Custom' and 'x' in first_gn:
-                #     sorted_res = sorted(segment_num, key=lambda x: (x.split("x")[0], x.split("x")[1]))
-                # elif segment == 'Custom' and '.' in first_gn:
-                #     sorted_res = sorted(segment_num, key=lambda x: (x.split(".")[0], x.split(".")[1]))
-                # else:
-
-                for gn in self.generic_numbers[self.numbering_schemes[0][0]][segment]:
-                    fs = segment_num[gn]
-
-                    for f, freq in fs.items():
-                        # find feature key
-                        i = index_AAG[f]
-
-                        frequency = str(round(freq/num_proteins*100))
-                        if len(frequency) == 1:
-                            freq_interval = '0'
-                        else:
-                            # intervals defined in the same way as for the consensus sequence
-                            freq_interval = frequency[:-1]
-
-                        self.feature_stats[i][j].append([])
-                        self.feature_stats[i][j][k] = [frequency, freq_interval]
-                    k += 1
-                j += 1
+            # amino acid and feature frequencies, accessed via amino acid/feature, segment, position
+            segment_columns = []
+            for segment in self.aa_count:
+                segment_columns.append([column_index.get((segment, gn), num_columns)
+                    for gn in self.generic_numbers[self.numbering_schemes[0][0]][segment]])
+            for freqs, stats in ((amino_acid_freqs, self.amino_acid_stats), (feature_freqs, self.feature_stats)):
+                for values in freqs.T:
+                    stats.append([[list(FREQUENCY_LABELS[v]) for v in values[cols].tolist()]
+                        for cols in segment_columns])
 
             # process feature frequency
-            feats = OrderedDict()
             self.feat_consensus = OrderedDict([(x, []) for x in self.segments])
             for sid, segment in enumerate(self.segments):
-
-                # Feature_stats is accessed via feature, segment, residue
-                feats[segment] = np.array(
-                    [[x[0] for x in feat[sid]] for feat in self.feature_stats],
-                    dtype='int'
-                )
-
+                # feature frequencies (features x positions) of this segment
+                feats = {segment: feature_freqs[segment_columns[sid]].T.reshape(len(features), -1)}
                 feat_cons_tmp = feats[segment].argmax(axis=0)
                 feat_cons_tmp = self._assign_preferred_features(feat_cons_tmp, segment, feats)
                 for col, pos in enumerate(list(feat_cons_tmp)):
@@ -1023,13 +1107,8 @@ class Alignment:
                         feats[segment][pos][col],
                         int(feats[segment][pos][col]/20)+5,
                         list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['length'],
-                        list(AMINO_ACID_GROUPS.keys())[pos]
+                        features[pos]
                     ])
-                #print(self.feat_consensus[segment])
-
-            del feats
-            if 'feat_cons_tmp' in locals():
-                del feat_cons_tmp
 
             self.calculate_zscales(True)
             self.stats_done = True
@@ -1048,42 +1127,57 @@ class Alignment:
                             generic_lookup_aa_freq[self.generic_number_objs[g].label] = {aa: round(c/num_proteins*100) }
         return generic_lookup_aa_freq
 
+    def encode_alignment(self, proteins=None):
+        """Encode the aligned residues of the proteins as an integer matrix (proteins x positions)."""
+        if proteins is None:
+            proteins = self.proteins
+        residue_codes = RESIDUE_CODES.copy()
+        for gap in self.gaps:
+            residue_codes[ord(gap)] = GAP_CODE
+
+        rows = []
+        for protein in proteins:
+            sequence = ''.join([p[2] for s in protein.alignment.values() for p in s])
+            rows.append(np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8))
+        if not rows:
+            return np.zeros((0, 0), dtype=np.uint8)
+        return residue_codes[np.array(rows)]
+
     def calculate_similarity(self, normalized=False):
         """Calculate the sequence identity/similarity of every selected protein compared to a selected reference."""
-        for i, protein in enumerate(self.proteins):
-            # skip the first row, as it is the reference
-            if i == 0:
-                continue
-
-            # calculate identity, similarity and similarity score to the reference
-            if not normalized:
-                calc_values = self.pairwise_similarity(self.proteins[0], self.proteins[i])
-                # update the protein
-                if calc_values:
-                    self.proteins[i].identity = calc_values[0]
-                    self.proteins[i].similarity = calc_values[1]
-                    self.proteins[i].similarity_score = calc_values[2]
-            else:
-                self.pairwise_similarity_normalized(self.proteins[0], self.proteins[i])
-
-        # calculate normalized identity, similarity and similarity score, removes columns where reference is gapped, gaps in templates are removed from the specific pairwise alignment
-        if normalized:
-            i = 1
-            for protein_2, values in self.normalized_scores.items():
-                for j in range(0, 3):
-                    for gn in list(values[j].keys()):
-                        if gn in self.residues_to_delete:
-                            del self.normalized_scores[protein_2][j][gn]
-                identities = list(self.normalized_scores[protein_2][0].values())
-                similarities = list(self.normalized_scores[protein_2][1].values())
-                similarity_scores = list(self.normalized_scores[protein_2][2].values())
-                identity = "{:10.0f}".format(sum(identities) / len(identities) * 100)
-                similarity = "{:10.0f}".format(sum(similarities) / len(similarities) * 100)
-                similarity_score = sum(similarity_scores)
-                self.proteins[i].identity = identity
-                self.proteins[i].similarity = similarity
-                self.proteins[i].similarity_score = similarity_score
-                i+=1
+        codes = self.encode_alignment()
+        reference = codes[0]
+        reference_gaps = reference == GAP_CODE
+        gaps = codes == GAP_CODE
+        scores = SIMILARITY_SCORES[reference, codes]
+        identical = (codes == reference) & ~gaps
+
+        if not normalized:
+            # positions gapped in both sequences are ignored, scores are only counted for ungapped positions
+            totals = (~(reference_gaps & gaps)).sum(axis=1)
+            positive = (scores > 0) & ~reference_gaps & ~gaps
+            identities = identical.sum(axis=1)
+            similarities = positive.sum(axis=1)
+            similarity_scores = np.where(positive, scores, 0).sum(axis=1)
+        else:
+            # calculate normalized identity, similarity and similarity score, removes columns where reference is
+            # gapped, gaps in templates are removed from the specific pairwise alignment
+            labels = [p[0] for s in self.proteins[0].alignment.values() for p in s]
+            if len(self.proteins) > 1:
+                for label, gap in zip(labels, reference_gaps):
+                    if gap and label not in self.residues_to_delete:
+                        self.residues_to_delete.append(label)
+            deleted = np.array([label in self.residues_to_delete for label in labels], dtype=bool)
+            compared = ~deleted & ~reference_gaps & ~gaps
+            totals = compared.sum(axis=1)
+            identities = (identical & compared).sum(axis=1)
+            similarities = ((scores > 0) & compared).sum(axis=1)
+            similarity_scores = np.where(compared, scores, 0).sum(axis=1)
+
+        for i in range(1, len(self.proteins)):
+            self.proteins[i].identity = format_percentage(identities[i], totals[i])
+            self.proteins[i].similarity = format_percentage(similarities[i], totals[i])
+            self.proteins[i].similarity_score = similarity_scores[i] if totals[i] else 0
 
         # order protein list by similarity score
         ref = self.proteins.pop(0)
@@ -1102,30 +1196,27 @@ class Alignment:
             protein_name = "[" + protein.protein.species.common_name + "] " + protein.protein.name
             self.similarity_matrix[protein_key] = {'name': protein_name, 'values': [None] * len(self.proteins)}
 
-        # similarity comparisons
-        for i, protein in enumerate(self.proteins):
-            protein_key = protein.protein.entry_name
-            self.similarity_matrix[protein_key]['values'][i] = ['-', '-']
+        # similarity comparisons, all pairs are calculated at once
+        identities, similarities, similarity_scores, totals = similarity_counts(self.encode_alignment())
+        identities = percentages(identities, totals)
+        similarities = percentages(similarities, totals)
 
-            for k in range(i+1, len(self.proteins)):
-                # calculate identity, similarity and similarity score to the reference
-                calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
-
-                # Identity
-                value = calc_values[1].strip()
-                if int(value) < 10:
-                    color_class = 0
-                else:
-                    color_class = str(value)[:-1]
-                self.similarity_matrix[self.proteins[k].protein.entry_name]['values'][i] = [value, color_class]
+        # cell values and color classes for every possible percentage
+        cells = {}
+        for value in range(-1, 101):
+            if value < 10:
+                color_class = 0
+            else:
+                color_class = str(value)[:-1]
+            cells[value] = (str(value), color_class)
 
-                # Similarity
-                value = calc_values[0].strip()
-                if int(value) < 10:
-                    color_class = 0
-                else:
-                    color_class = str(value)[:-1]
-                self.similarity_matrix[protein_key]['values'][k] = [value, color_class]
+        # lower triangle shows the similarity, upper triangle the identity
+        for i, protein in enumerate(self.proteins):
+            protein_key = protein.protein.entry_name
+            values = [list(cells[value]) for value in similarities[i][:i].tolist()]
+            values.append(['-', '-'])
+            values.extend([list(cells[value]) for value in identities[i][i+1:].tolist()])
+            self.similarity_matrix[protein_key]['values'] = values
 
     def calculate_zscales(self, from_stats = False):
         """Calculate Z-scales distribution for current alignment set."""
@@ -1136,39 +1227,36 @@ class Alignment:
             else:
                 # Prepare Z-scales per segment/GN position
                 self.zscales = OrderedDict([ (zscale, OrderedDict()) for zscale in ZSCALES ])
+                zscale_aas = [aa for aa in AMINO_ACIDS if aa in AA_ZSCALES and aa != '-']
+                zscale_values = np.array([AA_ZSCALES[aa] for aa in zscale_aas])
 
-                # Calculates distribution per GN position
+                # Calculates distribution per GN position from the amino acid counts
                 for segment in self.aa_count:
                     for zscale in ZSCALES:
                         self.zscales[zscale][segment] = OrderedDict()
-                    for generic_number in self.aa_count[segment]:
-                        zscale_position = { zscale: [] for zscale in ZSCALES }
-
-                        for amino_acid in self.aa_count[segment][generic_number]:
-                            if amino_acid != "-" and self.aa_count[segment][generic_number][amino_acid] > 0:
-                                for key in range(len(ZSCALES)):
-                                    # Frequency AA at this position * value
-                                    if amino_acid in AA_ZSCALES:
-                                        zscale_position[ZSCALES[key]].extend([AA_ZSCALES[amino_acid][key]] * self.aa_count[segment][generic_number][amino_acid])
+                    for generic_number, counts in self.aa_count[segment].items():
+                        # Z-scales (zscales x residues) of all residues at this position
+                        zscale_position = np.repeat(zscale_values, [counts[aa] for aa in zscale_aas], axis=0).T.copy()
+                        z_count = zscale_position.shape[1]
 
                         # store average + stddev + count + display
-                        for zscale in ZSCALES:
-                            if len(zscale_position[zscale]) == 1:
-                                display = tooltip = str(round(zscale_position[zscale][0], 2)) + " ± " + str(0) + " (1)"
-                                self.zscales[zscale][segment][generic_number] = [zscale_position[zscale][0], 0, 1, display]
-                            else:
-                                z_mean = np.mean(zscale_position[zscale])
-                                z_std = np.std(zscale_position[zscale], ddof=1)
-                                z_count = len(zscale_position[zscale])
-                                display = tooltip = str(round(z_mean,2)) + " ± " + str(round(z_std, 2)) + " (" + str(z_count) + ")"
+                        if z_count == 1:
+                            for key, zscale in enumerate(ZSCALES):
+                                z_value = float(zscale_position[key][0])
+                                display = str(round(z_value, 2)) + " ± " + str(0) + " (1)"
+                                self.zscales[zscale][segment][generic_number] = [z_value, 0, 1, display]
+                        else:
+                            with np.errstate(divide='ignore', invalid='ignore'):
+                                z_means = np.mean(zscale_position, axis=1)
+                                z_stds = np.std(zscale_position, axis=1, ddof=1)
+                            for key, zscale in enumerate(ZSCALES):
+                                z_mean = z_means[key]
+                                z_std = z_stds[key]
+                                display = str(round(z_mean,2)) + " ± " + str(round(z_std, 2)) + " (" + str(z_count) + ")"
                                 self.zscales[zscale][segment][generic_number] = [z_mean, z_std, z_count, display]
 
-    def evaluate_sites(self, request):
-        """Evaluate which user selected site definitions match each protein sequence."""
-        # get simple selection from session
-        simple_selection = request.session.get('selection', False)
-
-        # format site definititions
+    def get_site_definitions(self, simple_selection):
+        """Format the user selected site definitions by residue group."""
         site_defs = {}
         for position in simple_selection.segments:
             if position.type == 'site_residue' and position.properties['site_residue_group']:
@@ -1185,16 +1273,59 @@ class Alignment:
                     #         'amino_acids': {
                     #             {'3x51': ['H', 'K', 'N', 'Q', 'R', 'S', 'T', 'W', 'Y'], '6x50': ['H', 'K', 'R']}
                     #         },
+                    #         'generic_numbers': {
+                    #             {'3x51': 321, '6x50': 567}
+                    #         },
                     #     }
                     # }
                     site_defs[group_id] = {'min_match': simple_selection.site_residue_groups[group_id -1][0],
                                            'positions': {},
                                            'amino_acids': {},
+                                           'generic_numbers': {},
                                            }
 
                 site_defs[group_id]['positions'][position.item.label] = position.properties['feature']
+                site_defs[group_id]['generic_numbers'][position.item.label] = position.item.default_generic_number_id
                 if 'amino_acids' in position.properties:
                     site_defs[group_id]['amino_acids'][position.item.label] = position.properties['amino_acids']
+        return site_defs
+
+    def evaluate_indexed_sites(self, request):
+        """Evaluate which proteins match the user selected site definitions using the site search index.
+
+        Can be used before build_alignment, so that only the matching proteins are aligned. Returns False when the
+        index does not cover the selected proteins, the sites then have to be evaluated with evaluate_sites.
+        """
+        simple_selection = request.session.get('selection', False)
+        site_defs = self.get_site_definitions(simple_selection)
+
+        # allowed amino acids of every position by generic number id
+        indexed_defs = {}
+        for group_id, site_def in site_defs.items():
+            amino_acids = {}
+            for label, feature in site_def['positions'].items():
+                if label in site_def['amino_acids']:
+                    amino_acids[site_def['generic_numbers'][label]] = site_def['amino_acids'][label]
+                else:
+                    amino_acids[site_def['generic_numbers'][label]] = AMINO_ACID_GROUPS.get(feature, ())
+            indexed_defs[group_id] = {'min_match': site_def['min_match'], 'amino_acids': amino_acids}
+
+        matching = match_site_definitions(indexed_defs, self.proteins)
+        if matching is None:
+            return False
+
+        self.non_matching_proteins = [p for p in self.proteins if p.id not in matching]
+        self.proteins = [p for p in self.proteins if p.id in matching]
+        self.stats_done = False
+        return True
+
+    def evaluate_sites(self, request):
+        """Evaluate which user selected site definitions match each protein sequence."""
+        # get simple selection from session
+        simple_selection = request.session.get('selection', False)
+
+        # format site definititions
+        site_defs = self.get_site_definitions(simple_selection)
 
         # go through all proteins and match against site definitions
         for protein in self.proteins:
@@ -1221,93 +1352,6 @@ class Alignment:
         # remove non-matching proteins from protein list
         self.proteins = [p for p in self.proteins if p not in self.non_matching_proteins]
 
-    def pairwise_similarity(self, protein_1, protein_2):
-        """Calculate the identity, similarity and similarity score between a pair of proteins."""
-        identityscore = 0
-        similarityscore = 0
-        totalcount = 0
-        totalsimilarity = 0
-        for j, s in protein_2.alignment.items():
-            for k, p in enumerate(s):
-                reference_residue = protein_1.alignment[j][k][2]
-                protein_residue = protein_2.alignment[j][k][2]
-                if not (reference_residue in self.gaps and protein_residue in self.gaps):
-                    totalcount += 1
-                    # identity
-                    if protein_residue == reference_residue:
-                        identityscore += 1
-
-                    # similarity
-                    if not (reference_residue in self.gaps or protein_residue in self.gaps):
-                        pair = (protein_residue, reference_residue)
-                        # Similarity lookup is slow -> disabling results in 1/3 reduction calc. time
-                        similarity = self.score_match(pair, substitution_matrices.load("BLOSUM62"))
-                        #                        similarity = 1
-                        if similarity > 0:
-                            similarityscore += 1
-                            totalsimilarity += similarity
-
-        # format the calculated values
-        #if identityscore and similarityscore:
-        if totalcount:
-            identity = "{:10.0f}".format(identityscore / totalcount * 100)
-            similarity = "{:10.0f}".format(similarityscore / totalcount * 100)
-            similarity_score = totalsimilarity
-
-            return identity, similarity, similarity_score
-        else:
-            # return False
-            # NOTE returning F results in fatal errors. No aligned residues: return -1
-            return "{:10.0f}".format(-1), "{:10.0f}".format(-1), 0
-
-    def pairwise_similarity_normalized(self, protein_1, protein_2):
-        """Calculate the identity, similarity and similarity score between a pair of proteins but delete gaps and normalize.
-
-        Used for finding closest receptor homologue with crystal structure.
-        """
-        identities = OrderedDict()
-        similarities = OrderedDict()
-        similarity_scores = OrderedDict()
-        ref_seq, temp_seq = '',''
-        for j, s in protein_2.alignment.items():
-            for k, p in enumerate(s):
-                reference_residue = protein_1.alignment[j][k][2]
-                protein_residue = protein_2.alignment[j][k][2]
-                ref_seq+=reference_residue
-                temp_seq+=protein_residue
-                if not (reference_residue in self.gaps and protein_residue in self.gaps):
-                    # identity
-                    if protein_residue == reference_residue:
-                        identities[p[0]] = 1
-                    else:
-                        identities[p[0]] = 0
-
-                    # similarity
-                    if reference_residue in self.gaps:
-                        if p[0] not in self.residues_to_delete:
-                            self.residues_to_delete.append(p[0])
-                    elif protein_residue in self.gaps:
-                        del identities[p[0]]
-                        pass
-                    else:
-                        pair = (protein_residue, reference_residue)
-                        similarity = self.score_match(pair, substitution_matrices.load("BLOSUM62"))
-                        if similarity > 0:
-                            similarities[p[0]] = 1
-                        else:
-                            similarities[p[0]] = 0
-                        similarity_scores[p[0]] = similarity
-                else:
-                    if p[0] not in self.residues_to_delete:
-                        self.residues_to_delete.append(p[0])
-        self.normalized_scores[protein_2] = [identities, similarities, similarity_scores]
-
-    def score_match(self, pair, matrix):
-        if pair not in matrix:
-            return matrix[(tuple(reversed(pair)))]
-        else:
-            return matrix[pair]
-
 
 class AlignedReferenceTemplate(Alignment):
     """ Creates a structure based alignment between reference protein and target proteins that are made up from the
@@ -1320,6 +1364,9 @@ class AlignedReferenceTemplate(Alignment):
         @param provide_main_temlpate_structure: Structure object, use only when aligning loops and when the main
         template is already known.
     """
+    # Cache key prefix of the template structures and their protein conformations, set for the duration of a homology model
+    # build (see enable_template_cache). The cache is shared by the build processes through the default cache.
+    template_cache_prefix = None
 
     def __init__(self):
         super(AlignedReferenceTemplate, self).__init__()
@@ -1424,8 +1471,34 @@ class AlignedReferenceTemplate(Alignment):
                 if main_st.protein_conformation.protein.parent.entry_name in self.main_temp_ban_list:
                     self.main_temp_ban_list.remove(main_st.protein_conformation.protein.parent.entry_name)
             self.structures_data = self.structures_data.exclude(protein_conformation__protein__parent__entry_name__in=self.main_temp_ban_list)
-        self.load_proteins(
-            [Protein.objects.get(id=target.protein_conformation.protein.parent.id) for target in self.structures_data])
+        self.structures_data = self.structures_data.select_related('pdb_code', 'state',
+                                                                  'protein_conformation__protein__parent')
+        if self.template_cache_prefix:
+            templates = self.load_templates()
+            self.structures_data = templates['structures']
+            self.proteins.extend(templates['proteins'])
+            self.update_numbering_schemes()
+            self.stats_done = False
+        else:
+            self.load_proteins([target.protein_conformation.protein.parent for target in self.structures_data])
+
+    @classmethod
+    def enable_template_cache(cls, build_id):
+        """Share the template structures and their protein conformations between all alignments of a build."""
+        cls.template_cache_prefix = 'HOMMOD_TEMPLATES_{}_'.format(build_id)
+
+    def load_templates(self):
+        """Returns the template structures and their protein conformations from the template cache, fetches them on a
+        miss."""
+        cache_key = self.template_cache_prefix + hashlib.md5(str(self.structures_data.query).encode('utf-8')).hexdigest()
+        templates = cache.get(cache_key)
+        if templates is None:
+            structures = list(self.structures_data)
+            a = Alignment()
+            a.load_proteins([target.protein_conformation.protein.parent for target in structures])
+            templates = {'structures': structures, 'proteins': a.proteins}
+            cache.set(cache_key, templates, 60*60*24)
+        return templates
 
     def get_main_template(self):
         """Returns main template structure after checking for matching helix start and end positions."""
@@ -1473,9 +1546,12 @@ class AlignedReferenceTemplate(Alignment):
         temp_list = []
         self.ordered_proteins = [self.proteins[0]]
         similarity_table = OrderedDict()
+        structures_by_protein = OrderedDict()
+        for structure in self.structures_data:
+            structures_by_protein.setdefault(structure.protein_conformation.protein.parent_id, []).append(structure)
         for protein in self.proteins:
             try:
-                matches = self.structures_data.filter(protein_conformation__protein__parent=protein.protein)
+                matches = structures_by_protein.get(protein.protein_id, [])
                 for m in matches:
                     if m.protein_conformation.protein.parent==self.reference_protein.protein and int(protein.similarity)==0:
                         continue
@@ -1880,7 +1956,7 @@ class GProteinAlignment(Alignment):
 
 
 class ClosestReceptorHomolog():
-    """Finds the closest receptor homolog that has a structure. Uses the pairwise_similarity_normalized function that deletes gaps."""
+    """Finds the closest receptor homolog that has a structure. Uses Alignment.calculate_similarity(normalized=True), which deletes gaps."""
     def __init__(self, protein, protein_segments=['TM1','TM2','TM3','TM4','TM5','TM6','TM7','H8'], normalized=True):
         self.protein = protein
         self.protein_segments = protein_segments
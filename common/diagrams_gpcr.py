@@ -4,15 +4,27 @@ from residue.models import Residue
 from residue.models import ResidueGenericNumber
 from residue.models import ResidueNumberingScheme
 
+from django.core.cache import cache
 from django.utils.safestring import mark_safe
 
 from math import cos, sin, pi, floor,sqrt
 from collections import OrderedDict
 from datetime import datetime
+import hashlib
+
+# The drawn residues and loops only depend on the residues and the class, so they are cached by their content and shared
+# between proteins, pages and the API. Colours and data overlays are applied to the residue ids in the browser.
+DIAGRAM_CACHE_TIMEOUT = 60*60*24*7
+
+def get_layout_key(diagram_type, protein_class, residue_data):
+    return diagram_type + '_layout_' + hashlib.md5(repr([protein_class, residue_data]).encode('utf-8')).hexdigest()
 
 
 class DrawSnakePlot(Diagram):
 
+    # drawing results used by __str__
+    layout_attributes = ['output', 'traceoutput', 'helixoutput', 'TBCoords', 'high', 'low', 'maxY', 'maxX']
+
     def __init__(self, residue_list, protein_class,protein_name, nobuttons = None):
         self.nobuttons = nobuttons
         self.type = 'snakeplot'
@@ -110,6 +122,13 @@ class DrawSnakePlot(Diagram):
         self.traceoutput = ""
         self.helixoutput = ""
 
+        layout_key = get_layout_key(self.type, self.family, list(self.segments.items()))
+        layout = cache.get(layout_key)
+        if layout is not None:
+            for attribute in self.layout_attributes:
+                setattr(self, attribute, layout[attribute])
+            return
+
         # if self.family.startswith('Class D'):
         #     self.count = 1
         #     self.count_sheet = 0
@@ -155,6 +174,8 @@ class DrawSnakePlot(Diagram):
 
         self.drawSnakePlotTerminals()
 
+        cache.set(layout_key, {attribute: getattr(self, attribute) for attribute in self.layout_attributes}, DIAGRAM_CACHE_TIMEOUT)
+
     def __str__(self):
         # NOTE: this translate is overwritten in JS (diagram.js)
         self.output_final = "<g id=snake transform='translate(0, " + str(-self.low+ self.offsetY) + ")'>" + self.traceoutput+self.output+self.helixoutput+self.drawToolTip() + "</g>"; #for resizing height
@@ -1214,17 +1235,28 @@ class DrawHelixBox(Diagram):
             self.family = 'Class A'
 
         segment_lists = {}
+        residue_data = []
         for r in residue_list:
             if r.protein_segment:
-                if r.protein_segment.slug not in segment_lists:
-                    segment_lists[r.protein_segment.slug] = []
-
-                segment_lists[r.protein_segment.slug].append(r)
+                segment = r.protein_segment.slug
             elif r.segment_slug: #from aligment
-                if r.segment_slug not in segment_lists:
-                    segment_lists[r.segment_slug] = []
-
-                segment_lists[r.segment_slug].append(r)
+                segment = r.segment_slug
+            else:
+                continue
+            if segment not in segment_lists:
+                segment_lists[segment] = []
+
+            segment_lists[segment].append(r)
+            if segment.startswith('TM'):
+                residue_data.append([segment, r.sequence_number, r.amino_acid,
+                    r.generic_number.label if r.generic_number else getattr(r, 'family_generic_number', None),
+                    r.display_generic_number.label if r.display_generic_number else None, getattr(r, 'frequency', None)])
+
+        layout_key = get_layout_key(self.type, self.family, residue_data)
+        self.output = cache.get(layout_key)
+        if self.output is not None:
+            return
+        self.output = ''
 
         for i in range(1,len(self.plot_data[self.family]['coordinates'])):
             try:
@@ -1243,6 +1275,8 @@ class DrawHelixBox(Diagram):
                 print('failed helix',i,msg)
                 pass
 
+        cache.set(layout_key, self.output, DIAGRAM_CACHE_TIMEOUT)
+
     def __str__(self):
         return mark_safe(self.create(self.output+self.drawToolTip(),595,430,"helixbox", self.nobuttons))
 
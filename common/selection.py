@@ -1,9 +1,19 @@
-﻿from django.conf import settings
+﻿from django.apps import apps
+from django.conf import settings
 
 from protein.models import Species
 from protein.models import ProteinSource
 from residue.models import ResidueNumberingScheme
 
+import json
+import zlib
+from collections import defaultdict
+
+
+# attributes of SimpleSelection that are lists of selection items
+SELECTION_ITEM_LISTS = ['reference', 'targets', 'segments', 'species', 'pref_g_proteins', 'g_proteins', 'annotation',
+    'numbering_schemes']
+
 
 class SimpleSelection:
     """A class representing the proteins and segments a user has selected. Can be serialized and stored in session"""
@@ -19,14 +29,18 @@ class SimpleSelection:
         self.pref_g_proteins = []
         self.g_proteins = []
 
-        # annotation
-        ps = ProteinSource.objects.get(name='SWISSPROT') # Default protein source is SWISSPROT
-        o = SelectionItem('protein_source', ps)
+        # model objects of the selection items are loaded on first use
+        self.resolver = SelectionResolver()
+
+        # annotation (only the primary keys are looked up, the objects are loaded on first use)
+        ps = ProteinSource.objects.values_list('pk', flat=True).get(name='SWISSPROT') # Default protein source is SWISSPROT
+        o = SelectionItem.from_reference('protein_source', (ProteinSource._meta.label_lower, ps), {}, self.resolver)
         self.annotation = [o]
 
         # numbering schemes
-        gn = ResidueNumberingScheme.objects.get(slug=settings.DEFAULT_NUMBERING_SCHEME)
-        o = SelectionItem('numbering_schemes', gn)
+        gn = ResidueNumberingScheme.objects.values_list('pk', flat=True).get(slug=settings.DEFAULT_NUMBERING_SCHEME)
+        o = SelectionItem.from_reference('numbering_schemes', (ResidueNumberingScheme._meta.label_lower, gn), {},
+            self.resolver)
         self.numbering_schemes = [o]
 
         # Default values for phylogenetic tree creation
@@ -37,7 +51,83 @@ class SimpleSelection:
         self.active_site_residue_group = False
 
     def __str__(self):
-        return str(self.__dict__)
+        return str({k: v for k, v in self.__dict__.items() if k != 'resolver'})
+
+    def __getstate__(self):
+        # stored in the session as the types, model references and properties of the items in compressed JSON
+        model_labels = []
+        data = {
+            'models': model_labels,
+            'tree_settings': self.tree_settings,
+            'site_residue_groups': self.site_residue_groups,
+            'active_site_residue_group': self.active_site_residue_group,
+        }
+        for name in SELECTION_ITEM_LISTS:
+            items = []
+            for selection_item in getattr(self, name):
+                label, pk = selection_item.reference()
+                if label not in model_labels:
+                    model_labels.append(label)
+                encoded = [selection_item.type, model_labels.index(label), pk]
+                if selection_item.properties:
+                    encoded.append(selection_item.properties)
+                items.append(encoded)
+            data[name] = items
+        return {'compact': zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))}
+
+    def __setstate__(self, state):
+        if 'compact' not in state:
+            # selections pickled with the model objects
+            self.__dict__.update(state)
+            self.resolver = SelectionResolver()
+            return
+        data = json.loads(zlib.decompress(state['compact']).decode('utf-8'))
+        self.resolver = SelectionResolver()
+
+        # items of which the object no longer exists (e.g. after a rebuild) are removed from the selection
+        pks = defaultdict(list)
+        for name in SELECTION_ITEM_LISTS:
+            for encoded in data[name]:
+                pks[encoded[1]].append(encoded[2])
+        existing = {}
+        for model_index, model_pks in pks.items():
+            model = apps.get_model(data['models'][model_index])
+            existing[model_index] = set(model._default_manager.filter(pk__in=model_pks).values_list('pk', flat=True))
+
+        removed_groups = defaultdict(int)
+        kept_groups = set()
+        for name in SELECTION_ITEM_LISTS:
+            items = []
+            for encoded in data[name]:
+                properties = encoded[3] if len(encoded) > 3 else {}
+                if encoded[2] in existing[encoded[1]]:
+                    items.append(SelectionItem.from_reference(encoded[0], (data['models'][encoded[1]], encoded[2]),
+                        properties, self.resolver))
+                    kept_groups.add(properties.get('site_residue_group'))
+                elif properties.get('site_residue_group'):
+                    removed_groups[properties['site_residue_group']] += 1
+            setattr(self, name, items)
+        self.tree_settings = data['tree_settings']
+        self.site_residue_groups = data['site_residue_groups']
+        self.active_site_residue_group = data['active_site_residue_group']
+
+        # update the site residue groups of removed items as Selection.remove does, the items of the groups after a
+        # deleted group are moved up
+        deleted_groups = [group_id for group_id in removed_groups if group_id not in kept_groups]
+        for group_id in sorted(removed_groups, reverse=True):
+            if group_id in deleted_groups:
+                del self.site_residue_groups[group_id-1]
+                self.active_site_residue_group = 1 if self.site_residue_groups else False
+            else:
+                for i in range(removed_groups[group_id]):
+                    self.site_residue_groups[group_id-1].pop()
+                if self.site_residue_groups[group_id-1][0] > len(self.site_residue_groups[group_id-1]):
+                    self.site_residue_groups[group_id-1][0] = len(self.site_residue_groups[group_id-1])
+        if deleted_groups:
+            for selection_item in self.segments:
+                group_id = selection_item.properties.get('site_residue_group')
+                if group_id:
+                    selection_item.properties['site_residue_group'] -= len([g for g in deleted_groups if g < group_id])
 
 
 class Selection(SimpleSelection):
@@ -112,7 +202,7 @@ class Selection(SimpleSelection):
         group_id = False
         delete_group = False
         for selection_object in selection:
-            if (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id) and 
+            if (selection_object.type == selection_subtype and selection_object.reference()[1] == int(selection_id) and 
                 'site_residue_group' in selection_object.properties and
                 selection_object.properties['site_residue_group']):
                 group_id = selection_object.properties['site_residue_group']
@@ -120,7 +210,7 @@ class Selection(SimpleSelection):
 
         # loop through selected objects and remove the one that matches the subtype and ID
         for selection_object in selection:
-            if not (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id)):
+            if not (selection_object.type == selection_subtype and selection_object.reference()[1] == int(selection_id)):
                 updated_selection.append(selection_object)
                 
                 # check group ID
@@ -168,6 +258,28 @@ class Selection(SimpleSelection):
         }
 
 
+class SelectionResolver:
+    """Loads the model objects of selection items on first use, with one query per model for all pending items"""
+    def __init__(self):
+        self.pending = defaultdict(set)
+        self.objects = {}
+
+    def register(self, reference):
+        if reference not in self.objects:
+            self.pending[reference[0]].add(reference[1])
+
+    def get(self, reference):
+        if reference not in self.objects:
+            label = reference[0]
+            pks = self.pending.pop(label, set())
+            pks.add(reference[1])
+            model = apps.get_model(label)
+            objects = model._default_manager.in_bulk(list(pks))
+            for pk in pks:
+                self.objects[(label, pk)] = objects.get(pk)
+        return self.objects[reference]
+
+
 class SelectionItem:
     """A wrapper class for selectable objects (protein, family, sequence segment etc.) that adds a type attribute"""
     def __init__(self, selection_type, selection_object, properties={}):
@@ -176,8 +288,52 @@ class SelectionItem:
         self.item = selection_object
         self.properties = properties
 
+    @classmethod
+    def from_reference(cls, selection_type, reference, properties, resolver):
+        """Selection item of which the model object (model label, primary key) is loaded by resolver on first use"""
+        selection_item = cls(selection_type, None, properties)
+        selection_item._reference = tuple(reference)
+        selection_item._resolver = resolver
+        resolver.register(selection_item._reference)
+        return selection_item
+
+    @property
+    def item(self):
+        if self._reference is not None:
+            self._item = self._resolver.get(self._reference)
+            self._reference = None
+            self._resolver = None
+        return self._item
+
+    @item.setter
+    def item(self, selection_object):
+        self._item = selection_object
+        self._reference = None
+        self._resolver = None
+
+    def reference(self):
+        """Model label and primary key of the selected object"""
+        if self._reference is not None:
+            return self._reference
+        return (self._item._meta.label_lower, self._item.pk)
+
+    def __getstate__(self):
+        return {'type': self.type, 'reference': self.reference(), 'properties': self.properties}
+
+    def __setstate__(self, state):
+        if 'reference' not in state:
+            # items pickled with the model object
+            self.__init__(state['type'], state['item'], state['properties'])
+            return
+        self.__init__(state['type'], None, state['properties'])
+        self._reference = tuple(state['reference'])
+        self._resolver = SelectionResolver()
+        self._resolver.register(self._reference)
+
     def __str__(self):
-        return str(self.__dict__)
+        return str({'type': self.type, 'type_title': self.type_title, 'item': self.item,
+            'properties': self.properties})
 
     def __eq__(self, other): 
-        return self.__dict__ == other.__dict__
\ No newline at end of file
+        return (isinstance(other, SelectionItem) and self.type == other.type
+            and self.reference() == other.reference() and self.properties == other.properties)
@@ -1,3 +1,170 @@
-from django.test import TestCase
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
 
-# Create your tests here.
+from common import tools
+from common.alignment import GAP_CODE, SIMILARITY_SCORES, similarity_counts
+from common.selection import SELECTION_ITEM_LISTS, Selection, SelectionItem, SimpleSelection
+from protein.models import Protein, ProteinFamily, ProteinSequenceType, ProteinSource, Species
+from residue.models import ResidueNumberingScheme
+
+import json
+import pickle
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import numpy as np
+
+
+class WebAPIHandler(BaseHTTPRequestHandler):
+    """Answers /missing/ with 404, /flaky/ with 503 on the first request of a path and everything else with json"""
+    requests = Counter()
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        if self.path.startswith('/missing/'):
+            self.send_body(404, b'')
+        elif self.path.startswith('/flaky/') and self.requests[self.path] == 1:
+            self.send_body(503, b'')
+        else:
+            self.send_body(200, json.dumps({'path': self.path}).encode('utf-8'))
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchFromWebAPITest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), WebAPIHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.host = '127.0.0.1:{}'.format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        WebAPIHandler.requests.clear()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        settings = override_settings(BUILD_CACHE_DIR=cache_dir, WEB_API_OFFLINE=False,
+            WEB_API_RATE_LIMITS={self.host: 0})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # no waiting between the retries of failed requests
+        sleep = mock.patch('common.tools.time.sleep')
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def url(self, path):
+        return 'http://{}/{}/$index'.format(self.host, path)
+
+    def test_results_in_order(self):
+        indices = ['entry_{}'.format(i) for i in range(20)]
+        results = tools.fetch_all_from_web_api(self.url('found'), indices, ['web_api_test', 'found'])
+        self.assertEqual(results, [{'path': '/found/' + index} for index in indices])
+
+    def test_not_found_cached(self):
+        self.assertIs(tools.fetch_from_web_api(self.url('missing'), 'entry', ['web_api_test', 'missing']), False)
+        self.assertIs(tools.fetch_from_web_api(self.url('missing'), 'entry', ['web_api_test', 'missing']), False)
+        self.assertEqual(WebAPIHandler.requests['/missing/entry'], 1)
+
+    def test_server_error_retried(self):
+        result = tools.fetch_from_web_api(self.url('flaky'), 'entry', ['web_api_test', 'flaky'])
+        self.assertEqual(result, {'path': '/flaky/entry'})
+        self.assertEqual(WebAPIHandler.requests['/flaky/entry'], 2)
+
+    def test_offline_replay(self):
+        indices = ['entry_{}'.format(i) for i in range(5)]
+        online = tools.fetch_all_from_web_api(self.url('found'), indices, ['web_api_test', 'found'])
+        num_requests = sum(WebAPIHandler.requests.values())
+        with override_settings(WEB_API_OFFLINE=True):
+            offline = tools.fetch_all_from_web_api(self.url('found'), indices, ['web_api_test', 'found'])
+            not_cached = tools.fetch_from_web_api(self.url('found'), 'not_cached', ['web_api_test', 'found'])
+        self.assertEqual(offline, online)
+        self.assertIs(not_cached, False)
+        self.assertEqual(sum(WebAPIHandler.requests.values()), num_requests)
+
+
+class SelectionPickleTest(TestCase):
+
+    def setUp(self):
+        ResidueNumberingScheme.objects.create(slug=settings.DEFAULT_NUMBERING_SCHEME, short_name='GPCRdb',
+            name='GPCRdb')
+        source = ProteinSource.objects.create(name='SWISSPROT')
+        family = ProteinFamily.objects.create(slug='001', name='Class A (Rhodopsin)')
+        species = Species.objects.create(latin_name='Homo sapiens', common_name='Human')
+        sequence_type = ProteinSequenceType.objects.create(slug='wt', name='Wild-type')
+        self.proteins = [Protein.objects.create(family=family, species=species, source=source,
+            sequence_type=sequence_type, entry_name=entry_name, name=entry_name, sequence='')
+            for entry_name in ['adrb1_human', 'adrb2_human']]
+
+    def select_targets(self, proteins):
+        selection = Selection()
+        for protein in proteins:
+            selection.add('targets', 'protein', SelectionItem('protein', protein))
+        return selection.exporter()
+
+    def test_round_trip(self):
+        loaded = pickle.loads(pickle.dumps(self.select_targets(self.proteins)))
+        self.assertEqual([t.item for t in loaded.targets], self.proteins)
+        self.assertEqual(loaded.annotation[0].item.name, 'SWISSPROT')
+        self.assertEqual(loaded.numbering_schemes[0].item.slug, settings.DEFAULT_NUMBERING_SCHEME)
+
+    def test_legacy_format(self):
+        # selections stored before the compact format pickled the items with their model objects
+        selection = self.select_targets(self.proteins)
+        state = {k: v for k, v in selection.__dict__.items() if k != 'resolver'}
+        for name in SELECTION_ITEM_LISTS:
+            items = []
+            for selection_item in getattr(selection, name):
+                legacy_item = SelectionItem.__new__(SelectionItem)
+                legacy_item.__setstate__({'type': selection_item.type, 'type_title': selection_item.type_title,
+                    'item': selection_item.item, 'properties': selection_item.properties})
+                items.append(legacy_item)
+            state[name] = items
+        legacy = SimpleSelection.__new__(SimpleSelection)
+        legacy.__setstate__(state)
+
+        loaded = pickle.loads(pickle.dumps(legacy))
+        self.assertEqual([t.item for t in loaded.targets], self.proteins)
+
+    def test_deleted_object_dropped(self):
+        stored = pickle.dumps(self.select_targets(self.proteins))
+        self.proteins[0].delete()
+        loaded = pickle.loads(stored)
+        self.assertEqual([t.item for t in loaded.targets], self.proteins[1:])
+
+
+class SimilarityCountsTest(SimpleTestCase):
+
+    def setUp(self):
+        self.codes = np.random.RandomState(0).randint(0, GAP_CODE + 1, size=(7, 40))
+
+    def pair_counts(self, a, b):
+        compared = (a != GAP_CODE) & (b != GAP_CODE)
+        scores = SIMILARITY_SCORES[a[compared], b[compared]]
+        return ((a[compared] == b[compared]).sum(), (scores > 0).sum(), scores[scores > 0].sum(),
+            len(a) - ((a == GAP_CODE) & (b == GAP_CODE)).sum())
+
+    def test_counts(self):
+        # one position per block and all positions in one block
+        for block_size in (1, 2**22):
+            counts = similarity_counts(self.codes, block_size)
+            for i in range(len(self.codes)):
+                for j in range(len(self.codes)):
+                    self.assertEqual(tuple(c[i, j] for c in counts), self.pair_counts(self.codes[i], self.codes[j]))
@@ -6,18 +6,37 @@ import os
 import yaml
 import time
 import logging
+import hashlib
+import threading
 import urllib
-from urllib.parse import quote
+import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
 from urllib.request import urlopen
 from urllib.error import HTTPError
 import json
 import gzip
-from io import BytesIO
 from string import Template
 from Bio import Entrez, Medline
 import xml.etree.ElementTree as etree
 
 
+# rate limit of the web APIs, minimum seconds between two requests to the same host
+WEB_API_MIN_INTERVAL = 0.1
+WEB_API_MAX_WORKERS = 8
+WEB_API_MAX_TRIES = 5
+WEB_API_TIMEOUT = 60
+# responses of the web APIs are stored on disk under BUILD_CACHE_DIR, the bodies gzipped under the sha256 of their
+# content and the urls as small json entries pointing to the content (or the 400/404 status)
+WEB_API_CACHE_DIR = 'web_api'
+
+_web_api_local = threading.local()
+_web_api_lock = threading.Lock()
+_web_api_next_request = {}
+_web_api_stats = Counter()
+
+
 
 def save_to_cache(path, file_id, data):
     create_cache_dirs(path)
@@ -43,79 +62,185 @@ def create_cache_dirs(path):
         intermediate_path = os.sep.join([intermediate_path, directory])
         os.chmod(intermediate_path, 0o777)
 
-def fetch_from_web_api(url, index, cache_dir=False, xml=False, raw=False):
-    logger = logging.getLogger('build')
+def web_api_offline():
+    """True when web API lookups are only replayed from the disk cache."""
+    return getattr(settings, 'WEB_API_OFFLINE', False)
 
-    # slugify the index for the cache filename (some indices have symbols not allowed in file names (e.g. /))
-    index_slug= slugify(index)
-    cache_file_path = '{}/{}'.format('/'.join(cache_dir), index_slug)
+def web_api_cache_stats():
+    with _web_api_lock:
+        return dict(_web_api_stats)
 
-    # try fetching from cache
-    if cache_dir:
-        d = cache.get(cache_file_path)
-        # d = fetch_from_cache(cache_dir, index_slug)
-        if not d is None:
-            logger.info('Fetched {} from cache'.format(cache_file_path))
-            return d
+def _count_web_api(key):
+    with _web_api_lock:
+        _web_api_stats[key] += 1
 
-    # if nothing is found in the cache, use the web API
-    full_url = Template(url).substitute(index=quote(str(index), safe=''))
+def _web_api_cache_path(*parts):
+    return os.sep.join([settings.BUILD_CACHE_DIR, WEB_API_CACHE_DIR] + list(parts))
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _web_api_entry_path(full_url):
+    key = hashlib.sha256(full_url.encode('utf-8')).hexdigest()
+    return _web_api_cache_path('urls', key[:2], key + '.json')
+
+def _web_api_content_path(content_hash):
+    return _web_api_cache_path('objects', content_hash[:2], content_hash + '.gz')
+
+def read_web_api_cache(full_url):
+    """Cached (status, content) of a url, None if the url has not been fetched before."""
+    try:
+        with open(_web_api_entry_path(full_url)) as f:
+            entry = json.load(f)
+        if entry['status'] != 200:
+            return entry['status'], None
+        with open(_web_api_content_path(entry['content']), 'rb') as f:
+            return 200, gzip.decompress(f.read())
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_web_api_cache(full_url, status, content=None):
+    entry = {'url': full_url, 'status': status}
+    if content is not None:
+        entry['content'] = hashlib.sha256(content).hexdigest()
+        content_path = _web_api_content_path(entry['content'])
+        if not os.path.isfile(content_path):
+            _write_atomic(content_path, gzip.compress(content))
+    _write_atomic(_web_api_entry_path(full_url), json.dumps(entry).encode('utf-8'))
+
+def _web_api_session():
+    # one session per thread, so connections to a host are kept alive between requests
+    session = getattr(_web_api_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        _web_api_local.session = session
+    return session
+
+def _wait_for_host(full_url):
+    host = urlsplit(full_url).netloc
+    interval = getattr(settings, 'WEB_API_RATE_LIMITS', {}).get(host, WEB_API_MIN_INTERVAL)
+    with _web_api_lock:
+        now = time.monotonic()
+        start = max(now, _web_api_next_request.get(host, now))
+        _web_api_next_request[host] = start + interval
+    if start > now:
+        time.sleep(start - now)
+
+def download_from_web_api(full_url):
+    """Status and content of a url, retried on failures. The status is None when all tries failed."""
+    logger = logging.getLogger('build')
     logger.info('Fetching {}'.format(full_url))
-    tries = 0
-    max_tries = 5
-    while tries < max_tries:
+    for tries in range(WEB_API_MAX_TRIES):
         if tries > 0:
             logger.warning('Failed fetching {}, retrying'.format(full_url))
-
+            time.sleep(2)
+        _wait_for_host(full_url)
         try:
-            req = urlopen(full_url)
-            if full_url[-2:]=='gz' and xml:
-                try:
-                    buf = BytesIO( req.read())
-                    f = gzip.GzipFile(fileobj=buf)
-                    data = f.read()
-                    d = etree.fromstring(data)
-                except:
-                    return False
-            elif xml:
-                try:
-                    d = etree.fromstring(req.read().decode('UTF-8'))
-                except:
-                    return False
-            elif raw:
-                try:
-                    d = req.read().decode('UTF-8')
-                except:
-                    return False
+            if urlsplit(full_url).scheme in ('http', 'https'):
+                response = _web_api_session().get(full_url, timeout=WEB_API_TIMEOUT)
+                status, content = response.status_code, response.content
             else:
-                d = json.loads(req.read().decode('UTF-8'))
+                # other schemes (ftp) are not supported by requests
+                with urlopen(full_url, timeout=WEB_API_TIMEOUT) as req:
+                    status, content = 200, req.read()
         except HTTPError as e:
-            tries += 1
-            if e.code == 404:
-                logger.warning('Failed fetching {}, 404 - does not exist'.format(full_url))
-                tries = max_tries #skip more tries
-                return False
-            elif e.code == 400:
-                logger.warning('Failed fetching {}, 400 - does not exist'.format(full_url))
-                tries = max_tries #skip more tries
-                return False
-            else:
-                time.sleep(2)
-        except urllib.error.URLError as e:
+            status, content = e.code, None
+        except (requests.RequestException, OSError):
             # Catches 101 network is unreachable -- I think it's auto limiting feature
-            tries +=1
-            time.sleep(2)
-        else:
-            # save to cache
-            if cache_dir:
-                # save_to_cache(cache_dir, index_slug, d)
-                cache.set(cache_file_path, d, 60*60*24*7) #7 days
-                logger.info('Saved entry for {} in cache'.format(cache_file_path))
-            return d
+            continue
+
+        if status in (400, 404):
+            logger.warning('Failed fetching {}, {} - does not exist'.format(full_url, status))
+            return status, None
+        elif 200 <= status < 300:
+            return 200, content
 
     # give up if the lookup fails 5 times
-    logger.error('Failed fetching {} {} times, giving up'.format(full_url, max_tries))
-    return False
+    logger.error('Failed fetching {} {} times, giving up'.format(full_url, WEB_API_MAX_TRIES))
+    return None, None
+
+def _parse_web_api_content(full_url, content, xml, raw):
+    if full_url[-2:]=='gz' and xml:
+        try:
+            return etree.fromstring(gzip.decompress(content))
+        except:
+            return False
+    elif xml:
+        try:
+            return etree.fromstring(content.decode('UTF-8'))
+        except:
+            return False
+    elif raw:
+        try:
+            return content.decode('UTF-8')
+        except:
+            return False
+    return json.loads(content.decode('UTF-8'))
+
+def fetch_from_web_api(url, index, cache_dir=False, xml=False, raw=False):
+    """Parsed response of the web API url (a template with $index) for index, False if the lookup failed.
+
+    With a cache_dir the raw response is kept in the disk cache, so later lookups (also in offline mode) are served
+    without a request. 400 and 404 responses are cached as well.
+    """
+    logger = logging.getLogger('build')
+    full_url = Template(url).substitute(index=quote(str(index), safe=''))
+
+    cached = read_web_api_cache(full_url) if cache_dir else None
+    if cached is None and cache_dir:
+        # entries cached by earlier builds in the django cache
+        cache_file_path = '{}/{}'.format('/'.join(cache_dir), slugify(index))
+        d = cache.get(cache_file_path)
+        if not d is None:
+            _count_web_api('hits')
+            logger.info('Fetched {} from cache'.format(cache_file_path))
+            return d
+
+    if cached is not None:
+        _count_web_api('hits')
+        status, content = cached
+        logger.info('Fetched {} from cache'.format(full_url))
+    elif web_api_offline():
+        _count_web_api('offline_misses')
+        logger.warning('{} is not cached, skipped in offline mode'.format(full_url))
+        return False
+    else:
+        _count_web_api('downloads')
+        status, content = download_from_web_api(full_url)
+        if status is None:
+            _count_web_api('failures')
+            return False
+
+    if content is None:
+        if cached is None and cache_dir:
+            write_web_api_cache(full_url, status)
+        return False
+
+    d = _parse_web_api_content(full_url, content, xml, raw)
+    # only responses that could be parsed are kept
+    if cached is None and cache_dir and d is not False:
+        write_web_api_cache(full_url, status, content)
+        logger.info('Saved entry for {} in cache'.format(full_url))
+    return d
+
+def fetch_all_from_web_api(url, indices, cache_dir=False, xml=False, raw=False, max_workers=WEB_API_MAX_WORKERS):
+    """fetch_from_web_api for many indices, run in a thread pool. Results are returned in the order of indices."""
+    logger = logging.getLogger('build')
+    indices = list(indices)
+    if not indices:
+        return []
+    before = web_api_cache_stats()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(indices)))) as executor:
+        results = list(executor.map(lambda index: fetch_from_web_api(url, index, cache_dir, xml, raw), indices))
+    stats = {k: v - before.get(k, 0) for k, v in web_api_cache_stats().items()}
+    logger.info('Fetched {} entries of {}: {} from cache ({:.0%}), {} downloaded, {} failed, {} not cached in offline '
+        'mode'.format(len(indices), url, stats.get('hits', 0), stats.get('hits', 0) / len(indices),
+        stats.get('downloads', 0), stats.get('failures', 0), stats.get('offline_misses', 0)))
+    return results
 
 def fetch_from_entrez(index, cache_dir=''):
     logger = logging.getLogger('build')
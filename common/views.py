@@ -2220,7 +2220,7 @@ def ReadReferenceInput(request):
         if obj == None and (up_name.isnumeric()):
             selection_subtype = 'protein'
             try:
-                obj = up_name
+                obj = Protein.objects.get(pk=up_name)
             except:
                 obj = None
 
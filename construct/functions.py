@@ -9,7 +9,7 @@ from construct.models import *
 from ligand.models import Ligand, LigandType, LigandRole
 from ligand.functions import get_or_make_ligand
 
-from common.tools import fetch_from_web_api
+from common.tools import fetch_from_web_api, fetch_all_from_web_api
 from urllib.parse import quote
 from string import Template
 from urllib.request import urlopen
@@ -33,6 +33,21 @@ uniprot_convert_table = {'Q548Y0_HUMAN':'OX2R_HUMAN'}
 # def look_for_value(d,k):
 #     ### look for a value in dict if found, give back, otherwise None
 
+# per structure web API lookups of fetch_pdb_info as (url, cache_dir, xml, lowercase index)
+PDB_INFO_LOOKUPS = [
+    ('ftp://ftp.ebi.ac.uk/pub/databases/msd/sifts/xml/$index.xml.gz', ['sifts', 'xml'], True, True),
+    ('https://www.ebi.ac.uk/pdbe/api/pdb/entry/experiment/$index', ['pdbe', 'experiment'], False, False),
+    ('https://www.rcsb.org/pdb/explore/jmol.do?structureId=$index&json=true', ['rcsb', 'jmol_modifications'], False, False),
+    ('https://www.ebi.ac.uk/pdbe/api/pdb/entry/ligand_monomers/$index', ['pdbe', 'ligands'], False, False),
+    ('https://www.rcsb.org/pdb/rest/das/pdb_uniprot_mapping/alignment?query=$index', ['rcsb', 'pdb_uniprot_mapping'], True, False),
+]
+
+def prefetch_pdb_info(pdbnames):
+    """Fetches the web API entries of fetch_pdb_info for many structures concurrently into the web API cache."""
+    pdbnames = list(pdbnames)
+    for url, cache_dir, xml, lower in PDB_INFO_LOOKUPS:
+        fetch_all_from_web_api(url, [p.lower() if lower else p for p in pdbnames], cache_dir, xml=xml)
+
 def fetch_pdb_info(pdbname,protein,new_xtal=False, ignore_gasper_annotation=False):
     # ignore_gaspar_annotation skips PDB_RANGE edits that mark missing residues as deleted, which messes up constructs.
 
@@ -0,0 +1,164 @@
+from django.db.models import F
+
+from contactnetwork.models import Interaction, StructureContactIndex, contact_index_dtype
+
+import numpy as np
+
+
+# Contact classes of the index, code = type * 24 + loosened level * 12 + intrasegment * 6 + atom pair category
+# water-mediated polar interactions are indexed as their own type, so the browsers can leave them out
+CONTACT_INTERACTION_TYPES = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals', 'water-mediated']
+NUM_ATOM_CATEGORIES = 6
+
+# atoms are pure backbone (C, O, N), CA or side chain, the pair category does not depend on the order of the atoms
+pure_backbone_atoms = ["C", "O", "N"]
+ATOM_PAIR_CATEGORY = [[0, 1, 2], [1, 3, 4], [2, 4, 5]]
+
+# atom pair categories matching the backbone/sidechain options of the contact browsers
+# bbbb: both atoms in C, O, N, CA / scbb: one atom in C, O, N, CA and the other not in C, O, N / scsc: none in C, O, N
+CONTACT_OPTION_CATEGORIES = {
+    'bbbb': [0, 1, 3],
+    'scbb': [1, 2, 3, 4],
+    'scsc': [3, 4, 5],
+}
+
+
+def atom_category(atom_name):
+    if atom_name in pure_backbone_atoms:
+        return 0
+    elif atom_name == "CA":
+        return 1
+    return 2
+
+
+def contact_code(interaction_type, interaction_level, intrasegment, atom_name1, atom_name2):
+    return CONTACT_INTERACTION_TYPES.index(interaction_type) * 4 * NUM_ATOM_CATEGORIES \
+        + (interaction_level != 0) * 2 * NUM_ATOM_CATEGORIES + intrasegment * NUM_ATOM_CATEGORIES \
+        + ATOM_PAIR_CATEGORY[atom_category(atom_name1)][atom_category(atom_name2)]
+
+
+def encode_contacts(structure):
+    """Contact records of the stored interactions of a structure, as stored in its StructureContactIndex.
+
+    Only the residue pairs used by the contact frequency queries are indexed: both residues have a generic number,
+    belong to the same protein conformation and res1 has the lower id.
+    """
+    rows = Interaction.objects.filter(
+            interacting_pair__referenced_structure=structure,
+            interaction_type__in=CONTACT_INTERACTION_TYPES[:-1],
+            interacting_pair__res1__generic_number__isnull=False,
+            interacting_pair__res2__generic_number__isnull=False,
+            interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id'),
+            interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')
+        ).values_list(
+            'interacting_pair__res1__generic_number_id',
+            'interacting_pair__res2__generic_number_id',
+            'interaction_type',
+            'specific_type',
+            'interaction_level',
+            'interacting_pair__res1__protein_segment_id',
+            'interacting_pair__res2__protein_segment_id',
+            'atomname_residue1',
+            'atomname_residue2',
+        )
+
+    keys = np.array([(gn1, gn2, contact_code(specific_type if specific_type == 'water-mediated' else i_type, level,
+        segment1 == segment2, atom1, atom2))
+        for gn1, gn2, i_type, specific_type, level, segment1, segment2, atom1, atom2 in rows], dtype=np.int64).reshape(-1, 3)
+    keys, counts = np.unique(keys, axis=0, return_counts=True)
+
+    contacts = np.zeros(len(keys), dtype=contact_index_dtype)
+    contacts['gn1'] = keys[:, 0]
+    contacts['gn2'] = keys[:, 1]
+    contacts['code'] = keys[:, 2]
+    contacts['count'] = np.minimum(counts, 255)
+    return contacts
+
+
+def build_contact_index(structure):
+    """Encodes the stored interactions of a structure in its StructureContactIndex."""
+    contacts = encode_contacts(structure)
+    StructureContactIndex.objects.update_or_create(structure=structure, defaults={'contacts': contacts.tobytes()})
+    return contacts
+
+
+def get_contact_indices(structure_ids):
+    """Contact records of the structures with the index of the structure in structure_ids.
+
+    Indices are built by build_all_interactions, the contacts of structures without one are read from their stored
+    interactions (without storing an index).
+    """
+    structure_ids = list(structure_ids)
+    packed = dict(StructureContactIndex.objects.filter(structure_id__in=structure_ids).values_list('structure_id', 'contacts'))
+    parts = []
+    positions = []
+    for i, structure_id in enumerate(structure_ids):
+        if structure_id in packed:
+            contacts = np.frombuffer(packed[structure_id], dtype=contact_index_dtype)
+        else:
+            contacts = encode_contacts(structure_id)
+        parts.append(contacts)
+        positions.append(np.full(len(contacts), i, dtype=np.int32))
+    if not parts:
+        return np.zeros(0, dtype=contact_index_dtype), np.zeros(0, dtype=np.int32)
+    return np.concatenate(parts), np.concatenate(positions)
+
+
+def get_contact_selection(type_thresholds, contact_options, strict_level_types=[]):
+    """Selected class codes and the minimum number of atom pairs of every interaction type.
+
+    type_thresholds maps the interaction types to the minimum number of matching atom pairs, contact_options are
+    the browser options (inter_scsc, intra_bbbb, ...; other options are ignored) and strict_level_types are the types
+    only counted at level 0.
+    """
+    selected = np.zeros(len(CONTACT_INTERACTION_TYPES) * 4 * NUM_ATOM_CATEGORIES, dtype=bool)
+    thresholds = np.zeros(len(CONTACT_INTERACTION_TYPES), dtype=np.int32)
+    for t, interaction_type in enumerate(CONTACT_INTERACTION_TYPES):
+        if interaction_type not in type_thresholds:
+            continue
+        thresholds[t] = type_thresholds[interaction_type]
+        levels = [0] if interaction_type in strict_level_types else [0, 1]
+        for option in contact_options:
+            segment, _, categories = option.partition('_')
+            if segment not in ('inter', 'intra') or categories not in CONTACT_OPTION_CATEGORIES:
+                continue
+            intrasegment = int(segment == 'intra')
+            for level in levels:
+                for category in CONTACT_OPTION_CATEGORIES[categories]:
+                    selected[t * 4 * NUM_ATOM_CATEGORIES + level * 2 * NUM_ATOM_CATEGORIES
+                        + intrasegment * NUM_ATOM_CATEGORIES + category] = True
+    return selected, thresholds
+
+
+def get_structure_contact_types(structure_ids, type_thresholds, contact_options, strict_level_types=[]):
+    """Generic number pairs in contact in each structure per interaction type for the given options.
+
+    Returns an (n x 4) array of unique (index in structure_ids, gn1 id, gn2 id, index in CONTACT_INTERACTION_TYPES)
+    rows, gn1 is the generic number of the residue with the lower id.
+    """
+    contacts, positions = get_contact_indices(structure_ids)
+    selected, thresholds = get_contact_selection(type_thresholds, contact_options, strict_level_types)
+
+    mask = selected[contacts['code']]
+    contacts = contacts[mask]
+    positions = positions[mask]
+    if not len(contacts):
+        return np.zeros((0, 4), dtype=np.int64)
+
+    # sum the atom pairs of the selected classes per structure, pair and type and apply the type thresholds
+    types = contacts['code'] // (4 * NUM_ATOM_CATEGORIES)
+    keys, inverse = np.unique(np.column_stack([positions, contacts['gn1'], contacts['gn2'], types]), axis=0,
+        return_inverse=True)
+    counts = np.bincount(inverse.reshape(-1), weights=contacts['count'])
+    return keys[counts >= thresholds[keys[:, 3]]]
+
+
+def get_structure_contacts(structure_ids, type_thresholds, contact_options, strict_level_types=[]):
+    """Generic number pairs in contact in each structure for the given interaction and contact options.
+
+    Returns an (n x 3) array of unique (index in structure_ids, gn1 id, gn2 id) rows.
+    """
+    keys = get_structure_contact_types(structure_ids, type_thresholds, contact_options, strict_level_types)
+    if not len(keys):
+        return keys[:, :3]
+    return np.unique(keys[:, :3], axis=0)
@@ -4,6 +4,7 @@ from Bio.PDB.NeighborSearch import NeighborSearch
 from contactnetwork.interaction import *
 from contactnetwork.pdb import *
 from contactnetwork.models import *
+from contactnetwork.contacts import build_contact_index
 from io import StringIO
 
 from protein.models import ProteinConformation
@@ -12,11 +13,79 @@ from structure.models import Structure
 
 from signprot.models import SignprotComplex
 
+from django.db import transaction
+
 import copy
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
 
 # Distance between residues in peptide
 NUM_SKIP_RESIDUES = 0
 
+def get_complex_chain(struc):
+    alpha = SignprotComplex.objects.filter(structure=struc).values_list('alpha', flat=True).first()
+    return alpha if alpha else None
+
+def get_coordinates_hash(struc, complex_chain):
+    # Interactions only depend on the coordinates and the chains used
+    content = "{}|{}|{}".format(struc.preferred_chain, complex_chain, struc.pdb_data.pdb)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def interactions_up_to_date(pdb_name):
+    struc = Structure.objects.select_related('pdb_data').get(protein_conformation__protein__entry_name=pdb_name.lower())
+    stored_hash = StructureInteractionHash.objects.filter(structure=struc).values_list('coordinates_hash', flat=True).first()
+    if stored_hash != get_coordinates_hash(struc, get_complex_chain(struc)):
+        return False
+    # rebuilding the residues of a structure removes its interactions (cascade), but not the hash
+    return InteractingResiduePair.objects.filter(referenced_structure=struc).exists()
+
+def filter_pdb_chains(pdb, chains):
+    # Only keep the coordinates of the given chains and all waters to reduce parsing time
+    lines = [line for line in pdb.splitlines(True) if not line.startswith(('ATOM', 'HETATM', 'ANISOU')) \
+                or line[21:22] in chains or line[17:20] == 'HOH']
+    return ''.join(lines)
+
+def residue_atom_arrays(residues):
+    coords = [atom.coord for residue in residues for atom in residue.get_atoms()]
+    index = [i for i, residue in enumerate(residues) for atom in residue.get_atoms()]
+    return np.array(coords, dtype=float).reshape(-1, 3), np.array(index, dtype=int)
+
+def unique_rows(pairs):
+    return np.unique(pairs.reshape(-1, 2), axis=0)
+
+def find_interface_contacts(receptor_residues, partner_residues, water_atoms, cutoff = 4.5, water_cutoff = 3.5):
+    """Find the residue contacts between the receptor and the signaling protein (G protein or arrestin) chain
+
+    Returns an (n x 2) array with the indices of receptor and partner residues having atoms within the cutoff
+    and an (m x 3) array of receptor residue, partner residue and water atom indices for residues that are
+    both within the water cutoff of the same water
+    """
+    receptor_coords, receptor_index = residue_atom_arrays(receptor_residues)
+    partner_coords, partner_index = residue_atom_arrays(partner_residues)
+    receptor_tree = cKDTree(receptor_coords)
+    partner_tree = cKDTree(partner_coords)
+
+    hits = receptor_tree.sparse_distance_matrix(partner_tree, cutoff, output_type='ndarray')
+    contacts = unique_rows(np.column_stack([receptor_index[hits['i']], partner_index[hits['j']]]))
+
+    water_bridges = np.zeros((0, 3), dtype=int)
+    if len(water_atoms) > 0:
+        water_tree = cKDTree(np.array([water.coord for water in water_atoms], dtype=float))
+        hits = water_tree.sparse_distance_matrix(receptor_tree, water_cutoff, output_type='ndarray')
+        receptor_waters = unique_rows(np.column_stack([hits['i'], receptor_index[hits['j']]]))
+        hits = water_tree.sparse_distance_matrix(partner_tree, water_cutoff, output_type='ndarray')
+        partner_waters = unique_rows(np.column_stack([hits['i'], partner_index[hits['j']]]))
+
+        # join both (water, residue) lists on the water, partner_waters is sorted by water
+        starts = np.searchsorted(partner_waters[:, 0], receptor_waters[:, 0], 'left')
+        counts = np.searchsorted(partner_waters[:, 0], receptor_waters[:, 0], 'right') - starts
+        rows = np.repeat(np.arange(len(receptor_waters)), counts)
+        cols = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        water_bridges = np.column_stack([receptor_waters[rows, 1], partner_waters[cols, 1], receptor_waters[rows, 0]])
+
+    return contacts, water_bridges
+
 def compute_interactions(pdb_name,save_to_db = False):
 
     do_distances = False ## Distance calculation moved to build_structure_angles
@@ -30,10 +99,11 @@ def compute_interactions(pdb_name,save_to_db = False):
     pdb_name = pdb_name.lower()
 
     # Get the pdb structure
-    struc = Structure.objects.get(protein_conformation__protein__entry_name=pdb_name)
-    pdb_io = StringIO(struc.pdb_data.pdb)
-    # Get the preferred chain
+    struc = Structure.objects.select_related('pdb_data').get(protein_conformation__protein__entry_name=pdb_name)
+    # Get the preferred chain and the signaling protein chain (if in complex)
     preferred_chain = struc.preferred_chain.split(',')[0]
+    complex_chain = get_complex_chain(struc)
+    pdb_io = StringIO(filter_pdb_chains(struc.pdb_data.pdb, [preferred_chain, complex_chain]))
 
     # Get the Biopython structure for the PDB
     s = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', pdb_io)[0]
@@ -83,26 +153,22 @@ def compute_interactions(pdb_name,save_to_db = False):
         # Split unto classified and unclassified.
         classified = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
 
-    if do_complexes:
+    if do_complexes and complex_chain:
         try:
-            # check if structure in signprot_complex
-            complex = SignprotComplex.objects.get(structure=struc)
-
-            # Get all GPCR residue atoms based on preferred chain
-            gpcr_atom_list = [ atom for residue in Selection.unfold_entities(s[preferred_chain], 'R') if is_aa(residue) \
-                            for atom in residue.get_atoms()]
+            # Get all GPCR residues based on preferred chain
+            gpcr_residues = [ residue for residue in Selection.unfold_entities(s[preferred_chain], 'R') if is_aa(residue) ]
 
-            # Get all residue atoms from the coupled protein (e.g. G-protein)
+            # Get all residues from the coupled protein (e.g. G-protein)
             # NOW: select alpha subnit protein chain using complex model
-            sign_atom_list = [ atom for residue in Selection.unfold_entities(s[complex.alpha], 'R') if is_aa(residue) \
-                                for atom in residue.get_atoms()]
+            sign_residues = [ residue for residue in Selection.unfold_entities(s[complex_chain], 'R') if is_aa(residue) ]
 
-            ns_gpcr = NeighborSearch(gpcr_atom_list)
-            ns_sign = NeighborSearch(sign_atom_list)
+            # Obtain list of all water molecules in the structure
+            water_list = [ water for chain in s for residue in chain
+                            if residue.get_resname() == "HOH" for water in residue.get_atoms() ]
 
-            # For each GPCR atom perform the neighbor search on the signaling protein
-            all_neighbors = {(gpcr_atom.parent, match_res) for gpcr_atom in gpcr_atom_list
-                            for match_res in ns_sign.search(gpcr_atom.coord, 4.5, "R")}
+            # Find all interface contacts and water bridges in a single KD-tree pass
+            contacts, water_bridges = find_interface_contacts(gpcr_residues, sign_residues, water_list)
+            all_neighbors = [ (gpcr_residues[i], sign_residues[j]) for i, j in contacts ]
 
             # For each pair of interacting residues, determine the type of interaction
             #residues_sign = ProteinConformation.objects.get(protein__entry_name=pdb_name+"_"+complex.alpha.lower()).residue_set.exclude(generic_number=None).all().prefetch_related('generic_number')
@@ -130,57 +196,34 @@ def compute_interactions(pdb_name,save_to_db = False):
                 key =  res_1.get_parent().get_id()+str(res_1.get_id()[1]) + "_" + res_2.get_parent().get_id()+str(res_2.get_id()[1])
                 interaction_pairs[key] = pair
 
-            # Obtain list of all water molecules in the structure
-            water_list = { water for chain in s for residue in chain
-                            if residue.get_resname() == "HOH" for water in residue.get_atoms() }
+            # Water-mediated interactions: water_bridges holds (GPCR residue, signaling residue, water) index triples
+            # TODO: DEBUG AND VERIFY this code as water-mediated interactions were present at this time
+            # 1. UPDATE complexes to include also mini Gs and peptides (e.g. 4X1H/6FUF/5G53)
+            # 2. Run and verify water-mediated do_interactions
+#            for gpcr_index, sign_index, water_index in water_bridges:
+#                res_1 = gpcr_residues[gpcr_index]
+#                res_2 = sign_residues[sign_index]
+#                water = water_list[water_index]
+#                key =  res_1.get_parent().get_id()+str(res_1.get_id()[1]) + "_" + res_2.get_parent().get_id()+str(res_2.get_id()[1])
+
+                # Check if interaction is polar
+#                if any(get_polar_interactions(water.get_parent(), res_1)) and any(get_polar_interactions(water.get_parent(), res_2)):
+                    # TODO Check if water interaction is already present (e.g. multiple waters)
+                    # TODO Is splitting of sidechain and backbone-mediated interactions desired?
+#                    if not key in interaction_pairs:
+#                        interaction_pairs[key] = InteractingPair(res_1, res_2, dbres[res_1.id[1]], dbres_sign[res_2.id[1]], struc)
+
+                    # TODO: fix assignment of interacting atom labels (now seems limited to residues)
+#                    interaction_pairs[key].interactions.append(WaterMediated(a + "|" + str(water.get_parent().get_id()[1]), b))
 
-            # If waters are present calculate water-mediated interactions
-            if len(water_list) > 0:
-                ## Iterate water molecules over coupled and gpcr atom list
-                water_neighbors_gpcr = {(water, match_res) for water in water_list
-                                for match_res in ns_gpcr.search(water.coord, 3.5, "R")}
-
-                water_neighbors_sign = {(water, match_res) for water in water_list
-                                for match_res in ns_sign.search(water.coord, 3.5, "R")}
-
-
-                # TODO: DEBUG AND VERIFY this code as water-mediated interactions were present at this time
-                # 1. UPDATE complexes to include also mini Gs and peptides (e.g. 4X1H/6FUF/5G53)
-                # 2. Run and verify water-mediated do_interactions
-                # 3. Improve the intersection between the two hit lists
-
-                ## TODO: cleaner intersection between hits from the two Lists
-                # see new code below
-#                for water_pair_one in water_neighbors_gpcr:
-#                    for water_pair_two in water_neighbors_sign:
-#                        if water_pair_one[0]==water_pair_two[0]:
-#                            res_1 = water_pair_one[1]
-#                            res_2 = water_pair_two[1]
-#                            key =  res_1.get_parent().get_id()+str(res_1.get_id()[1]) + "_" + res_2.get_parent().get_id()+str(res_2.get_id()[1])
-
-                            # Check if interaction is polar
-#                            if any(get_polar_interactions(water_pair_one[0].get_parent(), water_pair_one[1])) and any(get_polar_interactions(water_pair_two[0].get_parent(), water_pair_two[1])):
-                                # TODO Check if water interaction is already present (e.g. multiple waters)
-                                # TODO Is splitting of sidechain and backbone-mediated interactions desired?
-#                                if not key in interaction_pairs:
-#                                    interaction_pairs[key] = InteractingPair(res_1, res_2, dbres[res_1.id[1]], dbres_sign[res_2.id[1]], struc)
-
-                                # TODO: fix assignment of interacting atom labels (now seems limited to residues)
-#                                interaction_pairs[key].interactions.append(WaterMediated(a + "|" + str(water_pair_one[0].get_parent().get_id()[1]), b))
-
-        except SignprotComplex.DoesNotExist:
-#            print("No complex definition found for", pdb_name)
-            log = "No complex definition found for " + pdb_name
         except ProteinConformation.DoesNotExist:
             print("No protein conformation definition found for signaling protein of ", pdb_name)
 #            log = "No protein conformation definition found for signaling protein of " + pdb_name
 
     if save_to_db:
+        pairs = []
 
         if do_interactions:
-            # Delete previous for faster load in
-            InteractingResiduePair.objects.filter(referenced_structure=struc).all().delete()
-
             # bulk_pair = []
             # for d in distances:
             #     pair = InteractingResiduePair(res1=d[0], res2=d[1], referenced_structure=struc)
@@ -226,12 +269,17 @@ def compute_interactions(pdb_name,save_to_db = False):
                                 # HACK: store water ID as part of first atom name
                                 interaction_pairs[key].interactions.append(WaterMediated(a + "|" + str(water_pair_one[0].get_parent().get_id()[1]), b))
 
-            for p in classified:
-                p.save_into_database()
+            pairs += classified
 
         if do_complexes:
-            for pair in classified_complex:
-                pair.save_into_database()
+            pairs += classified_complex
+
+        # Replace the previous interactions in two bulk inserts and store what they were based on
+        with transaction.atomic():
+            InteractingResiduePair.objects.filter(referenced_structure=struc).all().delete()
+            InteractingPair.bulk_save_into_database(pairs)
+            StructureInteractionHash.objects.update_or_create(structure=struc, defaults={'coordinates_hash': get_coordinates_hash(struc, complex_chain)})
+            build_contact_index(struc)
 
         # if do_distances:
         #     # Distance.objects.filter(structure=struc).all().delete()
@@ -1,16 +1,18 @@
-from django.db.models import Avg, Variance, Count, Value, StdDev
-from django.contrib.postgres.aggregates import ArrayAgg
-from django.core.cache import cache
+from django.db.models import Variance, Count
 
 from structure.models import Structure
 from contactnetwork.models import *
-from residue.models import Residue, ResidueGenericNumber
+from residue.models import Residue
 
 from collections import OrderedDict
 
 import numpy as np
+from scipy.spatial.distance import pdist, squareform
 
 
+# GNs of helix 8 and the loops are left out of the TM distances
+excluded_segments = ('8x', '12x', '23x', '34x', '45x')
+
 class Distances():
     """A class to do distances"""
     def __init__(self):
@@ -42,62 +44,52 @@ class Distances():
             self.pdbs.append(s.pdb_code.index)
             self.pconfs.append(s.protein_conformation)
 
+    def fetch_pair_distances(self, distance_type = "CA", tm_only = False, filtered = False):
+        """Pair labels and (structures x pairs) distances in Å of the loaded structures, NaN when missing"""
+        matrices = get_distance_matrices(self.pdbs, distance_type=distance_type)
+        gns = matrices.generic_numbers
+        if tm_only:
+            gns = [gn for gn in gns if not gn.startswith(excluded_segments)]
+        if filtered:
+            gns = [gn for gn in gns if gn in self.filter_gns]
+
+        index = np.array([matrices.generic_numbers.index(gn) for gn in gns], dtype=int)
+        upper = np.triu_indices(len(gns), 1)
+        labels = ["{}_{}".format(gns[i], gns[j]) for i, j in zip(*upper)]
+        # stored with two decimals, round to get rid of the float32 representation
+        values = np.round(matrices.distances[:, index[upper[0]], index[upper[1]]].astype(float), 2)
+
+        return labels, values, matrices.pdbs
+
 
     def fetch_agg(self):
-        ## REQUIRES PSQL SETTINGS TO HAVE MORE MEMORY
-        # sudo nano /etc/postgresql/9.3/main/postgresql.conf
-        # shared_buffers = 2GB
-        # work_mem = 100MB
-        # temp_buffers = 500MB
-        # sudo /etc/init.d/postgresql restart
-
-        ds = list(Distance.objects.filter(structure__in=self.structures) \
-                            .values('gns_pair').annotate(arr=ArrayAgg('distance')).values_list('gns_pair','arr'))
-        # #print(ds)
-        # print(ds.query)
-        # print(len(ds))
-        # for i,d in enumerate(ds):
-        #     print(d)
-        #     if i>100:
-        #         break
-        self.data = ds
-        self.stats = {}
-        self.stats_list = []
-        for label,d in ds:
-            var = round(np.var(d),2)
-            mean = round(np.mean(d),2)
-            dispersion = round(var/mean,3)
-            self.stats[label] = {'var': var , 'mean': mean, 'dispersion': dispersion, 'count':len(d)}
-            self.stats_list.append({'label':label, 'var': var , 'mean': mean, 'dispersion': dispersion, 'count':len(d)})
-            # continue
-        print(len(self.stats))
+        labels, values, pdbs = self.fetch_pair_distances()
+        present = np.flatnonzero((~np.isnan(values)).any(axis=0))
+        labels = [labels[i] for i in present]
+        values = np.rint(values[:, present]*distance_scaling_factor)
+
+        self.data = [(label, [int(v) for v in d[~np.isnan(d)]]) for label, d in zip(labels, values.T)]
+        self.set_stats(labels, values)
 
     def fetch_and_calculate(self, with_arr = False):
-        ## REQUIRES PSQL SETTINGS TO HAVE MORE MEMORY
-        # sudo nano /etc/postgresql/9.3/main/postgresql.conf
-        # shared_buffers = 2GB
-        # work_mem = 100MB
-        # temp_buffers = 500MB
-        # sudo /etc/init.d/postgresql restart
         ds_with_key = {}
-        if with_arr:
-            ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                            .values('gns_pair') \
-                            .annotate(mean = Avg('distance'), std = StdDev('distance'), c = Count('distance'), dis = Count('distance'),arr=ArrayAgg('distance'),arr2=ArrayAgg('structure__pdb_code__index'),arr3=ArrayAgg('gns_pair')).values_list('gns_pair','mean','std','c','dis','arr','arr2','arr3').filter(c__gte=int(0.8*len(self.structures))))
-            for i,d in enumerate(ds):
-                ds[i] = list(ds[i])
-                ds[i][1] = ds[i][1] / distance_scaling_factor
-                ds[i][2] = ds[i][2] / distance_scaling_factor
-                ds[i][5] = [x / distance_scaling_factor for x in ds[i][5]]
-                ds[i][3] = d[2]/d[1]
-                ds_with_key[d[0]] = ds[i]
-        else:
-            ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                            .values('gns_pair') \
-                            .annotate(mean = Avg('distance'), std = StdDev('distance'), c = Count('distance')).values_list('gns_pair','mean','std','c').filter(c__gte=int(len(self.structures)*0.8)))
-            for i,d in enumerate(ds):
-                ds[i] += (d[2]/d[1],)
-                ds_with_key[d[0]] = ds[i]
+        labels, values, pdbs = self.fetch_pair_distances(tm_only = True)
+        present = ~np.isnan(values)
+        counts = present.sum(axis=0)
+        keep = np.flatnonzero((counts > 0) & (counts >= int(len(self.structures)*0.8)))
+        means = np.nanmean(values[:, keep], axis=0)
+        stds = np.nanstd(values[:, keep], axis=0)
+
+        ds = []
+        for c, i in enumerate(keep):
+            label = labels[i]
+            if with_arr:
+                arr = [float(v) for v in values[present[:, i], i]]
+                arr2 = [pdb for pdb, p in zip(pdbs, present[:, i]) if p]
+                ds.append([label, means[c], stds[c], stds[c]/means[c], int(counts[i]), arr, arr2, [label]*len(arr)])
+            else:
+                ds.append((label, means[c]*distance_scaling_factor, stds[c]*distance_scaling_factor, int(counts[i]), stds[c]/means[c]))
+            ds_with_key[label] = ds[-1]
         # # print(ds.query)
         # print(ds[1])
         # Assume that dispersion is always 4
@@ -343,159 +335,95 @@ class Distances():
         self.stats_window_key = stats_window_key
 
     def fetch_distances(self):
-        ds = Distance.objects.filter(structure__in=self.structures).all().values_list('distance','gns_pair')
-        self.data = {}
-        for d in ds:
-            label = d[1]
-            if label not in self.data:
-                self.data[label] = []
-            self.data[label].append(d[0]/distance_scaling_factor)
+        labels, values, pdbs = self.fetch_pair_distances()
+        self.data = self.pair_distances_to_data(labels, values)
 
     def fetch_distances_tm(self, distance_type = "CA"):
-#                .filter(gn1__in=self.filter_gns).filter(gn2__in=self.filter_gns) \
-        # ds = Distance.objects.filter(structure__in=self.structures) \
-        #         .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x')
-
-        if distance_type == "HC":
-            ds = Distance.objects.filter(structure__in=self.structures) \
-                .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                .values_list('distance_helix_center','gns_pair')
-        elif distance_type == "CB":
-            ds = Distance.objects.filter(structure__in=self.structures) \
-                .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                .values_list('distance_cb','gns_pair')
-        else:
-            ds = Distance.objects.filter(structure__in=self.structures) \
-                .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                .values_list('distance','gns_pair')
+        labels, values, pdbs = self.fetch_pair_distances(distance_type, tm_only = True, filtered = self.filtered_gns)
+        self.data = self.pair_distances_to_data(labels, values)
 
-        if self.filtered_gns:
-            ds = ds.filter(gn1__in=self.filter_gns).filter(gn2__in=self.filter_gns) \
-
-        self.data = {}
-        for d in ds:
-            label = d[1]
-            if label not in self.data:
-                self.data[label] = []
-            self.data[label].append(d[0]/distance_scaling_factor)
+    @staticmethod
+    def pair_distances_to_data(labels, values):
+        data = {}
+        present = ~np.isnan(values)
+        for i in np.flatnonzero(present.any(axis=0)):
+            data[labels[i]] = [float(v) for v in values[present[:, i], i]]
+        return data
 
     def calculate(self):
+        labels = list(self.data.keys())
+        lengths = np.array([len(d) for d in self.data.values()], dtype=int)
+
+        # NaN padded (distances x labels) array
+        values = np.full((lengths.max() if len(lengths) else 0, len(labels)), np.nan)
+        offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        values[np.arange(lengths.sum()) - offsets, np.repeat(np.arange(len(labels)), lengths)] = \
+            np.fromiter((v for d in self.data.values() for v in d), dtype=float, count=lengths.sum())
+
+        self.set_stats(labels, values)
+
+    def set_stats(self, labels, values):
+        """Variance, mean and dispersion for each label (column) of a NaN padded array"""
+        counts = np.sum(~np.isnan(values), axis=0)
+        variances = np.round(np.nanvar(values, axis=0), 2)
+        means = np.round(np.nanmean(values, axis=0), 2)
+        dispersions = np.round(variances/means, 3)
+
         self.stats = {}
         self.stats_list = []
-        for label,d in self.data.items():
-            var = round(np.var(d),2)
-            mean = round(np.mean(d),2)
-            dispersion = round(var/mean,3)
-            self.stats[label] = {'var': var , 'mean': mean, 'dispersion': dispersion, 'count':len(d)}
-            self.stats_list.append({'label':label, 'var': var , 'mean': mean, 'dispersion': dispersion, 'count':len(d)})
-            # continue
-        print(len(self.stats))
-        # stats_sorted = self.stats_list.sort(key=lambda x: x['dispersion'])
-        # stats_sorted = sorted(self.stats_list, key=lambda k: -k['dispersion'])
-        # print(stats_sorted[1])
-        #print(data)
-            #print(d.interacting_pair.res1.generic_number.label)
+        for label, var, mean, dispersion, count in zip(labels, variances, means, dispersions, counts):
+            self.stats[label] = {'var': var , 'mean': mean, 'dispersion': dispersion, 'count': int(count)}
+            self.stats_list.append({'label':label, 'var': var , 'mean': mean, 'dispersion': dispersion, 'count': int(count)})
 
     def get_distance_matrix(self, normalize = True, cache_enabled = True):
         # common GNs
         common_gn = self.fetch_common_gns_tm()
 
-#            .filter(label__in=self.filter_gns) \
-        all_gns = ResidueGenericNumber.objects.filter(scheme__slug='gpcrdb')\
-            .exclude(label__startswith='8x') \
-            .exclude(label__startswith='12x') \
-            .exclude(label__startswith='23x') \
-            .exclude(label__startswith='34x') \
-            .exclude(label__startswith='45x') \
-            .values_list('label',flat=True)
-
-        if self.filtered_gns:
-            all_gns = all_gns.filter(label__in=self.filter_gns)
-
-        all_gns = sorted(list(all_gns))
-
-        pdb_distance_maps = {}
-        pdb_gns = {}
-        for pdb in self.pdbs:
-            cache_key = "distanceMap-" + pdb
+        # (structures x pairs) upper triangle distances between the common GNs, zero when missing
+        matrices = get_distance_matrices(self.pdbs, common_gn)
+        upper = np.triu_indices(len(common_gn), 1)
+        distance_maps = np.zeros((len(self.pdbs), len(upper[0])))
+        pdb_index = {pdb: i for i, pdb in enumerate(self.pdbs)}
+        distance_maps[[pdb_index[pdb] for pdb in matrices.pdbs]] = np.nan_to_num(np.round(matrices.distances[:, upper[0], upper[1]].astype(float), 2))
+
+        # GNs annotated per structure, only pairs where both GNs are present are compared
+        gn_index = {gn: i for i, gn in enumerate(common_gn)}
+        pconf_index = {pconf.id: i for i, pconf in enumerate(self.pconfs)}
+        pdb_gns = np.zeros((len(self.pdbs), len(common_gn)), dtype=bool)
+        structure_gns = Residue.objects.filter(protein_conformation__in=self.pconfs, generic_number__label__in=common_gn) \
+                            .values_list('protein_conformation_id', 'generic_number__label')
+        for pconf, gn in structure_gns:
+            pdb_gns[pconf_index[pconf], gn_index[gn]] = True
+        pair_masks = pdb_gns[:, upper[0]] & pdb_gns[:, upper[1]]
+        distance_maps *= pair_masks
 
-            # Cached?
-            if cache.has_key(cache_key) and cache_enabled:
-                cached_data = cache.get(cache_key)
-                distance_map = cached_data["map"]
-                structure_gn = cached_data["gns"]
-            else:
-                # grab raw distance data per structure
-                temp = Distances()
-                temp.load_pdbs([pdb])
-                temp.fetch_distances_tm()
-
-#                    .filter(generic_number__label__in=self.filter_gns) \
-                structure_gn = Residue.objects.filter(protein_conformation__in=temp.pconfs) \
-                    .exclude(generic_number=None) \
-                    .exclude(generic_number__label__startswith='8x') \
-                    .exclude(generic_number__label__startswith='12x') \
-                    .exclude(generic_number__label__startswith='23x') \
-                    .exclude(generic_number__label__startswith='34x') \
-                    .exclude(generic_number__label__startswith='45x') \
-                    .values_list('generic_number__label',flat=True)
-
-                if self.filtered_gns:
-                    structure_gn = structure_gn.filter(generic_number__label__in=self.filter_gns)
-
-                structure_gn = list(structure_gn)
-
-                # create distance map
-                distance_map = np.full((len(all_gns), len(all_gns)), 0.0)
-
-                for i,res1 in enumerate(all_gns):
-                    for j in range(i+1, len(all_gns)):
-                        # grab average value
-                        res2 = all_gns[j]
-                        if res1+"_"+res2 in temp.data:
-                            distance_map[i][j] = temp.data[res1+"_"+res2][0]
-
-                # store in cache
-                if cache_enabled:
-                    store = {
-                        "map" : distance_map,
-                        "gns" : structure_gn
-                        }
-                    cache.set(cache_key, store, 60*60*24*14)
-
-            pdb_gns[pdb] = structure_gn
-
-            # Filtering indices to map to common_gns
-            gn_indices = np.array([ all_gns.index(residue) for residue in common_gn ])
-            pdb_distance_maps[pdb] = distance_map[gn_indices,:][:, gn_indices]
-
-            if "average" in pdb_distance_maps:
-                pdb_distance_maps["average"] +=  pdb_distance_maps[pdb]/len(self.pdbs)
-            else:
-                pdb_distance_maps["average"] =  pdb_distance_maps[pdb]/len(self.pdbs)
-
-        # store distance map
         if normalize:
-            for pdb in self.pdbs:
-                pdb_distance_maps[pdb] = np.nan_to_num(pdb_distance_maps[pdb]/pdb_distance_maps["average"])
-
-        # calculate distance matrix
-        distance_matrix = np.full((len(self.pdbs), len(self.pdbs)), 0.0)
-        for i, pdb1 in enumerate(self.pdbs):
-            for j in range(i+1, len(self.pdbs)):
-                pdb2 = self.pdbs[j]
-
-                # Get common GNs between two PDBs
-                common_between_pdbs = sorted(list(set(pdb_gns[pdb1]).intersection(pdb_gns[pdb2])))
-
-                # Get common between above set and the overall common set of GNs
-                common_with_query_gns = sorted(list(set(common_gn).intersection(common_between_pdbs)))
-
-                # Get the indices of positions that are shared between two PDBs
-                gn_indices = np.array([ common_gn.index(residue) for residue in common_with_query_gns ])
-
-                # Get distance between cells that have both GNs.
-                distance = np.sum(np.absolute(pdb_distance_maps[pdb1][gn_indices,:][:, gn_indices] - pdb_distance_maps[pdb2][gn_indices,:][:, gn_indices]))
-                distance_matrix[i, j] = distance_matrix[j, i] = distance * distance/(len(gn_indices)*len(gn_indices))
-
-        return distance_matrix
+            average = distance_maps.mean(axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distance_maps = np.nan_to_num(distance_maps/average)
+
+        return masked_cityblock(distance_maps, pair_masks, pdb_gns)
+
+def masked_cityblock(values, masks, present):
+    """Squared L1 distance between the rows of values over the cells masked in both rows, normalized by
+    the squared number of positions present in both rows
+
+    Values have to be non-negative and zero outside their own mask. The absolute differences outside the
+    shared mask are then the row values themselves, so they can be subtracted from the full L1 distance.
+    """
+    values = np.asarray(values, dtype=float)
+    masks = masks.astype(float)
+    present = present.astype(float)
+
+    shared_sums = values @ masks.T
+    totals = values.sum(axis=1)
+    distance = squareform(pdist(values, 'cityblock')) \
+                - (totals[:, np.newaxis] - shared_sums) - (totals[np.newaxis, :] - shared_sums.T)
+    distance = np.clip(distance, 0, None)
+    np.fill_diagonal(distance, 0)
+
+    shared_gns = present @ present.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distance_matrix = np.nan_to_num(distance * distance/(shared_gns * shared_gns))
+
+    return distance_matrix
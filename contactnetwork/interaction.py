@@ -4,6 +4,7 @@ from contactnetwork.models import *
 
 from residue.models import Residue
 
+from collections import OrderedDict
 import math
 
 class InteractingPair:
@@ -114,6 +115,23 @@ class InteractingPair:
             bulk.append(ni)
         Interaction.objects.bulk_create(bulk)
 
+    @staticmethod
+    def bulk_save_into_database(pairs):
+        # Save all pairs in one insert (PostgreSQL sets the primary keys), then all their interactions
+        db_pairs = OrderedDict()
+        for p in pairs:
+            key = (p.dbres1.pk, p.dbres2.pk)
+            if key not in db_pairs:
+                db_pairs[key] = InteractingResiduePair(res1=p.dbres1, res2=p.dbres2, referenced_structure=p.structure)
+        InteractingResiduePair.objects.bulk_create(db_pairs.values(), batch_size=5000)
+
+        bulk = []
+        for p in pairs:
+            pair = db_pairs[(p.dbres1.pk, p.dbres2.pk)]
+            for i in p.get_interactions():
+                bulk.append(Interaction(interaction_type=i.get_type(),specific_type=i.get_details(), interacting_pair=pair, atomname_residue1=i.atomname_residue1, atomname_residue2=i.atomname_residue2, interaction_level = i.get_level()))
+        Interaction.objects.bulk_create(bulk, batch_size=5000)
+
     def ionic_interactions(self):
         # Only oppositely charged residues
         if (is_pos_charged(self.res1) and is_neg_charged(self.res2)) or (is_neg_charged(self.res1) and is_pos_charged(self.res2)):
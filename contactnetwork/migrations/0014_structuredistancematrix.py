@@ -0,0 +1,31 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0038_auto_20211026_0935'),
+        ('contactnetwork', '0013_auto_20200602_1710'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureDistanceMatrix',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generic_numbers', models.TextField()),
+                ('amino_acids', models.TextField()),
+                ('distances_ca', models.BinaryField()),
+                ('distances_cb', models.BinaryField()),
+                ('distances_helix_center', models.BinaryField()),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='distance_matrix', to='structure.Structure')),
+            ],
+            options={
+                'db_table': 'structure_distance_matrix',
+            },
+        ),
+        migrations.DeleteModel(
+            name='Distance',
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0038_auto_20211026_0935'),
+        ('contactnetwork', '0014_structuredistancematrix'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureInteractionHash',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coordinates_hash', models.CharField(max_length=40)),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='interaction_hash', to='structure.Structure')),
+            ],
+            options={
+                'db_table': 'structure_interaction_hash',
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0038_auto_20211026_0935'),
+        ('contactnetwork', '0015_structureinteractionhash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureContactIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contacts', models.BinaryField()),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='contact_index', to='structure.Structure')),
+            ],
+            options={
+                'db_table': 'structure_contact_index',
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('protein', '0015_proteincouplings_physiological_ligand'),
+        ('contactnetwork', '0016_structurecontactindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistanceMatrixSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('structures', models.BinaryField()),
+                ('source_hash', models.CharField(max_length=40)),
+                ('generic_numbers', models.TextField()),
+                ('counts', models.BinaryField()),
+                ('sums', models.BinaryField()),
+                ('sum_squares', models.BinaryField()),
+                ('receptor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.Protein')),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.ProteinState')),
+            ],
+            options={
+                'db_table': 'distance_matrix_summary',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='distancematrixsummary',
+            unique_together={('receptor', 'state')},
+        ),
+    ]
@@ -1,6 +1,8 @@
-from structure.models import Structure
+from structure.models import Structure, get_group_summaries
 
 from django.db import models
+from collections import namedtuple
+
 import numpy as np
 import statistics
 
@@ -55,16 +57,49 @@ class ConsensusInteraction(models.Model):
     class Meta():
         unique_together = ('gn1', 'gn2','protein_class','state')
 
-class Distance(models.Model):
-    structure = models.ForeignKey('structure.Structure', related_name='distances', on_delete=models.CASCADE, null=True)
-    res1 = models.ForeignKey('residue.Residue', related_name='distance_residue1', on_delete=models.CASCADE, null=True)
-    res2 = models.ForeignKey('residue.Residue', related_name='distance_residue2', on_delete=models.CASCADE, null=True)
-    gn1 = models.CharField(max_length=100, null=True)
-    gn2 = models.CharField(max_length=100, null=True)
-    gns_pair = models.CharField(db_index=True, max_length=100, null=True)
-    distance = models.IntegerField(null=True)
-    distance_cb = models.IntegerField(null=True)
-    distance_helix_center = models.IntegerField(null=True)
+class StructureInteractionHash(models.Model):
+    # hash of the coordinates (and chains) the stored interactions of the structure were computed from
+    structure = models.OneToOneField('structure.Structure', related_name='interaction_hash', on_delete=models.CASCADE)
+    coordinates_hash = models.CharField(max_length=40)
+
+    class Meta():
+        db_table = 'structure_interaction_hash'
+
+
+# Contact index: per structure, the number of interaction rows (atom pairs) for each generic number pair and contact
+# class. The class code combines the interaction type, the interaction level (0 or loosened), intra- or
+# intersegment and the backbone/sidechain category of the two atoms (see contactnetwork.contacts)
+contact_index_dtype = np.dtype([('gn1', '<i4'), ('gn2', '<i4'), ('code', 'u1'), ('count', 'u1')])
+
+class StructureContactIndex(models.Model):
+    structure = models.OneToOneField('structure.Structure', related_name='contact_index', on_delete=models.CASCADE)
+    # packed contact_index_dtype records, gn1/gn2 are ResidueGenericNumber ids
+    contacts = models.BinaryField()
+
+    def get_contacts(self):
+        return np.frombuffer(self.contacts, dtype=contact_index_dtype)
+
+    class Meta():
+        db_table = 'structure_contact_index'
+
+
+
+# Distance matrices are stored as uint16 in 1/100 Å (max 655.34 Å), the max value marks a missing distance
+distance_matrix_scaling_factor = 100
+distance_matrix_missing = np.iinfo(np.uint16).max
+distance_matrix_fields = {'CA': 'distances_ca', 'CB': 'distances_cb', 'HC': 'distances_helix_center'}
+
+DistanceMatrices = namedtuple('DistanceMatrices', ['structures', 'pdbs', 'generic_numbers', 'distances', 'amino_acids'])
+
+class StructureDistanceMatrix(models.Model):
+    structure = models.OneToOneField('structure.Structure', related_name='distance_matrix', on_delete=models.CASCADE)
+    # comma-separated GN labels and the one-letter amino acids of the residues, in matrix order
+    generic_numbers = models.TextField()
+    amino_acids = models.TextField()
+    # condensed upper triangles (np.triu_indices/pdist order) of the packed distances
+    distances_ca = models.BinaryField()
+    distances_cb = models.BinaryField()
+    distances_helix_center = models.BinaryField()
 
     @classmethod
     def truncate(cls):
@@ -72,8 +107,158 @@ class Distance(models.Model):
         with connection.cursor() as cursor:
             cursor.execute('TRUNCATE TABLE "{0}" RESTART IDENTITY CASCADE'.format(cls._meta.db_table))
 
+    @staticmethod
+    def pack(distances):
+        """Pack a condensed array of distances in Å (NaN when missing)"""
+        packed = np.clip(np.round(np.asarray(distances, dtype=float)*distance_matrix_scaling_factor), 0, distance_matrix_missing-1)
+        packed[np.isnan(packed)] = distance_matrix_missing
+        return packed.astype(np.uint16).tobytes()
+
+    def get_generic_numbers(self):
+        return self.generic_numbers.split(',')
+
+    def get_matrix(self, distance_type = 'CA'):
+        """Square distance matrix in Å in stored GN order (NaN on the diagonal and when missing)"""
+        return unpack_distance_matrix(getattr(self, distance_matrix_fields[distance_type]), len(self.get_generic_numbers()))
+
     class Meta():
-        db_table = 'distance'
+        db_table = 'structure_distance_matrix'
+
+class DistanceMatrixSummary(models.Model):
+    # mergeable statistics of the CA distances of the structures of a receptor in a state (see structure.models.get_structure_groups)
+    receptor = models.ForeignKey('protein.Protein', on_delete=models.CASCADE)
+    state = models.ForeignKey('protein.ProteinState', on_delete=models.CASCADE)
+    # packed int32 structure ids and a hash of the distance matrices they were computed from
+    structures = models.BinaryField()
+    source_hash = models.CharField(max_length=40)
+    # comma-separated GN labels and the condensed upper triangles (float64) of the number of distances, their sum and
+    # their sum of squares
+    generic_numbers = models.TextField()
+    counts = models.BinaryField()
+    sums = models.BinaryField()
+    sum_squares = models.BinaryField()
+
+    def get_structures(self):
+        return np.frombuffer(self.structures, dtype=np.int32).tolist()
+
+    def get_generic_numbers(self):
+        return self.generic_numbers.split(',') if self.generic_numbers else []
+
+    class Meta():
+        db_table = 'distance_matrix_summary'
+        unique_together = ('receptor', 'state')
+
+def summarize_distance_matrices(pdbs):
+    """GN labels and the condensed counts, sums and sums of squares of the CA distances of the structures"""
+    matrices = get_distance_matrices(pdbs)
+    upper = np.triu_indices(len(matrices.generic_numbers), 1)
+    distances = matrices.distances[:, upper[0], upper[1]].astype(np.float64)
+    present = ~np.isnan(distances)
+    distances[~present] = 0
+    return matrices.generic_numbers, present.sum(axis=0).astype(np.float64), distances.sum(axis=0), (distances ** 2).sum(axis=0)
+
+def condensed_index(i, j, size):
+    # position of (i, j), i < j, in a condensed upper triangle
+    return size * i - i * (i + 1) // 2 + j - i - 1
+
+def unpack_distance_matrix(packed, size):
+    condensed = np.frombuffer(packed, dtype=np.uint16)
+    values = condensed.astype(np.float32)/distance_matrix_scaling_factor
+    values[condensed==distance_matrix_missing] = np.nan
+
+    matrix = np.full((size, size), np.nan, dtype=np.float32)
+    upper = np.triu_indices(size, 1)
+    matrix[upper] = values
+    matrix[upper[::-1]] = values
+    return matrix
+
+def generic_number_order(label):
+    """Sort key placing GNs in sequence order (e.g. 4x49, 4x491, 4x50, 45x50, 5x30)"""
+    part1, _, part2 = label.partition("x")
+    if part1.isnumeric() and part2.isnumeric():
+        multiply1 = 1000 if len(part1)>=2 else 10000
+        multiply2 = 10 if len(part2)<=2 else 1
+        return (0, int(part1)*multiply1 + int(part2)*multiply2, label)
+    return (1, 0, label)
+
+def get_distance_matrices(pdbs = None, generic_numbers = None, distance_type = 'CA'):
+    """Stack the distance matrices of the structures (all when pdbs is None) on a shared GN axis
+
+    Returns the structure ids and PDB codes, the GN axis (the sorted union of all GNs when not given),
+    a symmetric (structures x gns x gns) float32 array of distances in Å with NaN when missing and
+    a (structures x gns) array with the amino acids at each position
+    """
+    matrices = StructureDistanceMatrix.objects.all()
+    if pdbs is not None:
+        pdbs = [pdb.upper() for pdb in pdbs]
+        matrices = matrices.filter(structure__pdb_code__index__in=pdbs)
+    rows = list(matrices.values_list('structure_id', 'structure__pdb_code__index', 'generic_numbers', 'amino_acids', distance_matrix_fields[distance_type]))
+    if pdbs is not None:
+        order = {pdb: i for i, pdb in enumerate(pdbs)}
+        rows.sort(key=lambda row: order[row[1]])
+
+    if generic_numbers is None:
+        generic_numbers = sorted(set(gn for row in rows for gn in row[2].split(',')), key=generic_number_order)
+    else:
+        generic_numbers = list(generic_numbers)
+    axis = {gn: i for i, gn in enumerate(generic_numbers)}
+
+    distances = np.full((len(rows), len(axis), len(axis)), np.nan, dtype=np.float32)
+    amino_acids = np.full((len(rows), len(axis)), '', dtype='<U1')
+    for s, (structure_id, pdb, gns, aas, packed) in enumerate(rows):
+        gns = gns.split(',')
+        present = [i for i, gn in enumerate(gns) if gn in axis]
+        if not present:
+            continue
+        target = [axis[gns[i]] for i in present]
+        distances[s][np.ix_(target, target)] = unpack_distance_matrix(packed, len(gns))[np.ix_(present, present)]
+        amino_acids[s, target] = [aas[i] for i in present]
+
+    return DistanceMatrices([row[0] for row in rows], [row[1] for row in rows], generic_numbers, distances, amino_acids)
+
+def get_summary_distance_averages(summaries, s_lookup, pairs, normalized = False, standard_deviation = False):
+    """get_distance_averages of the GN pairs from DistanceMatrixSummary groups"""
+    keys = list(pairs)
+    # count, sum and sum of squares of each pair, for all structures or per receptor when normalized
+    totals = {}
+    for summary in summaries:
+        index = {gn: i for i, gn in enumerate(summary.get_generic_numbers())}
+        found = [k for k, key in enumerate(keys) if pairs[key][0] in index and pairs[key][1] in index and pairs[key][0] != pairs[key][1]]
+        i1 = np.array([index[pairs[keys[k]][0]] for k in found], dtype=np.int64)
+        i2 = np.array([index[pairs[keys[k]][1]] for k in found], dtype=np.int64)
+        positions = condensed_index(np.minimum(i1, i2), np.maximum(i1, i2), len(index))
+        group = s_lookup[summary.get_structures()[0]][2] if normalized else None
+        if group not in totals:
+            totals[group] = np.zeros((3, len(keys)))
+        for row, packed in enumerate([summary.counts, summary.sums, summary.sum_squares]):
+            totals[group][row, found] += np.frombuffer(packed, dtype=np.float64)[positions]
+
+    group_distances = {}
+    if not normalized:
+        counts, sums, sum_squares = totals[None]
+        for k in np.flatnonzero(counts):
+            if standard_deviation:
+                if counts[k]==1:
+                    group_distances[keys[k]] = 0
+                else:
+                    group_distances[keys[k]] = float(np.sqrt(max(0, (sum_squares[k] - sums[k]**2/counts[k])/(counts[k]-1))))
+            else:
+                group_distances[keys[k]] = float(sums[k]/counts[k])
+    else:
+        means = np.array([total[1]/np.where(total[0] > 0, total[0], np.nan) for total in totals.values()])
+        for k in np.flatnonzero((~np.isnan(means)).any(axis=0)):
+            pf_means = means[~np.isnan(means[:, k]), k].tolist()
+            if standard_deviation:
+                group_distances[keys[k]] = 0 if len(pf_means)==1 else statistics.stdev(pf_means)
+            else:
+                group_distances[keys[k]] = sum(pf_means)/len(pf_means)
+    return group_distances
+
+def get_pair_distances(gns_pair, pdbs = None, distance_type = 'CA'):
+    """Distance in Å between a GN pair (e.g. 2x46_6x37) for each structure containing both GNs"""
+    matrices = get_distance_matrices(pdbs, gns_pair.split("_"), distance_type)
+    values = matrices.distances[:, 0, 1]
+    return {pdb: round(float(value), 2) for pdb, value in zip(matrices.pdbs, values) if not np.isnan(value)}
 
 def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, standard_deviation = False, split_by_amino_acid = False):
     ## Returned dataset is in ClassA GNs...
@@ -84,17 +269,34 @@ def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, st
         # Never get SD when only looking at a single pdb...
         standard_deviation = False
 
-    ds = list(Distance.objects.filter(structure__pdb_code__index__in=[ pdb.upper() for pdb in pdbs], gns_pair__in=interaction_keys) \
-                         .values('gns_pair','distance','res1__amino_acid','res2__amino_acid','structure__pk'))
-    if not normalized:
-        for d in ds:
+    pairs = {key: key.split("_") for key in set(interaction_keys) if key.count("_")==1}
+    if not split_by_amino_acid:
+        # complete receptor and state groups are averaged from their precomputed summaries
+        structure_ids = Structure.objects.filter(pdb_code__index__in=[pdb.upper() for pdb in pdbs]).values_list('pk', flat=True)
+        summaries = get_group_summaries(DistanceMatrixSummary.objects.all(), structure_ids)
+        if summaries is not None:
+            return get_summary_distance_averages(summaries, s_lookup, pairs, normalized, standard_deviation)
+
+    gns = sorted(set(gn for pair in pairs.values() for gn in pair), key=generic_number_order)
+    matrices = get_distance_matrices(pdbs, gns)
+    index = {gn: i for i, gn in enumerate(gns)}
+
+    ds = []
+    for gns_pair, (gn1, gn2) in pairs.items():
+        i1, i2 = index[gn1], index[gn2]
+        values = matrices.distances[:, i1, i2]
+        for s in np.flatnonzero(~np.isnan(values)):
             if split_by_amino_acid:
-                key = '{}{}{}'.format(d['gns_pair'],d['res1__amino_acid'],d['res2__amino_acid']).replace("_",",")
+                key = '{}{}{}'.format(gns_pair,matrices.amino_acids[s, i1],matrices.amino_acids[s, i2]).replace("_",",")
             else:
-                key = d['gns_pair']
+                key = gns_pair
+            ds.append((key, float(values[s]), matrices.structures[s]))
+
+    if not normalized:
+        for key, dist, structure in ds:
             if key not in matrix:
                 matrix[key] = []
-            matrix[key].append(d['distance'])
+            matrix[key].append(dist)
 
         # Calculate the average of averages
         for key,dists in matrix.items():
@@ -103,18 +305,13 @@ def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, st
                     stdevdists = 0
                 else:
                     stdevdists = statistics.stdev(dists)
-                group_distances[key] = stdevdists/distance_scaling_factor
+                group_distances[key] = stdevdists
             else:
-                group_distances[key] = sum(dists)/len(dists)/distance_scaling_factor
+                group_distances[key] = sum(dists)/len(dists)
     else:
         # NORMALIZE CODE
-        for d in ds:
-            if split_by_amino_acid:
-                key = '{}{}{}'.format(d['gns_pair'],d['res1__amino_acid'],d['res2__amino_acid']).replace("_",",")
-            else:
-                key = d['gns_pair']
-            dist = d['distance']
-            pf = s_lookup[d['structure__pk']][2] # get the "receptor" level of the structure to group these regardless of species
+        for key, dist, structure in ds:
+            pf = s_lookup[structure][2] # get the "receptor" level of the structure to group these regardless of species
 
             if key not in matrix:
                 matrix[key] = {}
@@ -124,19 +321,16 @@ def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, st
 
         # Calculate the average of averages
         for key,pfs in matrix.items():
-            # if key=='3x50_5x50':
-            #     print(pfs)
             means = [sum(dists)/len(dists) for pf,dists in pfs.items() ]
             if standard_deviation and len(pdbs)>1:
                 if len(means)==1:
                     stdevofmeans = 0
                 else:
-                    # stdevofmeans = np.std(means, ddof=1)
                     stdevofmeans = statistics.stdev(means)
 
-                group_distances[key] = stdevofmeans/distance_scaling_factor
+                group_distances[key] = stdevofmeans
             else:
                 meanofmeans = sum(means)/len(means)
-                group_distances[key] = meanofmeans/distance_scaling_factor
+                group_distances[key] = meanofmeans
 
     return group_distances
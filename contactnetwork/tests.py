@@ -1,3 +1,104 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 
-# Create your tests here.
+from common.models import WebLink, WebResource
+from contactnetwork.cube import get_coordinates_hash, interactions_up_to_date
+from contactnetwork.distances import Distances, masked_cityblock
+from contactnetwork.models import InteractingResiduePair, Interaction, StructureInteractionHash
+from protein.models import (Protein, ProteinConformation, ProteinFamily, ProteinSequenceType, ProteinSource,
+    ProteinState, Species)
+from residue.models import Residue
+from structure.models import PdbData, Structure, StructureType
+
+from collections import OrderedDict
+
+import datetime
+import numpy as np
+
+
+class InteractionsUpToDateTest(TestCase):
+
+    def setUp(self):
+        state = ProteinState.objects.create(slug='inactive', name='Inactive')
+        protein = Protein.objects.create(
+            family=ProteinFamily.objects.create(slug='001', name='Class A (Rhodopsin)'),
+            species=Species.objects.create(latin_name='Homo sapiens', common_name='Human'),
+            source=ProteinSource.objects.create(name='SWISSPROT'),
+            sequence_type=ProteinSequenceType.objects.create(slug='wt', name='Wild-type'),
+            entry_name='1abc', name='1ABC', sequence='')
+        self.conformation = ProteinConformation.objects.create(protein=protein, state=state)
+        self.structure = Structure.objects.create(
+            protein_conformation=self.conformation,
+            structure_type=StructureType.objects.create(slug='x-ray-diffraction', name='X-ray diffraction'),
+            pdb_code=WebLink.objects.create(web_resource=WebResource.objects.create(slug='pdb', url='$index'),
+                index='1ABC'),
+            state=state, preferred_chain='A', resolution=2.0, publication_date=datetime.date(2020, 1, 1),
+            pdb_data=PdbData.objects.create(pdb='ATOM'))
+        self.store_interactions()
+        StructureInteractionHash.objects.create(structure=self.structure,
+            coordinates_hash=get_coordinates_hash(self.structure, None))
+
+    def store_interactions(self):
+        residues = [Residue.objects.create(protein_conformation=self.conformation, sequence_number=i,
+            amino_acid='A') for i in (1, 2)]
+        pair = InteractingResiduePair.objects.create(referenced_structure=self.structure, res1=residues[0],
+            res2=residues[1])
+        Interaction.objects.create(interacting_pair=pair, interaction_type='hydrophobic')
+
+    def test_unchanged(self):
+        self.assertTrue(interactions_up_to_date('1abc'))
+
+    def test_coordinates_changed(self):
+        PdbData.objects.filter(pk=self.structure.pdb_data_id).update(pdb='HETATM')
+        self.assertFalse(interactions_up_to_date('1abc'))
+
+    def test_residues_rebuilt(self):
+        # build_structures replaces the residues of existing structures, removing their interactions
+        Residue.objects.filter(protein_conformation=self.conformation).delete()
+        self.assertTrue(StructureInteractionHash.objects.filter(structure=self.structure).exists())
+        self.assertFalse(interactions_up_to_date('1abc'))
+
+        self.store_interactions()
+        self.assertTrue(interactions_up_to_date('1abc'))
+
+
+class DistanceStatisticsTest(SimpleTestCase):
+    """The vectorized statistics and structure distances are the same as the former per-pair calculations."""
+
+    def setUp(self):
+        self.random = np.random.RandomState(0)
+
+    def test_stats(self):
+        distances = Distances()
+        distances.data = OrderedDict()
+        for i, length in enumerate([1, 2, 5, 7, 3]):
+            distances.data['1x{}_2x{}'.format(50 + i, 50 + i)] = list(self.random.uniform(5, 30, length))
+        distances.calculate()
+
+        stats_list = []
+        for label, d in distances.data.items():
+            var = round(np.var(d),2)
+            mean = round(np.mean(d),2)
+            dispersion = round(var/mean,3)
+            stats_list.append({'label':label, 'var': var , 'mean': mean, 'dispersion': dispersion, 'count':len(d)})
+
+        self.assertEqual(distances.stats_list, stats_list)
+        self.assertEqual(distances.stats, {s.pop('label'): s for s in stats_list})
+
+    def test_masked_cityblock(self):
+        n_pdbs, n_gns = 6, 8
+        present = self.random.rand(n_pdbs, n_gns) > 0.3
+        present[:, :2] = True
+        upper = np.triu_indices(n_gns, 1)
+        masks = present[:, upper[0]] & present[:, upper[1]]
+        values = self.random.uniform(0, 2, masks.shape) * masks
+
+        expected = np.zeros((n_pdbs, n_pdbs))
+        for i in range(n_pdbs):
+            for j in range(i+1, n_pdbs):
+                # distance between cells that have both GNs in both structures
+                gn_indices = np.flatnonzero(present[i] & present[j])
+                cells = np.isin(upper[0], gn_indices) & np.isin(upper[1], gn_indices)
+                distance = np.sum(np.absolute(values[i][cells] - values[j][cells]))
+                expected[i, j] = expected[j, i] = distance * distance/(len(gn_indices)*len(gn_indices))
+
+        np.testing.assert_allclose(masked_cityblock(values, masks, present), expected, atol=1e-9)
@@ -15,6 +15,7 @@ import hashlib
 import copy
 
 from contactnetwork.models import *
+from contactnetwork.contacts import CONTACT_INTERACTION_TYPES, get_structure_contact_types
 from contactnetwork.distances import *
 from contactnetwork.functions import *
 from structure.models import Structure, StructureVectors, StructureExtraProteins
@@ -606,20 +607,19 @@ def InteractionBrowserData(request):
     except IndexError:
         strict_interactions = []
 
-    i_types_filter = Q()
-    if i_types:
-        if len(strict_interactions) == 0:
-            i_types_filter |= Q(interaction_type__in=i_types)
-        else:
-            # Merging the interaction filter with filters for the strict settings
-            for int_type in i_types:
-                if int_type in strict_interactions:
-                    if int_type == 'polar' or int_type == 'aromatic':
-                        i_types_filter = i_types_filter | (Q(interaction_type=int_type) & Q(interaction_level=0))
-                    elif int_type == 'hydrophobic' or int_type == 'van-der-waals':
-                        i_types_filter = i_types_filter | (Q(interaction_type=int_type) & Q(atompaircount__gte=4))
-                else:
-                    i_types_filter = i_types_filter | Q(interaction_type=int_type)
+    # Minimum number of atom pairs per interaction type, the strict settings only count polar and aromatic
+    # interactions at the normal level and require 4 atom pairs for hydrophobic and van der Waals contacts
+    type_thresholds = {}
+    strict_level_types = []
+    for int_type in i_types:
+        if int_type not in CONTACT_INTERACTION_TYPES or int_type == 'water-mediated':
+            continue
+        type_thresholds[int_type] = 1
+        if int_type in strict_interactions:
+            if int_type == 'polar' or int_type == 'aromatic':
+                strict_level_types.append(int_type)
+            elif int_type == 'hydrophobic' or int_type == 'van-der-waals':
+                type_thresholds[int_type] = 4
 
     # Options settings
     try:
@@ -627,74 +627,14 @@ def InteractionBrowserData(request):
     except IndexError:
         contact_options = []
 
-    i_options_filter = Q()
-    # Filter out contact within the same helix
-    #if contact_options and len(contact_options) > 0:
-    # if not contact_options or "intrahelical" not in contact_options:
-    #    i_options_filter = ~Q(interacting_pair__res1__protein_segment=F('interacting_pair__res2__protein_segment'))
-
-    # Filter out contact with backbone atoms
-    # backbone_atoms = ["C", "O", "N", "CA"]
-    # if not contact_options or "backbone" not in contact_options:
-    #    i_options_filter = i_options_filter & ~Q(atomname_residue1__in=backbone_atoms) & ~Q(atomname_residue2__in=backbone_atoms)
-
-    # Filters for inter- and intrasegment contacts + BB/SC filters
-    backbone_atoms = ["C", "O", "N", "CA"]
-    pure_backbone_atoms = ["C", "O", "N"]
-
-    # INTERsegment interactions
-    inter_segments = ~Q(interacting_pair__res1__protein_segment=F('interacting_pair__res2__protein_segment'))
-
-    # Blocking filter for empty settings
-    inter_options_filter = (inter_segments & Q(atomname_residue1="FOO"))
-
-    # BB-BB
-    if contact_options and "inter_bbbb" in contact_options:
-        bbbb = Q(atomname_residue1__in=backbone_atoms) & Q(atomname_residue2__in=backbone_atoms) & inter_segments
-        inter_options_filter = inter_options_filter | bbbb
-
-    # SC-BB
-    if contact_options and "inter_scbb" in contact_options:
-        scbb = ((Q(atomname_residue1__in=backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms)) | (~Q(atomname_residue1__in=pure_backbone_atoms) & Q(atomname_residue2__in=backbone_atoms))) & inter_segments
-        inter_options_filter = inter_options_filter | scbb
-
-    # SC-SC
-    if contact_options and "inter_scsc" in contact_options:
-        scsc = ~Q(atomname_residue1__in=pure_backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms) & inter_segments
-        inter_options_filter = inter_options_filter | scsc
-
-    # INTRAsegment interactions
-    intra_segments = Q(interacting_pair__res1__protein_segment=F('interacting_pair__res2__protein_segment'))
-
-    # Blocking filter for empty settings
-    intra_options_filter = (intra_segments & Q(atomname_residue1="FOO"))
-
-    # BB-BB
-    if contact_options and "intra_bbbb" in contact_options:
-        bbbb = Q(atomname_residue1__in=backbone_atoms) & Q(atomname_residue2__in=backbone_atoms) & intra_segments
-        intra_options_filter = intra_options_filter | bbbb
-
-    # SC-BB
-    if contact_options and "intra_scbb" in contact_options:
-        scbb = ((Q(atomname_residue1__in=backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms)) | (~Q(atomname_residue1__in=pure_backbone_atoms) & Q(atomname_residue2__in=backbone_atoms))) & intra_segments
-        intra_options_filter = intra_options_filter | scbb
-
-    # SC-SC
-    if contact_options and "intra_scsc" in contact_options:
-        scsc = ~Q(atomname_residue1__in=pure_backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms) & intra_segments
-        intra_options_filter = intra_options_filter | scsc
-
-    i_options_filter = inter_options_filter | intra_options_filter
+    # Inter- and intrasegment contacts + BB/SC filters are selected with the inter_bbbb, intra_scsc, ... options
+    # (see contactnetwork.contacts), no contacts are returned without these options
 
     # DISCUSS: cache hash now takes the normalize along, is this necessary
     normalized = "normalize" in contact_options
 
     forced_class_a = "classa" in contact_options
 
-    # Segment filters are now disabled
-    segment_filter_res1 = Q()
-    segment_filter_res2 = Q()
-
     # Cache
     hash_list = [pdbs1,pdbs2,i_types, strict_interactions, contact_options]
     hash_cache_key = 'interactionbrowserdata_{}'.format(get_hash(hash_list))
@@ -847,50 +787,9 @@ def InteractionBrowserData(request):
             class_mutations = {key: len(value) for key, value in class_mutations.items()}
             cache.set(cache_key, class_mutations, 3600 * 24 * 7)
 
-        # Get the relevant interactions
-        # TODO MAKE SURE ITs only gpcr residues..
-        interactions = Interaction.objects.filter(
-            interacting_pair__referenced_structure__pdb_code__index__in=pdbs_upper
-        ).filter(
-            interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id') # Filter interactions with other proteins
-        ).filter(
-            interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')
-        ).filter(
-            segment_filter_res1 & segment_filter_res2
-        ).values(
-            'interaction_type',
-            'interacting_pair__referenced_structure__pk',
-            'interacting_pair__res1__pk',
-            'interacting_pair__res2__pk',
-        ).distinct(
-        ).annotate(
-             atompaircount=Count('interaction_type'),
-             arr=ArrayAgg('pk')
-        ).exclude(
-            specific_type='water-mediated'
-        ).filter(
-            i_types_filter
-        ).filter(
-            i_options_filter
-        ).order_by(
-            'interaction_type',
-            'interacting_pair__referenced_structure__pk',
-            'interacting_pair__res1__pk',
-            'interacting_pair__res2__pk'
-        )
-
-        # FOR DEBUGGING interaction + strict filters
-        # print(interactions.query)
-        interactions = list(interactions)
-
-        # Grab unique interaction_IDs
-        interaction_ids = []
-        for entry in interactions:
-            interaction_ids.extend(entry['arr'])
-
-        # Interaction type sort - optimize by statically defining interaction type order
-        order = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals','None']
-        interactions = sorted(interactions, key=lambda x: order.index(x['interaction_type']))
+        # Get the relevant contacts (GPCR residue pairs within the same protein) from the precomputed contact index
+        structure_ids = list(Structure.objects.filter(pdb_code__index__in=pdbs_upper).order_by('pk').values_list('pk', flat=True))
+        contacts = get_structure_contact_types(structure_ids, type_thresholds, contact_options, strict_level_types)
 
 
 
@@ -1049,8 +948,9 @@ def InteractionBrowserData(request):
                                 all_pdbs_pairs[coord][pair] = p
             cache.set("all_pdbs_aa_pairs",all_pdbs_pairs,60*60*24*7) #Cache results
         residues = Residue.objects.filter(protein_conformation__protein__entry_name__in=pdbs
-                ).exclude(generic_number=None).values('pk','sequence_number','generic_number__label','amino_acid','protein_conformation__protein__entry_name','protein_segment__slug','display_generic_number__label').all()
+                ).exclude(generic_number=None).values('pk','sequence_number','generic_number','generic_number__label','amino_acid','protein_conformation__protein__entry_name','protein_segment__slug','display_generic_number__label').all()
         r_lookup = {}
+        r_gn_lookup = {}
         r_pair_lookup = defaultdict(lambda: defaultdict(lambda: []))
         segm_lookup = {}
         r_presence_lookup = defaultdict(lambda: [])
@@ -1060,6 +960,8 @@ def InteractionBrowserData(request):
         distinct_gns = []
 
         for r in residues:
+            r_gn_lookup[(r['protein_conformation__protein__entry_name'], r['generic_number'])] = r['pk']
+            r['classa_generic_number__label'] = r['generic_number__label']
 
             # remove .50 number from the display number format (1.50x50), so only the GPCRdb number is left
             r['display_generic_number__label'] = re.sub(r'\.[\d]+', '', r['display_generic_number__label'])
@@ -1100,6 +1002,20 @@ def InteractionBrowserData(request):
         # Dict to keep track of which residue numbers are in use
         number_dict = set()
 
+        # Contacts as (interaction type, structure, residue pair) rows, the residue with the lower id first
+        interactions = []
+        for position, gn1, gn2, i_type in contacts.tolist():
+            s = structure_ids[position]
+            pdb_name = s_lookup[s][1]
+            interactions.append({
+                'interaction_type': CONTACT_INTERACTION_TYPES[i_type],
+                'interacting_pair__referenced_structure__pk': s,
+                'interacting_pair__res1__pk': r_gn_lookup[(pdb_name, gn1)],
+                'interacting_pair__res2__pk': r_gn_lookup[(pdb_name, gn2)],
+            })
+        interactions.sort(key=lambda x: (CONTACT_INTERACTION_TYPES.index(x['interaction_type']),
+            x['interacting_pair__referenced_structure__pk'], x['interacting_pair__res1__pk'], x['interacting_pair__res2__pk']))
+
         print('Start going through interactions',time.time()-start_time)
         for i in interactions:
             s = i['interacting_pair__referenced_structure__pk']
@@ -1677,6 +1593,27 @@ def InteractionBrowserData(request):
                     data['tab4'][gn]['angles'] = gn_values
 
 
+        def aa_pair_interactions(pdb_set):
+            # The interaction types, structures and receptor families of the contacts in pdb_set per Class A generic
+            # number and amino acid pair
+            pairs = OrderedDict()
+            for i in interactions:
+                s = i['interacting_pair__referenced_structure__pk']
+                if s_lookup[s][1] not in pdb_set:
+                    continue
+                res1 = r_lookup[i['interacting_pair__res1__pk']]
+                res2 = r_lookup[i['interacting_pair__res2__pk']]
+                key = (res1['classa_generic_number__label'], res2['classa_generic_number__label'], res1['amino_acid'], res2['amino_acid'])
+                if key not in pairs:
+                    pairs[key] = {'gn1': key[0], 'gn2': key[1], 'aa1': key[2], 'aa2': key[3], 'i_types': [], 'structures': [], 'pfs': []}
+                pairs[key]['i_types'].append(i['interaction_type'])
+                pairs[key]['structures'].append(s_lookup[s][1].upper())
+                pairs[key]['pfs'].append(s_lookup[s][2])
+            for pair in pairs.values():
+                pair['structuresC'] = len(set(pair['structures']))
+                pair['pfsC'] = len(set(pair['pfs']))
+            return list(pairs.values())
+
         # Tab 2 data generation
         # Get the relevant interactions
         data['tab2'] = {}
@@ -1686,31 +1623,8 @@ def InteractionBrowserData(request):
 
             set_id = 'set1'
             aa_pair_data = data['tab2']
-            interactions = list(Interaction.objects.filter(
-                    interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs1']]
-                ).filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
-            for i in interactions:
+            aa_pairs = aa_pair_interactions(data['pdbs1'])
+            for i in aa_pairs:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
                 if key not in aa_pair_data:
                     aa_pair_data[key] = {'classA':'{},{}'.format(i['gn1'],i['gn2']),'set1':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'set2':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'types':[]}
@@ -1728,32 +1642,9 @@ def InteractionBrowserData(request):
             print('Gotten first set occurance calcs',time.time()-start_time)
 
             set_id = 'set2'
-            interactions = list(Interaction.objects.filter(
-                    interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs2']]
-                ).filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            aa_pairs = aa_pair_interactions(data['pdbs2'])
 
-            for i in interactions:
+            for i in aa_pairs:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
                 if key not in aa_pair_data:
                     aa_pair_data[key] = {'classA':'{},{}'.format(i['gn1'],i['gn2']),'set1':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'set2':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'types':[]}
@@ -1851,30 +1742,9 @@ def InteractionBrowserData(request):
             # Single set!
             # TODO: fix the interaction filter subselection
             aa_pair_data = data['tab2']
-            interactions = list(Interaction.objects.filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            aa_pairs = aa_pair_interactions(data['pdbs'])
 
-            for i in interactions:
+            for i in aa_pairs:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
                 if key not in aa_pair_data:
                     aa_pair_data[key] = {'classA':'{},{}'.format(i['gn1'],i['gn2']),'set':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'types':[]}
@@ -2739,19 +2609,23 @@ def stableResMatrix(pdbs):
     for selclass in ['001', '002', '003', '004', '006']:
         # select all distances to selected residue
         reference = stable_residues[selclass]
-        ds = list(Distance.objects.filter(structure__pdb_code__index__in=pdbs) \
-                                .filter(structure__protein_conformation__protein__family__slug__startswith=selclass) \
-                                .filter(Q(gn1=reference) | Q(gn2=reference)) \
-                                .values('structure__pdb_code__index', 'gns_pair', 'distance'))
+        class_pdbs = list(Structure.objects.filter(pdb_code__index__in=pdbs) \
+                                .filter(protein_conformation__protein__family__slug__startswith=selclass) \
+                                .values_list('pdb_code__index', flat=True))
+        if len(class_pdbs) == 0:
+            continue
+        matrices = get_distance_matrices(class_pdbs)
+        if reference not in matrices.generic_numbers:
+            continue
 
         # create dictionary of all structures and all distances
-        for i,d in enumerate(ds):
-            if not d['structure__pdb_code__index'] in stable_distances:
-                stable_distances[d['structure__pdb_code__index']] = {}
-                pdb_classes[d['structure__pdb_code__index']] = selclass
-
-            gn_label = d['gns_pair'].replace(reference, "").replace("_", "")
-            stable_distances[d['structure__pdb_code__index']][gn_label] = d['distance']
+        ref_index = matrices.generic_numbers.index(reference)
+        for pdb, ref_distances in zip(matrices.pdbs, matrices.distances[:, ref_index, :]):
+            present = np.flatnonzero(~np.isnan(ref_distances))
+            if len(present) == 0:
+                continue
+            stable_distances[pdb] = { matrices.generic_numbers[i]: float(ref_distances[i])*distance_scaling_factor for i in present }
+            pdb_classes[pdb] = selclass
 
 
     pdbs = list(stable_distances.keys())
@@ -0,0 +1,886 @@
+"""
+Ligand-receptor interaction calculation (hydrogen bond, ionic, aromatic and hydrophobic contacts) of PDB files.
+
+Replaces the legacy interaction script (legacy_functions.py, still available through run_legacy_calculation): all state
+of a calculation is kept in an InteractionCalculation object, so calculations can run side by side in one process or in
+a pool of processes (see run_calculations). The output files are the same as those of the legacy script and are read
+with interaction.views.parsecalculation.
+"""
+from Bio.PDB import PDBIO, PDBParser, Select
+
+from io import StringIO
+import logging
+import os
+import re
+import shutil
+import subprocess
+import time
+import urllib.request
+from functools import partial
+from math import acos, degrees
+from multiprocessing import Pool, TimeoutError, get_context
+
+import numpy as np
+import yaml
+from scipy.spatial import cKDTree
+
+
+logger = logging.getLogger("protwis")
+
+# openbabel is only imported by the calculations (load_openbabel), so the views importing this module do not need it
+openbabel = None
+pybel = None
+
+AA = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D',
+      'CYS': 'C', 'GLN': 'Q', 'GLU': 'E', 'GLY': 'G',
+      'HIS': 'H', 'ILE': 'I', 'LEU': 'L', 'LYS': 'K',
+      'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S',
+      'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V'}
+
+NEGATIVE = {'D', 'E'}
+POSITIVE = {'H', 'K', 'R'}
+AROMATIC = {'TYR', 'TRP', 'PHE', 'HIS'}
+CHARGEDAA = {'ARG', 'LYS', 'ASP', 'GLU'}  # skip ,'HIS'
+HYDROPHOBIC_AA = {'A', 'C', 'F', 'I', 'L', 'M', 'P', 'V', 'W', 'Y'}
+BACKBONE_ATOMS = ('C', 'O', 'N')
+
+INTERACTIONS_DIR = '/tmp/interactions/'
+IGNORE_HET = ['NA', 'W']  # ignore sodium and water
+RADIUS = 5
+HYDROPHOBIC_RADIUS = 4.5
+HBOND_DISTANCE = 3.5
+# atoms of the different molecules (Open Babel, Biopython, PDB file) within this distance are the same atom
+SAME_ATOM_DISTANCE = 0.1
+SAME_POSITION_DISTANCE = 0.5
+
+
+def load_openbabel():
+    global openbabel, pybel
+    if pybel is None:
+        try:
+            from openbabel import openbabel as ob, pybel as pb
+        except ImportError:
+            import openbabel as ob
+            import pybel as pb
+        openbabel, pybel = ob, pb
+
+
+def vector_angle(v1, v2):
+    """Angle between two vectors in radians (as Bio.PDB.Vector.angle)."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = float(np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2)))
+    # clipped in the same order, so an undefined angle (zero vector) is pi
+    return acos(max(-1.0, min(c, 1.0)))
+
+
+def distance(v1, v2):
+    return float(np.sqrt(((v1 - v2) ** 2).sum()))
+
+
+def count_free_atoms(ob_atom, atomic_num):
+    return len([a for a in openbabel.OBAtomAtomIter(ob_atom) if a.GetAtomicNum() == atomic_num
+        and len([n for n in openbabel.OBAtomAtomIter(a) if n.GetAtomicNum() != 1]) == 1])
+
+
+def is_carboxyl_oxygen(ob_atom):
+    if hasattr(ob_atom, 'IsCarboxylOxygen'):
+        return ob_atom.IsCarboxylOxygen()
+    # Open Babel 3 dropped IsCarboxylOxygen, same definition: a terminal oxygen of a carbon with two terminal oxygens
+    # (or a terminal oxygen and a terminal sulfur)
+    if ob_atom.GetAtomicNum() != 8 or len([n for n in openbabel.OBAtomAtomIter(ob_atom) if n.GetAtomicNum() != 1]) != 1:
+        return False
+    for neighbor in openbabel.OBAtomAtomIter(ob_atom):
+        if neighbor.GetAtomicNum() == 6:
+            free_oxygens = count_free_atoms(neighbor, 8)
+            return free_oxygens == 2 or (free_oxygens == 1 and count_free_atoms(neighbor, 16) == 1)
+    return False
+
+
+def aromatic_rings(mol):
+    """Aromatic rings of a pybel molecule as [atom indices, center, normal, atom types, atom coordinates]."""
+    ringlist = []
+    for ring in mol.OBMol.GetSSSR():
+        if not ring.IsAromatic():
+            continue
+        atoms = [atom for atom in mol if ring.IsMember(atom.OBAtom)]
+        vectors = np.array([atom.coords for atom in atoms], dtype=float)
+        center = vectors.sum(axis=0) / ring.Size()
+        normal = np.cross(center - vectors[0], center - vectors[2])
+        ringlist.append([[atom.idx for atom in atoms], center, normal, [atom.type for atom in atoms], vectors])
+    return ringlist
+
+
+def hydrogen_coords(atom):
+    return [np.array(pybel.Atom(neighbor).coords, dtype=float) for neighbor in pybel.ob.OBAtomAtomIter(atom.OBAtom)
+        if pybel.Atom(neighbor).type == "H"]
+
+
+def unique_ligand_pdb(pdb):
+    """Only keep the HETATM records of the first residue of a ligand PDB."""
+    lines = []
+    ligandid = 0
+    chainid = 0
+    for line in pdb.splitlines(True):
+        if line.startswith('HETATM'):
+            residue_number = line[22:26]
+            chain = line[21]
+            if (residue_number != ligandid and ligandid != 0) or (chain != chainid and chainid != 0):
+                continue
+            ligandid = residue_number
+            chainid = chain
+        lines.append(line)
+    return ''.join(lines)
+
+
+class HetSelect(Select):
+
+    def __init__(self, hetnam):
+        self.hetnam = hetnam
+
+    def accept_residue(self, residue):
+        return residue.get_resname().strip() == self.hetnam
+
+
+class ChainSelect(Select):
+
+    def __init__(self, chain_id):
+        self.chain_id = chain_id
+
+    def accept_residue(self, residue):
+        return residue.get_parent().id == self.chain_id
+
+
+class SequenceNumberSelect(Select):
+
+    def __init__(self, sequence_number):
+        self.sequence_number = sequence_number
+
+    def accept_residue(self, residue):
+        return str(residue.get_full_id()[3][1]) == self.sequence_number
+
+
+class InteractionCalculation:
+    """Interactions of all ligands (or a peptide chain) of a PDB file with the receptor residues.
+
+    Receptor-ligand atom pairs are found with a k-d tree of the receptor atoms, the contacts of a residue are then
+    classified on the coordinate arrays of its pairs. Results are written per ligand to the results directory of the
+    PDB (output/*.yaml, interaction/*.pdb and fragments/*.pdb).
+    """
+
+    def __init__(self, pdbname, session=None, peptide=None):
+        load_openbabel()
+        self.pdbname = pdbname
+        self.session = session
+        self.peptide = peptide or None
+        if session:
+            self.projectdir = INTERACTIONS_DIR + session + '/'
+        else:
+            self.projectdir = INTERACTIONS_DIR
+        self.pdb_path = self.projectdir + 'pdbs/' + pdbname + '.pdb'
+        self.result_dir = self.projectdir + 'results/' + pdbname + '/'
+
+        self.hetlist = {}
+        self.hetlist_display = {}
+        self.ligand_mols = {}
+        self.ligand_fragment_atoms = {}
+        self.ligand_charged = {}
+        self.ligandcenter = {}
+        self.ligand_rings = {}
+        self.ligand_donors = {}
+        self.ligand_acceptors = {}
+        self.inchikeys = {}
+        self.smiles = {}
+        self.results = {}
+        self.new_results = {}
+        self.binding_residues = {}
+        self.residue_rings = {}
+        self.residue_donors = {}
+
+    def run(self):
+        if not self.session:
+            self.check_pdb()
+        self.check_dirs()
+        self.structure = PDBParser(QUIET=True).get_structure(self.pdbname, self.pdb_path)
+        self.read_pdb_lines()
+        self.hetlist_display = self.find_ligand_full_names()
+        self.create_ligands()
+        self.build_ligand_info()
+        self.find_interactions()
+        self.analyze_interactions()
+        self.write_results()
+        return self.new_results
+
+    def check_pdb(self):
+        # check if PDB is there, otherwise fetch
+        os.makedirs(self.projectdir + 'pdbs/', exist_ok=True)
+        if not os.path.isfile(self.pdb_path):
+            url = 'https://www.rcsb.org/pdb/files/%s.pdb' % self.pdbname
+            pdbdata = urllib.request.urlopen(url).read().decode('utf-8')
+            with open(self.pdb_path, 'w') as f:
+                f.write(pdbdata)
+
+    def check_dirs(self):
+        # check that dirs are there and have right permissions
+        if os.path.exists(self.result_dir):
+            shutil.rmtree(self.result_dir)
+        for directory in [INTERACTIONS_DIR, self.projectdir, self.projectdir + 'results/', self.result_dir]:
+            os.makedirs(directory, exist_ok=True)
+        for subdir in ['interaction', 'ligand', 'output', 'png', 'fragments']:
+            directory = self.result_dir + subdir
+            os.makedirs(directory, exist_ok=True)
+            os.chmod(directory, 0o777)
+
+    def read_pdb_lines(self):
+        """Coordinate records of the PDB file, used to cut out the fragment files."""
+        with open(self.pdb_path, 'r') as f:
+            self.pdb_lines = [line for line in f if line.startswith(('ATOM', 'HETATM'))]
+        self.line_is_het = np.array([line.startswith('HETATM') for line in self.pdb_lines], dtype=bool)
+        self.line_residue = np.array([line[22:26].strip() for line in self.pdb_lines])
+        self.line_chain = np.array([line[21].strip() for line in self.pdb_lines])
+        self.line_coords = np.full((len(self.pdb_lines), 3), np.nan)
+        for i in np.nonzero(self.line_is_het)[0]:
+            line = self.pdb_lines[i]
+            self.line_coords[i] = [float(line[30:38]), float(line[38:46]), float(line[46:54])]
+
+    def find_ligand_full_names(self):
+        d = {}
+        with open(self.pdb_path, 'r') as f:
+            for line in f:
+                if line.startswith('HETSYN'):
+                    # need to fix bad PDB formatting where col4 and col5 are put
+                    # together for some reason -- usually seen when the id is +1000
+                    m = re.match(r"HETSYN[\s]+([\w]{3})[\s]+(.+)", line)
+                    if m:
+                        d[m.group(1)] = m.group(2).strip()
+        return d
+
+    def ligand_path(self, hetflag, extension):
+        return self.result_dir + 'ligand/' + hetflag + '_' + self.pdbname + extension
+
+    def het_residues(self):
+        """Ligand residues of the structure with their hetflag, in the order of the file."""
+        for model in self.structure:
+            for chain in model:
+                if self.peptide and chain.id != self.peptide:
+                    continue
+                for residue in chain:
+                    if self.peptide:
+                        hetflag = 'pep'
+                    else:
+                        hetflag = residue.get_full_id()[3][0].strip().replace("H_", "").strip()
+                    if hetflag and hetflag not in IGNORE_HET:
+                        yield chain, residue, hetflag
+
+    def create_ligands(self):
+        """Write the PDB, SDF and InChI files of every ligand and load its molecule (with hydrogens)."""
+        done = set()
+        for chain, residue, hetflag in self.het_residues():
+            if hetflag in done:
+                continue
+            done.add(hetflag)
+
+            pdb = StringIO()
+            io = PDBIO()
+            io.set_structure(self.structure)
+            if self.peptide:
+                io.save(pdb, ChainSelect(self.peptide))
+            else:
+                io.save(pdb, HetSelect(hetflag))
+            ligand_pdb = self.ligand_path(hetflag, '.pdb')
+            with open(ligand_pdb, 'w') as f:
+                f.write(unique_ligand_pdb(pdb.getvalue()))
+
+            mols = list(pybel.readfile("pdb", ligand_pdb))
+            if not mols:
+                continue
+
+            obConversion = openbabel.OBConversion()
+            obConversion.SetInAndOutFormats("pdb", "inchi")
+            obConversion.SetOptions("K", obConversion.OUTOPTIONS)
+            mol = openbabel.OBMol()
+            obConversion.ReadFile(mol, ligand_pdb)
+            obConversion.WriteFile(mol, self.ligand_path(hetflag, '.inchi'))
+            self.inchikeys[hetflag] = obConversion.WriteString(mol).strip()
+            self.smiles[hetflag] = mols[0].write("smi").split("\t")[0]
+
+            mol = mols[0]
+            mol.OBMol.AddHydrogens(False, True, 7.4)
+            mol.write("pdb", ligand_pdb, overwrite=True)
+
+            obConversion = openbabel.OBConversion()
+            obConversion.SetInAndOutFormats("pdb", "sdf")
+            mol = openbabel.OBMol()
+            obConversion.ReadFile(mol, ligand_pdb)
+            obConversion.WriteFile(mol, self.ligand_path(hetflag, '.sdf'))
+
+            # the ligand is analyzed as read back from the PDB file (with hydrogens)
+            self.ligand_mols[hetflag] = next(pybel.readfile("pdb", ligand_pdb))
+
+    def build_ligand_info(self):
+        """Ligand atoms and center, rings, charged atoms and hydrogen bond donors and acceptors of every ligand."""
+        for chain, residue, hetflag in self.het_residues():
+            if hetflag not in self.ligand_mols or (hetflag in self.hetlist and not self.peptide):
+                continue
+
+            if hetflag not in self.hetlist:
+                self.hetlist[hetflag] = []
+                mol = self.ligand_mols[hetflag]
+                self.ligand_rings[hetflag] = aromatic_rings(mol)
+                self.ligand_charged[hetflag] = []
+                self.ligand_donors[hetflag] = []
+                self.ligand_acceptors[hetflag] = []
+                for atom in mol:
+                    coords = np.array(atom.coords, dtype=float)
+                    if atom.formalcharge != 0:
+                        self.ligand_charged[hetflag].append([atom.type, coords, atom.formalcharge])
+                    if is_carboxyl_oxygen(atom.OBAtom):
+                        self.ligand_charged[hetflag].append([atom.type, coords, -1])
+                    if atom.OBAtom.IsHbondDonor():
+                        self.ligand_donors[hetflag].append([atom.type, coords, hydrogen_coords(atom)])
+                    if atom.OBAtom.IsHbondAcceptor():
+                        self.ligand_acceptors[hetflag].append([atom.type, coords])
+
+            # the atoms of all residues of a peptide chain and of the first residue of other ligands
+            for atom in residue:
+                self.hetlist[hetflag].append([residue.get_resname(), atom.name, np.array(atom.coord, dtype=float)])
+
+        # the legacy CA cutoff: residues with the CA further from the ligand center than the number of ligand atoms are
+        # skipped
+        for hetflag, atomlist in self.hetlist.items():
+            coords = np.array([atom[2] for atom in atomlist], dtype=float).reshape(-1, 3)
+            self.ligandcenter[hetflag] = [coords.sum(axis=0) / len(coords), len(coords)]
+
+    def get_residue_rings(self, sequence_number):
+        """Aromatic rings of the residues with this sequence number."""
+        if sequence_number not in self.residue_rings:
+            self.residue_rings[sequence_number] = aromatic_rings(self.residue_molecule(sequence_number))
+        return self.residue_rings[sequence_number]
+
+    def get_residue_donors(self, sequence_number):
+        """Hydrogen bond donors of the residues with this sequence number with their hydrogens and acceptor flag."""
+        if sequence_number not in self.residue_donors:
+            mol = self.residue_molecule(sequence_number)
+            mol.OBMol.AddHydrogens(False, True, 7.4)
+            self.residue_donors[sequence_number] = [[atom.type, np.array(atom.coords, dtype=float),
+                hydrogen_coords(atom), atom.OBAtom.IsHbondAcceptor()] for atom in mol if atom.OBAtom.IsHbondDonor()]
+        return self.residue_donors[sequence_number]
+
+    def residue_molecule(self, sequence_number):
+        pdb = StringIO()
+        io = PDBIO()
+        io.set_structure(self.structure)
+        io.save(pdb, SequenceNumberSelect(sequence_number))
+        return pybel.readstring("pdb", pdb.getvalue())
+
+    def get_fragment_atoms(self, hetflag):
+        """Heavy atom coordinates of a ligand and the coordinates of every atom with its first and second neighbors."""
+        if hetflag not in self.ligand_fragment_atoms:
+            mol = next(pybel.readfile("pdb", self.ligand_path(hetflag, '.pdb')))
+            mol.removeh()
+            coords = []
+            neighborhoods = []
+            for atom in mol:
+                vectors = [atom.coords]
+                for neighbour_atom in openbabel.OBAtomAtomIter(atom.OBAtom):
+                    vectors.append(pybel.Atom(neighbour_atom).coords)
+                    for neighbour_atom2 in openbabel.OBAtomAtomIter(neighbour_atom):
+                        vectors.append(pybel.Atom(neighbour_atom2).coords)
+                coords.append(atom.coords)
+                neighborhoods.append(np.array(vectors, dtype=float))
+            self.ligand_fragment_atoms[hetflag] = (np.array(coords, dtype=float).reshape(-1, 3), neighborhoods)
+        return self.ligand_fragment_atoms[hetflag]
+
+    def fragment_lines(self, targets, residuenr, chain):
+        """PDB records of the HETATMs at the target coordinates and of the residue, with the residue name."""
+        selected = self.line_is_het.copy()
+        if len(targets) and selected.any():
+            het_coords = self.line_coords[selected]
+            near = np.zeros(len(het_coords), dtype=bool)
+            for target in targets:
+                near |= np.sqrt(((het_coords - target) ** 2).sum(axis=1)) < SAME_ATOM_DISTANCE
+            selected[selected] = near
+        else:
+            selected[:] = False
+        residue_lines = ~self.line_is_het & (self.line_residue == residuenr) & (self.line_chain == chain)
+        residue_index = np.nonzero(residue_lines)[0]
+        residuename = self.pdb_lines[residue_index[-1]][17:20].strip() if len(residue_index) else None
+        return ''.join([self.pdb_lines[i] for i in np.nonzero(selected | residue_lines)[0]]), residuename
+
+    def fragment_library(self, ligand, atomvector, atomname, residuenr, chain, typeinteraction):
+        """Write the fragment PDB of a ligand atom (with its neighbors up to two bonds away) and a residue."""
+        chain = chain.strip()
+        targets = []
+        if atomvector is not None:
+            coords, neighborhoods = self.get_fragment_atoms(ligand)
+            if len(coords):
+                close = np.sqrt(((coords - atomvector) ** 2).sum(axis=1)) <= SAME_ATOM_DISTANCE
+                targets = [vector for i in np.nonzero(close)[0] for vector in neighborhoods[i]]
+
+        tempstr, residuename = self.fragment_lines(targets, residuenr, chain)
+        filename = self.result_dir + 'fragments/' + self.pdbname + "_" + ligand + "_" + \
+            (residuename or 'unknown') + residuenr + chain + "_" + atomname + "_" + typeinteraction + ".pdb"
+        with open(filename, 'w') as f:
+            f.write(tempstr)
+        mol = next(pybel.readfile("pdb", filename))
+        mol.write("pdb", filename, overwrite=True)
+        return filename
+
+    def fragment_library_aromatic(self, ligand, atomvectors, residuenr, chain, ringnr):
+        """Write the fragment PDB of a ligand ring and a residue."""
+        chain = chain.strip()
+        tempstr, residuename = self.fragment_lines(atomvectors, residuenr, chain)
+        filename = self.result_dir + 'fragments/' + self.pdbname + "_" + ligand + "_" + (residuename or '') + \
+            str(residuenr) + chain + "_aromatic_" + str(ringnr) + ".pdb"
+        with open(filename, 'w') as f:
+            f.write(tempstr)
+        return filename
+
+    def add_interaction(self, ligand, interaction):
+        self.new_results[ligand]['interactions'].append(interaction)
+
+    def remove_hyd(self, aa, ligand):
+        self.new_results[ligand]['interactions'] = [res for res in self.new_results[ligand]['interactions']
+            if not (res[0] == aa and (res[2] == 'HYD' or res[2] == 'hyd'))]
+
+    def check_other_aromatic(self, aa, ligand, info):
+        templist = []
+        check = True
+        for res in self.new_results[ligand]['interactions']:
+            if res[0] == aa and res[4] == 'aromatic':
+                # if the new aromatic interaction has a center-center distance greater than the old one, keep old.
+                if info['Distance'] > res[6]['Distance']:
+                    templist.append(res)
+                    check = False
+                else:
+                    check = True
+                    continue
+            else:
+                templist.append(res)
+        self.new_results[ligand]['interactions'] = templist
+        return check
+
+    def receptor_residues(self):
+        """Receptor residues (no hetero residues or peptide ligand chain) in the order of the file."""
+        residues = []
+        for model in self.structure:
+            for chain in model:
+                if self.peptide and chain.id == self.peptide:
+                    continue
+                for residue in chain:
+                    if residue.get_full_id()[3][0].strip().replace("H_", ""):
+                        continue  # residue is a hetnam
+                    residues.append((chain.id, residue))
+        return residues
+
+    def find_interactions(self):
+        """Find the residues within the radius of every ligand and their accessible, hydrophobic and aromatic contacts."""
+        residues = self.receptor_residues()
+        atoms = [(i, atom) for i, (chainid, residue) in enumerate(residues) for atom in residue]
+        if not atoms or not self.hetlist:
+            return
+        atom_residue = np.array([i for i, atom in atoms], dtype=int)
+        atom_names = np.array([atom.name for i, atom in atoms])
+        atom_coords = np.array([atom.coord for i, atom in atoms], dtype=float)
+        atom_hydrogen = np.array([atom.name[0] == 'H' or atom.element == 'H' for i, atom in atoms], dtype=bool)
+        atom_carbon = np.array([atom.name[0] == 'C' for i, atom in atoms], dtype=bool)
+        atom_sidechain = ~np.isin(atom_names, BACKBONE_ATOMS)
+        receptor_tree = cKDTree(atom_coords)
+
+        ca_coords = np.array([residue['CA'].coord if 'CA' in residue else [np.nan] * 3 for chainid, residue in residues],
+            dtype=float)
+
+        for hetflag, atomlist in self.hetlist.items():
+            het_names = [atom[1] for atom in atomlist]
+            het_coords = np.array([atom[2] for atom in atomlist], dtype=float)
+            het_hydrogen = np.array([name[0] == 'H' for name in het_names], dtype=bool)
+            het_carbon = np.array([name[0] == 'C' for name in het_names], dtype=bool)
+            center, num_atoms = self.ligandcenter[hetflag]
+
+            # all ligand-receptor atom pairs within the radius, ordered by residue, ligand atom and residue atom
+            hits = cKDTree(het_coords).sparse_distance_matrix(receptor_tree, RADIUS, output_type='ndarray')
+            het_index = hits['i'].astype(int)
+            atom_index = hits['j'].astype(int)
+            d = np.sqrt(((het_coords[het_index] - atom_coords[atom_index]) ** 2).sum(axis=1))
+            keep = d < RADIUS
+            het_index, atom_index, d = het_index[keep], atom_index[keep], d[keep]
+            order = np.lexsort((atom_index, het_index, atom_residue[atom_index]))
+            het_index, atom_index, d = het_index[order], atom_index[order], d[order]
+            pair_residue = atom_residue[atom_index]
+
+            # residues without CA or with the CA too far from the ligand center are skipped
+            ca_distance = np.sqrt(((ca_coords - center) ** 2).sum(axis=1))
+            contact_residues = np.unique(pair_residue)
+            contact_residues = contact_residues[ca_distance[contact_residues] <= num_atoms]
+            starts = np.searchsorted(pair_residue, contact_residues, 'left')
+            ends = np.searchsorted(pair_residue, contact_residues, 'right')
+
+            for r, start, end in zip(contact_residues, starts, ends):
+                chainid, residue = residues[r]
+                self.residue_contacts(hetflag, chainid, residue, het_names, het_coords, het_index[start:end],
+                    atom_index[start:end], d[start:end], het_hydrogen, het_carbon, atom_names, atom_coords,
+                    atom_hydrogen, atom_carbon, atom_sidechain)
+
+    def residue_contacts(self, hetflag, chainid, residue, het_names, het_coords, het_index, atom_index, d,
+                         het_hydrogen, het_carbon, atom_names, atom_coords, atom_hydrogen, atom_carbon, atom_sidechain):
+        aa_resname = residue.get_resname()
+        aa_seqid = str(residue.get_full_id()[3][1])
+        aaname = aa_resname + aa_seqid + chainid
+
+        if hetflag not in self.results:
+            self.results[hetflag] = {}
+            self.new_results[hetflag] = {'interactions': []}
+            self.binding_residues[hetflag] = set()
+        if aaname not in self.results[hetflag]:
+            self.results[hetflag][aaname] = []
+
+        # atom pairs without hydrogens, for the polar interactions
+        heavy = ~(het_hydrogen[het_index] | atom_hydrogen[atom_index])
+        for h, a, pair_distance in zip(het_index[heavy], atom_index[heavy], d[heavy]):
+            self.results[hetflag][aaname].append([het_names[h], atom_names[a], round(float(pair_distance), 2),
+                het_coords[h], atom_coords[a], aa_seqid, chainid])
+        num_contacts = int(heavy.sum())
+
+        # number of ligand carbons with a residue carbon within the hydrophobic radius
+        hydrophobic = het_carbon[het_index] & atom_carbon[atom_index] & (d < HYDROPHOBIC_RADIUS)
+        hydrophobic_count = len(np.unique(het_index[hydrophobic]))
+
+        # within the radius of a residue atom that is not a backbone atom (name C, O, N)
+        if atom_sidechain[atom_index].any():
+            self.binding_residues[hetflag].add(aaname)
+            fragment_file = self.fragment_library(hetflag, None, '', aa_seqid, chainid, 'access')
+            self.add_interaction(hetflag, [aaname, fragment_file, 'acc', 'accessible', 'hidden', ''])
+
+        if hydrophobic_count > 2 and AA.get(aa_resname) in HYDROPHOBIC_AA:  # min 3 c-c interactions
+            self.binding_residues[hetflag].add(aaname)
+            fragment_file = self.fragment_library(hetflag, None, '', aa_seqid, chainid, 'hydrop')
+            self.add_interaction(hetflag, [aaname, fragment_file, 'hyd', 'hydrophobic', 'hydrophobic', ''])
+
+        if num_contacts > 1 and aa_resname in AROMATIC:
+            self.aromatic_contacts(hetflag, aaname, aa_seqid, chainid)
+
+    def aromatic_contacts(self, hetflag, aaname, aa_seqid, chainid):
+        for aaring in self.get_residue_rings(aa_seqid):
+            center = aaring[1]
+            count = 0
+            for ring in self.ligand_rings[hetflag]:
+                count += 1
+                shortest_center_het_ring_to_res_atom = min(10,
+                    float(np.sqrt(((aaring[4] - ring[1]) ** 2).sum(axis=1)).min()))
+                shortest_center_aa_ring_to_het_atom = min(10,
+                    float(np.sqrt(((ring[4] - center) ** 2).sum(axis=1)).min()))
+
+                # aa center to ring center vs ring normal, vs aa normal and the two normals against each other
+                angle_degrees = [round(degrees(vector_angle(center - ring[1], ring[2])), 1),
+                    round(degrees(vector_angle(center - ring[1], aaring[2])), 1),
+                    round(degrees(vector_angle(ring[2], aaring[2])), 1)]
+                ring_distance = round(distance(center, ring[1]), 2)
+                info = {'Distance': ring_distance,
+                    'ResAtom to center': round(shortest_center_het_ring_to_res_atom, 2),
+                    'LigAtom to center': round(shortest_center_aa_ring_to_het_atom, 2),
+                    'Angles': angle_degrees}
+
+                if distance(center, ring[1]) < 5 and (angle_degrees[2] < 20 or abs(angle_degrees[2] - 180) < 20):
+                    interaction = ['aro_ff', 'aromatic (face-to-face)', 'none']
+                # need to be careful for edge-edge
+                elif shortest_center_aa_ring_to_het_atom < 4.5 and abs(angle_degrees[0] - 90) < 30 \
+                        and abs(angle_degrees[2] - 90) < 30:
+                    interaction = ['aro_fe_protein', 'aromatic (face-to-edge)', 'protein']
+                elif shortest_center_het_ring_to_res_atom < 4.5 and abs(angle_degrees[1] - 90) < 30 \
+                        and abs(angle_degrees[2] - 90) < 30:
+                    interaction = ['aro_ef_protein', 'aromatic (edge-to-face)', 'protein']
+                else:
+                    continue
+
+                self.binding_residues[hetflag].add(aaname)
+                fragment_file = self.fragment_library_aromatic(hetflag, ring[4], aa_seqid, chainid, count)
+                if self.check_other_aromatic(aaname, hetflag, {'Distance': ring_distance, 'Angles': angle_degrees}):
+                    self.add_interaction(hetflag, [aaname, fragment_file, interaction[0], interaction[1], 'aromatic',
+                        interaction[2], info])
+                    self.remove_hyd(aaname, hetflag)
+
+            for charged in self.ligand_charged[hetflag]:
+                # needs max 4.2 distance to make aromatic+
+                charge_distance = distance(center, charged[1])
+                if charge_distance < 4.2 and charged[2] > 0:
+                    self.binding_residues[hetflag].add(aaname)
+                    #FIXME fragment file
+                    self.add_interaction(hetflag, [aaname, '', 'aro_ion_protein', 'aromatic (pi-cation)', 'aromatic',
+                        'protein', {'Distance': round(charge_distance, 2)}])
+                    self.remove_hyd(aaname, hetflag)
+
+    def hydrogen_bonds(self, donor, hydrogens, acceptor, direction, entry, hbondconfirmed):
+        """Confirm hydrogen bonds of a donor by the distance and angle of its hydrogens to the acceptor."""
+        found = False
+        for hydrogen in hydrogens:
+            bindingvector = acceptor - hydrogen
+            angle = round(degrees(vector_angle(hydrogen - donor, bindingvector)), 2)
+            hydrogen_distance = round(float(np.linalg.norm(bindingvector)), 2)
+            if hydrogen_distance > 2.5 or angle > 60:
+                continue
+            found = True
+            hbondconfirmed.append([direction, entry[0], entry[1], angle, hydrogen_distance])
+        return found
+
+    def analyze_interactions(self):
+        """Classify the polar contacts of every residue and score the ligands."""
+        for ligand, result in self.results.items():
+            ligscore = 0
+            for residue, interaction in result.items():
+                num_contacts = 0
+                score = 0
+                type = 'waals'
+                for entry in interaction:
+                    if entry[2] <= HBOND_DISTANCE:
+                        if entry[0][0] == 'C' or entry[1][0] == 'C':
+                            continue  # If either atom is C then no hydrogen bonding
+                        type = self.polar_contact(ligand, residue, entry) or type
+
+                    if entry[2] < 4.5:
+                        num_contacts += 1
+                        score += 4.5 - entry[2]
+                score = round(score, 2)
+
+                if type in ('hbond', 'hbondplus'):
+                    self.binding_residues[ligand].add(residue)
+                ligscore += score
+
+            self.new_results[ligand]['score'] = ligscore
+            self.new_results[ligand]['inchikey'] = self.inchikeys[ligand]
+            self.new_results[ligand]['smiles'] = self.smiles[ligand]
+            if ligand in self.hetlist_display:
+                self.new_results[ligand]['prettyname'] = self.hetlist_display[ligand]
+
+    def polar_contact(self, ligand, residue, entry):
+        """Classify a polar contact and add it to the results, returns the contact type of the residue summary."""
+        hbondconfirmed = []
+        hydrogenmatch = False
+        res_is_acceptor = False
+        res_is_donor = False
+        for donor in self.get_residue_donors(entry[5]):
+            if distance(donor[1], entry[4]) < SAME_POSITION_DISTANCE:
+                res_is_acceptor = donor[3]
+                res_is_donor = True
+                hydrogenmatch |= self.hydrogen_bonds(donor[1], donor[2], entry[3], "D", entry, hbondconfirmed)
+
+        found_donor = False
+        for donor in self.ligand_donors[ligand]:
+            if distance(donor[1], entry[3]) < SAME_POSITION_DISTANCE:
+                found_donor = True
+                hydrogenmatch |= self.hydrogen_bonds(donor[1], donor[2], entry[4], "A", entry, hbondconfirmed)
+
+        found_acceptor = False
+        for acceptor in self.ligand_acceptors[ligand]:
+            if distance(acceptor[1], entry[3]) < SAME_POSITION_DISTANCE:
+                found_acceptor = True
+                if not found_donor and res_is_donor:
+                    hydrogenmatch = True
+                    hbondconfirmed.append(['D'])  # set residue as donor
+
+        if not found_acceptor and found_donor and res_is_acceptor:
+            hydrogenmatch = True
+            hbondconfirmed.append(['A'])  # set residue as acceptor
+
+        if found_acceptor and found_donor:
+            if res_is_donor and not res_is_acceptor:
+                hydrogenmatch = True
+                hbondconfirmed.append(['D'])
+            elif not res_is_donor and res_is_acceptor:
+                hydrogenmatch = True
+                hbondconfirmed.append(['A'])
+
+        chargedcheck = False
+        charge_value = 0
+        res_charge_value = 0
+        doublechargecheck = False
+        for charged in self.ligand_charged[ligand]:
+            if distance(charged[1], entry[3]) < SAME_POSITION_DISTANCE:
+                chargedcheck = True
+                hydrogenmatch = False  # Replace previous match!
+                charge_value = charged[2]
+
+        if residue[0:3] in CHARGEDAA:
+            # Need to check which atoms, but for now assume charged
+            doublechargecheck = chargedcheck
+            chargedcheck = True
+            hydrogenmatch = False  # Replace previous match!
+            if AA[residue[0:3]] in POSITIVE:
+                res_charge_value = 1
+            elif AA[residue[0:3]] in NEGATIVE:
+                res_charge_value = -1
+
+        contact = [entry[0], entry[1], entry[2]]
+        if entry[1] in ('N', 'O'):  # backbone connection!
+            fragment_file = self.fragment_library(ligand, entry[3], entry[0], entry[5], entry[6], 'HB_backbone')
+            self.add_interaction(ligand, [residue, fragment_file, 'polar_backbone',
+                'polar (hydrogen bond with backbone)', 'polar', 'protein'] + contact)
+            self.remove_hyd(residue, ligand)
+            return None
+
+        if hydrogenmatch:
+            fragment_file = self.fragment_library(ligand, entry[3], entry[0], entry[5], entry[6], 'HB')
+            self.binding_residues[ligand].add(residue)
+            if hbondconfirmed[0][0] == "D":
+                self.add_interaction(ligand, [residue, fragment_file, 'polar_donor_protein', 'polar (hydrogen bond)',
+                    'polar', 'protein'] + contact)
+                self.remove_hyd(residue, ligand)
+            if hbondconfirmed[0][0] == "A":
+                self.add_interaction(ligand, [residue, fragment_file, 'polar_acceptor_protein',
+                    'polar (hydrogen bond)', 'polar', 'protein'] + contact)
+                self.remove_hyd(residue, ligand)
+            return 'hbondplus' if chargedcheck else None
+
+        if chargedcheck:
+            fragment_file = self.fragment_library(ligand, entry[3], entry[0], entry[5], entry[6], 'HBC')
+            self.remove_hyd(residue, ligand)
+            if doublechargecheck:
+                if res_charge_value > 0:
+                    interaction = ['polar_double_pos_protein', 'polar (charge-charge)', '']
+                elif res_charge_value < 0:
+                    interaction = ['polar_double_neg_protein', 'polar (charge-charge)', '']
+                else:
+                    interaction = None
+            elif charge_value > 0:
+                interaction = ['polar_pos_ligand', 'polar (charge-assisted hydrogen bond)', 'ligand']
+            elif charge_value < 0:
+                interaction = ['polar_neg_ligand', 'polar (charge-assisted hydrogen bond)', 'ligand']
+            elif res_charge_value > 0:
+                interaction = ['polar_pos_protein', 'polar (charge-assisted hydrogen bond)', 'protein']
+            elif res_charge_value < 0:
+                interaction = ['polar_neg_protein', 'polar (charge-assisted hydrogen bond)', 'protein']
+            else:
+                interaction = ['polar_unknown_protein', 'polar (charge-assisted hydrogen bond)', 'protein']
+            if interaction:
+                self.add_interaction(ligand, [residue, fragment_file, interaction[0], interaction[1], 'polar',
+                    interaction[2]] + contact)
+            return 'hbondplus'
+
+        fragment_file = self.fragment_library(ligand, entry[3], entry[0], entry[5], entry[6], 'HB')
+        self.add_interaction(ligand, [residue, fragment_file, 'polar_unspecified', 'polar (hydrogen bond)', 'polar',
+            ''] + contact)
+        self.remove_hyd(residue, ligand)
+        return 'hbond'
+
+    def write_results(self):
+        """Write the interactions of every ligand (YAML) and the ligand with its binding residues (PDB)."""
+        for ligand in self.results:
+            with open(self.result_dir + 'output/' + self.pdbname + '_' + ligand.replace("H_", "") + '.yaml', 'w') as f:
+                yaml.dump(self.new_results[ligand], f)
+            self.add_residues_to_ligand(ligand, self.binding_residues[ligand])
+
+    def add_residues_to_ligand(self, ligand, residuelist):
+        inserstr = ''
+        for line in self.pdb_lines:
+            if line.startswith('ATOM'):
+                temp = line.split()
+                # need to fix bad PDB formatting where col4 and col5 are put
+                # together for some reason -- usually seen when the id is +1000
+                m = re.match(r"(\w)(\d+)", temp[4])
+                if m:
+                    temp[4] = m.group(1)
+                    temp[5] = m.group(2)
+                if temp[3] + temp[5] + temp[4] in residuelist:
+                    inserstr += line
+
+        tempstr = ''
+        inserted = False
+        with open(self.ligand_path(ligand, '.pdb'), 'r') as f_in:
+            for line in f_in:
+                if line.startswith('ATOM') and line.split()[2] == 'H':
+                    continue  # skip hydrogen in model
+                if line.startswith(('CONECT', 'MASTER', 'END')) and not inserted:
+                    tempstr += inserstr
+                    inserted = True
+                tempstr += line
+
+        with open(self.result_dir + 'interaction/' + self.pdbname + '_' + ligand + '.pdb', 'w') as f:
+            f.write(tempstr)
+
+
+class InteractionCalculationError(Exception):
+    """The interaction calculation of a PDB failed or did not finish in time."""
+
+
+def calculate_interactions(pdbname, session=None, peptide=None):
+    """Calculate the ligand interactions of a PDB (in the session directory for user uploaded structures)."""
+    return InteractionCalculation(pdbname, session, peptide).run()
+
+
+def run_legacy_calculation(pdbname, session=None, peptide=None, timeout=None):
+    """Calculate the ligand interactions of a PDB with the legacy Python 2 script (legacy_functions.py).
+
+    Writes the same output files as calculate_interactions, raises InteractionCalculationError if the script fails or
+    does not finish within timeout seconds.
+    """
+    calc_script = os.sep.join([os.path.dirname(__file__), 'legacy_functions.py'])
+    if session:
+        args = ["python2.7", calc_script, "-p", pdbname, "-s", session]
+    else:
+        args = ["python2.7", calc_script, "-p", pdbname, "-c", peptide or ""]
+    try:
+        process = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise InteractionCalculationError('The interaction calculation of {} did not finish within {} seconds'.format(
+            pdbname, timeout))
+    except OSError as e:
+        raise InteractionCalculationError('The interaction calculation of {} failed: {}'.format(pdbname, e)) from e
+    if process.returncode != 0:
+        error = process.stderr.decode('utf-8', 'replace').strip().splitlines()
+        raise InteractionCalculationError('The interaction calculation of {} failed: {}'.format(pdbname,
+            error[-1] if error else 'exit status {}'.format(process.returncode)))
+
+
+def run_calculation(pdbname, session=None, peptide=None, timeout=None, legacy=False):
+    """Calculate the ligand interactions of a PDB, in a separate process that is stopped after timeout seconds if a
+    timeout is given.
+
+    Raises InteractionCalculationError if the calculation fails or times out, so the caller can report it.
+    """
+    if legacy:
+        return run_legacy_calculation(pdbname, session, peptide, timeout)
+
+    if timeout is None:
+        try:
+            return calculate_interactions(pdbname, session, peptide)
+        except Exception as e:
+            raise InteractionCalculationError('The interaction calculation of {} failed: {}'.format(pdbname, e)) from e
+
+    # a spawned process does not share the database connections or the memory of the calling (web) process
+    with get_context('spawn').Pool(1) as pool:
+        result = pool.apply_async(calculate_interactions, (pdbname, session, peptide))
+        try:
+            return result.get(timeout)
+        except TimeoutError:
+            raise InteractionCalculationError('The interaction calculation of {} did not finish within {} seconds'.format(
+                pdbname, timeout))
+        except Exception as e:
+            raise InteractionCalculationError('The interaction calculation of {} failed: {}'.format(pdbname, e)) from e
+
+
+def timed_calculation(pdbname, legacy=False):
+    start = time.time()
+    try:
+        if legacy:
+            run_legacy_calculation(pdbname)
+        else:
+            calculate_interactions(pdbname)
+    except Exception:
+        logger.exception('Interaction calculation failed for {}'.format(pdbname))
+    return pdbname, time.time() - start
+
+
+def run_calculations(pdbnames, processes=None, legacy=False):
+    """Calculate the ligand interactions of many PDBs in a pool of processes.
+
+    Yields (pdb name, run time) as the calculations finish, so the results can be parsed while the others run.
+    """
+    pdbnames = list(pdbnames)
+    if not pdbnames:
+        return
+    processes = min(processes or os.cpu_count() or 1, len(pdbnames))
+    if processes > 1:
+        with Pool(processes) as pool:
+            for result in pool.imap_unordered(partial(timed_calculation, legacy=legacy), pdbnames):
+                yield result
+    else:
+        for pdbname in pdbnames:
+            yield timed_calculation(pdbname, legacy)
@@ -1,3 +1,83 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from interaction.functions import INTERACTIONS_DIR, run_calculation
+
+from unittest import skipUnless
+import os
+import shutil
+import subprocess
+import uuid
+import yaml
+
+
+TEST_DATA_DIR = os.sep.join([os.path.dirname(__file__), 'test_data'])
+
+
+def legacy_calculation_available():
+    # the legacy script runs with Python 2 and its Open Babel and RDKit bindings
+    try:
+        return subprocess.call(["python2.7", "-c", "import openbabel, pybel, rdkit"], stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL) == 0
+    except OSError:
+        return False
+
+
+def calculation_available():
+    try:
+        from openbabel import pybel
+    except ImportError:
+        try:
+            import pybel
+        except ImportError:
+            return False
+    return True
+
+
+@skipUnless(calculation_available() and legacy_calculation_available(),
+    'comparing with the legacy interaction calculation needs Open Babel for Python 3 and Python 2')
+class LegacyInteractionCalculationTest(SimpleTestCase):
+    """The interactions and fragments of the in-process calculation are the same as those of the legacy script."""
+
+    pdbname = 'ligandsite'
+
+    def setUp(self):
+        self.session = 'test_' + uuid.uuid4().hex
+        self.session_dir = INTERACTIONS_DIR + self.session + '/'
+        os.makedirs(self.session_dir + 'pdbs/')
+        shutil.copy(os.sep.join([TEST_DATA_DIR, 'ligand_site.pdb']), self.session_dir + 'pdbs/' + self.pdbname + '.pdb')
+
+    def tearDown(self):
+        shutil.rmtree(self.session_dir, ignore_errors=True)
+
+    def calculate(self, legacy):
+        """The ligand results (as read by parsecalculation) and fragment files of a calculation."""
+        run_calculation(self.pdbname, self.session, legacy=legacy)
+        result_dir = self.session_dir + 'results/' + self.pdbname + '/'
+
+        results = {}
+        for f in sorted(os.listdir(result_dir + 'output')):
+            with open(result_dir + 'output/' + f, 'rb') as result_file:
+                results[f] = yaml.load(result_file, Loader=yaml.FullLoader)
+
+        fragments = {}
+        for f in sorted(os.listdir(result_dir + 'fragments')):
+            with open(result_dir + 'fragments/' + f) as fragment_file:
+                # atom and residue names of the fragment (the coordinates are formatted by Open Babel)
+                fragments[f] = sorted(line[12:26] for line in fragment_file if line.startswith(('ATOM', 'HETATM')))
+        return results, fragments
+
+    def interactions(self, result):
+        return sorted((interaction[0], os.path.basename(interaction[1]), interaction[2], interaction[4])
+            for interaction in result['interactions'])
+
+    def test_same_as_legacy(self):
+        legacy_results, legacy_fragments = self.calculate(True)
+        results, fragments = self.calculate(False)
+
+        self.assertTrue(legacy_results)
+        self.assertEqual(sorted(results), sorted(legacy_results))
+        for f, legacy_result in legacy_results.items():
+            self.assertEqual(self.interactions(results[f]), self.interactions(legacy_result))
+            self.assertAlmostEqual(results[f]['score'], legacy_result['score'], places=2)
+            self.assertEqual(results[f]['inchikey'].strip(), legacy_result['inchikey'].strip())
+        self.assertEqual(fragments, legacy_fragments)
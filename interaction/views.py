@@ -1,11 +1,13 @@
 from django.shortcuts import render, redirect
 from django.http import HttpResponse, HttpResponseRedirect
 from django.conf import settings
+from django.db import connection
 from django.db.models import Count, Sum, Avg, Q
 from django.utils.text import slugify
 
 from interaction.models import ResidueFragmentInteraction, StructureLigandInteraction, ResidueFragmentInteractionType
 from interaction.forms import PDBform
+from interaction.functions import InteractionCalculationError, run_calculation, run_calculations
 from ligand.models import Ligand
 from ligand.models import LigandType
 from ligand.models import LigandRole
@@ -27,7 +29,6 @@ from datetime import datetime
 import re
 import json
 import logging
-from subprocess import call
 import urllib
 import collections
 from collections import OrderedDict
@@ -354,42 +355,40 @@ def fragment(request):
 
 def updateall(request):
     structures = Structure.objects.values('pdb_code__index').distinct()
+    pending = []
     for s in structures:
         pdbname = s['pdb_code__index']
         check = ResidueFragmentInteraction.objects.filter(
             structure_ligand_pair__structure__pdb_code__index=pdbname).all()
 
         if check.count() == 0:
-            t1 = datetime.now()
-            runcalculation(pdbname)
-            t2 = datetime.now()
-            delta = t2 - t1
-            seconds = delta.total_seconds()
-            print("Calculation: Total time " +
-                  str(seconds) + " seconds for " + pdbname)
-            t1 = datetime.now()
-            results = parsecalculation(pdbname, False)
-            t2 = datetime.now()
-            delta = t2 - t1
-            seconds = delta.total_seconds()
-            print("Parsing: Total time " +
-                  str(seconds) + " seconds for " + pdbname)
-            check = ResidueFragmentInteraction.objects.filter(
-                structure_ligand_pair__structure__pdb_code__index=pdbname).all()
-            print("Interactions found: " + str(check.count()))
+            pending.append(pdbname)
         else:
             print(pdbname + " already calculated")
 
+    # calculations run in parallel, the results are parsed as they come in
+    connection.close()
+    for pdbname, seconds in run_calculations(pending, legacy=settings.INTERACTION_LEGACY_CALCULATION):
+        print("Calculation: Total time " +
+              str(seconds) + " seconds for " + pdbname)
+        t1 = datetime.now()
+        results = parsecalculation(pdbname, False)
+        t2 = datetime.now()
+        delta = t2 - t1
+        seconds = delta.total_seconds()
+        print("Parsing: Total time " +
+              str(seconds) + " seconds for " + pdbname)
+        check = ResidueFragmentInteraction.objects.filter(
+            structure_ligand_pair__structure__pdb_code__index=pdbname).all()
+        print("Interactions found: " + str(check.count()))
+
     # return render(request,'interaction/view.html',{'form': form, 'pdbname':
     # pdbname, 'structures': structures})
 
 
 def runcalculation(pdbname, peptide=""):
-    calc_script = os.sep.join(
-        [os.path.dirname(__file__), 'legacy_functions.py'])
-
-    call(["python2.7", calc_script, "-p", pdbname, "-c", peptide],
-         stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
+    # raises InteractionCalculationError if the calculation fails
+    run_calculation(pdbname, peptide=peptide, legacy=settings.INTERACTION_LEGACY_CALCULATION)
 
     return None
 
@@ -593,9 +592,10 @@ def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False):
 
 
 def runusercalculation(filename, session):
-    calc_script = os.sep.join(
-        [os.path.dirname(__file__), 'legacy_functions.py'])
-    call(["python2.7", calc_script, "-p", filename, "-s", session])
+    # runs outside of the request process and is stopped after INTERACTION_CALCULATION_TIMEOUT seconds, raises
+    # InteractionCalculationError if the calculation fails or times out
+    run_calculation(filename, session, timeout=settings.INTERACTION_CALCULATION_TIMEOUT,
+        legacy=settings.INTERACTION_LEGACY_CALCULATION)
     return None
 
 
@@ -628,6 +628,8 @@ def parseusercalculation(pdbname, session, debug=True, ignore_ligand_preset=Fals
 def showcalculation(request):
 
     context = calculate(request)
+    if isinstance(context, HttpResponse):
+        return context
 
     return render(request, 'interaction/diagram.html', context)
 
@@ -689,7 +691,6 @@ def calculate(request, redirect=None):
 
                 temp_path = module_dir + '/pdbs/' + str(pdbdata).replace("_","")
                 pdbdata = open(temp_path, 'r').read()
-                runusercalculation(pdbname, session_key)
 
             else:
                 pdbname = form.cleaned_data['pdbname'].strip()
@@ -705,7 +706,12 @@ def calculate(request, redirect=None):
                     f.close()
                 else:
                     pdbdata = open(temp_path, 'r').read()
+
+            try:
                 runusercalculation(pdbname, session_key)
+            except InteractionCalculationError as msg:
+                logging.getLogger('build').error(msg)
+                return HttpResponse("Error with the interaction calculation: {}".format(msg), status=500)
 
             # MAPPING GPCRdb numbering onto pdb.
             generic_numbering = GenericNumbering(temp_path,top_results=1, blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_gpcr_blastdb']))
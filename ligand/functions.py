@@ -1,10 +1,12 @@
 from django.utils.text import slugify
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 
 #from chembl_webresource_client import new_client
 from common.models import WebResource
 from common.models import WebLink
-from ligand.models import Ligand, LigandType, LigandProperities
+from ligand.models import Ligand, LigandType, LigandProperities, AnalyzedExperiment, AnalyzedAssay, BiasBrowserEntry
+from protein.models import Protein
+
 
 def get_or_make_ligand(ligand_id, type_id, name = None, pep_or_prot = None):
     if type_id=='PubChem CID' or type_id=='SMILES':
@@ -175,3 +177,147 @@ def get_or_make_ligand(ligand_id, type_id, name = None, pep_or_prot = None):
 #    #https://www.ebi.ac.uk/chembl/doc/inspect/CHEMBL2766014
 
 #    return refs
+
+
+# assay descriptions of the tested and reference assays of each bias browser source
+BIAS_BROWSER_SOURCES = {
+    'different_family': ('tested_assays', 'endogenous'),
+    'sub_different_family': ('sub_tested_assays', 'sub_endogenous'),
+    'predicted_family': ('predicted_tested_assays', None),
+}
+
+# browser column prefix and AnalyzedAssay field, the columns are <prefix>_p1 .. <prefix>_p5 for the first five assays
+BIAS_BROWSER_ASSAY_COLUMNS = [
+    ('pathways', 'family'),
+    ('activity', 'quantitive_activity_initial'),
+    ('quality_activity', 'qualitative_activity'),
+    ('standard_type', 'quantitive_measure_type'),
+    ('emax', 'quantitive_efficacy'),
+    ('lbf_part', 'log_bias_factor_a'),
+    ('reference_ligand', 'reference_ligand_id'),
+    ('tfactor', 't_value'),
+    ('molecule1', 'molecule_1'),
+    ('molecule2', 'molecule_2'),
+    ('assay', 'signalling_protein'),
+    ('cell', 'cell_line'),
+    ('time', 'assay_time_resolved'),
+    ('measured_biological_process', 'measured_biological_process'),
+    ('reference_a', 'log_bias_factor_a'),
+]
+# values relative to the first assay, the columns are <prefix>_p2_p1 .. <prefix>_p5_p1
+BIAS_BROWSER_RATIO_COLUMNS = [
+    ('opmodel', 't_factor'),
+    ('lbf', 'log_bias_factor'),
+    ('potency', 'potency'),
+]
+# columns from the reference assays, <prefix>_p1 .. <prefix>_p5
+BIAS_BROWSER_REFERENCE_COLUMNS = [
+    ('reference_quantitive_activity_initial', 'quantitive_activity_initial'),
+    ('reference_qualitative_activity', 'qualitative_activity'),
+    ('reference_quantitive_efficacy', 'quantitive_efficacy'),
+    ('reference_assay_type', 'assay_type'),
+]
+
+
+def pivot_bias_assays(assays, columns, ratio_columns=[]):
+    """Spreads the assays of one experiment (ordered by order_no) over the numbered browser columns."""
+    values = {}
+    for i in range(5):
+        assay = assays[i] if i < len(assays) else {}
+        for prefix, field in columns:
+            values['{}_p{}'.format(prefix, i + 1)] = assay.get(field)
+        if i > 0:
+            for prefix, field in ratio_columns:
+                values['{}_p{}_p1'.format(prefix, i + 1)] = assay.get(field)
+    return values
+
+
+def build_bias_browser_entries(source):
+    """(Re)builds the bias browser table of a source from the analyzed experiments and assays.
+
+    Replaces the per-row subqueries of the browsers with one row per experiment holding all assay columns.
+    """
+    tested_description, reference_description = BIAS_BROWSER_SOURCES[source]
+    descriptions = [d for d in (tested_description, reference_description) if d]
+    fields = set([f for p, f in BIAS_BROWSER_ASSAY_COLUMNS + BIAS_BROWSER_RATIO_COLUMNS + BIAS_BROWSER_REFERENCE_COLUMNS])
+
+    assays = {}
+    for assay in AnalyzedAssay.objects.filter(experiment__source=source, order_no__lte=5,
+            assay_description__in=descriptions).order_by('order_no', 'id').values('experiment_id', 'assay_description', *fields):
+        assays.setdefault((assay['experiment_id'], assay['assay_description']), []).append(assay)
+
+    entries = []
+    for experiment_id, receptor_id in AnalyzedExperiment.objects.filter(source=source).values_list('id', 'receptor_id'):
+        values = pivot_bias_assays(assays.get((experiment_id, tested_description), []), BIAS_BROWSER_ASSAY_COLUMNS,
+            BIAS_BROWSER_RATIO_COLUMNS)
+        if reference_description:
+            values.update(pivot_bias_assays(assays.get((experiment_id, reference_description), []),
+                BIAS_BROWSER_REFERENCE_COLUMNS))
+        entries.append(BiasBrowserEntry(experiment_id=experiment_id, receptor_id=receptor_id, source=source, **values))
+    # replace the entries of the source in one transaction, so the browsers never see a partially built table
+    with transaction.atomic():
+        BiasBrowserEntry.objects.filter(source=source).delete()
+        BiasBrowserEntry.objects.bulk_create(entries, batch_size=5000)
+    return len(entries)
+
+
+def get_selection_protein_ids(simple_selection):
+    """Ids of the proteins in the targets of a selection, families are expanded with the species and annotation filters."""
+    protein_ids = set()
+    families = []
+    for target in simple_selection.targets:
+        if target.type == 'protein':
+            protein_ids.add(target.item.id)
+        elif target.type == 'family':
+            families.append(target.item.slug)
+
+    if families:
+        species_list = [species.item for species in simple_selection.species]
+        protein_source_list = [protein_source.item for protein_source in simple_selection.annotation]
+        for slug in families:
+            family_proteins = Protein.objects.filter(family__slug__startswith=slug, source__in=protein_source_list)
+            if species_list:
+                family_proteins = family_proteins.filter(species__in=species_list)
+            protein_ids.update(family_proteins.values_list('id', flat=True))
+    return sorted(protein_ids)
+
+
+def get_bias_browser_entries(source, protein_ids):
+    """Bias browser entries of the receptors, with the experiments and their related objects selected."""
+    return BiasBrowserEntry.objects.filter(source=source, receptor__in=protein_ids).select_related(
+        'experiment', 'experiment__ligand', 'experiment__ligand__properities', 'experiment__reference_ligand',
+        'experiment__endogenous_ligand', 'experiment__receptor', 'experiment__receptor__family',
+        'experiment__receptor__family__parent', 'experiment__receptor__family__parent__parent',
+        'experiment__receptor__family__parent__parent__parent', 'experiment__receptor__species',
+        'experiment__publication', 'experiment__publication__web_link',
+        'experiment__publication__web_link__web_resource', 'experiment__publication__journal').prefetch_related(
+        'experiment__analyzed_data', 'experiment__analyzed_data__emax_ligand_reference',
+        'experiment__ligand__ref_ligand_bias_analyzed').order_by('experiment_id')
+
+
+def bias_browser_entry_experiments(entries):
+    """Analyzed experiments of bias browser entries with the bias browser columns set as attributes."""
+    experiments = []
+    for entry in entries:
+        experiment = entry.experiment
+        for column in get_bias_browser_columns(entry.source):
+            setattr(experiment, column, getattr(entry, column))
+        experiments.append(experiment)
+    return experiments
+
+
+def get_bias_browser_experiments(source, protein_ids):
+    """Analyzed experiments of the receptors with the bias browser columns set as attributes."""
+    return bias_browser_entry_experiments(get_bias_browser_entries(source, protein_ids))
+
+
+def get_bias_browser_columns(source):
+
+    columns = []
+    for i in range(1, 6):
+        columns.extend(['{}_p{}'.format(prefix, i) for prefix, field in BIAS_BROWSER_ASSAY_COLUMNS])
+        if i > 1:
+            columns.extend(['{}_p{}_p1'.format(prefix, i) for prefix, field in BIAS_BROWSER_RATIO_COLUMNS])
+        if BIAS_BROWSER_SOURCES[source][1]:
+            columns.extend(['{}_p{}'.format(prefix, i) for prefix, field in BIAS_BROWSER_REFERENCE_COLUMNS])
+    return columns
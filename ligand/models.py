@@ -538,6 +538,126 @@ class AnalyzedAssay(models.Model):
                                               null=True, blank=True)
 
 
+class BiasBrowserEntry(models.Model):
+    experiment = models.OneToOneField(AnalyzedExperiment, related_name='browser_entry', on_delete=models.CASCADE)
+    receptor = models.ForeignKey('protein.Protein', on_delete=models.CASCADE)
+    source = models.CharField(max_length=60)
+    # assay columns of the bias browsers, built by ligand.functions.build_bias_browser_entries: the first five tested
+    # assays (<column>_p1 .. <column>_p5), their values relative to the first assay (<column>_p2_p1 .. <column>_p5_p1)
+    # and the reference assays
+    pathways_p1 = models.CharField(max_length=60, null=True)
+    pathways_p2 = models.CharField(max_length=60, null=True)
+    pathways_p3 = models.CharField(max_length=60, null=True)
+    pathways_p4 = models.CharField(max_length=60, null=True)
+    pathways_p5 = models.CharField(max_length=60, null=True)
+    activity_p1 = models.FloatField(null=True)
+    activity_p2 = models.FloatField(null=True)
+    activity_p3 = models.FloatField(null=True)
+    activity_p4 = models.FloatField(null=True)
+    activity_p5 = models.FloatField(null=True)
+    quality_activity_p1 = models.CharField(max_length=60, null=True)
+    quality_activity_p2 = models.CharField(max_length=60, null=True)
+    quality_activity_p3 = models.CharField(max_length=60, null=True)
+    quality_activity_p4 = models.CharField(max_length=60, null=True)
+    quality_activity_p5 = models.CharField(max_length=60, null=True)
+    standard_type_p1 = models.CharField(max_length=60, null=True)
+    standard_type_p2 = models.CharField(max_length=60, null=True)
+    standard_type_p3 = models.CharField(max_length=60, null=True)
+    standard_type_p4 = models.CharField(max_length=60, null=True)
+    standard_type_p5 = models.CharField(max_length=60, null=True)
+    emax_p1 = models.FloatField(null=True)
+    emax_p2 = models.FloatField(null=True)
+    emax_p3 = models.FloatField(null=True)
+    emax_p4 = models.FloatField(null=True)
+    emax_p5 = models.FloatField(null=True)
+    lbf_part_p1 = models.CharField(max_length=60, null=True)
+    lbf_part_p2 = models.CharField(max_length=60, null=True)
+    lbf_part_p3 = models.CharField(max_length=60, null=True)
+    lbf_part_p4 = models.CharField(max_length=60, null=True)
+    lbf_part_p5 = models.CharField(max_length=60, null=True)
+    reference_ligand_p1 = models.CharField(max_length=900, null=True)
+    reference_ligand_p2 = models.CharField(max_length=900, null=True)
+    reference_ligand_p3 = models.CharField(max_length=900, null=True)
+    reference_ligand_p4 = models.CharField(max_length=900, null=True)
+    reference_ligand_p5 = models.CharField(max_length=900, null=True)
+    tfactor_p1 = models.CharField(max_length=60, null=True)
+    tfactor_p2 = models.CharField(max_length=60, null=True)
+    tfactor_p3 = models.CharField(max_length=60, null=True)
+    tfactor_p4 = models.CharField(max_length=60, null=True)
+    tfactor_p5 = models.CharField(max_length=60, null=True)
+    molecule1_p1 = models.CharField(max_length=60, null=True)
+    molecule1_p2 = models.CharField(max_length=60, null=True)
+    molecule1_p3 = models.CharField(max_length=60, null=True)
+    molecule1_p4 = models.CharField(max_length=60, null=True)
+    molecule1_p5 = models.CharField(max_length=60, null=True)
+    molecule2_p1 = models.CharField(max_length=60, null=True)
+    molecule2_p2 = models.CharField(max_length=60, null=True)
+    molecule2_p3 = models.CharField(max_length=60, null=True)
+    molecule2_p4 = models.CharField(max_length=60, null=True)
+    molecule2_p5 = models.CharField(max_length=60, null=True)
+    assay_p1 = models.CharField(max_length=60, null=True)
+    assay_p2 = models.CharField(max_length=60, null=True)
+    assay_p3 = models.CharField(max_length=60, null=True)
+    assay_p4 = models.CharField(max_length=60, null=True)
+    assay_p5 = models.CharField(max_length=60, null=True)
+    cell_p1 = models.CharField(max_length=60, null=True)
+    cell_p2 = models.CharField(max_length=60, null=True)
+    cell_p3 = models.CharField(max_length=60, null=True)
+    cell_p4 = models.CharField(max_length=60, null=True)
+    cell_p5 = models.CharField(max_length=60, null=True)
+    time_p1 = models.CharField(max_length=60, null=True)
+    time_p2 = models.CharField(max_length=60, null=True)
+    time_p3 = models.CharField(max_length=60, null=True)
+    time_p4 = models.CharField(max_length=60, null=True)
+    time_p5 = models.CharField(max_length=60, null=True)
+    measured_biological_process_p1 = models.CharField(max_length=60, null=True)
+    measured_biological_process_p2 = models.CharField(max_length=60, null=True)
+    measured_biological_process_p3 = models.CharField(max_length=60, null=True)
+    measured_biological_process_p4 = models.CharField(max_length=60, null=True)
+    measured_biological_process_p5 = models.CharField(max_length=60, null=True)
+    reference_a_p1 = models.CharField(max_length=60, null=True)
+    reference_a_p2 = models.CharField(max_length=60, null=True)
+    reference_a_p3 = models.CharField(max_length=60, null=True)
+    reference_a_p4 = models.CharField(max_length=60, null=True)
+    reference_a_p5 = models.CharField(max_length=60, null=True)
+    opmodel_p2_p1 = models.CharField(max_length=60, null=True)
+    opmodel_p3_p1 = models.CharField(max_length=60, null=True)
+    opmodel_p4_p1 = models.CharField(max_length=60, null=True)
+    opmodel_p5_p1 = models.CharField(max_length=60, null=True)
+    lbf_p2_p1 = models.CharField(max_length=60, null=True)
+    lbf_p3_p1 = models.CharField(max_length=60, null=True)
+    lbf_p4_p1 = models.CharField(max_length=60, null=True)
+    lbf_p5_p1 = models.CharField(max_length=60, null=True)
+    potency_p2_p1 = models.CharField(max_length=60, null=True)
+    potency_p3_p1 = models.CharField(max_length=60, null=True)
+    potency_p4_p1 = models.CharField(max_length=60, null=True)
+    potency_p5_p1 = models.CharField(max_length=60, null=True)
+    reference_quantitive_activity_initial_p1 = models.FloatField(null=True)
+    reference_quantitive_activity_initial_p2 = models.FloatField(null=True)
+    reference_quantitive_activity_initial_p3 = models.FloatField(null=True)
+    reference_quantitive_activity_initial_p4 = models.FloatField(null=True)
+    reference_quantitive_activity_initial_p5 = models.FloatField(null=True)
+    reference_qualitative_activity_p1 = models.CharField(max_length=60, null=True)
+    reference_qualitative_activity_p2 = models.CharField(max_length=60, null=True)
+    reference_qualitative_activity_p3 = models.CharField(max_length=60, null=True)
+    reference_qualitative_activity_p4 = models.CharField(max_length=60, null=True)
+    reference_qualitative_activity_p5 = models.CharField(max_length=60, null=True)
+    reference_quantitive_efficacy_p1 = models.FloatField(null=True)
+    reference_quantitive_efficacy_p2 = models.FloatField(null=True)
+    reference_quantitive_efficacy_p3 = models.FloatField(null=True)
+    reference_quantitive_efficacy_p4 = models.FloatField(null=True)
+    reference_quantitive_efficacy_p5 = models.FloatField(null=True)
+    reference_assay_type_p1 = models.CharField(max_length=60, null=True)
+    reference_assay_type_p2 = models.CharField(max_length=60, null=True)
+    reference_assay_type_p3 = models.CharField(max_length=60, null=True)
+    reference_assay_type_p4 = models.CharField(max_length=60, null=True)
+    reference_assay_type_p5 = models.CharField(max_length=60, null=True)
+
+    class Meta():
+        db_table = 'bias_browser_entry'
+        index_together = [('source', 'receptor')]
+
+
 class BiasedPathways(models.Model):
     submission_author = models.CharField(max_length=50)
     ligand = models.ForeignKey(Ligand, on_delete=models.CASCADE)
@@ -51,12 +51,15 @@ urlpatterns = [
     url(r'^(?P<pk>[-\w]+)/info$', views.LigandInformationView.as_view()),
 
     url(r'^biased/$', views.CachedBiasBrowser, name='bias_browser-list'),
+    url(r'^biased/data$', views.BiasBrowserData, {'source': 'different_family'}, name='bias_browser-data'),
     # url(r'^biased/$', views.BiasBrowser.as_view(), name='bias_browser-list'),
 #
     url(r'^biasedsubtypes/$',views.CachedBiasGBrowser, name='bias_browser-subtype'),
+    url(r'^biasedsubtypes/data$', views.BiasBrowserData, {'source': 'sub_different_family'}, name='bias_browser-subtype-data'),
     # url(r'^biasedsubtypes/$',views.BiasGBrowser.as_view(), name='bias_browser-list'),
 
     url(r'^biasedpredicted/$',views.CachedBiasPredictBrowser, name='bias_browser-predict'),
+    url(r'^biasedpredicted/data$', views.BiasBrowserData, {'source': 'predicted_family'}, name='bias_browser-predict-data'),
     # url(r'^biasedpredicted/$',views.BiasPredictionBrowser.as_view(), name='bias_browser-list'),
 
     url(r'^biasedbrowser',views.BiasTargetSelection.as_view(), name='bias_browser-list1'),
@@ -8,10 +8,11 @@ from copy import deepcopy
 from collections import defaultdict, OrderedDict
 
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.core.paginator import Paginator
+from django.http import HttpResponse, JsonResponse
 from django.views.generic import TemplateView, DetailView, ListView
 
-from django.db.models import Count, Subquery, OuterRef
+from django.db.models import Count, Subquery, OuterRef, Max
 from django.views.decorators.csrf import csrf_exempt
 
 from django.core.cache import cache
@@ -20,7 +21,10 @@ from common.views import AbsTargetSelectionTable, Alignment, AbsReferenceSelecti
 from common.models import ReleaseNotes
 from common.phylogenetic_tree import PhylogeneticTreeGenerator
 from common.selection import Selection
-from ligand.models import Ligand, LigandVendorLink,LigandVendors, AnalyzedExperiment, AnalyzedAssay, BiasedPathways, AssayExperiment
+from ligand.models import Ligand, LigandVendorLink,LigandVendors, AnalyzedExperiment, AnalyzedAssay, BiasedPathways, AssayExperiment, \
+    BiasBrowserEntry
+from ligand.functions import get_selection_protein_ids, get_bias_browser_experiments, get_bias_browser_columns, \
+    get_bias_browser_entries, bias_browser_entry_experiments
 from protein.models import Protein, ProteinFamily, ProteinCouplings
 from interaction.models import StructureLigandInteraction
 from mutation.models import MutationExperiment
@@ -1782,602 +1786,93 @@ def CachedBiasPredictBrowser(request):
     return CachedBiasBrowsers("biasprecictedbrowser", request)
 
 def CachedBiasBrowsers(browser_type, request):
-    protein_ids = []
-    try:
-        simple_selection = request.session.get('selection', False)
-
-        families = []
-        for target in simple_selection.targets:
-            if target.type == 'protein':
-                protein_ids.append(target.item.entry_name)
-            elif target.type == 'family':
-                families.append(target.item.slug)
-
-        if len(families) > 0:
-            # species filter
-            species_list = []
-            for species in simple_selection.species:
-                species_list.append(species.item)
-
-            # annotation filter
-            protein_source_list = []
-            for protein_source in simple_selection.annotation:
-                protein_source_list.append(protein_source.item)
-
-            family_proteins = Protein.objects.filter(family__slug__in=families, source__in=(protein_source_list))
-            if len(species_list) > 0:
-                family_proteins.filter(species__in=(species_list))
-
-            for prot_name in family_proteins.values_list("entry_name", flat=True):
-                protein_ids.append(prot_name)
-
-    except:
-        protein_ids = ["NOSELECTION"]
+    if browser_type == "biasbrowser":
+        browser = BiasBrowser
+    elif browser_type == "biasgbrowser":
+        browser = BiasGBrowser
+    else:
+        browser = BiasPredictionBrowser
 
-    protein_ids.sort()
-    cache_key = "BIASBROWSER_" + browser_type + "_" + hashlib.md5("_".join(protein_ids).encode('utf-8')).hexdigest()
+    # the rendered page is cached per selection, the entry ids change when the bias browser table is rebuilt
+    protein_ids = [str(protein_id) for protein_id in get_bias_selection_protein_ids(request)]
+    table_version = BiasBrowserEntry.objects.filter(source=browser.source).aggregate(Max('id'))['id__max']
+    cache_key = "BIASBROWSER_" + browser_type + "_" + str(table_version) + "_" + \
+        hashlib.md5("_".join(protein_ids).encode('utf-8')).hexdigest()
     return_html = cache.get(cache_key)
     if return_html == None:
-        if browser_type == "biasbrowser":
-            return_html = BiasBrowser.as_view()(request).render()
-        elif browser_type == "biasgbrowser":
-            return_html = BiasGBrowser.as_view()(request).render()
-        else:
-            return_html = BiasPredictionBrowser.as_view()(request).render()
+        return_html = browser.as_view()(request).render()
         cache.set(cache_key, return_html, 60*60*24*7)
     return return_html
 
 
+def get_bias_selection_protein_ids(request):
+    try:
+        simple_selection = request.session.get('selection', False)
+        return get_selection_protein_ids(simple_selection)
+    except:
+        return [1]
+
+
+def BiasBrowserData(request, source):
+    """Paginated JSON rows of a bias browser for the receptors in the selection."""
+    try:
+        page_size = min(max(int(request.GET.get('page_size', 100)), 1), 1000)
+    except ValueError:
+        page_size = 100
+    entries = get_bias_browser_entries(source, get_bias_selection_protein_ids(request))
+    # optional ordering on an assay column (e.g. order=-emax_p1), sorted in the database
+    order = request.GET.get('order')
+    if order and order.lstrip('-') in get_bias_browser_columns(source):
+        entries = entries.order_by(order, 'experiment_id')
+    # paginate the entries, only the experiments of the current page are loaded
+    paginator = Paginator(entries, page_size)
+    page = paginator.get_page(request.GET.get('page', 1))
+    rows = []
+    for e in bias_browser_entry_experiments(page.object_list):
+        row = {
+            'id': e.id,
+            'ligand': str(e.ligand),
+            'ligand_id': e.ligand_id,
+            'receptor': e.receptor.entry_name,
+            'receptor_name': e.receptor.name,
+            'species': e.receptor.species.common_name,
+            'reference_ligand': str(e.reference_ligand) if e.reference_ligand else None,
+            'endogenous_ligand': str(e.endogenous_ligand) if e.endogenous_ligand else None,
+            'publication': e.publication.web_link.index if e.publication and e.publication.web_link else None,
+            'primary': e.primary,
+            'secondary': e.secondary,
+            'vendor_quantity': e.vendor_quantity,
+            'article_quantity': e.article_quantity,
+            'labs_quantity': e.labs_quantity,
+        }
+        for column in get_bias_browser_columns(source):
+            row[column] = getattr(e, column, None)
+        rows.append(row)
+    return JsonResponse({'count': paginator.count, 'page': page.number, 'num_pages': paginator.num_pages, 'rows': rows})
+
+
 '''
 Bias browser between families
 access data from db, fill empty fields with empty parse_children
 '''
 class BiasBrowser(ListView):
-    # serializer_class = AnalyzedExperimentSerializer
     template_name = 'bias_browser.html'
     context_object_name = 'data_test'
-    # @cache_page(50000)
-    def get_queryset(self):
-        protein_list = list()
+    source = 'different_family'
 
-        try:
-            simple_selection = self.request.session.get('selection', False)
-            a = Alignment()
-            # load data from selection into the alignment
-            a.load_proteins_from_selection(simple_selection)
-            for items in a.proteins:
-                protein_list.append(items.protein)
-        except:
-            protein_list.append(1)
-        assay_qs = AnalyzedAssay.objects.filter(
-            order_no__lte=5,
-            assay_description='tested_assays',
-
-            experiment=OuterRef('pk'),
-        ).order_by('order_no')
-
-        ref_assay_qs = AnalyzedAssay.objects.filter(
-            order_no__lte=5,
-            assay_description='endogenous',
-            experiment=OuterRef('pk'),
-        ).order_by('order_no')
-
-        queryset = AnalyzedExperiment.objects.filter(
-            source='different_family',
-            receptor__in=protein_list,
-        ).prefetch_related(
-            'analyzed_data', 'ligand', 'ligand__reference_ligand', 'reference_ligand',
-            'endogenous_ligand', 'ligand__properities', 'receptor', 'receptor', 'receptor__family',
-            'receptor__family__parent', 'receptor__family__parent__parent__parent',
-            'receptor__family__parent__parent', 'receptor__family', 'receptor__species',
-            'publication', 'publication__web_link', 'publication__web_link__web_resource',
-            'publication__journal', 'ligand__ref_ligand_bias_analyzed',
-            'analyzed_data__emax_ligand_reference'
-        ).annotate(
-            # pathways
-            pathways_p1=Subquery(assay_qs.values('family')[:1]),
-            pathways_p2=Subquery(assay_qs.values('family')[1:2]),
-            pathways_p3=Subquery(assay_qs.values('family')[2:3]),
-            pathways_p4=Subquery(assay_qs.values('family')[3:4]),
-            pathways_p5=Subquery(assay_qs.values('family')[4:5]),
-            # t_factor
-            opmodel_p2_p1=Subquery(assay_qs.values('t_factor')[1:2]),
-            opmodel_p3_p1=Subquery(assay_qs.values('t_factor')[2:3]),
-            opmodel_p4_p1=Subquery(assay_qs.values('t_factor')[3:4]),
-            opmodel_p5_p1=Subquery(assay_qs.values('t_factor')[4:5]),
-            # log bias factor
-            lbf_p2_p1=Subquery(assay_qs.values('log_bias_factor')[1:2]),
-            lbf_p3_p1=Subquery(assay_qs.values('log_bias_factor')[2:3]),
-            lbf_p4_p1=Subquery(assay_qs.values('log_bias_factor')[3:4]),
-            lbf_p5_p1=Subquery(assay_qs.values('log_bias_factor')[4:5]),
-            # Potency ratio
-            potency_p2_p1=Subquery(assay_qs.values('potency')[1:2]),
-            potency_p3_p1=Subquery(assay_qs.values('potency')[2:3]),
-            potency_p4_p1=Subquery(assay_qs.values('potency')[3:4]),
-            potency_p5_p1=Subquery(assay_qs.values('potency')[4:5]),
-            # Potency
-            activity_p1=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[:1]),
-            activity_p2=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[1:2]),
-            activity_p3=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[2:3]),
-            activity_p4=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[3:4]),
-            activity_p5=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[4:5]),
-            quality_activity_p1=Subquery(
-                assay_qs.values('qualitative_activity')[:1]),
-            quality_activity_p2=Subquery(
-                assay_qs.values('qualitative_activity')[1:2]),
-            quality_activity_p3=Subquery(
-                assay_qs.values('qualitative_activity')[2:3]),
-            quality_activity_p4=Subquery(
-                assay_qs.values('qualitative_activity')[3:4]),
-            quality_activity_p5=Subquery(
-                assay_qs.values('qualitative_activity')[4:5]),
-            # quality_activity
-            standard_type_p1=Subquery(
-                assay_qs.values('quantitive_measure_type')[:1]),
-            standard_type_p2=Subquery(assay_qs.values(
-                'quantitive_measure_type')[1:2]),
-            standard_type_p3=Subquery(assay_qs.values(
-                'quantitive_measure_type')[2:3]),
-            standard_type_p4=Subquery(assay_qs.values(
-                'quantitive_measure_type')[3:4]),
-            standard_type_p5=Subquery(assay_qs.values(
-                'quantitive_measure_type')[4:5]),
-            # E Max
-            emax_p1=Subquery(assay_qs.values('quantitive_efficacy')[:1]),
-            emax_p2=Subquery(assay_qs.values('quantitive_efficacy')[1:2]),
-            emax_p3=Subquery(assay_qs.values('quantitive_efficacy')[2:3]),
-            emax_p4=Subquery(assay_qs.values('quantitive_efficacy')[3:4]),
-            emax_p5=Subquery(assay_qs.values('quantitive_efficacy')[4:5]),
-
-            lbf_part_p1=Subquery(assay_qs.values('log_bias_factor_a')[:1]),
-            lbf_part_p2=Subquery(assay_qs.values('log_bias_factor_a')[1:2]),
-            lbf_part_p3=Subquery(assay_qs.values('log_bias_factor_a')[2:3]),
-            lbf_part_p4=Subquery(assay_qs.values('log_bias_factor_a')[3:4]),
-            lbf_part_p5=Subquery(assay_qs.values('log_bias_factor_a')[4:5]),
-            # reference assay
-            reference_ligand_p1=Subquery(assay_qs.values('reference_ligand_id')[:1]),
-            reference_ligand_p2=Subquery(assay_qs.values('reference_ligand_id')[1:2]),
-            reference_ligand_p3=Subquery(assay_qs.values('reference_ligand_id')[2:3]),
-            reference_ligand_p4=Subquery(assay_qs.values('reference_ligand_id')[3:4]),
-            reference_ligand_p5=Subquery(assay_qs.values('reference_ligand_id')[4:5]),
-
-            # T factor
-            tfactor_p1=Subquery(assay_qs.values('t_value')[:1]),
-            tfactor_p2=Subquery(assay_qs.values('t_value')[1:2]),
-            tfactor_p3=Subquery(assay_qs.values('t_value')[2:3]),
-            tfactor_p4=Subquery(assay_qs.values('t_value')[3:4]),
-            tfactor_p5=Subquery(assay_qs.values('t_value')[4:5]),
-
-            molecule1_p1=Subquery(assay_qs.values('molecule_1')[:1]),
-            molecule1_p2=Subquery(assay_qs.values('molecule_1')[1:2]),
-            molecule1_p3=Subquery(assay_qs.values('molecule_1')[2:3]),
-            molecule1_p4=Subquery(assay_qs.values('molecule_1')[3:4]),
-            molecule1_p5=Subquery(assay_qs.values('molecule_1')[4:5]),
-            #molecule
-            molecule2_p1=Subquery(assay_qs.values('molecule_2')[:1]),
-            molecule2_p2=Subquery(assay_qs.values('molecule_2')[1:2]),
-            molecule2_p3=Subquery(assay_qs.values('molecule_2')[2:3]),
-            molecule2_p4=Subquery(assay_qs.values('molecule_2')[3:4]),
-            molecule2_p5=Subquery(assay_qs.values('molecule_2')[4:5]),
-            # Assay
-            assay_p1=Subquery(assay_qs.values('signalling_protein')[:1]),
-            assay_p2=Subquery(assay_qs.values('signalling_protein')[1:2]),
-            assay_p3=Subquery(assay_qs.values('signalling_protein')[2:3]),
-            assay_p4=Subquery(assay_qs.values('signalling_protein')[3:4]),
-            assay_p5=Subquery(assay_qs.values('signalling_protein')[4:5]),
-
-            # Cell Line
-            cell_p1=Subquery(assay_qs.values('cell_line')[:1]),
-            cell_p2=Subquery(assay_qs.values('cell_line')[1:2]),
-            cell_p3=Subquery(assay_qs.values('cell_line')[2:3]),
-            cell_p4=Subquery(assay_qs.values('cell_line')[3:4]),
-            cell_p5=Subquery(assay_qs.values('cell_line')[4:5]),
-
-            # Time
-            time_p1=Subquery(assay_qs.values('assay_time_resolved')[:1]),
-            time_p2=Subquery(assay_qs.values('assay_time_resolved')[1:2]),
-            time_p3=Subquery(assay_qs.values('assay_time_resolved')[2:3]),
-            time_p4=Subquery(assay_qs.values('assay_time_resolved')[3:4]),
-            time_p5=Subquery(assay_qs.values('assay_time_resolved')[4:5]),
-
-            measured_biological_process_p1=Subquery(assay_qs.values('measured_biological_process')[:1]),
-            measured_biological_process_p2=Subquery(assay_qs.values('measured_biological_process')[1:2]),
-            measured_biological_process_p3=Subquery(assay_qs.values('measured_biological_process')[2:3]),
-            measured_biological_process_p4=Subquery(assay_qs.values('measured_biological_process')[3:4]),
-            measured_biological_process_p5=Subquery(assay_qs.values('measured_biological_process')[4:5]),
-
-
-            reference_quantitive_activity_initial_p1=Subquery(ref_assay_qs.values('quantitive_activity_initial')[:1]),
-            reference_quantitive_activity_initial_p2=Subquery(ref_assay_qs.values('quantitive_activity_initial')[1:2]),
-            reference_quantitive_activity_initial_p3=Subquery(ref_assay_qs.values('quantitive_activity_initial')[2:3]),
-            reference_quantitive_activity_initial_p4=Subquery(ref_assay_qs.values('quantitive_activity_initial')[3:4]),
-            reference_quantitive_activity_initial_p5=Subquery(ref_assay_qs.values('quantitive_activity_initial')[4:5]),
-
-            reference_qualitative_activity_p1=Subquery(ref_assay_qs.values('qualitative_activity')[:1]),
-            reference_qualitative_activity_p2=Subquery(ref_assay_qs.values('qualitative_activity')[1:2]),
-            reference_qualitative_activity_p3=Subquery(ref_assay_qs.values('qualitative_activity')[2:3]),
-            reference_qualitative_activity_p4=Subquery(ref_assay_qs.values('qualitative_activity')[3:4]),
-            reference_qualitative_activity_p5=Subquery(ref_assay_qs.values('qualitative_activity')[4:5]),
-
-            reference_quantitive_efficacy_p1=Subquery(ref_assay_qs.values('quantitive_efficacy')[:1]),
-            reference_quantitive_efficacy_p2=Subquery(ref_assay_qs.values('quantitive_efficacy')[1:2]),
-            reference_quantitive_efficacy_p3=Subquery(ref_assay_qs.values('quantitive_efficacy')[2:3]),
-            reference_quantitive_efficacy_p4=Subquery(ref_assay_qs.values('quantitive_efficacy')[3:4]),
-            reference_quantitive_efficacy_p5=Subquery(ref_assay_qs.values('quantitive_efficacy')[4:5]),
-
-            reference_assay_type_p1=Subquery(ref_assay_qs.values('assay_type')[:1]),
-            reference_assay_type_p2=Subquery(ref_assay_qs.values('assay_type')[1:2]),
-            reference_assay_type_p3=Subquery(ref_assay_qs.values('assay_type')[2:3]),
-            reference_assay_type_p4=Subquery(ref_assay_qs.values('assay_type')[3:4]),
-            reference_assay_type_p5=Subquery(ref_assay_qs.values('assay_type')[4:5]),
-
-            reference_a_p1=Subquery(assay_qs.values('log_bias_factor_a')[:1]),
-            reference_a_p2=Subquery(assay_qs.values('log_bias_factor_a')[1:2]),
-            reference_a_p3=Subquery(assay_qs.values('log_bias_factor_a')[2:3]),
-            reference_a_p4=Subquery(assay_qs.values('log_bias_factor_a')[3:4]),
-            reference_a_p5=Subquery(assay_qs.values('log_bias_factor_a')[4:5]),
-        )
-        return queryset
+    def get_queryset(self):
+        # experiments with the assay columns from the bias browser table built by tools/build_bias_data-*
+        return get_bias_browser_experiments(self.source, get_bias_selection_protein_ids(self.request))
 
 
-class BiasGBrowser(ListView):
-    # serializer_class = AnalyzedExperimentSerializer
+class BiasGBrowser(BiasBrowser):
     template_name = 'bias_browser_subtypes.html'
-    context_object_name = 'data_test'
-    # @cache_page(50000)
-    def get_queryset(self):
-        protein_list = list()
-
-        try:
-            simple_selection = self.request.session.get('selection', False)
-            a = Alignment()
-            # load data from selection into the alignment
-            a.load_proteins_from_selection(simple_selection)
-            for items in a.proteins:
-                protein_list.append(items.protein)
-        except:
-            protein_list.append(1)
-        assay_qs = AnalyzedAssay.objects.filter(
-            order_no__lte=5,
-            assay_description='sub_tested_assays',
-
-            experiment=OuterRef('pk'),
-        ).order_by('order_no')
-
-        ref_assay_qs = AnalyzedAssay.objects.filter(
-            order_no__lte=5,
-            assay_description='sub_endogenous',
-            experiment=OuterRef('pk'),
-        ).order_by('order_no')
-
-        queryset = AnalyzedExperiment.objects.filter(
-            source='sub_different_family',
-            receptor__in=protein_list,
-        ).prefetch_related(
-            'analyzed_data', 'ligand', 'ligand__reference_ligand', 'reference_ligand',
-            'endogenous_ligand', 'ligand__properities', 'receptor', 'receptor', 'receptor__family',
-            'receptor__family__parent', 'receptor__family__parent__parent__parent',
-            'receptor__family__parent__parent', 'receptor__family', 'receptor__species',
-            'publication', 'publication__web_link', 'publication__web_link__web_resource',
-            'publication__journal', 'ligand__ref_ligand_bias_analyzed',
-            'analyzed_data__emax_ligand_reference'
-        ).annotate(
-            # pathways
-            pathways_p1=Subquery(assay_qs.values('family')[:1]),
-            pathways_p2=Subquery(assay_qs.values('family')[1:2]),
-            pathways_p3=Subquery(assay_qs.values('family')[2:3]),
-            pathways_p4=Subquery(assay_qs.values('family')[3:4]),
-            pathways_p5=Subquery(assay_qs.values('family')[4:5]),
-            # t_factor
-            opmodel_p2_p1=Subquery(assay_qs.values('t_factor')[1:2]),
-            opmodel_p3_p1=Subquery(assay_qs.values('t_factor')[2:3]),
-            opmodel_p4_p1=Subquery(assay_qs.values('t_factor')[3:4]),
-            opmodel_p5_p1=Subquery(assay_qs.values('t_factor')[4:5]),
-            # log bias factor
-            lbf_p2_p1=Subquery(assay_qs.values('log_bias_factor')[1:2]),
-            lbf_p3_p1=Subquery(assay_qs.values('log_bias_factor')[2:3]),
-            lbf_p4_p1=Subquery(assay_qs.values('log_bias_factor')[3:4]),
-            lbf_p5_p1=Subquery(assay_qs.values('log_bias_factor')[4:5]),
-            # Potency ratio
-            potency_p2_p1=Subquery(assay_qs.values('potency')[1:2]),
-            potency_p3_p1=Subquery(assay_qs.values('potency')[2:3]),
-            potency_p4_p1=Subquery(assay_qs.values('potency')[3:4]),
-            potency_p5_p1=Subquery(assay_qs.values('potency')[4:5]),
-            # Potency
-            activity_p1=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[:1]),
-            activity_p2=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[1:2]),
-            activity_p3=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[2:3]),
-            activity_p4=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[3:4]),
-            activity_p5=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[4:5]),
-            quality_activity_p1=Subquery(
-                assay_qs.values('qualitative_activity')[:1]),
-            quality_activity_p2=Subquery(
-                assay_qs.values('qualitative_activity')[1:2]),
-            quality_activity_p3=Subquery(
-                assay_qs.values('qualitative_activity')[2:3]),
-            quality_activity_p4=Subquery(
-                assay_qs.values('qualitative_activity')[3:4]),
-            quality_activity_p5=Subquery(
-                assay_qs.values('qualitative_activity')[4:5]),
-            # quality_activity
-            standard_type_p1=Subquery(
-                assay_qs.values('quantitive_measure_type')[:1]),
-            standard_type_p2=Subquery(assay_qs.values(
-                'quantitive_measure_type')[1:2]),
-            standard_type_p3=Subquery(assay_qs.values(
-                'quantitive_measure_type')[2:3]),
-            standard_type_p4=Subquery(assay_qs.values(
-                'quantitive_measure_type')[3:4]),
-            standard_type_p5=Subquery(assay_qs.values(
-                'quantitive_measure_type')[4:5]),
-            # E Max
-            emax_p1=Subquery(assay_qs.values('quantitive_efficacy')[:1]),
-            emax_p2=Subquery(assay_qs.values('quantitive_efficacy')[1:2]),
-            emax_p3=Subquery(assay_qs.values('quantitive_efficacy')[2:3]),
-            emax_p4=Subquery(assay_qs.values('quantitive_efficacy')[3:4]),
-            emax_p5=Subquery(assay_qs.values('quantitive_efficacy')[4:5]),
-
-            lbf_part_p1=Subquery(assay_qs.values('log_bias_factor_a')[:1]),
-            lbf_part_p2=Subquery(assay_qs.values('log_bias_factor_a')[1:2]),
-            lbf_part_p3=Subquery(assay_qs.values('log_bias_factor_a')[2:3]),
-            lbf_part_p4=Subquery(assay_qs.values('log_bias_factor_a')[3:4]),
-            lbf_part_p5=Subquery(assay_qs.values('log_bias_factor_a')[4:5]),
-            # reference assay
-            reference_ligand_p1=Subquery(assay_qs.values('reference_ligand_id')[:1]),
-            reference_ligand_p2=Subquery(assay_qs.values('reference_ligand_id')[1:2]),
-            reference_ligand_p3=Subquery(assay_qs.values('reference_ligand_id')[2:3]),
-            reference_ligand_p4=Subquery(assay_qs.values('reference_ligand_id')[3:4]),
-            reference_ligand_p5=Subquery(assay_qs.values('reference_ligand_id')[4:5]),
-
-            # T factor
-            tfactor_p1=Subquery(assay_qs.values('t_value')[:1]),
-            tfactor_p2=Subquery(assay_qs.values('t_value')[1:2]),
-            tfactor_p3=Subquery(assay_qs.values('t_value')[2:3]),
-            tfactor_p4=Subquery(assay_qs.values('t_value')[3:4]),
-            tfactor_p5=Subquery(assay_qs.values('t_value')[4:5]),
-
-            molecule1_p1=Subquery(assay_qs.values('molecule_1')[:1]),
-            molecule1_p2=Subquery(assay_qs.values('molecule_1')[1:2]),
-            molecule1_p3=Subquery(assay_qs.values('molecule_1')[2:3]),
-            molecule1_p4=Subquery(assay_qs.values('molecule_1')[3:4]),
-            molecule1_p5=Subquery(assay_qs.values('molecule_1')[4:5]),
-            #molecule
-            molecule2_p1=Subquery(assay_qs.values('molecule_2')[:1]),
-            molecule2_p2=Subquery(assay_qs.values('molecule_2')[1:2]),
-            molecule2_p3=Subquery(assay_qs.values('molecule_2')[2:3]),
-            molecule2_p4=Subquery(assay_qs.values('molecule_2')[3:4]),
-            molecule2_p5=Subquery(assay_qs.values('molecule_2')[4:5]),
-            # signalling protein
-            assay_p1=Subquery(assay_qs.values('signalling_protein')[:1]),
-            assay_p2=Subquery(assay_qs.values('signalling_protein')[1:2]),
-            assay_p3=Subquery(assay_qs.values('signalling_protein')[2:3]),
-            assay_p4=Subquery(assay_qs.values('signalling_protein')[3:4]),
-            assay_p5=Subquery(assay_qs.values('signalling_protein')[4:5]),
-
-            # Cell Line
-            cell_p1=Subquery(assay_qs.values('cell_line')[:1]),
-            cell_p2=Subquery(assay_qs.values('cell_line')[1:2]),
-            cell_p3=Subquery(assay_qs.values('cell_line')[2:3]),
-            cell_p4=Subquery(assay_qs.values('cell_line')[3:4]),
-            cell_p5=Subquery(assay_qs.values('cell_line')[4:5]),
-
-            # Time
-            time_p1=Subquery(assay_qs.values('assay_time_resolved')[:1]),
-            time_p2=Subquery(assay_qs.values('assay_time_resolved')[1:2]),
-            time_p3=Subquery(assay_qs.values('assay_time_resolved')[2:3]),
-            time_p4=Subquery(assay_qs.values('assay_time_resolved')[3:4]),
-            time_p5=Subquery(assay_qs.values('assay_time_resolved')[4:5]),
-
-            measured_biological_process_p1=Subquery(assay_qs.values('measured_biological_process')[:1]),
-            measured_biological_process_p2=Subquery(assay_qs.values('measured_biological_process')[1:2]),
-            measured_biological_process_p3=Subquery(assay_qs.values('measured_biological_process')[2:3]),
-            measured_biological_process_p4=Subquery(assay_qs.values('measured_biological_process')[3:4]),
-            measured_biological_process_p5=Subquery(assay_qs.values('measured_biological_process')[4:5]),
-
-
-            reference_quantitive_activity_initial_p1=Subquery(ref_assay_qs.values('quantitive_activity_initial')[:1]),
-            reference_quantitive_activity_initial_p2=Subquery(ref_assay_qs.values('quantitive_activity_initial')[1:2]),
-            reference_quantitive_activity_initial_p3=Subquery(ref_assay_qs.values('quantitive_activity_initial')[2:3]),
-            reference_quantitive_activity_initial_p4=Subquery(ref_assay_qs.values('quantitive_activity_initial')[3:4]),
-            reference_quantitive_activity_initial_p5=Subquery(ref_assay_qs.values('quantitive_activity_initial')[4:5]),
-
-            reference_qualitative_activity_p1=Subquery(ref_assay_qs.values('qualitative_activity')[:1]),
-            reference_qualitative_activity_p2=Subquery(ref_assay_qs.values('qualitative_activity')[1:2]),
-            reference_qualitative_activity_p3=Subquery(ref_assay_qs.values('qualitative_activity')[2:3]),
-            reference_qualitative_activity_p4=Subquery(ref_assay_qs.values('qualitative_activity')[3:4]),
-            reference_qualitative_activity_p5=Subquery(ref_assay_qs.values('qualitative_activity')[4:5]),
-
-            reference_quantitive_efficacy_p1=Subquery(ref_assay_qs.values('quantitive_efficacy')[:1]),
-            reference_quantitive_efficacy_p2=Subquery(ref_assay_qs.values('quantitive_efficacy')[1:2]),
-            reference_quantitive_efficacy_p3=Subquery(ref_assay_qs.values('quantitive_efficacy')[2:3]),
-            reference_quantitive_efficacy_p4=Subquery(ref_assay_qs.values('quantitive_efficacy')[3:4]),
-            reference_quantitive_efficacy_p5=Subquery(ref_assay_qs.values('quantitive_efficacy')[4:5]),
-
-            reference_assay_type_p1=Subquery(ref_assay_qs.values('assay_type')[:1]),
-            reference_assay_type_p2=Subquery(ref_assay_qs.values('assay_type')[1:2]),
-            reference_assay_type_p3=Subquery(ref_assay_qs.values('assay_type')[2:3]),
-            reference_assay_type_p4=Subquery(ref_assay_qs.values('assay_type')[3:4]),
-            reference_assay_type_p5=Subquery(ref_assay_qs.values('assay_type')[4:5]),
-
-            reference_a_p1=Subquery(assay_qs.values('log_bias_factor_a')[:1]),
-            reference_a_p2=Subquery(assay_qs.values('log_bias_factor_a')[1:2]),
-            reference_a_p3=Subquery(assay_qs.values('log_bias_factor_a')[2:3]),
-            reference_a_p4=Subquery(assay_qs.values('log_bias_factor_a')[3:4]),
-            reference_a_p5=Subquery(assay_qs.values('log_bias_factor_a')[4:5]),
-        )
-        return queryset
+    source = 'sub_different_family'
 
 
-class BiasPredictionBrowser(ListView):
-    # serializer_class = AnalyzedExperimentSerializer
+class BiasPredictionBrowser(BiasBrowser):
     template_name = 'bias_browser_predict.html'
-    context_object_name = 'data_test'
-    # @cache_page(50000)
-    def get_queryset(self):
-        protein_list = list()
-
-        try:
-            simple_selection = self.request.session.get('selection', False)
-            a = Alignment()
-            # load data from selection into the alignment
-            a.load_proteins_from_selection(simple_selection)
-            for items in a.proteins:
-                protein_list.append(items.protein)
-        except:
-            protein_list.append(1)
-        assay_qs = AnalyzedAssay.objects.filter(
-            order_no__lte=5,
-            assay_description='predicted_tested_assays',
-
-            experiment=OuterRef('pk'),
-        ).order_by('order_no')
-
-        queryset = AnalyzedExperiment.objects.filter(
-            source='predicted_family',
-            receptor__in=protein_list,
-        ).prefetch_related(
-            'analyzed_data', 'ligand', 'ligand__reference_ligand', 'reference_ligand',
-            'endogenous_ligand', 'ligand__properities', 'receptor', 'receptor', 'receptor__family',
-            'receptor__family__parent', 'receptor__family__parent__parent__parent',
-            'receptor__family__parent__parent', 'receptor__family', 'receptor__species',
-            'publication', 'publication__web_link', 'publication__web_link__web_resource',
-            'publication__journal', 'ligand__ref_ligand_bias_analyzed',
-            'analyzed_data__emax_ligand_reference'
-        ).annotate(
-            # pathways
-            pathways_p1=Subquery(assay_qs.values('family')[:1]),
-            pathways_p2=Subquery(assay_qs.values('family')[1:2]),
-            pathways_p3=Subquery(assay_qs.values('family')[2:3]),
-            pathways_p4=Subquery(assay_qs.values('family')[3:4]),
-            pathways_p5=Subquery(assay_qs.values('family')[4:5]),
-            # t_factor
-            opmodel_p2_p1=Subquery(assay_qs.values('t_factor')[1:2]),
-            opmodel_p3_p1=Subquery(assay_qs.values('t_factor')[2:3]),
-            opmodel_p4_p1=Subquery(assay_qs.values('t_factor')[3:4]),
-            opmodel_p5_p1=Subquery(assay_qs.values('t_factor')[4:5]),
-            # log bias factor
-            lbf_p2_p1=Subquery(assay_qs.values('log_bias_factor')[1:2]),
-            lbf_p3_p1=Subquery(assay_qs.values('log_bias_factor')[2:3]),
-            lbf_p4_p1=Subquery(assay_qs.values('log_bias_factor')[3:4]),
-            lbf_p5_p1=Subquery(assay_qs.values('log_bias_factor')[4:5]),
-            # Potency ratio
-            potency_p2_p1=Subquery(assay_qs.values('potency')[1:2]),
-            potency_p3_p1=Subquery(assay_qs.values('potency')[2:3]),
-            potency_p4_p1=Subquery(assay_qs.values('potency')[3:4]),
-            potency_p5_p1=Subquery(assay_qs.values('potency')[4:5]),
-            # Potency
-            activity_p1=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[:1]),
-            activity_p2=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[1:2]),
-            activity_p3=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[2:3]),
-            activity_p4=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[3:4]),
-            activity_p5=Subquery(assay_qs.values(
-                'quantitive_activity_initial')[4:5]),
-            quality_activity_p1=Subquery(
-                assay_qs.values('qualitative_activity')[:1]),
-            quality_activity_p2=Subquery(
-                assay_qs.values('qualitative_activity')[1:2]),
-            quality_activity_p3=Subquery(
-                assay_qs.values('qualitative_activity')[2:3]),
-            quality_activity_p4=Subquery(
-                assay_qs.values('qualitative_activity')[3:4]),
-            quality_activity_p5=Subquery(
-                assay_qs.values('qualitative_activity')[4:5]),
-            # quality_activity
-            standard_type_p1=Subquery(
-                assay_qs.values('quantitive_measure_type')[:1]),
-            standard_type_p2=Subquery(assay_qs.values(
-                'quantitive_measure_type')[1:2]),
-            standard_type_p3=Subquery(assay_qs.values(
-                'quantitive_measure_type')[2:3]),
-            standard_type_p4=Subquery(assay_qs.values(
-                'quantitive_measure_type')[3:4]),
-            standard_type_p5=Subquery(assay_qs.values(
-                'quantitive_measure_type')[4:5]),
-            # E Max
-            emax_p1=Subquery(assay_qs.values('quantitive_efficacy')[:1]),
-            emax_p2=Subquery(assay_qs.values('quantitive_efficacy')[1:2]),
-            emax_p3=Subquery(assay_qs.values('quantitive_efficacy')[2:3]),
-            emax_p4=Subquery(assay_qs.values('quantitive_efficacy')[3:4]),
-            emax_p5=Subquery(assay_qs.values('quantitive_efficacy')[4:5]),
-
-            lbf_part_p1=Subquery(assay_qs.values('log_bias_factor_a')[:1]),
-            lbf_part_p2=Subquery(assay_qs.values('log_bias_factor_a')[1:2]),
-            lbf_part_p3=Subquery(assay_qs.values('log_bias_factor_a')[2:3]),
-            lbf_part_p4=Subquery(assay_qs.values('log_bias_factor_a')[3:4]),
-            lbf_part_p5=Subquery(assay_qs.values('log_bias_factor_a')[4:5]),
-            # reference assay
-            reference_ligand_p1=Subquery(assay_qs.values('reference_ligand_id')[:1]),
-            reference_ligand_p2=Subquery(assay_qs.values('reference_ligand_id')[1:2]),
-            reference_ligand_p3=Subquery(assay_qs.values('reference_ligand_id')[2:3]),
-            reference_ligand_p4=Subquery(assay_qs.values('reference_ligand_id')[3:4]),
-            reference_ligand_p5=Subquery(assay_qs.values('reference_ligand_id')[4:5]),
-
-            # T factor
-            tfactor_p1=Subquery(assay_qs.values('t_value')[:1]),
-            tfactor_p2=Subquery(assay_qs.values('t_value')[1:2]),
-            tfactor_p3=Subquery(assay_qs.values('t_value')[2:3]),
-            tfactor_p4=Subquery(assay_qs.values('t_value')[3:4]),
-            tfactor_p5=Subquery(assay_qs.values('t_value')[4:5]),
-
-            molecule1_p1=Subquery(assay_qs.values('molecule_1')[:1]),
-            molecule1_p2=Subquery(assay_qs.values('molecule_1')[1:2]),
-            molecule1_p3=Subquery(assay_qs.values('molecule_1')[2:3]),
-            molecule1_p4=Subquery(assay_qs.values('molecule_1')[3:4]),
-            molecule1_p5=Subquery(assay_qs.values('molecule_1')[4:5]),
-            #molecule
-            molecule2_p1=Subquery(assay_qs.values('molecule_2')[:1]),
-            molecule2_p2=Subquery(assay_qs.values('molecule_2')[1:2]),
-            molecule2_p3=Subquery(assay_qs.values('molecule_2')[2:3]),
-            molecule2_p4=Subquery(assay_qs.values('molecule_2')[3:4]),
-            molecule2_p5=Subquery(assay_qs.values('molecule_2')[4:5]),
-            # signalling protein
-            assay_p1=Subquery(assay_qs.values('signalling_protein')[:1]),
-            assay_p2=Subquery(assay_qs.values('signalling_protein')[1:2]),
-            assay_p3=Subquery(assay_qs.values('signalling_protein')[2:3]),
-            assay_p4=Subquery(assay_qs.values('signalling_protein')[3:4]),
-            assay_p5=Subquery(assay_qs.values('signalling_protein')[4:5]),
-
-            # Cell Line
-            cell_p1=Subquery(assay_qs.values('cell_line')[:1]),
-            cell_p2=Subquery(assay_qs.values('cell_line')[1:2]),
-            cell_p3=Subquery(assay_qs.values('cell_line')[2:3]),
-            cell_p4=Subquery(assay_qs.values('cell_line')[3:4]),
-            cell_p5=Subquery(assay_qs.values('cell_line')[4:5]),
-
-            # Time
-            time_p1=Subquery(assay_qs.values('assay_time_resolved')[:1]),
-            time_p2=Subquery(assay_qs.values('assay_time_resolved')[1:2]),
-            time_p3=Subquery(assay_qs.values('assay_time_resolved')[2:3]),
-            time_p4=Subquery(assay_qs.values('assay_time_resolved')[3:4]),
-            time_p5=Subquery(assay_qs.values('assay_time_resolved')[4:5]),
-
-            measured_biological_process_p1=Subquery(assay_qs.values('measured_biological_process')[:1]),
-            measured_biological_process_p2=Subquery(assay_qs.values('measured_biological_process')[1:2]),
-            measured_biological_process_p3=Subquery(assay_qs.values('measured_biological_process')[2:3]),
-            measured_biological_process_p4=Subquery(assay_qs.values('measured_biological_process')[3:4]),
-            measured_biological_process_p5=Subquery(assay_qs.values('measured_biological_process')[4:5]),
-
-            reference_a_p1=Subquery(assay_qs.values('log_bias_factor_a')[:1]),
-            reference_a_p2=Subquery(assay_qs.values('log_bias_factor_a')[1:2]),
-            reference_a_p3=Subquery(assay_qs.values('log_bias_factor_a')[2:3]),
-            reference_a_p4=Subquery(assay_qs.values('log_bias_factor_a')[3:4]),
-            reference_a_p5=Subquery(assay_qs.values('log_bias_factor_a')[4:5]),
-        )
-        return queryset
+    source = 'predicted_family'
 
 class BiasGuidelines(TemplateView):
 
@@ -18,13 +18,14 @@ from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
 from common import definitions
 
 from construct.views import ConstructMutation
+from contactnetwork.contacts import get_structure_contacts
 from contactnetwork.models import Interaction, InteractingResiduePair
 
 from interaction.models import ResidueFragmentInteraction, StructureLigandInteraction
 from interaction.views import calculate
 from interaction.forms import PDBform
 
-from residue.models import Residue,ResidueNumberingScheme, ResidueGenericNumberEquivalent
+from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
 from residue.views import ResidueTablesDisplay
 from protein.models import Protein, ProteinSegment, ProteinFamily, ProteinConformation, ProteinCouplings
 from structure.models import Structure
@@ -683,6 +684,8 @@ def showcalculationPDB(request):
             print('pdb code entered')
 
         context = calculate(request)
+        if isinstance(context, HttpResponse):
+            return context
 
         #print(context['residues'])
         matrix = definitions.DESIGN_SUBSTITUTION_MATRIX
@@ -1046,6 +1049,8 @@ def showcalculation(request):
     if request.method == 'POST':
         form = PDBform(request.POST, request.FILES)
         context = calculate(request)
+        if isinstance(context, HttpResponse):
+            return context
 
     else:
         simple_selection = request.session.get('selection', False)
@@ -2963,82 +2968,23 @@ def calculateResidueContactFrequency(pdbs, allowed_gns, detail_gn = None):
     #result_pairs = None
     if result_pairs == None:
 
-        # Add interaction type filter + minimum interaction for VdW + Hyd
-        i_types_filter = Q()
-        i_types = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals']
-        for int_type in i_types:
-            if int_type == 'hydrophobic' or int_type == 'van-der-waals':
-                i_types_filter = i_types_filter | (Q(interaction_type=int_type) & Q(atompaircount__gte=4))
-            else:
-                i_types_filter = i_types_filter | Q(interaction_type=int_type)
-
-        # intrasegment (only S-S interactions) intersegments(S-S + S-B interactions)
-        i_options_filter = Q()
-
-        # Filters for inter- and intrasegment contacts + BB/SC filters
-        backbone_atoms = ["C", "O", "N", "CA"]
-        pure_backbone_atoms = ["C", "O", "N"]
-
-        # INTERsegment interactions
-        inter_segments = ~Q(interacting_pair__res1__protein_segment=F('interacting_pair__res2__protein_segment'))
-
-        # SC-BB
-        scbb = ((Q(atomname_residue1__in=backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms)) | (~Q(atomname_residue1__in=pure_backbone_atoms) & Q(atomname_residue2__in=backbone_atoms))) & inter_segments
-        inter_options_filter = scbb
-
-        # SC-SC
-        scsc = ~Q(atomname_residue1__in=pure_backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms) & inter_segments
-        inter_options_filter = inter_options_filter | scsc
-
-        # INTRAsegment interactions
-        intra_segments = Q(interacting_pair__res1__protein_segment=F('interacting_pair__res2__protein_segment'))
-
-        # SC-SC
-        scsc = ~Q(atomname_residue1__in=pure_backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms) & intra_segments
-        intra_options_filter = scsc
-
-        i_options_filter = inter_options_filter | intra_options_filter
-
-        pairs = Interaction.objects.filter(
-            interacting_pair__referenced_structure__pdb_code__index__in=pdbs
-        ).filter(interacting_pair__res1__generic_number__label__in = allowed_gns,
-                 interacting_pair__res2__generic_number__label__in = allowed_gns
-        ).filter(
-            interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id') # Filter interactions with other proteins
-        ).filter(
-            interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')
-        ).values(
-            'interaction_type',
-            'interacting_pair__referenced_structure__pk',
-            'interacting_pair__referenced_structure__protein_conformation__protein__family__slug',
-            'interacting_pair__res1__generic_number__label',
-            'interacting_pair__res2__generic_number__label',
-        ).distinct(
-        ).annotate(
-             atompaircount=Count('interaction_type')
-        ).filter(
-            i_types_filter
-        ).filter(
-            i_options_filter
-        ).values(
-            'interacting_pair__referenced_structure__pk',
-            'interacting_pair__referenced_structure__protein_conformation__protein__family__slug',
-            'interacting_pair__res1__generic_number__label',
-            'interacting_pair__res2__generic_number__label',
-        ).order_by(
-            'interacting_pair__referenced_structure__pk',
-            'interacting_pair__referenced_structure__protein_conformation__protein__family__slug',
-            'interacting_pair__res1__generic_number__label',
-            'interacting_pair__res2__generic_number__label',
-        ).distinct(
-        )
+        # Contacts from the precomputed index: ionic, polar (incl. water-mediated) and aromatic with a single atom pair,
+        # hydrophobic and VdW with at least 4 atom pairs. Intersegment SC-BB and SC-SC contacts and intrasegment SC-SC contacts
+        structures = list(Structure.objects.filter(pdb_code__index__in=pdbs).values_list('pk', 'protein_conformation__protein__family__slug'))
+        contacts = get_structure_contacts([pk for pk, slug in structures],
+            {'ionic': 1, 'polar': 1, 'aromatic': 1, 'hydrophobic': 4, 'van-der-waals': 4, 'water-mediated': 1},
+            ['inter_scbb', 'inter_scsc', 'intra_scsc'])
+        gn_labels = dict(ResidueGenericNumber.objects.filter(pk__in=set(contacts[:, 1:].flatten().tolist()),
+            label__in=allowed_gns).values_list('pk', 'label'))
 
         # Count and normalize by receptor slug
         result_pairs = {}
-        for pair in pairs:
-            gn1 = pair["interacting_pair__res1__generic_number__label"]
-            gn2 = pair["interacting_pair__res2__generic_number__label"]
-            slug = pair["interacting_pair__referenced_structure__protein_conformation__protein__family__slug"]
+        for position, gn1_id, gn2_id in contacts.tolist():
+            if gn1_id not in gn_labels or gn2_id not in gn_labels:
+                continue
+            gn1 = gn_labels[gn1_id]
+            gn2 = gn_labels[gn2_id]
+            slug = structures[position][1]
 
             pair_id = "{}_{}".format(gn1, gn2)
             if pair_id not in result_pairs:
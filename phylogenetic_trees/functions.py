@@ -0,0 +1,243 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from common.alignment import AMINO_ACID_CODES
+
+import hashlib
+import logging
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+
+logger = logging.getLogger("protwis")
+
+# only the 20 standard amino acids are compared, gaps and ambiguous residues are skipped pairwise
+NUM_STANDARD_AA = 20
+# Kimura's formula is undefined above ~85% difference, larger distances are capped
+MAX_DISTANCE = 10.0
+# seed of the bootstrap resampling, the same as the one used with PHYLIP seqboot
+BOOTSTRAP_SEED = 77
+TREE_CACHE_TIMEOUT = 60*60*24*7
+
+# one-hot encoded alignment shared with the bootstrap workers
+_bootstrap_data = {}
+
+
+def encode_sequences(sequences):
+    """One-hot encoding (proteins x positions*20) of aligned sequences of equal length."""
+    codes = np.array([AMINO_ACID_CODES[np.frombuffer(s.encode('ascii', 'replace'), dtype=np.uint8)] for s in sequences])
+    onehot = np.zeros(codes.shape + (NUM_STANDARD_AA,), dtype=np.float32)
+    rows, columns = np.nonzero(codes < NUM_STANDARD_AA)
+    onehot[rows, columns, codes[rows, columns]] = 1
+    return onehot.reshape(len(sequences), -1)
+
+
+def protein_distances(onehot, weights=None):
+    """Kimura protein distances between all rows of the encoded alignment, optionally with column weights."""
+    valid = onehot.reshape(onehot.shape[0], -1, NUM_STANDARD_AA).sum(axis=2)
+    if weights is None:
+        identical = onehot.dot(onehot.T)
+        compared = valid.dot(valid.T)
+    else:
+        identical = (onehot * np.repeat(weights, NUM_STANDARD_AA).astype(np.float32)).dot(onehot.T)
+        compared = (valid * weights.astype(np.float32)).dot(valid.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = 1 - identical / compared
+        arg = 1 - p - 0.2 * p * p
+        distances = np.where((compared > 0) & (arg > 0), -np.log(np.where(arg > 0, arg, 1)), MAX_DISTANCE)
+    distances = np.minimum(distances, MAX_DISTANCE).astype(np.float64)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def neighbor_joining(distances):
+    """Neighbor-joining tree (Saitou and Nei) of a distance matrix.
+
+    Returns the clusters of the tree as (taxa bitmask, [(child, branch length), ...]) tuples, children are taxon
+    indices or clusters. The last cluster is the unrooted trifurcation at the base of the tree.
+    """
+    d = distances.copy()
+    nodes = list(range(len(d)))
+    masks = [1 << i for i in nodes]
+    m = len(d)
+    while m > 3:
+        sub = d[:m, :m]
+        r = sub.sum(axis=1)
+        q = (m - 2) * sub - r[:, None] - r[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = divmod(int(np.argmin(q)), m)
+        if i > j:
+            i, j = j, i
+        length_i = 0.5 * sub[i, j] + (r[i] - r[j]) / (2 * (m - 2))
+        length_j = sub[i, j] - length_i
+        new_row = 0.5 * (sub[i] + sub[j] - sub[i, j])
+        nodes[i] = (masks[i] | masks[j], [(nodes[i], length_i), (nodes[j], length_j)])
+        masks[i] = nodes[i][0]
+        d[i, :m] = new_row
+        d[:m, i] = new_row
+        d[i, i] = 0
+        # move the last cluster into the place of j
+        last = m - 1
+        d[j, :m] = d[last, :m]
+        d[:m, j] = d[:m, last]
+        d[j, j] = 0
+        nodes[j], masks[j] = nodes[last], masks[last]
+        m -= 1
+
+    if m == 3:
+        sub = d[:3, :3]
+        lengths = [(sub[0, 1] + sub[0, 2] - sub[1, 2]) / 2, (sub[0, 1] + sub[1, 2] - sub[0, 2]) / 2,
+            (sub[0, 2] + sub[1, 2] - sub[0, 1]) / 2]
+    else:
+        lengths = [d[0, 1] / 2, d[0, 1] / 2][:m]
+    return (sum(masks[:m]), [(nodes[k], lengths[k]) for k in range(m)])
+
+
+def upgma(distances):
+    """UPGMA tree of a distance matrix, in the same format as neighbor_joining."""
+    d = distances.copy()
+    nodes = list(range(len(d)))
+    masks = [1 << i for i in nodes]
+    sizes = [1] * len(d)
+    heights = [0.0] * len(d)
+    m = len(d)
+    while m > 1:
+        sub = d[:m, :m].copy()
+        np.fill_diagonal(sub, np.inf)
+        i, j = divmod(int(np.argmin(sub)), m)
+        if i > j:
+            i, j = j, i
+        height = d[i, j] / 2
+        new_row = (sizes[i] * d[i, :m] + sizes[j] * d[j, :m]) / (sizes[i] + sizes[j])
+        nodes[i] = (masks[i] | masks[j], [(nodes[i], height - heights[i]), (nodes[j], height - heights[j])])
+        masks[i], sizes[i], heights[i] = nodes[i][0], sizes[i] + sizes[j], height
+        d[i, :m] = new_row
+        d[:m, i] = new_row
+        d[i, i] = 0
+        last = m - 1
+        d[j, :m] = d[last, :m]
+        d[:m, j] = d[:m, last]
+        d[j, j] = 0
+        nodes[j], masks[j], sizes[j], heights[j] = nodes[last], masks[last], sizes[last], heights[last]
+        m -= 1
+    return nodes[0]
+
+
+def tree_splits(tree, num_taxa):
+    """Non-trivial splits of a tree as taxa bitmasks, oriented to exclude the first taxon."""
+    full = (1 << num_taxa) - 1
+    splits = set()
+    stack = [tree]
+    while stack:
+        mask, children = stack.pop()
+        if mask & 1:
+            mask = full ^ mask
+        if 1 < bin(mask).count('1') < num_taxa - 1:
+            splits.add(mask)
+        stack.extend([child for child, length in children if not isinstance(child, int)])
+    return splits
+
+
+def consensus_tree(split_counts, num_taxa, num_trees):
+    """Extended majority rule consensus of bootstrap splits (as PHYLIP consense).
+
+    Splits are added by decreasing frequency if they are compatible with the splits added before. Returns the tree
+    in the format of neighbor_joining, branch lengths are the number of trees supporting the branch.
+    """
+    accepted = []
+    for split, count in sorted(split_counts.items(), key=lambda x: (-x[1], x[0])):
+        # all splits exclude the first taxon, so two splits are compatible when they are nested or disjoint
+        if all(split & a == 0 or split & a == split or split & a == a for a, c in accepted):
+            accepted.append((split, count))
+
+    # build the tree from the largest clusters down, the first taxon is attached to the root
+    accepted.sort(key=lambda x: -bin(x[0]).count('1'))
+    root = [(1 << num_taxa) - 1, [], None]
+    for split, count in accepted:
+        parent = root
+        while True:
+            inner = [c for c in parent[1] if c[0] & split == split]
+            if not inner:
+                break
+            parent = inner[0]
+        parent[1].append([split, [], count])
+
+    def to_tree(cluster):
+        children = []
+        covered = 0
+        for child in cluster[1]:
+            children.append((to_tree(child), child[2]))
+            covered |= child[0]
+        for taxon in range(num_taxa):
+            if cluster[0] & (1 << taxon) and not covered & (1 << taxon):
+                children.append((taxon, num_trees))
+        return (cluster[0], children)
+
+    return to_tree(root)
+
+
+def to_newick(tree, names, length_format='{:.5f}'):
+
+    def node_string(node, length):
+        if isinstance(node, int):
+            label = names[node]
+        else:
+            label = '(' + ','.join([node_string(child, l) for child, l in node[1]]) + ')'
+        return label + ':' + length_format.format(length)
+
+    return '(' + ','.join([node_string(child, l) for child, l in tree[1]]) + ');'
+
+
+def _init_bootstrap(onehot, use_upgma):
+    _bootstrap_data['onehot'] = onehot
+    _bootstrap_data['upgma'] = use_upgma
+
+
+def _bootstrap_splits(weights):
+
+    onehot = _bootstrap_data['onehot']
+    distances = protein_distances(onehot, weights)
+    tree = upgma(distances) if _bootstrap_data['upgma'] else neighbor_joining(distances)
+    return tree_splits(tree, len(onehot))
+
+
+def build_tree(names, sequences, bootstrap=0, use_upgma=False, processes=None):
+    """Newick tree of aligned sequences, computed in-process and cached by alignment and settings.
+
+    Distances are Kimura protein distances, the tree is built by neighbor-joining or UPGMA. With bootstrap, the
+    extended majority rule consensus of the replicates is returned, branch lengths are then the number of replicates
+    supporting a branch. The replicates are spread over a pool of processes (PHYLOGENETIC_TREE_PROCESSES by default,
+    in-process when 1).
+    """
+    cache_key = 'phylo_tree_' + hashlib.md5('|'.join([str(bootstrap), str(use_upgma)] + list(names)
+        + list(sequences)).encode('utf-8')).hexdigest()
+    newick = cache.get(cache_key)
+    if newick is not None:
+        return newick
+
+    onehot = encode_sequences(sequences)
+    if bootstrap:
+        num_columns = len(sequences[0])
+        random_state = np.random.RandomState(BOOTSTRAP_SEED)
+        replicates = [np.bincount(random_state.randint(0, num_columns, num_columns), minlength=num_columns)
+            for i in range(bootstrap)]
+        split_counts = Counter()
+        processes = min(processes or getattr(settings, 'PHYLOGENETIC_TREE_PROCESSES', 1), bootstrap)
+        if processes > 1:
+            with Pool(processes, initializer=_init_bootstrap, initargs=(onehot, use_upgma)) as pool:
+                for splits in pool.imap_unordered(_bootstrap_splits, replicates, chunksize=max(1, bootstrap // (processes * 4))):
+                    split_counts.update(splits)
+        else:
+            _init_bootstrap(onehot, use_upgma)
+            for weights in replicates:
+                split_counts.update(_bootstrap_splits(weights))
+        newick = to_newick(consensus_tree(split_counts, len(names), bootstrap), names, '{:.1f}')
+    else:
+        distances = protein_distances(onehot)
+        tree = upgma(distances) if use_upgma else neighbor_joining(distances)
+        newick = to_newick(tree, names)
+
+    cache.set(cache_key, newick, TREE_CACHE_TIMEOUT)
+    return newick
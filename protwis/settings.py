@@ -199,6 +199,25 @@ CACHES = {
     }
 }
 
+# Web API lookups of the builds (common.tools.fetch_from_web_api) are cached under BUILD_CACHE_DIR/web_api
+# WEB_API_OFFLINE only replays cached responses, WEB_API_RATE_LIMITS sets the seconds between requests per host
+WEB_API_OFFLINE = os.environ.get('GPCRDB_WEB_API_OFFLINE', '') == '1'
+WEB_API_RATE_LIMITS = {
+    'rest.ensembl.org': 0.07,
+    'grch37.rest.ensembl.org': 0.07,
+}
+
+# Phylogenetic trees are built within the request, PHYLOGENETIC_TREE_MAX_SIZE limits the number of sequences times
+# bootstrap replicates and PHYLOGENETIC_TREE_PROCESSES the processes the bootstrap replicates are spread over
+PHYLOGENETIC_TREE_MAX_SIZE = 30000
+PHYLOGENETIC_TREE_PROCESSES = 1
+
+# Ligand interactions are calculated by interaction.functions, INTERACTION_LEGACY_CALCULATION selects the legacy Python 2
+# script (interaction/legacy_functions.py) instead. Calculations of user uploads are stopped after
+# INTERACTION_CALCULATION_TIMEOUT seconds
+INTERACTION_LEGACY_CALCULATION = False
+INTERACTION_CALCULATION_TIMEOUT = 300
+
 # Note that https://www.django-rest-framework.org/community/3.10-announcement
 # So, have to switch from CoreAPI to OpenAPI. Next line will work for now.
 # Uncomment when needed.
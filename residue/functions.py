@@ -1,6 +1,6 @@
 from django.conf import settings
 from django.db.models import Q
-from django.db import IntegrityError
+from django.db import transaction
 
 from protein.models import Protein, ProteinAnomaly, ProteinSegment
 from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
@@ -43,119 +43,135 @@ def load_reference_positions(path):
     except:
         return False
 
-def create_or_update_residue(protein_conformation, segment, schemes,residue,b_and_c):
-    logger = logging.getLogger('build')
-
-    rns_defaults = {'protein_segment': segment} # default numbering scheme for creating generic numbers
-
-    # default numbering scheme
-    ns = settings.DEFAULT_NUMBERING_SCHEME
-    ns_obj = ResidueNumberingScheme.objects.get(slug=ns)
-    
-    rvalues = {}
-    rvalues['protein_segment'] = segment
-    rvalues['amino_acid'] = residue['aa']
-    rvalues['generic_number'] = None
-    rvalues['display_generic_number'] = None
-    sequence_number = residue['pos']
-    numbers = residue['numbers']
-
-    if 'generic_number' in numbers:
-        numbers = format_generic_numbers(protein_conformation.protein.residue_numbering_scheme, schemes,
-                    sequence_number, numbers['generic_number'], numbers['bw'],b_and_c)
-        # print(numbers)
-    # print(residues,numbers)
-    # main generic number
+class GenericNumberRegistry(object):
+    """In-memory lookup of the numbering schemes, generic numbers and generic number equivalents of residue builds.
+
+    Generic numbers are identified by (scheme id, label) keys. Missing numbers and equivalents are created in batches,
+    conflicting rows inserted at the same time by other workers are ignored and the ids are read back from the
+    database, so parallel builds do not need to retry.
+    """
+
+    def __init__(self):
+        self.schemes = {scheme.slug: scheme for scheme in ResidueNumberingScheme.objects.all()}
+        self.generic_numbers = {(scheme_id, label): gn_id for scheme_id, label, gn_id
+            in ResidueGenericNumber.objects.values_list('scheme_id', 'label', 'id')}
+        self.equivalents = set(ResidueGenericNumberEquivalent.objects.values_list('default_generic_number_id',
+            'scheme_id'))
+
+    def key(self, scheme_slug, label):
+        return (self.schemes[scheme_slug].id, label)
+
+    def get_id(self, key):
+        if key is None:
+            return None
+        return self.generic_numbers[key]
+
+    def create_generic_numbers(self, keys_and_segments):
+        """Creates the generic numbers of (key, protein segment) pairs that are not in the registry yet."""
+        missing = OrderedDict()
+        for key, segment in keys_and_segments:
+            if key not in self.generic_numbers and key not in missing:
+                missing[key] = segment
+        if not missing:
+            return
+        ResidueGenericNumber.objects.bulk_create([ResidueGenericNumber(scheme_id=scheme_id, label=label,
+            protein_segment=segment) for (scheme_id, label), segment in missing.items()], batch_size=5000,
+            ignore_conflicts=True)
+        for scheme_id, label, gn_id in ResidueGenericNumber.objects.filter(scheme_id__in={k[0] for k in missing},
+                label__in={k[1] for k in missing}).values_list('scheme_id', 'label', 'id'):
+            self.generic_numbers[(scheme_id, label)] = gn_id
+        logging.getLogger('build').info('Added {} generic numbers'.format(len(missing)))
+
+    def create_equivalents(self, equivalents):
+        """Creates the missing equivalents of (generic number key, scheme id, label) tuples."""
+        missing = OrderedDict()
+        for key, scheme_id, label in equivalents:
+            equivalent_key = (self.generic_numbers[key], scheme_id)
+            if equivalent_key not in self.equivalents and equivalent_key not in missing:
+                missing[equivalent_key] = label
+        if not missing:
+            return
+        ResidueGenericNumberEquivalent.objects.bulk_create([ResidueGenericNumberEquivalent(
+            default_generic_number_id=gn_id, scheme_id=scheme_id, label=label)
+            for (gn_id, scheme_id), label in missing.items()], batch_size=5000, ignore_conflicts=True)
+        self.equivalents.update(missing)
+
+def residue_entry(registry, protein_conformation, segment, sequence_number, amino_acid, numbers=None):
+    """Values of a residue for save_residues, generic numbers are taken from the output of format_generic_numbers."""
+    entry = {'sequence_number': sequence_number, 'amino_acid': amino_acid, 'protein_segment': segment,
+        'generic_number': None, 'display_generic_number': None, 'equivalent': None, 'alternative_generic_numbers': []}
+    if not numbers:
+        return entry
+    scheme = protein_conformation.protein.residue_numbering_scheme
     if 'generic_number' in numbers:
-        gnl = numbers['generic_number']
-        if gnl in schemes[ns]['generic_numbers']:
-            rvalues['generic_number'] = schemes[ns]['generic_numbers'][gnl]
-        else:
-            try:
-                gn, created = ResidueGenericNumber.objects.get_or_create(
-                    scheme=ns_obj, label=gnl, defaults=rns_defaults)
-                # if created:
-                #     logger.info('Created generic number {}'.format(gn.label))
-            except IntegrityError:
-                gn = ResidueGenericNumber.objects.get(scheme=ns_obj, label=gnl)
-            rvalues['generic_number'] = schemes[ns]['generic_numbers'][gnl] = gn
-
-
-     # equivalent to main generic number
-    if 'equivalent' in numbers:
-        try:
-            gn_equivalent, created = ResidueGenericNumberEquivalent.objects.get_or_create(
-                default_generic_number=rvalues['generic_number'],
-                scheme=protein_conformation.protein.residue_numbering_scheme,
-                defaults={'label': numbers['equivalent']})
-            # if created:
-            #     logger.info('Created generic number equivalent {} ({}) for scheme {}'.format(
-            #         numbers['equivalent'], numbers['generic_number'],
-            #         protein_conformation.protein.residue_numbering_scheme))
-        except:
-            sleep(0.5)
-            print('sleep to hope to fix')
-            gn_equivalent, created = ResidueGenericNumberEquivalent.objects.get_or_create(
-                default_generic_number=rvalues['generic_number'],
-                scheme=protein_conformation.protein.residue_numbering_scheme,
-                defaults={'label': numbers['equivalent']})
-            # gn_equivalent = ResidueGenericNumberEquivalent.objects.get(
-            #     default_generic_number=rvalues['generic_number'],
-            #     scheme=protein_conformation.protein.residue_numbering_scheme)
-    
-    # display generic number
+        entry['generic_number'] = registry.key(settings.DEFAULT_NUMBERING_SCHEME, numbers['generic_number'])
+        if 'equivalent' in numbers:
+            entry['equivalent'] = (scheme.id, numbers['equivalent'])
     if 'display_generic_number' in numbers:
-        ns = protein_conformation.protein.residue_numbering_scheme.slug
-        gnl = numbers['display_generic_number']
-        if gnl in schemes[ns]['generic_numbers']:
-            rvalues['display_generic_number'] = schemes[ns]['generic_numbers'][gnl]
+        entry['display_generic_number'] = registry.key(scheme.slug, numbers['display_generic_number'])
+    if 'alternative_generic_numbers' in numbers:
+        entry['alternative_generic_numbers'] = [registry.key(alt_scheme, alt_num)
+            for alt_scheme, alt_num in numbers['alternative_generic_numbers'].items()]
+    return entry
+
+def save_residues(protein_conformation, residues, registry=None):
+    """Creates or updates the residues of a protein conformation from residue entries in bulk.
+
+    Missing generic numbers and equivalents are created first, existing residues with the same sequence numbers are
+    updated and their alternative generic numbers replaced. Entries with the same sequence number (overlapping
+    segments) are saved once, the last entry wins. Returns the number of created residues.
+    """
+    registry = registry or get_generic_number_registry()
+    residues = list(OrderedDict((r['sequence_number'], r) for r in residues).values())
+    registry.create_generic_numbers([(key, r['protein_segment']) for r in residues
+        for key in [r['generic_number'], r['display_generic_number']] + r['alternative_generic_numbers'] if key])
+    registry.create_equivalents([(r['generic_number'],) + r['equivalent'] for r in residues if r['equivalent']])
+
+    existing = dict(Residue.objects.filter(protein_conformation=protein_conformation,
+        sequence_number__in=[r['sequence_number'] for r in residues]).values_list('sequence_number', 'id'))
+    new_residues = []
+    updated_residues = []
+    for r in residues:
+        residue = Residue(protein_conformation=protein_conformation, sequence_number=r['sequence_number'],
+            amino_acid=r['amino_acid'], protein_segment=r['protein_segment'],
+            generic_number_id=registry.get_id(r['generic_number']),
+            display_generic_number_id=registry.get_id(r['display_generic_number']))
+        if r['sequence_number'] in existing:
+            residue.pk = existing[r['sequence_number']]
+            updated_residues.append(residue)
         else:
-            try:
-                gn, created = ResidueGenericNumber.objects.get_or_create(
-                    scheme=protein_conformation.protein.residue_numbering_scheme,
-                    label=gnl, defaults=rns_defaults)
-                # if created:
-                #     logger.info('Created display generic number {}'.format(gn.label))
-            except IntegrityError:
-                gn = ResidueGenericNumber.objects.get(
-                    scheme=protein_conformation.protein.residue_numbering_scheme, label=gnl)
-            rvalues['display_generic_number'] = schemes[ns]['generic_numbers'][gnl] = gn
-            
-
-        # UPDATE or CREATE the residue
-    # bulk_r = Residue(protein_conformation=protein_conformation,sequence_number=sequence_number,defaults = rvalues)
-    bulk_r = Residue(protein_conformation=protein_conformation,sequence_number=sequence_number, amino_acid = rvalues['amino_acid'],
-        display_generic_number = rvalues['display_generic_number'],
-        generic_number = rvalues['generic_number'], protein_segment = segment)
-    # r, created = Residue.objects.update_or_create(protein_conformation=protein_conformation,
-    #     sequence_number=sequence_number, defaults = rvalues)
-
-
-    # alternative generic numbers
-    # r.alternative_generic_numbers.clear() # remove any existing relations
-    bulk_add_alt = []
-    if (numbers and 'alternative_generic_numbers' in numbers):
-        for alt_scheme, alt_num in numbers['alternative_generic_numbers'].items():
-            if alt_num in schemes[alt_scheme]['generic_numbers']:
-                argn = schemes[alt_scheme]['generic_numbers'][alt_num]
-            else:
-                try:
-                    argn, created = ResidueGenericNumber.objects.get_or_create(
-                        scheme=ResidueNumberingScheme.objects.get(slug=alt_scheme), label=alt_num,
-                        defaults=rns_defaults)
-                except IntegrityError:
-                    argn = ResidueGenericNumber.objects.get(
-                        scheme=ResidueNumberingScheme.objects.get(slug=alt_scheme), label=alt_num)
-                schemes[alt_scheme]['generic_numbers'][alt_num] = argn
-            try:
-                bulk_add_alt.append(argn)
-                # r.alternative_generic_numbers.add(argn)
-            except IntegrityError:
-                print('argn already added?')
-                pass
-                # print('argn already added?')
-
-    return [bulk_r,bulk_add_alt]
+            new_residues.append(residue)
+
+    ThroughModel = Residue.alternative_generic_numbers.through
+    with transaction.atomic():
+        # the primary keys of created residues are set by the insert (PostgreSQL)
+        Residue.objects.bulk_create(new_residues, batch_size=5000)
+        Residue.objects.bulk_update(updated_residues, ['amino_acid', 'protein_segment', 'generic_number',
+            'display_generic_number'], batch_size=5000)
+        ThroughModel.objects.filter(residue_id__in=[r.pk for r in updated_residues]).delete()
+        residue_ids = {residue.sequence_number: residue.pk for residue in new_residues + updated_residues}
+        ThroughModel.objects.bulk_create([ThroughModel(residue_id=residue_ids[r['sequence_number']],
+            residuegenericnumber_id=registry.get_id(key)) for r in residues
+            for key in r['alternative_generic_numbers']], batch_size=5000)
+    return len(new_residues)
+
+_generic_number_registry = None
+
+def get_generic_number_registry():
+    """Registry shared by the residue builds of this process, loaded on first use."""
+    global _generic_number_registry
+    if _generic_number_registry is None:
+        _generic_number_registry = GenericNumberRegistry()
+    return _generic_number_registry
+
+def get_residue_entry(protein_conformation, segment, schemes, residue, b_and_c, registry=None):
+    """Residue entry of an annotated residue (pos, aa and numbers with the generic and BW numbers)."""
+    numbers = residue['numbers']
+    if 'generic_number' in numbers:
+        numbers = format_generic_numbers(protein_conformation.protein.residue_numbering_scheme, schemes,
+                    residue['pos'], numbers['generic_number'], numbers['bw'], b_and_c)
+    return residue_entry(registry or get_generic_number_registry(), protein_conformation, segment, residue['pos'],
+        residue['aa'], numbers)
 
 
 def get_gprotein_non_gns(consensus_prot_conf, segment, residues_to_update):
@@ -180,10 +196,10 @@ def get_gprotein_non_gns(consensus_prot_conf, segment, residues_to_update):
     return non_gns
 
 
-def create_or_update_residues_in_segment(protein_conformation, segment, start, aligned_start, end, aligned_end,
-    schemes, ref_positions, protein_anomalies, disregard_db_residues, signprot=False):
-    logger = logging.getLogger('build')
-    rns_defaults = {'protein_segment': segment} # default numbering scheme for creating generic numbers
+def get_residues_in_segment(protein_conformation, segment, start, aligned_start, end, aligned_end, schemes,
+    ref_positions, protein_anomalies, disregard_db_residues, signprot=False, registry=None):
+    """Residue entries (see residue_entry) of the residues from start to end of a protein conformation."""
+    registry = registry or get_generic_number_registry()
 
     # fetch the residues that should be updated
     residues_to_update = Residue.objects.filter(Q(sequence_number__gte=start) & Q(sequence_number__lte=end),
@@ -203,28 +219,18 @@ def create_or_update_residues_in_segment(protein_conformation, segment, start, a
     if aligned_end:
         residues_after = len(residues_to_update) - (end - aligned_end)
     else:
-        residues_after = 0 
+        residues_after = 0
 
-    # default numbering scheme
-    ns = settings.DEFAULT_NUMBERING_SCHEME
-    ns_obj = ResidueNumberingScheme.objects.get(slug=ns)
-    
+    signprot_segments = set()
     if signprot:
         non_gns = get_gprotein_non_gns(protein_conformation, segment, residues_to_update)
-    created_residues = 0
+        signprot_segments = set(ProteinSegment.objects.filter(proteinfamily=signprot).values_list('slug', flat=True))
+    residues = []
     for res_num, residue in enumerate(residues_to_update, start=1):
         sequence_number = residue[0]
-        
-        # dictionary of values for updating/creating a residue
-        rvalues = {}
-        rvalues['protein_segment'] = segment
-        rvalues['amino_acid'] = residue[1]
 
         # generic numbers
         numbers = None
-        rvalues['generic_number'] = None
-        rvalues['display_generic_number'] = None
-
         if (segment.slug in settings.REFERENCE_POSITIONS
             and settings.REFERENCE_POSITIONS[segment.slug] in ref_positions
             and res_num > residues_before 
@@ -232,89 +238,23 @@ def create_or_update_residues_in_segment(protein_conformation, segment, start, a
             numbers = format_generic_numbers_old(protein_conformation.protein.residue_numbering_scheme, schemes,
                 sequence_number, settings.REFERENCE_POSITIONS[segment.slug],
                 ref_positions[settings.REFERENCE_POSITIONS[segment.slug]], protein_anomalies)
-            
-            # main generic number
-            if 'generic_number' in numbers:
-                gnl = numbers['generic_number']
-                if gnl in schemes[ns]['generic_numbers']:
-                    rvalues['generic_number'] = schemes[ns]['generic_numbers'][gnl]
-                else:
-                    try:
-                        gn, created = ResidueGenericNumber.objects.get_or_create(
-                            scheme=ns_obj, label=gnl, defaults=rns_defaults)
-                        if created:
-                            logger.info('Created generic number {}'.format(gn.label))
-                    except IntegrityError:
-                        gn = ResidueGenericNumber.objects.get(scheme=ns_obj, label=gnl)
-                    rvalues['generic_number'] = schemes[ns]['generic_numbers'][gnl] = gn
-
-            # equivalent to main generic number
-            if 'equivalent' in numbers:
-                try:
-                    gn_equivalent, created = ResidueGenericNumberEquivalent.objects.get_or_create(
-                        default_generic_number=rvalues['generic_number'],
-                        scheme=protein_conformation.protein.residue_numbering_scheme,
-                        defaults={'label': numbers['equivalent']})
-                    if created:
-                        logger.info('Created generic number equivalent {} ({}) for scheme {}'.format(
-                            numbers['equivalent'], numbers['generic_number'],
-                            protein_conformation.protein.residue_numbering_scheme))
-                except IntegrityError:
-                    try:
-                        print("Get",rvalues['generic_number'],protein_conformation.protein.residue_numbering_scheme,)
-                        gn_equivalent = ResidueGenericNumberEquivalent.objects.get(
-                            default_generic_number=rvalues['generic_number'],
-                            scheme=protein_conformation.protein.residue_numbering_scheme)
-                    except:
-                        print("failed gn_equivalent", rvalues['generic_number'], protein_conformation.protein.residue_numbering_scheme)
-            
-            # display generic number
-            if 'display_generic_number' in numbers:
-                ns = protein_conformation.protein.residue_numbering_scheme.slug
-                gnl = numbers['display_generic_number']
-                if gnl in schemes[ns]['generic_numbers']:
-                    rvalues['display_generic_number'] = schemes[ns]['generic_numbers'][gnl]
-                else:
-                    try:
-                        gn, created = ResidueGenericNumber.objects.get_or_create(
-                            scheme=protein_conformation.protein.residue_numbering_scheme,
-                            label=gnl, defaults=rns_defaults)
-                        if created:
-                            logger.info('Created generic number {}'.format(gn.label))
-                    except IntegrityError:
-                        gn = ResidueGenericNumber.objects.get(
-                            scheme=protein_conformation.protein.residue_numbering_scheme, label=gnl)
-                    rvalues['display_generic_number'] = schemes[ns]['generic_numbers'][gnl] = gn
-        elif segment.slug in ProteinSegment.objects.filter(proteinfamily=signprot).values_list('slug', flat=True):
-            # if protein_conformation.protein.entry_name!='alpha-consensus':
-            rvalues['display_generic_number'] = non_gns[res_num-1]
-            rvalues['generic_number'] = non_gns[res_num-1]
+        entry = residue_entry(registry, protein_conformation, segment, sequence_number, residue[1], numbers)
 
-        # UPDATE or CREATE the residue
-        r, created = Residue.objects.update_or_create(protein_conformation=protein_conformation,
-            sequence_number=sequence_number, defaults = rvalues)
-        if created:
-            created_residues += 1
-
-        # alternative generic numbers
-        r.alternative_generic_numbers.clear() # remove any existing relations
-        if (segment.slug in settings.REFERENCE_POSITIONS
-            and settings.REFERENCE_POSITIONS[segment.slug] in ref_positions
-            and numbers and 'alternative_generic_numbers' in numbers):
-            for alt_scheme, alt_num in numbers['alternative_generic_numbers'].items():
-                if alt_num in schemes[alt_scheme]['generic_numbers']:
-                    argn = schemes[alt_scheme]['generic_numbers'][alt_num]
-                else:
-                    try:
-                        argn, created = ResidueGenericNumber.objects.get_or_create(
-                            scheme=ResidueNumberingScheme.objects.get(slug=alt_scheme), label=alt_num,
-                            defaults=rns_defaults)
-                    except IntegrityError:
-                        argn = ResidueGenericNumber.objects.get(
-                            scheme=ResidueNumberingScheme.objects.get(slug=alt_scheme), label=alt_num)
-                    schemes[alt_scheme]['generic_numbers'][alt_num] = argn
-                r.alternative_generic_numbers.add(argn)
+        if numbers is None and segment.slug in signprot_segments:
+            # if protein_conformation.protein.entry_name!='alpha-consensus':
+            gn = non_gns[res_num-1]
+            if gn:
+                entry['generic_number'] = entry['display_generic_number'] = (gn.scheme_id, gn.label)
+        residues.append(entry)
+    return residues
 
+def create_or_update_residues_in_segment(protein_conformation, segment, start, aligned_start, end, aligned_end,
+    schemes, ref_positions, protein_anomalies, disregard_db_residues, signprot=False, registry=None):
+    logger = logging.getLogger('build')
+    registry = registry or get_generic_number_registry()
+    residues = get_residues_in_segment(protein_conformation, segment, start, aligned_start, end, aligned_end, schemes,
+        ref_positions, protein_anomalies, disregard_db_residues, signprot, registry)
+    created_residues = save_residues(protein_conformation, residues, registry)
     if created_residues:
         logger.info('Created {} residues for {} of {}'.format(created_residues, segment, protein_conformation))
 
@@ -3,6 +3,7 @@ A module for generating sequence signatures for the given two sets of proteins.
 """
 from django.conf import settings
 #from django.core import exceptions
+from django.db.models import Q
 
 from alignment.functions import strip_html_tags, get_format_props, prepare_aa_group_preference, zscales_color_scale
 Alignment = getattr(__import__(
@@ -18,11 +19,11 @@ from signprot.models import SignprotComplex
 
 from collections import OrderedDict
 from copy import deepcopy
+from multiprocessing import Pool
 import numpy as np
 from operator import itemgetter
 import re
 from scipy.stats import t
-import time
 
 class SequenceSignature:
     """
@@ -1182,6 +1183,7 @@ class SignatureMatch():
                     self.residue_to_feat['-'].add(fidx)
 
         self._find_norm()
+        self._prepare_scoring()
         if protein_set_pos:
             self.scores_pos, self.signatures_pos, self.scored_proteins_pos = self.score_protein_set(self.protein_set_pos, signprot)
         if protein_set_neg:
@@ -1271,17 +1273,123 @@ class SignatureMatch():
         self.signature_consensus = signature
 
 
-    def score_protein_class(self, pclass_slug='001', signprot=False):
+    def _prepare_scoring(self):
+        """
+        Collect the signature feature and value of every relevant generic number position, and the feature membership
+        of every amino acid, as arrays for scoring many proteins at once.
+        """
+        self.score_positions = []
+        feats = []
+        values = []
+        for segment in self.relevant_segments:
+            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
+            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
+            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
+                feat = signature_map[idx]
+                val = self.signature_matrix_filtered[segment][feat][idx]
+                self.score_positions.append([
+                    segment,
+                    pos,
+                    list(AMINO_ACID_GROUPS.keys())[feat],
+                    list(AMINO_ACID_GROUP_NAMES.values())[feat],
+                    val,
+                    ])
+                feats.append(feat)
+                values.append(val)
+        self.score_feats = np.array(feats, dtype=int)
+        self.score_values = np.array(values, dtype=float)
+        self.score_gaps = np.array([x[3] == 'Gap' for x in self.score_positions], dtype=bool)
+
+        # amino acid code -> feature membership, the last row is used for unknown amino acids
+        self.score_amino_acids = dict([(aa, i) for i, aa in enumerate(self.residue_to_feat)])
+        self.score_feature_matrix = np.zeros((len(self.score_amino_acids) + 1, len(AMINO_ACID_GROUPS)), dtype=bool)
+        for aa, aa_feats in self.residue_to_feat.items():
+            self.score_feature_matrix[self.score_amino_acids[aa], list(aa_feats)] = True
+
+    def residue_matrix(self, pcfs):
+        """
+        Fetch the amino acids of the protein conformations at the relevant generic numbers as a
+        (protein conformations x positions) matrix of amino acid codes, -1 marks a missing residue.
+        """
+        pcf_index = dict([(pcf.pk, i) for i, pcf in enumerate(pcfs)])
+        gn_index = dict([(x[1], i) for i, x in enumerate(self.score_positions)])
+        unknown = len(self.score_amino_acids)
+
+        residue_codes = np.full((len(pcf_index), len(gn_index)), -1, dtype=int)
+        resi = Residue.objects.filter(
+            protein_conformation__in=list(pcf_index),
+            generic_number__label__in=list(gn_index)
+            ).values_list('protein_conformation_id', 'generic_number__label', 'amino_acid')
+        for pcf, gn, amino_acid in resi:
+            residue_codes[pcf_index[pcf], gn_index[gn]] = self.score_amino_acids.get(amino_acid, unknown)
+        return residue_codes
+
+    def score_proteins(self, pcfs, proc=1):
+        """
+        Score a list of protein conformations against the signature.
+
+        Returns dicts of protein conformation -> (score, normalized score) and protein conformation -> signature match.
+        With proc > 1 the scoring is spread over a process pool.
+        """
+        pcfs = list(pcfs)
+        residue_codes = self.residue_matrix(pcfs)
+        args = (self.score_feats, self.score_values, self.score_gaps, self.score_feature_matrix)
+        if proc > 1 and len(pcfs) > proc:
+            with Pool(proc) as pool:
+                chunks = pool.starmap(score_residue_matrix,
+                    [(chunk,) + args for chunk in np.array_split(residue_codes, proc)])
+            scores = np.concatenate([x[0] for x in chunks])
+            matches = np.concatenate([x[1] for x in chunks])
+        else:
+            scores, matches = score_residue_matrix(residue_codes, *args)
 
-        start = time.time()
         protein_scores = {}
         protein_signature_match = {}
-        class_proteins = Protein.objects.filter(
-            species__common_name='Human',
-            family__slug__startswith=pclass_slug
-            ).exclude(
-                id__in=[x.id for x in self.protein_set]
-                )
+        for i, pcf in enumerate(pcfs):
+            protein_scores[pcf] = (scores[i]/100, scores[i]/self.norm*100)
+            protein_signature_match[pcf] = self.signature_match(residue_codes[i], matches[i])
+        return protein_scores, protein_signature_match
+
+    def signature_match(self, residue_codes, matches):
+        """
+        Prepare the per position signature match of a single protein conformation for display.
+        """
+        amino_acids = list(self.score_amino_acids.keys()) + ['X']
+        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
+        for position, code, match in zip(self.score_positions, residue_codes, matches):
+            segment, pos, feat_abr, feat_name, val = position
+            if code >= 0:
+                amino_acid = amino_acids[code]
+                if match:
+                    color = "#808080" if val > 0 else "white"
+                else:
+                    color = "white" if val > 0 else "#808080"
+            else:
+                amino_acid = '-'
+                if feat_name == 'Gap' and val > 0:
+                    color = "#808080"
+                else:
+                    color = "white"
+            consensus_match[segment].append([feat_abr, feat_name, val, color, amino_acid, pos])
+        return consensus_match
+
+    def score_protein_class(self, pclass_slug='001', signprot=False, species='Human', proc=1):
+        """
+        Score all wild type proteins of one or more classes that are not part of the signature protein sets.
+
+        @param: pclass_slug - class slug, or a list of class slugs
+        @param: species - species common name, None to score the proteins of all species
+        @param: proc - number of processes to score with
+        """
+        if isinstance(pclass_slug, str):
+            pclass_slug = [pclass_slug]
+        class_filter = Q()
+        for slug in pclass_slug:
+            class_filter |= Q(family__slug__startswith=slug)
+
+        class_proteins = Protein.objects.filter(class_filter).exclude(id__in=[x.id for x in self.protein_set])
+        if species:
+            class_proteins = class_proteins.filter(species__common_name=species)
 
         if signprot:
             complex_objs = SignprotComplex.objects.prefetch_related('structure__protein_conformation__protein').values_list('structure__protein_conformation__protein__parent_id', flat=True)
@@ -1293,46 +1401,18 @@ class SignatureMatch():
             ).filter(
                 protein__in=class_proteins,
                 protein__sequence_type__slug='wt'
-            ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein','protein__family__parent','protein__species')
+            ).exclude(protein__entry_name__endswith='-consensus').select_related('protein__family__parent','protein__species')
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
+        protein_scores, protein_signature_match = self.score_proteins(class_a_pcf, proc)
 
-        resi = Residue.objects.filter(
-            protein_conformation__in=class_a_pcf,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in class_a_pcf:
-            # p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf, resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            # p_end = time.time()
-            # print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
-        end = time.time()
         self.protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
         for prot in self.protein_report.items():
             self.protein_signatures[prot[0]] = protein_signature_match[prot[0]]
         self.scored_proteins = list(self.protein_report.keys())
-        print("Total time: ", end - start)
 
 
     def score_protein_set(self, protein_set, signprot=False):
 
-        start = time.time()
-        protein_scores = {}
-        protein_signature_match = {}
-
         seq_type_slug=['wt']
         if signprot:
             seq_type_slug.append('mod')
@@ -1343,157 +1423,39 @@ class SignatureMatch():
             ).filter(
                 protein__in=protein_set,
                 protein__sequence_type__slug__in=seq_type_slug
-                ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein')
+                ).exclude(protein__entry_name__endswith='-consensus').select_related('protein')
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
+        protein_scores, protein_signature_match = self.score_proteins(pcfs)
 
-        resi = Residue.objects.filter(
-            protein_conformation__in=pcfs,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in pcfs:
-            # p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf,resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            # p_end = time.time()
-            # print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
-        end = time.time()
         protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
         protein_signatures = OrderedDict()
         for prot in protein_report.items():
             protein_signatures[prot[0]] = protein_signature_match[prot[0]]
         scored_proteins = list(protein_report.keys())
-        print("Total time: ", end - start)
 
         return (protein_report, protein_signatures, scored_proteins)
 
-    def score_protein(self, pcf,resi_dict_all):
-        prot_score = 0.0
-        #norm = 0.0
-        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
-
-        if resi_dict_all == None or pcf.pk not in resi_dict_all:
-            relevant_gns_total = []
-            for segment in  self.relevant_segments:
-                for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                    relevant_gns_total.append(pos)
-            resi = Residue.objects.filter(
-                protein_conformation=pcf,
-                generic_number__label__in=relevant_gns_total
-                ).prefetch_related('generic_number')
-            resi_dict = {}
-            for r in resi:
-                if r.generic_number:
-                    resi_dict[r.generic_number.label] = r
-        else:
-            resi_dict = resi_dict_all[pcf.pk]
-        for segment in self.relevant_segments:
-            tmp = []
-            # signature_map = self.signature_matrix_filtered[segment].argmax(axis=0)
-            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
-            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
 
-            #norm += np.sum(np.amax(self.signature_matrix_filtered[segment], axis=0))
+def score_residue_matrix(residue_codes, feats, values, gaps, feature_matrix):
+    """
+    Score a (proteins x positions) matrix of amino acid codes against signature features and values.
 
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                feat = signature_map[idx]
-                feat_abr = list(AMINO_ACID_GROUPS.keys())[feat]
-                feat_name = list(AMINO_ACID_GROUP_NAMES.values())[feat]
-                val = self.signature_matrix_filtered[segment][feat][idx]
-                if pos in resi_dict:
-                    res = resi_dict[pos]
-                    if feat in self.residue_to_feat[res.amino_acid]:
-                        if val > 0:
-                            prot_score += val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            #"green",
-                            "#808080",
-                            res.amino_acid, pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                res.amino_acid,
-                                pos
-                                ])
-                    else:
-                        #David doesn't want the negative values in the score
-                        # prot_score -= val
-                        if val < 0:
-                            prot_score -= val #if a receptor does NOT have the negative property, add the score
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            res.amino_acid,
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                # "green",
-                                "#808080",
-                                res.amino_acid,
-                                pos
-                                ])
-                else:
-                    if feat_name == 'Gap':
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "green",
-                            "#808080",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-                        prot_score += val
-                    else:
-                        #David doesn't want the negative values in the score
-                        #prot_score -= val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-            consensus_match[segment] = tmp
-        return (prot_score/100, prot_score/self.norm*100, consensus_match)
+    A present residue scores the positive value when it has the signature feature, and the absolute negative value
+    when it does not have it. A missing residue only scores at gap features. Returns the scores and a matrix that
+    marks the residues that have the signature feature.
+    """
+    present = residue_codes >= 0
+    matches = feature_matrix[np.where(present, residue_codes, feature_matrix.shape[0] - 1), feats] & present
+    contributions = np.where(
+        present,
+        np.where(matches, np.maximum(values, 0), np.where(values < 0, -values, 0)),
+        np.where(gaps, values, 0)
+        )
+    # add up the positions one by one, keeping the summation order of the per protein scoring
+    scores = np.zeros(residue_codes.shape[0])
+    for col in range(contributions.shape[1]):
+        scores += contributions[:, col]
+    return scores, matches
 
 def signature_score_excel(workbook, scores, protein_signatures, signature_filtered, relevant_gn, relevant_segments, numbering_schemes, scores_positive=None, scores_negative=None, signatures_positive=None, signatures_negative=None):
 
@@ -250,11 +250,15 @@ def render_alignment(request):
     a.load_proteins_from_selection(simple_selection)
     a.load_segments_from_selection(simple_selection)
 
+    # evaluate sites with the site search index first, so that only the matching proteins are aligned
+    indexed = a.evaluate_indexed_sites(request)
+
     # build the alignment data matrix
     a.build_alignment()
 
-    # evaluate sites
-    a.evaluate_sites(request)
+    # evaluate sites on the alignment when the index does not cover the selection
+    if not indexed:
+        a.evaluate_sites(request)
 
     num_of_sequences = len(a.proteins)
     num_of_non_matching_sequences = len(a.non_matching_proteins)
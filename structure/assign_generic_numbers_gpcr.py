@@ -208,12 +208,13 @@ class GenericNumbering(object):
         io.save("%s_GPCRDB%s" %(root, ext))
 
 
-    def assign_generic_numbers(self):
+    def assign_generic_numbers(self, alignments=None):
 
-        alignments = {}
-        #blast search goes first, looping through all the chains
-        for chain in self.pdb_seq.keys():
-            alignments[chain] = self.blast.run(self.pdb_seq[chain])
+        #blast search goes first, all the chains are searched at once
+        #alignments by chain can be passed in when several structures are searched together
+        if alignments is None:
+            chains = list(self.pdb_seq.keys())
+            alignments = dict(zip(chains, self.blast.run_batch([self.pdb_seq[chain] for chain in chains])))
 
         #map the results onto pdb sequence for every sequence pair from blast
         for chain in self.pdb_seq.keys():
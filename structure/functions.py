@@ -1,5 +1,6 @@
 ﻿from Bio.Blast import NCBIXML, NCBIWWW
 from Bio.PDB import PDBParser
+from Bio import SeqIO
 from Bio.PDB.PDBIO import Select
 import Bio.PDB.Polypeptide as polypeptide
 from Bio.PDB.AbstractPropertyMap import AbstractPropertyMap
@@ -26,7 +27,7 @@ import tempfile
 import logging
 import math
 import urllib
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import Bio.PDB as PDB
 import csv
 # from openpyxl import Workbook
@@ -42,6 +43,18 @@ logger = logging.getLogger("protwis")
 
 ATOM_FORMAT_STRING="%s%5i %-4s%c%3s %c%4i%c   %8.3f%8.3f%8.3f%s%6.2f      %4s%2s%2s\n"
 
+# BLAST hits as returned by BlastSearch, with the attributes of the Bio.Blast records that are in use
+BlastHit = namedtuple('BlastHit', ['hit_id', 'hit_def', 'length', 'hsps'])
+BlastHsp = namedtuple('BlastHsp', ['score', 'bits', 'expect', 'identities', 'positives', 'gaps', 'align_length',
+    'query', 'match', 'sbjct', 'query_start', 'query_end', 'sbjct_start', 'sbjct_end'])
+
+# results of earlier searches of this process by (database, database version, number of results, sequence)
+blast_cache = OrderedDict()
+BLAST_CACHE_SIZE = 10000
+
+# database sequences by database path, see BlastSearch.load_database_sequences
+blast_database_sequences = {}
+
 #==============================================================================
 # I have put it into separate class for the sake of future uses
 class BlastSearch(object):
@@ -61,30 +74,139 @@ class BlastSearch(object):
     #alignments
     def run (self, input_seq):
 
-        output = []
+        return self.run_batch([input_seq])[0]
+
+    #takes a list of sequences and returns a list of results as returned by run,
+    #all sequences that are not cached are searched with a single blastp process,
+    #sequences matched exactly are only searched against their matching database
+    #sequences
+    def run_batch (self, input_seqs):
+
+        sequences = [str(seq) for seq in input_seqs]
+        version = self.get_database_version()
+        results = {}
+        queries = []
+        exact_queries = []
+        exact_ids = set()
+        for seq in sequences:
+            key = (self.blastdb, version, self.top_results, seq)
+            if seq in results or seq in queries or seq in exact_queries:
+                continue
+            elif key in blast_cache:
+                results[seq] = blast_cache[key]
+            elif not seq:
+                results[seq] = []
+            else:
+                seqid = self.find_exact_match(seq)
+                if seqid:
+                    exact_queries.append(seq)
+                    exact_ids.add(seqid)
+                else:
+                    queries.append(seq)
+
+        if queries:
+            for seq, output in zip(queries, self.run_blast(queries)):
+                results[seq] = output
+        if exact_queries:
+            for seq, output in zip(exact_queries, self.run_blast(exact_queries, sorted(exact_ids))):
+                results[seq] = output
+
+        for seq, output in results.items():
+            blast_cache[(self.blastdb, version, self.top_results, seq)] = output
+        while len(blast_cache) > BLAST_CACHE_SIZE:
+            blast_cache.popitem(last=False)
+
+        return [list(results[seq]) for seq in sequences]
+
+    #searches the sequences with one blastp process, optionally limited to the
+    #database sequences with the given ids (E values are still calculated for
+    #the size of the whole database)
+    def run_blast (self, sequences, seqids=None):
+
+        query = ''.join(['>query_{}\n{}\n'.format(i, seq) for i, seq in enumerate(sequences)])
+        options = []
+        seqidlist = None
+        if seqids:
+            seqidlist = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+            seqidlist.write(''.join([seqid + '\n' for seqid in seqids]))
+            seqidlist.close()
+            options = ['-seqidlist', seqidlist.name, '-dbsize', str(int(self.load_database_sequences()['lengths'].sum()))]
         #Windows has problems with Popen and PIPE
         if sys.platform == 'win32':
             tmp = tempfile.NamedTemporaryFile()
-            logger.debug("Running Blast with sequence: {}".format(input_seq))
-            tmp.write(bytes(str(input_seq) + '\n', 'latin1'))
+            logger.debug("Running Blast with {} sequences".format(len(sequences)))
+            tmp.write(bytes(query, 'latin1'))
             tmp.seek(0)
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, stdin=tmp,
-                stdout=PIPE, stderr=PIPE)
+            blast = Popen(' '.join(['%s -db %s -outfmt 5' % (self.blast_path, self.blastdb)] + options),
+                universal_newlines=True, stdin=tmp, stdout=PIPE, stderr=PIPE)
             (blast_out, blast_err) = blast.communicate()
         else:
         #Rest of the world:
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, shell=True,
+            blast = Popen([self.blast_path, '-db', self.blastdb, '-outfmt', '5'] + options, universal_newlines=True,
                 stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            (blast_out, blast_err) = blast.communicate(input=str(input_seq))
+            (blast_out, blast_err) = blast.communicate(input=query)
+        if seqidlist:
+            os.unlink(seqidlist.name)
 
         if len(blast_err) != 0:
             logger.debug(blast_err)
-        if blast_out!='\n':
-            result = NCBIXML.read(StringIO(blast_out))
-            for aln in result.alignments[:self.top_results]:
-                logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
-                output.append((aln.hit_id, aln))
-        return output
+        outputs = []
+        if blast_out.strip():
+            for result in NCBIXML.parse(StringIO(blast_out)):
+                output = []
+                for aln in result.alignments[:self.top_results]:
+                    logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
+                    hsps = [BlastHsp(h.score, h.bits, h.expect, h.identities, h.positives, h.gaps, h.align_length,
+                        h.query, h.match, h.sbjct, h.query_start, h.query_end, h.sbjct_start, h.sbjct_end)
+                        for h in aln.hsps]
+                    output.append((aln.hit_id, BlastHit(aln.hit_id, aln.hit_def, aln.length, hsps)))
+                outputs.append(output)
+        return outputs + [[] for seq in sequences[len(outputs):]]
+
+    def get_database_version (self):
+
+        #modification time of the database, cached results are dropped when it
+        #is rebuilt
+        for extension in ['.pin', '.fasta']:
+            if os.path.isfile(self.blastdb + extension):
+                return os.path.getmtime(self.blastdb + extension)
+        return None
+
+    def load_database_sequences (self):
+
+        #the sequences the database was built from are stored next to it by
+        #build_blast_database, concatenated into one string for searching
+        version = self.get_database_version()
+        if self.blastdb not in blast_database_sequences or blast_database_sequences[self.blastdb][0] != version:
+            database = None
+            if os.path.isfile(self.blastdb + '.fasta'):
+                records = list(SeqIO.parse(self.blastdb + '.fasta', 'fasta'))
+                lengths = numpy.array([len(r.seq) + 1 for r in records], dtype=int)
+                database = {
+                    'sequences': ''.join([str(r.seq) + '*' for r in records]),
+                    'starts': numpy.cumsum(lengths) - lengths,
+                    'lengths': lengths - 1,
+                    'ids': [r.id for r in records],
+                    'descriptions': [r.description[len(r.id):].strip() for r in records],
+                }
+            blast_database_sequences[self.blastdb] = (version, database)
+        return blast_database_sequences[self.blastdb][1]
+
+    def find_exact_match (self, seq):
+
+        #a sequence found in exactly one database sequence has no better scoring
+        #hit, so only that database sequence has to be searched (only for the top
+        #hit of sequences long enough for a significant E value), returns its id
+        if self.top_results != 1 or len(seq) < 50 or '*' in seq:
+            return None
+        database = self.load_database_sequences()
+        if not database:
+            return None
+        position = database['sequences'].find(seq)
+        if position == -1 or database['sequences'].find(seq, position + 1) != -1:
+            return None
+        index = int(numpy.searchsorted(database['starts'], position, side='right')) - 1
+        return database['ids'][index]
 #==============================================================================
 
 class BlastSearchOnline(object):
@@ -384,35 +506,56 @@ class BackboneSelector():
         [['Y'], ['aro_fe_protein'], ['F']],
         [['S', 'T'], ['polar_acceptor_protein', 'polar_donor_protein'], ['S', 'T']],]
 
-    def __init__(self, ref_pdbio_struct, fragment, use_similar=False):
+    def __init__(self, ref_pdbio_struct, fragment, use_similar=False, alt_pdbio_struct=None, ref_residues=None):
 
         self.ref_atoms = []
         self.alt_atoms = []
 
-        self.ref_atoms = self.select_ref_atoms(fragment, ref_pdbio_struct, use_similar)
-        self.alt_atoms = self.select_alt_atoms(PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(str(fragment.rotamer.pdbdata)))[0])
+        self.ref_atoms = self.select_ref_atoms(fragment, ref_pdbio_struct, use_similar, ref_residues)
+        if alt_pdbio_struct is None:
+            alt_pdbio_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(str(fragment.rotamer.pdbdata)))[0]
+        self.alt_atoms = self.select_alt_atoms(alt_pdbio_struct)
 
 
-    def select_ref_atoms(self, fragment, ref_pdbio_struct, use_similar=False):
-
+    @classmethod
+    def get_residue_index(cls, ref_pdbio_struct):
+        """Residues of the structure by generic number, to select the reference atoms of many fragments."""
+        residues = OrderedDict()
         for chain in ref_pdbio_struct:
             for res in chain:
                 try:
-                    gn = self.get_generic_number(res)
-                    if gn == fragment.rotamer.residue.display_generic_number.label:
-                        # logger.info("Ref {}:{}\tFragment {}:{}".format(polypeptide.three_to_one(res.resname), self.get_generic_number(res), fragment.rotamer.residue.amino_acid, fragment.rotamer.residue.display_generic_number.label))
-                        if polypeptide.three_to_one(res.resname) == fragment.rotamer.residue.amino_acid:
-                            return [res['CA'], res['N'], res['O']]
-                        else:
-                            if use_similar:
-                                for rule in self.similarity_rules:
-                                    if polypeptide.three_to_one(res.resname) in rule[self.similarity_dict["target_residue"]] and fragment.rotamer.residue.amino_acid in rule[self.similarity_dict["target_residue"]] and fragment.interaction_type.slug in rule[self.similarity_dict["interaction_type"]]:
-                                        return [res['CA'], res['N'], res['O']]
-                        # else:
-                        #     if fragment.interaction_type.slug not in ['acc', 'hyd']:
-                        #         return [res['CA'], res['N'], res['O']]
+                    residues.setdefault(cls.get_generic_number(res), []).append(res)
                 except Exception as msg:
                     continue
+        return residues
+
+
+    def select_ref_atoms(self, fragment, ref_pdbio_struct, use_similar=False, ref_residues=None):
+
+        if ref_residues is not None:
+            try:
+                candidates = ref_residues.get(fragment.rotamer.residue.display_generic_number.label, [])
+            except Exception as msg:
+                return []
+        else:
+            candidates = [res for chain in ref_pdbio_struct for res in chain]
+        for res in candidates:
+            try:
+                gn = self.get_generic_number(res)
+                if gn == fragment.rotamer.residue.display_generic_number.label:
+                    # logger.info("Ref {}:{}\tFragment {}:{}".format(polypeptide.three_to_one(res.resname), self.get_generic_number(res), fragment.rotamer.residue.amino_acid, fragment.rotamer.residue.display_generic_number.label))
+                    if polypeptide.three_to_one(res.resname) == fragment.rotamer.residue.amino_acid:
+                        return [res['CA'], res['N'], res['O']]
+                    else:
+                        if use_similar:
+                            for rule in self.similarity_rules:
+                                if polypeptide.three_to_one(res.resname) in rule[self.similarity_dict["target_residue"]] and fragment.rotamer.residue.amino_acid in rule[self.similarity_dict["target_residue"]] and fragment.interaction_type.slug in rule[self.similarity_dict["interaction_type"]]:
+                                    return [res['CA'], res['N'], res['O']]
+                    # else:
+                    #     if fragment.interaction_type.slug not in ['acc', 'hyd']:
+                    #         return [res['CA'], res['N'], res['O']]
+            except Exception as msg:
+                continue
         return []
 
 
@@ -427,18 +570,20 @@ class BackboneSelector():
         return []
 
 
-    def get_generic_number(self, res):
+    @classmethod
+    def get_generic_number(cls, res):
 
         if 'CA' not in res:
             return 0.0
         if 0 < res['CA'].get_bfactor() < 8.1:
-            return "{:.2f}x{!s}".format(res['N'].get_bfactor(), self._get_fraction_string(res['CA'].get_bfactor()))
+            return "{:.2f}x{!s}".format(res['N'].get_bfactor(), cls._get_fraction_string(res['CA'].get_bfactor()))
         if -8.1 < res['CA'].get_bfactor() < 0:
-            return "{:.2f}x{!s}".format(res['N'].get_bfactor(),  self._get_fraction_string(res['CA'].get_bfactor() - 0.001))
+            return "{:.2f}x{!s}".format(res['N'].get_bfactor(),  cls._get_fraction_string(res['CA'].get_bfactor() - 0.001))
         return 0.0
 
     #TODO: Is this function really neccessary?
-    def _get_fraction_string(self, number):
+    @staticmethod
+    def _get_fraction_string(number):
 
         if number > 0:
             return "{:.2f}".format(number).split('.')[1]
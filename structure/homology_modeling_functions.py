@@ -1,4 +1,5 @@
 from django.conf import settings
+from django.core.cache import cache
 
 from protein.models import Protein, ProteinConformation, ProteinAnomaly, ProteinState, ProteinSegment
 from residue.models import Residue
@@ -212,6 +213,13 @@ class GPCRDBParsingPDB(object):
             @param filename: str, filename of pdb to be parsed. When using filename, leave structure=None).
         '''
         # seq_nums_overwrite_cutoff_dict = {'4PHU':2000, '4LDL':1000, '4LDO':1000, '4QKX':1000, '5JQH':1000, '5TZY':2000, '5KW2':2000}
+        # parsed templates are shared during a homology model build, every call returns its own copy from the cache
+        cache_key = None
+        if structure!=None and filename==None and AlignedReferenceTemplate.template_cache_prefix:
+            cache_key = '{}pdb_array_{}'.format(AlignedReferenceTemplate.template_cache_prefix, structure.pk)
+            output = cache.get(cache_key)
+            if output is not None:
+                return output
         if structure!=None and filename==None:
             io = StringIO(structure.pdb_data.pdb)
         else:
@@ -348,6 +356,8 @@ class GPCRDBParsingPDB(object):
                             except:
                                 found_gn = str(gn)
                             output[found_res.protein_segment.slug][found_gn] = res
+            if cache_key:
+                cache.set(cache_key, output, 60*60*24)
         return output
 
     @staticmethod
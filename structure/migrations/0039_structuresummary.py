@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0038_auto_20211026_0935'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pdb_code', models.CharField(max_length=20, unique=True)),
+                ('data', models.TextField()),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='structure.Structure')),
+            ],
+            options={
+                'db_table': 'structure_summary',
+            },
+        ),
+    ]
@@ -110,6 +110,116 @@ class Structure(models.Model):
         db_table = 'structure'
 
 
+class StructureSummary(models.Model):
+    # Denormalized /services/structure/ entry (JSON) of a structure, refreshed by build_structure_summaries,
+    # build_structures and assign_structure_states
+    structure = models.OneToOneField('Structure', on_delete=models.CASCADE, related_name='summary')
+    pdb_code = models.CharField(max_length=20, unique=True)
+    data = models.TextField()
+
+    def __str__(self):
+        return self.pdb_code
+
+    @classmethod
+    def refresh(cls, structures=None, chunk_size=500):
+        """(Re)build the summaries of the given structures (all by default)"""
+        from django.db import transaction
+
+        if structures is None:
+            structures = Structure.objects.all()
+        structure_ids = list(structures.values_list('id', flat=True))
+
+        for i in range(0, len(structure_ids), chunk_size):
+            chunk_ids = structure_ids[i:i+chunk_size]
+            summaries = [cls(structure_id=structure_id, pdb_code=pdb_code, data=data)
+                for structure_id, pdb_code, data in cls.render(Structure.objects.filter(id__in=chunk_ids), chunk_size)]
+            with transaction.atomic():
+                cls.objects.filter(structure_id__in=chunk_ids).delete()
+                cls.objects.bulk_create(summaries)
+
+    @classmethod
+    def render(cls, structures, chunk_size=500):
+        """Generates (structure id, pdb code, summary JSON) of the given structures, in the order of structures"""
+        from django.db.models import Prefetch
+        from interaction.models import StructureLigandInteraction
+        from rest_framework.utils.encoders import JSONEncoder
+        import json
+
+        structure_ids = list(structures.values_list('id', flat=True))
+        for i in range(0, len(structure_ids), chunk_size):
+            chunk = Structure.objects.filter(id__in=structure_ids[i:i+chunk_size]).select_related('pdb_code',
+                'protein_conformation__protein__parent__family', 'protein_conformation__protein__parent__species',
+                'publication__web_link__web_resource', 'structure_type', 'state', 'signprot_complex__protein',
+                'signprot_complex__beta_protein', 'signprot_complex__gamma_protein').prefetch_related(
+                Prefetch('structureligandinteraction_set', to_attr='annotated_ligands',
+                    queryset=StructureLigandInteraction.objects.filter(annotated=True).select_related(
+                    'ligand__properities__ligand_type', 'ligand_role')),
+                Prefetch('extra_proteins', queryset=StructureExtraProteins.objects.select_related('wt_protein__family')))
+            chunk = {structure.id: structure for structure in chunk}
+
+            # Same rendering as the API JSON renderer
+            for structure_id in structure_ids[i:i+chunk_size]:
+                if structure_id not in chunk:
+                    continue
+                structure = chunk[structure_id]
+                yield structure_id, structure.pdb_code.index, json.dumps(cls.summarize(structure), cls=JSONEncoder,
+                    ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def summarize(structure):
+        # essential fields
+        structure_data = {
+            'pdb_code': structure.pdb_code.index,
+            'protein': structure.protein_conformation.protein.parent.entry_name,
+            'family': structure.protein_conformation.protein.parent.family.slug,
+            'species': structure.protein_conformation.protein.parent.species.latin_name,
+            'preferred_chain': structure.preferred_chain,
+            'resolution': structure.resolution,
+            'publication_date': structure.publication_date,
+            'type': structure.structure_type.name,
+            'state': structure.state.name,
+            'distance': structure.distance,
+        }
+
+        # publication
+        if structure.publication:
+            structure_data['publication'] = structure.publication.web_link.__str__()
+        else:
+            structure_data['publication'] = None
+
+        # ligand
+        ligands = []
+        for interaction in structure.annotated_ligands:
+            ligand = {}
+            if interaction.ligand.name:
+                ligand['name'] = interaction.ligand.name
+            if interaction.ligand.properities.ligand_type and interaction.ligand.properities.ligand_type.name:
+                ligand['type'] = interaction.ligand.properities.ligand_type.name
+            if interaction.ligand_role and interaction.ligand_role.name:
+                ligand['function'] = interaction.ligand_role.name
+            if ligand:
+                ligands.append(ligand)
+        structure_data['ligands'] = ligands
+
+        # signalling protein
+        if structure.signprot_complex:
+            sign_prot = {'type': 'G protein', 'data': {}}
+            sign_prot['data']['entity1'] = {'entry_name':structure.signprot_complex.protein.entry_name, 'chain':structure.signprot_complex.alpha}
+            if structure.signprot_complex.beta_protein:
+                sign_prot['data']['entity2'] = {'entry_name':structure.signprot_complex.beta_protein.entry_name, 'chain':structure.signprot_complex.beta_chain}
+            if structure.signprot_complex.gamma_protein:
+                sign_prot['data']['entity3'] = {'entry_name':structure.signprot_complex.gamma_protein.entry_name, 'chain':structure.signprot_complex.gamma_chain}
+            structure_data['signalling_protein'] = sign_prot
+        for ep in structure.extra_proteins.all():
+            if ep.wt_protein and ep.wt_protein.family.slug.startswith('200'):
+                structure_data['signalling_protein'] = {'type': 'Arrestin', 'data': {'entity1':{'entry_name':ep.wt_protein.entry_name, 'chain':ep.chain}}}
+
+        return structure_data
+
+    class Meta():
+        db_table = 'structure_summary'
+
+
 class StructureComplexProtein(models.Model):
     structure = models.ForeignKey('structure.Structure', on_delete=models.CASCADE)
     protein_conformation = models.ForeignKey('protein.ProteinConformation', on_delete=models.CASCADE)
@@ -391,3 +501,34 @@ class StructureEngineeringDescription(models.Model):
 
     class Meta():
         db_table = "structure_engineering_description"
+
+
+def get_structure_groups(structure_ids = None):
+    """Structure ids per (receptor id, state id), the groups of the precomputed structure group summaries
+
+    The standard receptor, family, class and state groupings of structures are unions of these groups.
+    """
+    structures = Structure.objects.all()
+    if structure_ids is not None:
+        structures = structures.filter(pk__in=list(structure_ids))
+    groups = {}
+    for pk, receptor, state in structures.values_list('pk', 'protein_conformation__protein__parent_id', 'protein_conformation__state_id'):
+        groups.setdefault((receptor, state), []).append(pk)
+    return groups
+
+def get_group_summaries(summaries, structure_ids):
+    """The group summaries (models with receptor, state and get_structures) covering exactly the structures
+
+    Returns None when the structures are not a union of complete summarized groups.
+    """
+    groups = get_structure_groups(structure_ids)
+    if not groups:
+        return None
+    summaries = summaries.filter(receptor_id__in=set(key[0] for key in groups), state_id__in=set(key[1] for key in groups))
+    matched = [summary for summary in summaries if (summary.receptor_id, summary.state_id) in groups]
+    if len(matched) != len(groups):
+        return None
+    for summary in matched:
+        if set(summary.get_structures()) != set(groups[(summary.receptor_id, summary.state_id)]):
+            return None
+    return matched
@@ -13,6 +13,62 @@ from structure.models import Structure
 from interaction.models import ResidueFragmentInteraction
 
 logger = logging.getLogger("protwis")
+
+# parsed fragment structures by ResidueFragmentInteraction id, superposition moves copies of them
+fragment_structure_cache = OrderedDict()
+FRAGMENT_CACHE_SIZE = 5000
+
+
+def superpose_coordinates(ref_coords, alt_coords):
+    """Least squares fit (Kabsch) of a batch of coordinate sets, same convention as Bio.PDB.Superimposer.
+
+    ref_coords and alt_coords are (n, k, 3) arrays of n pairs of k matching atoms. Returns the (n, 3, 3) rotations,
+    (n, 3) translations and the n RMS values, alt_coords @ rot + tran gives the fitted alt coordinates.
+    """
+    ref_coords = np.asarray(ref_coords, dtype=np.float64)
+    alt_coords = np.asarray(alt_coords, dtype=np.float64)
+    ref_center = ref_coords.mean(axis=1)
+    alt_center = alt_coords.mean(axis=1)
+    correlation = np.matmul(np.transpose(alt_coords - alt_center[:, None, :], (0, 2, 1)), ref_coords - ref_center[:, None, :])
+    u, d, vt = np.linalg.svd(correlation)
+    # avoid reflections
+    reflected = np.linalg.det(np.matmul(u, vt)) < 0
+    vt[reflected, 2, :] *= -1
+    rot = np.matmul(u, vt)
+    tran = ref_center - np.matmul(alt_center[:, None, :], rot)[:, 0, :]
+    diff = np.matmul(alt_coords, rot) + tran[:, None, :] - ref_coords
+    rms = np.sqrt((diff ** 2).sum(axis=2).mean(axis=1))
+    return rot, tran, rms
+
+
+def superpose_atom_sets(atom_set_pairs):
+    """Fits every (ref_atoms, alt_atoms) pair, sets with the same number of atoms are fitted in one batch.
+
+    Returns a list of (rot, tran, rms) in the order of the pairs.
+    """
+    results = [None] * len(atom_set_pairs)
+    by_size = OrderedDict()
+    for i, (ref_atoms, alt_atoms) in enumerate(atom_set_pairs):
+        by_size.setdefault(len(ref_atoms), []).append(i)
+    for size, indices in by_size.items():
+        ref_coords = np.array([[atom.get_coord() for atom in atom_set_pairs[i][0]] for i in indices]).reshape(-1, size, 3)
+        alt_coords = np.array([[atom.get_coord() for atom in atom_set_pairs[i][1]] for i in indices]).reshape(-1, size, 3)
+        rot, tran, rms = superpose_coordinates(ref_coords, alt_coords)
+        for j, i in enumerate(indices):
+            results[i] = (rot[j], tran[j], rms[j])
+    return results
+
+
+def transform_atoms(atoms, rot, tran):
+
+    # all alternate locations of disordered atoms are moved, as with Superimposer.apply
+    atoms = [child for atom in atoms for child in (atom.disordered_get_list() if atom.is_disordered() else [atom])]
+    if not atoms:
+        return
+    coords = np.dot(np.array([atom.get_coord() for atom in atoms], dtype=np.float64), rot) + tran
+    for atom, coord in zip(atoms, coords.astype('f')):
+        atom.set_coord(coord)
+
 #==============================================================================  
 class ProteinSuperpose(object):
   
@@ -28,19 +84,38 @@ class ProteinSuperpose(object):
                 gn_assigner = GenericNumbering(structure=self.ref_struct)
                 self.ref_struct = gn_assigner.assign_generic_numbers()
       
-        self.alt_structs = []
+        structs = {}
+        gn_assigners = []
         for alt_id, alt_file in enumerate(alt_files):
             try:
                 tmp_struct = PDBParser(PERMISSIVE=True).get_structure(alt_id, alt_file)[0]
                 if self.selection.generic_numbers != [] or self.selection.helices != []:
                     if not check_gn(tmp_struct):
-                        gn_assigner = GenericNumbering(structure=tmp_struct)
-                        self.alt_structs.append(gn_assigner.assign_generic_numbers())
-                        self.alt_structs[-1].id = alt_id
+                        gn_assigners.append((alt_id, GenericNumbering(structure=tmp_struct)))
                     else:
-                        self.alt_structs.append(tmp_struct)
+                        tmp_struct.id = alt_id
+                        structs[alt_id] = tmp_struct
             except Exception as e:
                 logger.warning("Can't parse the file {!s}\n{!s}".format(alt_id, e))
+        if gn_assigners:
+            #one blast search for the chains of all structures without generic numbers
+            chains = [(alt_id, gn_assigner, chain) for alt_id, gn_assigner in gn_assigners for chain in gn_assigner.pdb_seq.keys()]
+            try:
+                blast_results = gn_assigners[0][1].blast.run_batch([gn_assigner.pdb_seq[chain] for alt_id, gn_assigner, chain in chains])
+            except Exception as e:
+                logger.warning("Blast search of all structures failed, searching them one by one\n{!s}".format(e))
+                blast_results = None
+            for alt_id, gn_assigner in gn_assigners:
+                try:
+                    alignments = None
+                    if blast_results is not None:
+                        alignments = {chain: result for (a_id, assigner, chain), result in zip(chains, blast_results) if a_id == alt_id}
+                    structs[alt_id] = gn_assigner.assign_generic_numbers(alignments)
+                    structs[alt_id].id = alt_id
+                except Exception as e:
+                    logger.warning("Can't assign generic numbers to structure {!s}\n{!s}".format(alt_id, e))
+        #keep the order of the input files, results are matched to the file names by position
+        self.alt_structs = [structs[alt_id] for alt_id in sorted(structs)]
         self.selector = CASelector(self.selection, self.ref_struct, self.alt_structs)
 
     def run (self):
@@ -49,15 +124,23 @@ class ProteinSuperpose(object):
             logger.error("No structures to align!")
             return []
     
-        super_imposer = Superimposer()
+        fit_structs = []
+        atom_set_pairs = []
         for alt_struct in self.alt_structs:
             try:
                 ref, alt = self.selector.get_consensus_atom_sets(alt_struct.id)
-                super_imposer.set_atoms(ref, alt)
-                super_imposer.apply(alt_struct.get_atoms())
-                logger.info("RMS(reference, model {!s}) = {:f}".format(alt_struct.id, super_imposer.rms))
             except Exception as msg:
                 logger.error("Failed to superpose structures {} and {}\n{}".format(self.ref_struct.id, alt_struct.id, msg))
+                continue
+            if len(ref) < 3:
+                logger.error("Failed to superpose structures {} and {}\nNot enough matching atoms".format(self.ref_struct.id, alt_struct.id))
+                continue
+            fit_structs.append(alt_struct)
+            atom_set_pairs.append((ref, alt))
+
+        for alt_struct, (rot, tran, rms) in zip(fit_structs, superpose_atom_sets(atom_set_pairs)):
+            transform_atoms(alt_struct.get_atoms(), rot, tran)
+            logger.info("RMS(reference, model {!s}) = {:f}".format(alt_struct.id, rms))
 
         return self.alt_structs
 
@@ -81,6 +164,7 @@ class FragmentSuperpose(object):
             self.target = Protein.objects.get(pk=gn_assigner.prot_id_list[0])
         else:
             self.target = Protein.objects.get(pk=self.identify_receptor())
+        self.ref_residues = BackboneSelector.get_residue_index(self.pdb_struct)
 
 
     def parse_pdb (self):
@@ -127,22 +211,36 @@ class FragmentSuperpose(object):
         else:
             fragments = self.get_all_fragments()
 
+        atom_set_pairs = []
         for fragment in fragments:
-            atom_sel = BackboneSelector(self.pdb_struct, fragment, use_similar)
-            if atom_sel.get_ref_atoms() == []:
-                continue
-            super_imposer = Superimposer()
             try:
-                fragment_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('alt', StringIO(fragment.get_pdbdata()))[0]
-                super_imposer.set_atoms(atom_sel.get_ref_atoms(), atom_sel.get_alt_atoms())
-                super_imposer.apply(fragment_struct)
-                superposed_frags.append([fragment,fragment_struct])
+                #atoms are only read for the fit, the transformation is applied to a copy of the cached structure
+                fragment_struct = self.get_fragment_structure(fragment)
+                atom_sel = BackboneSelector(self.pdb_struct, fragment, use_similar, fragment_struct, self.ref_residues)
+                if atom_sel.get_ref_atoms() == []:
+                    continue
+                if len(atom_sel.get_ref_atoms()) != len(atom_sel.get_alt_atoms()):
+                    raise ValueError('Different number of atoms in the reference and the fragment')
+                superposed_frags.append([fragment,fragment_struct.copy()])
+                atom_set_pairs.append((atom_sel.get_ref_atoms(), atom_sel.get_alt_atoms()))
             except Exception as msg:
                 logger.error('Failed to superpose fragment {!s} with structure {!s}\nDebug message: {!s}'.format(fragment, self.pdb_filename, msg))
+
+        for (fragment, fragment_struct), (rot, tran, rms) in zip(superposed_frags, superpose_atom_sets(atom_set_pairs)):
+            transform_atoms(fragment_struct.get_atoms(), rot, tran)
         logger.info("Number of superimposed fragments: {}".format(len(superposed_frags)))
         return superposed_frags
 
 
+    def get_fragment_structure(self, fragment):
+
+        if fragment.id not in fragment_structure_cache:
+            if len(fragment_structure_cache) >= FRAGMENT_CACHE_SIZE:
+                fragment_structure_cache.popitem(last=False)
+            fragment_structure_cache[fragment.id] = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('alt', StringIO(fragment.get_pdbdata()))[0]
+        return fragment_structure_cache[fragment.id]
+
+
     def get_representative_fragments(self, state):
 
         template = get_segment_template(self.target, state)
@@ -1,3 +1,118 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from structure import functions
+from structure.functions import BlastSearch
+from structure.structural_superposition import ProteinSuperpose
+
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+import math
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+
+GENERIC_NUMBERS = [1.50, 1.51, 1.52, 1.53]
+
+
+def pdb_file(amino_acid, bfactor=None, shift=0.0):
+    """PDB file of CA atoms, B-factors hold the generic numbers when bfactor is None"""
+    lines = []
+    for i, gn in enumerate(GENERIC_NUMBERS):
+        lines.append('ATOM  {:5d}  CA  {} A{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00{:6.2f}           C'.format(
+            i + 1, amino_acid, i + 1, 3.8 * i + shift, 1.5 * (i % 2), 0.5 * i * i, gn if bfactor is None else bfactor))
+    lines.append('END')
+    return StringIO('\n'.join(lines) + '\n')
+
+
+class FakeGenericNumbering(object):
+    """Assigns the generic numbers by residue order instead of with a BLAST search"""
+
+    def __init__(self, structure=None):
+        self.structure = structure
+        self.pdb_seq = {'A': 'AAAA'}
+        self.blast = self
+
+    def run_batch(self, sequences):
+        return [None] * len(sequences)
+
+    def assign_generic_numbers(self, alignments=None):
+        for residue, gn in zip(self.structure.get_residues(), GENERIC_NUMBERS):
+            residue['CA'].set_bfactor(gn)
+        return self.structure
+
+
+class ProteinSuperposeTest(SimpleTestCase):
+
+    def setUp(self):
+        self.selection = SimpleNamespace(segments=[SimpleNamespace(type='residue',
+            item=SimpleNamespace(label='{:.2f}'.format(gn).replace('.', 'x'))) for gn in GENERIC_NUMBERS])
+
+    @mock.patch('structure.structural_superposition.GenericNumbering', FakeGenericNumbering)
+    def test_mixed_batch_keeps_input_order(self):
+        # a structure without generic numbers between two numbered ones
+        alt_files = [pdb_file('ALA', shift=1.0), pdb_file('GLY', bfactor=20.0, shift=2.0), pdb_file('SER', shift=3.0)]
+        superposition = ProteinSuperpose(pdb_file('VAL'), alt_files, self.selection)
+        out_structs = superposition.run()
+
+        self.assertEqual([s.id for s in out_structs], [0, 1, 2])
+        self.assertEqual([next(s.get_residues()).get_resname() for s in out_structs], ['ALA', 'GLY', 'SER'])
+        for s in out_structs:
+            ca = next(s.get_atoms()).get_coord()
+            self.assertAlmostEqual(float(ca[0]), 0.0, places=2)
+
+
+@skipUnless(shutil.which('blastp') and shutil.which('makeblastdb'), 'BLAST+ is not installed')
+class BlastSearchTest(SimpleTestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.sequences = [''.join(rng.choice('ACDEFGHIKLMNPQRSTVWY') for i in range(120)) for j in range(5)]
+        # a query found in one database sequence, with a few differences to another one
+        self.query = self.sequences[2][20:100]
+        self.sequences[3] = self.sequences[2][:40] + 'W' + self.sequences[2][41:70] + 'C' + self.sequences[2][71:]
+        self.tmp_dir = tempfile.mkdtemp()
+        self.blastdb = os.path.join(self.tmp_dir, 'test_blastdb')
+        self.make_database(['seq{}'.format(i) for i in range(len(self.sequences))])
+        functions.blast_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        functions.blast_cache.clear()
+
+    def make_database(self, ids):
+        """Builds the database as build_blast_database does, with its FASTA file next to it"""
+        with open(self.blastdb + '.fasta', 'w') as f:
+            f.write(''.join('>{}\n{}\n'.format(seqid, seq) for seqid, seq in zip(ids, self.sequences)))
+        subprocess.check_call(['makeblastdb', '-in', self.blastdb + '.fasta', '-dbtype', 'prot', '-parse_seqids',
+            '-out', self.blastdb], stdout=subprocess.DEVNULL)
+
+    def test_exact_match_same_as_full_search(self):
+        blast = BlastSearch(blastdb=self.blastdb)
+        self.assertEqual(blast.find_exact_match(self.query), 'seq2')
+
+        full = blast.run_blast([self.query])[0]
+        prefiltered = blast.run_batch([self.query])[0]
+        self.assertEqual(prefiltered[0][0], full[0][0])
+        self.assertEqual(prefiltered[0][1].hsps[0].score, full[0][1].hsps[0].score)
+        # the limited search is given the size of the whole database for its E values
+        self.assertTrue(math.isclose(prefiltered[0][1].hsps[0].expect, full[0][1].hsps[0].expect, rel_tol=1e-2))
+
+    def test_rebuilt_database_invalidates_cache(self):
+        blast = BlastSearch(blastdb=self.blastdb)
+        before = blast.run_batch([self.query])[0]
+        self.assertEqual(blast.run_batch([self.query])[0], before)
+        self.assertIn((self.blastdb, blast.get_database_version(), 1, self.query), functions.blast_cache)
+
+        version = blast.get_database_version()
+        self.make_database(['new{}'.format(i) for i in range(len(self.sequences))])
+        for extension in ['.pin', '.fasta']:
+            os.utime(self.blastdb + extension, (version + 10, version + 10))
+
+        after = blast.run_batch([self.query])[0]
+        self.assertNotEqual(after[0][0], before[0][0])
+        self.assertEqual(after[0][0], blast.run_blast([self.query])[0][0][0])
+        self.assertIn('new2', after[0][0] + after[0][1].hit_def)
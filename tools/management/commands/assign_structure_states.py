@@ -1,13 +1,12 @@
 from django.core.management.base import BaseCommand
 from django.contrib.postgres.aggregates import ArrayAgg
-from django.db.models import Max, Min
 
-from contactnetwork.distances import Distance, Distances
-from contactnetwork.models import distance_scaling_factor
+from contactnetwork.distances import Distances
+from contactnetwork.models import get_pair_distances
 from protein.models import ProteinFamily, ProteinState
 from residue.models import Residue
 from signprot.models import SignprotComplex
-from structure.models import Structure
+from structure.models import Structure, StructureSummary
 
 import logging
 import pandas as pd
@@ -68,13 +67,9 @@ class Command(BaseCommand):
                 class_pair_inactives['005'] = ["2x47_6x37", 1000] #D PLACEHOLDER
                 class_pair_inactives['006'] = ["2x44_6x31", 13] #F
 
-                inactive_ids = list(Distance.objects.filter(distance__lt=class_pair_inactives[slug[0]][1]*distance_scaling_factor) \
-                                    .filter(gns_pair=class_pair_inactives[slug[0]][0]) \
-                                    .filter(structure__pdb_code__index__in=structure_ids) \
-                                    .exclude(structure__pdb_code__index__in=active_ids) \
-                                    .values_list("structure__pdb_code__index"))
-
-                inactive_ids = [x[0] for x in inactive_ids if x[0][0].isnumeric()]
+                class_pair_distances = get_pair_distances(class_pair_inactives[slug[0]][0], structure_ids)
+                inactive_ids = [pdb for pdb, distance in class_pair_distances.items() \
+                                    if distance < class_pair_inactives[slug[0]][1] and pdb not in active_ids and pdb[0].isnumeric()]
 
                 # HARDCODED INACTIVE STRUCTURES
                 if slug[0] == "004":
@@ -141,18 +136,11 @@ class Command(BaseCommand):
 
                     # Percentage score for TM2-TM6 opening
                     #range_distance = Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                    range_distance = Distance.objects.filter(gns_pair=class_pair_inactives[slug[0]][0]) \
-                                        .filter(structure__pdb_code__index__in=structure_ids) \
-                                        .aggregate(Max('distance'), Min('distance'))
-
-                    min_open = range_distance['distance__min']
-                    max_open = range_distance['distance__max']
+                    min_open = min(class_pair_distances.values(), default=0)
+                    max_open = max(class_pair_distances.values(), default=0)
 
                     #distances = list(Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                    distances = list(Distance.objects.filter(gns_pair=class_pair_inactives[slug[0]][0]) \
-                                        .filter(structure__pdb_code__index__in=structure_ids) \
-                                        .distinct("gns_pair", "structure") \
-                                        .values_list("structure__pdb_code__index", "distance"))
+                    distances = list(class_pair_distances.items())
 
                     opening_percentage = {}
                     for entry in distances:
@@ -215,16 +203,12 @@ class Command(BaseCommand):
                         struct.gprot_bound_likeness = gprot_likeness
                         struct.save()
                 elif len(structure_ids) > 0:
-                    distances = list(Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                                        .filter(structure__pdb_code__index__in=structure_ids) \
-                                        .distinct("gns_pair", "structure") \
-                                        .values_list("structure__pdb_code__index", "distance"))
+                    distances = list(get_pair_distances("2x46_6x37", structure_ids).items())
 
-                    range_distance = Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                                        .aggregate(Max('distance'), Min('distance'))
+                    range_distance = get_pair_distances("2x46_6x37").values()
 
-                    min_open = range_distance['distance__min']
-                    max_open = range_distance['distance__max']
+                    min_open = min(range_distance, default=0)
+                    max_open = max(range_distance, default=0)
                     for entry in distances:
                         # Percentage score
                         percentage = int(round((entry[1]-min_open)/(max_open-min_open)*100))
@@ -238,7 +222,7 @@ class Command(BaseCommand):
                         struct.tm6_angle = percentage
 
                         # Definitely an inactive state structure When distance is smaller than 13Å
-                        if entry[1] < 13*distance_scaling_factor:
+                        if entry[1] < 13:
                             struct.state = ProteinState.objects.get_or_create(slug="inactive", defaults={'name': "Inactive"})[0]
 
                         # UGLY: knowledge-based hardcoded corrections
@@ -249,6 +233,10 @@ class Command(BaseCommand):
                         # Save changes
                         struct.save()
 
+        # the states are part of the structure API summaries
+        if class_slugs:
+            StructureSummary.refresh(Structure.objects.filter(protein_conformation__protein__family__slug__startswith="00"))
+
         self.logger.info("DONE assiging the \"Degree Active\" levels and activation states")
 
         if not options["states_only"]:
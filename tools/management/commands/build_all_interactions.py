@@ -6,8 +6,10 @@ from django.db import connection
 from structure.models import Structure
 
 from contactnetwork.cube import *
+from contactnetwork.contacts import build_contact_index
 
-import logging, json, os
+from multiprocessing import Value
+import logging, json, os, time
 
 class Command(BaseBuild):
 
@@ -15,6 +17,7 @@ class Command(BaseBuild):
 
     logger = logging.getLogger(__name__)
     pdbs = Structure.objects.all().values_list('pdb_code__index', flat=True)
+    label = 'ALL'
 
 
     def add_arguments(self, parser):
@@ -24,23 +27,54 @@ class Command(BaseBuild):
             dest='proc',
             default=1,
             help='Number of processes to run')
+        parser.add_argument('--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Also recalculate structures whose coordinates did not change since the last calculation')
 
     def handle(self, *args, **options):
+        self.force = options['force']
+        self.pdbs = list(self.pdbs)
+        self.computed = Value('i', 0)
+        self.skipped = Value('i', 0)
+        self.failed = Value('i', 0)
+
+        start = time.time()
         try:
-            self.logger.info('CREATING ALL INTERACTIONS')
+            self.logger.info('CREATING {} INTERACTIONS'.format(self.label))
             self.prepare_input(options['proc'], self.pdbs)
         except Exception as msg:
             print(msg)
             self.logger.error(msg)
-        self.logger.info('COMPLETED ALL INTERACTIONS')
+        elapsed = time.time() - start
+
+        throughput = 'Processed {} structures ({} computed, {} unchanged, {} failed) in {:.1f}s - {:.2f} structures/s'.format(
+            len(self.pdbs), self.computed.value, self.skipped.value, self.failed.value, elapsed, len(self.pdbs)/elapsed if elapsed else 0)
+        print(throughput)
+        self.logger.info(throughput)
+        self.logger.info('COMPLETED {} INTERACTIONS'.format(self.label))
 
     def main_func(self, positions, iteration,count,lock):
         pdbs = self.pdbs
         while count.value<len(pdbs):
             with lock:
-                pdb = pdbs[count.value]
-                count.value +=1
+                if count.value<len(pdbs):
+                    pdb = pdbs[count.value]
+                    count.value +=1
+                else:
+                    break
             try:
-                compute_interactions(pdb, True)
+                if not self.force and interactions_up_to_date(pdb):
+                    # the generic numbers of the residues may have changed, rebuild the contact index from the
+                    # stored interactions (compute_interactions rebuilds it with the interactions)
+                    build_contact_index(Structure.objects.get(protein_conformation__protein__entry_name=pdb.lower()))
+                    counter = self.skipped
+                else:
+                    compute_interactions(pdb, True)
+                    counter = self.computed
             except:
                 print('Issue making interactions for',pdb)
+                counter = self.failed
+            with lock:
+                counter.value += 1
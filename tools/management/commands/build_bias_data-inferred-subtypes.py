@@ -6,6 +6,7 @@ import os
 from build.management.commands.base_build import Command as BaseBuild
 from protein.models import ProteinGProteinPair
 from ligand.models import BiasedExperiment, AnalyzedExperiment, AnalyzedAssay
+from ligand.functions import build_bias_browser_entries
 from django.conf import settings
 
 
@@ -108,6 +109,8 @@ class Command(BaseBuild):
         # save dataset to model
         self.save_data_to_model(context, 'sub_different_family')
         print('stage # 12: saving data to model is finished')
+        build_bias_browser_entries('sub_different_family')
+        print('stage # 13: building the bias browser table is finished')
 
     def get_from_model(self):
         try:
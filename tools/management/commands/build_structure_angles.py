@@ -5,7 +5,7 @@ import contactnetwork.pdb as pdb
 from structure.models import Structure, StructureVectors
 from residue.models import Residue
 from angles.models import ResidueAngle as Angle
-from contactnetwork.models import Distance, distance_scaling_factor
+from contactnetwork.models import StructureDistanceMatrix
 
 import Bio.PDB
 import copy
@@ -21,6 +21,7 @@ import traceback
 import numpy as np
 import scipy.stats as stats
 
+from scipy.spatial.distance import pdist
 from scipy.spatial.transform import Rotation as R
 from collections import OrderedDict
 from sklearn.decomposition import PCA
@@ -284,9 +285,9 @@ class Command(BaseCommand):
             self.references = Structure.objects.all().exclude(id__in=done_structures).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
         else:
             Angle.objects.all().delete()
-            Distance.objects.all().delete()
+            StructureDistanceMatrix.objects.all().delete()
             StructureVectors.objects.all().delete()
-            print("All Angle, Distance, and StructureVector data cleaned")
+            print("All Angle, StructureDistanceMatrix, and StructureVector data cleaned")
             self.references = Structure.objects.all().prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
 
         # DEBUG for a specific PDB
@@ -1223,28 +1224,19 @@ class Command(BaseCommand):
                 # print("pseudo mid, pos=[", center_tm1[0], ",", center_tm1[1], ",", center_tm1[2] ,"];")
                 # print(rotation_angles[key_tm1])
 
-                # triangular matrix for distances
-                up_ind = np.triu_indices(len(gns_ca_list), 1)
-                bulk_distances = []
-
-                for i1, i2 in zip(up_ind[0], up_ind[1]):
-                    key1 = gns_ids_list[i1]
-                    key2 = gns_ids_list[i2]
-                    res1 = full_resdict[str(key1)]
-                    res2 = full_resdict[str(key2)]
-
-                    ca_dist = int(np.linalg.norm(gns_ca_list[key1] - gns_ca_list[key2])*distance_scaling_factor)
-                    cb_dist = int(np.linalg.norm(gns_cb_list[key1] - gns_cb_list[key2])*distance_scaling_factor)
-                    center_dist = None
-                    if key1 in gns_center_list and key2 in gns_center_list:
-                        center_dist = int(np.linalg.norm(gns_center_list[key1] - gns_center_list[key2])*distance_scaling_factor)
-
-                    # residues in gn_reslist, structure in structure
-                    distance = Distance(distance = ca_dist, distance_cb = cb_dist, distance_helix_center = center_dist, res1=res1, res2=res2, gn1=res1.generic_number.label, gn2=res2.generic_number.label, gns_pair='_'.join([res1.generic_number.label, res2.generic_number.label]), structure=reference)
-                    bulk_distances.append(distance)
-
-                # Bulk insert
-                Distance.objects.bulk_create(bulk_distances, batch_size=5000)
+                # Packed triangular matrices for distances
+                gns_reslist = [full_resdict[str(key)] for key in gns_ids_list]
+                ca_coords = np.array([gns_ca_list[key] for key in gns_ids_list], dtype=float)
+                cb_coords = np.array([gns_cb_list[key] for key in gns_ids_list], dtype=float)
+                center_coords = np.array([gns_center_list[key] if key in gns_center_list else [np.nan]*3 for key in gns_ids_list], dtype=float)
+
+                StructureDistanceMatrix.objects.update_or_create(structure=reference, defaults={
+                    'generic_numbers': ','.join([res.generic_number.label for res in gns_reslist]),
+                    'amino_acids': ''.join([res.amino_acid for res in gns_reslist]),
+                    'distances_ca': StructureDistanceMatrix.pack(pdist(ca_coords)),
+                    'distances_cb': StructureDistanceMatrix.pack(pdist(cb_coords)),
+                    'distances_helix_center': StructureDistanceMatrix.pack(pdist(center_coords)),
+                })
 
                 ### ANGLES
                 # Center axis to helix axis to CA
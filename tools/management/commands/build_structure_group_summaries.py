@@ -0,0 +1,76 @@
+from build.management.commands.base_build import Command as BaseBuild
+from django.db.models import Max
+from django.db.models.functions import MD5
+
+from angles.models import ResidueAngle, ResidueAngleSummary, summarize_angles
+from contactnetwork.models import StructureDistanceMatrix, DistanceMatrixSummary, summarize_distance_matrices
+from structure.models import Structure, get_structure_groups
+
+import hashlib
+import logging
+
+import numpy as np
+
+
+class Command(BaseBuild):
+
+    help = 'Builds the mergeable angle and distance statistics of the structures of each receptor and state'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Also rebuild the summaries of groups whose structures and data did not change')
+
+    def handle(self, *args, **options):
+        self.groups = get_structure_groups()
+
+        # The angle rows of a structure get new ids when they are rebuilt, so the ids identify the angles a summary was
+        # computed from. Distance matrices are updated in place, they are identified by a digest of their content.
+        matrix_digests = StructureDistanceMatrix.objects.values_list('structure_id', MD5('generic_numbers'),
+            MD5('amino_acids'), MD5('distances_ca'), MD5('distances_cb'), MD5('distances_helix_center'))
+        sources = {
+            'ResidueAngleSummary': dict(ResidueAngle.objects.values('structure_id').annotate(last_id=Max('id')).values_list('structure_id', 'last_id')),
+            'DistanceMatrixSummary': {digests[0]: '/'.join(digests[1:]) for digests in matrix_digests},
+        }
+
+        jobs = []
+        for model in [ResidueAngleSummary, DistanceMatrixSummary]:
+            stored = {(receptor, state): source_hash for receptor, state, source_hash in model.objects.values_list('receptor_id', 'state_id', 'source_hash')}
+            for receptor, state in stored:
+                if (receptor, state) not in self.groups:
+                    model.objects.filter(receptor_id=receptor, state_id=state).delete()
+
+            for (receptor, state), structure_ids in self.groups.items():
+                if receptor is None or state is None:
+                    continue
+                source_hash = self.get_source_hash(structure_ids, sources[model.__name__])
+                if options['force'] or stored.get((receptor, state)) != source_hash:
+                    jobs.append((model.__name__, receptor, state, source_hash))
+
+        self.logger.info('Building {} structure group summaries'.format(len(jobs)))
+        self.run_jobs(options['proc'], jobs, self.build_summary, options['resume'])
+
+    def get_source_hash(self, structure_ids, sources):
+        content = ','.join(['{}:{}'.format(pk, sources.get(pk)) for pk in sorted(structure_ids)])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def build_summary(self, item):
+        model_name, receptor, state, source_hash = item
+        structure_ids = sorted(self.groups[(receptor, state)])
+        defaults = {'structures': np.array(structure_ids, dtype=np.int32).tobytes(), 'source_hash': source_hash}
+
+        if model_name == 'ResidueAngleSummary':
+            gns, statistics = summarize_angles(structure_ids)
+            defaults.update({'generic_numbers': ','.join(gns), 'statistics': statistics.astype(np.float64).tobytes()})
+            ResidueAngleSummary.objects.update_or_create(receptor_id=receptor, state_id=state, defaults=defaults)
+        else:
+            pdbs = list(Structure.objects.filter(pk__in=structure_ids).values_list('pdb_code__index', flat=True))
+            gns, counts, sums, sum_squares = summarize_distance_matrices(pdbs)
+            defaults.update({'generic_numbers': ','.join(gns), 'counts': counts.tobytes(), 'sums': sums.tobytes(),
+                'sum_squares': sum_squares.tobytes()})
+            DistanceMatrixSummary.objects.update_or_create(receptor_id=receptor, state_id=state, defaults=defaults)
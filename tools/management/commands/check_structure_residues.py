@@ -1,13 +1,14 @@
 from build.management.commands.base_build import Command as BaseBuild
 from django.conf import settings
 from django.db import connection
-from django.db.models import Count
 
 from protein.models import Protein, ProteinConformation, ProteinAnomaly, ProteinState, ProteinSegment
 from residue.models import Residue, ResidueGenericNumber
 from structure.models import *
+from contactnetwork.models import StructureDistanceMatrix, distance_matrix_missing
 
 from collections import OrderedDict
+import numpy as np
 import os
 import logging
 import sys
@@ -24,7 +25,7 @@ class Command(BaseBuild):
         parser.add_argument('--verbose', help='Print specific outliers', default=False, action='store_true')
         
     def handle(self, *args, **options):
-        structures = Structure.objects.all().prefetch_related('protein_conformation__protein__parent','pdb_code').annotate(dc=Count('distances'))
+        structures = Structure.objects.all().prefetch_related('protein_conformation__protein__parent','pdb_code')
         structures_with_issue = []
         missing_helices = {}
         segments_query_obj = ProteinSegment.objects.filter(proteinfamily="GPCR")
@@ -42,6 +43,10 @@ class Command(BaseBuild):
             s_gn = resis.exclude(display_generic_number=None).count()
             fraction = s_gn / wt_gn
 
+            # number of stored residue pair distances
+            distances_ca = StructureDistanceMatrix.objects.filter(structure=s).values_list('distances_ca', flat=True).first()
+            dc = np.count_nonzero(np.frombuffer(distances_ca, dtype=np.uint16)!=distance_matrix_missing) if distances_ca else 0
+
             s_gns = set(resis.exclude(display_generic_number=None).all().values_list('generic_number__label',flat=True))
             missing_gns = all_gns-s_gns
             for gn in missing_gns:
@@ -50,7 +55,7 @@ class Command(BaseBuild):
                 missing_gns_count[gn]['count'] += 1
                 missing_gns_count[gn]['pdbs'].append(str(s))
 
-            print(s,"distances",s.dc,"WT residues",wt_resis.count(),"PDB residues",resis.count(),"WT GNs",wt_gn,"PDB GNs",s_gn,"Fraction",fraction)
+            print(s,"distances",dc,"WT residues",wt_resis.count(),"PDB residues",resis.count(),"WT GNs",wt_gn,"PDB GNs",s_gn,"Fraction",fraction)
             # print('missing gns',missing_gns)
             c = 0
             segments = OrderedDict((i,[]) for i in segments_query_obj)
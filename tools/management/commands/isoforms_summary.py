@@ -5,7 +5,7 @@ from django.db import connection
 from django.db.models import Q
 from django.template.loader import render_to_string
 from protein.models import *
-from common.tools import fetch_from_web_api
+from common.tools import fetch_all_from_web_api
 from Bio import pairwise2
 
 import time
@@ -77,6 +77,7 @@ class Command(BaseCommand):
                 # continue
             # print('WT SEQ',wt_seq==wt_seq2.replace("-",""))
             ranges = {}
+            isoform_infos = dict(zip(es, fetch_all_from_web_api(url, es, cache_dir)))
             for e in es:
                 iso_seq_msa = fasta[1+int(isoform_id)*2]
                 iso_seq_msa_corrected = ''
@@ -85,7 +86,7 @@ class Command(BaseCommand):
                         continue
                     iso_seq_msa_corrected += a
 
-                isoform_info = fetch_from_web_api(url, e, cache_dir)
+                isoform_info = isoform_infos[e]
                 if (isoform_info):
                     iso_seq = isoform_info['seq']
                     iso_check = iso_seq == iso_seq_msa.replace("-","")
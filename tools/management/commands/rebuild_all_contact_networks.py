@@ -63,7 +63,6 @@ class Command(BaseCommand):
     def purge_contact_network(self):
 
         InteractingResiduePair.truncate()
-        Distance.truncate()
         Interaction.truncate()
 
     def build_contact_network(self,s,pdb_code):
@@ -118,7 +117,7 @@ class Command(BaseCommand):
             # self.purge_contact_network(s)
             current = time.time()
             if self.update:
-                if Distance.objects.filter(structure=s).count():
+                if InteractingResiduePair.objects.filter(referenced_structure=s).count():
                     print(s,'already done - skipping')
                     continue
             try:
@@ -15,6 +15,7 @@ from structure.models import *
 # 5XRA Contact Network 10.246203184127808
 
 import time
+from collections import OrderedDict
 
 
 class Command(BaseCommand):
@@ -22,81 +23,54 @@ class Command(BaseCommand):
     help = "Test distances"
 
 
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[25, 50, 100, 200, 400, 800],
+                            help='Numbers of structures to benchmark with (the full set is always included)')
+
     def handle(self, *args, **options):
 
-        strucs = Structure.objects.all().prefetch_related('pdb_code')[:100]
+        strucs = Structure.objects.filter(distance_matrix__isnull=False).prefetch_related('pdb_code')
         ss = []
         for s in strucs:
             ss.append(s.pdb_code.index)
 
-        for i in [3,30,50,100,200,310]:
+        sizes = sorted(set([i for i in options['sizes'] if i < len(ss)] + [len(ss)]))
+        print("Timings in seconds (and per structure) for the distance pipelines, these should grow linearly")
+        print("except for the pairwise comparison in get_distance_matrix, which is quadratic by definition")
+
+        for i in sizes:
+            timings = OrderedDict()
+
             d = Distances()
             d.load_pdbs(ss[:i])
             current = time.time()
-            d.fetch_distances()
+            d.fetch_distances_tm()
             d.calculate()
-            print(i,'pdbs',time.time()-current, 'time spent with individual records')
-            del d
+            timings['fetch_distances_tm + calculate'] = time.time()-current
 
-            d = Distances()
-            d.load_pdbs(ss[:i])
             current = time.time()
             d.fetch_and_calculate(with_arr=True)
-            print(i,'pdbs',time.time()-current, 'time spent with individual records and calc (pure DB)')
-            del d
-
+            timings['fetch_and_calculate (with arrays)'] = time.time()-current
 
-            d = Distances()
-            d.load_pdbs(ss[:i])
             current = time.time()
             d.fetch_and_calculate()
-            print(i,'pdbs',time.time()-current, 'time spent with individual records and calc (without individual distances) (pure DB)')
-            del d
-
+            timings['fetch_and_calculate'] = time.time()-current
 
-            d = Distances()
-            d.load_pdbs(ss[:i])
             current = time.time()
             d.fetch_agg()
-            print(i,'pdbs',time.time()-current, 'time spent with individual records (semi DB)')
-            del d
-            
-
-            # d = Distances()
-            # d.load_pdbs(ss[:i])
-            # current = time.time()
-            # d.fetch_distances_set()
-            # print(i,'pdbs',time.time()-current, 'time spent with msg records')
-            # d.calculate()
-            # del d
-
-            # d = Distances()
-            # d.load_pdbs(ss[:i])
-            # current = time.time()
-            # d.fetch_distances_set_pickled()
-            # print(i,'pdbs',time.time()-current, 'time spent with pickle records')
-            # d.calculate()
-            # del d
-
-
-            # d = Distances()
-            # d.load_pdbs(ss[:i])
-            # current = time.time()
-            # d.fetch_distances_set_json()
-            # print(i,'pdbs',time.time()-current, 'time spent with json records')
-            # d.calculate()
-            # del d
-
-            # d = Distances()
-            # d.load_pdbs(ss[:i])
-            # current = time.time()
-            # d.fetch_distances_set_ujson()
-            # print(i,'pdbs',time.time()-current, 'time spent with ujson records')
-            # d.calculate()
-            # del d
+            timings['fetch_agg'] = time.time()-current
 
+            # Clustering views (get_distance_matrix)
+            current = time.time()
+            d.get_distance_matrix()
+            timings['get_distance_matrix'] = time.time()-current
+
+            d.filtered_gns = True
+            current = time.time()
+            d.get_distance_matrix(normalize = False)
+            timings['get_distance_matrix (lower TM, not normalized)'] = time.time()-current
+
+            for label, spent in timings.items():
+                print(i, 'pdbs', label, round(spent, 3), round(spent/i, 5))
             print("########")
-            # current = time.time()
-            # d.fetch_distances_set()
-            # print(i,'pdbs',time.time()-current, 'time spent with pickled records')
-            # d.calculate()
+            del d